@@ -45,6 +45,143 @@ DATABASES = {
     }
 }
 
+# Shared MongoDB client configuration used for raw database access
+MONGO_MAX_POOL_SIZE = 100
+MONGO_CONNECT_TIMEOUT_MS = 20000
+MONGO_SOCKET_TIMEOUT_MS = None
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 30000
+MONGO_WAIT_QUEUE_TIMEOUT_MS = None
+
+# Whether the indexes of the hot lookups are created on startup, otherwise they are only verified
+MONGO_ENSURE_INDEXES = True
+
+# Document locks: lease in seconds, retry backoff bounds and default wait timeout
+DOCUMENT_LOCK_LEASE = 300
+DOCUMENT_LOCK_BACKOFF = 0.05
+DOCUMENT_LOCK_MAX_BACKOFF = 2.0
+DOCUMENT_LOCK_TIMEOUT = None
+
+# Lease of the order lock shared by the payment confirmation and its timeout, it must be
+# longer than the worst case confirmation, including the payment gateway and charging calls
+ORDER_LOCK_LEASE = 1800
+
+# Usage documents retrieved per request and whether the Usage API supports filtering by product
+USAGE_PAGE_SIZE = 500
+USAGE_PRODUCT_FILTER = False
+
+# Asynchronous usage rating: concurrent requests, journal chunk size and retries
+USAGE_RATING_WORKERS = 8
+USAGE_RATING_CHUNK = 500
+USAGE_RATING_MAX_ATTEMPTS = 10
+USAGE_RATING_BACKOFF = 5
+
+# Seconds the rates of a usage charge not confirmed are kept in the rating journal
+USAGE_RATING_STAGE_TTL = 24 * 3600
+
+# Batch SDR ingestion: SDRs accepted per request and concurrent updates of the Usage API
+SDR_BATCH_MAX_RECORDS = 1000
+SDR_BATCH_WORKERS = 8
+
+# CDR outbox: CDRs sent per request and retries of failed deliveries
+CDR_BATCH_SIZE = 100
+CDR_MAX_ATTEMPTS = 10
+CDR_RETRY_BACKOFF = 30
+CDR_MAX_RETRY_BACKOFF = 3600
+
+# Invoice rendering backend, the PDF invoices are generated in background if INVOICE_ASYNC is enabled
+INVOICE_RENDERER = 'wstore.charging_engine.invoice_renderer.WkhtmltopdfRenderer'
+INVOICE_ASYNC = False
+INVOICE_RENDER_WORKERS = 2
+WKHTMLTOPDF_PATH = None
+INVOICE_XVFB_DISPLAY = ':98'
+INVOICE_XVFB_TIMEOUT = 10
+
+# Errors of the background tasks, e.g. invoice rendering and notifications, are logged to the console
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler'
+        }
+    },
+    'loggers': {
+        'wstore': {
+            'handlers': ['console'],
+            'level': 'INFO'
+        }
+    }
+}
+
+# Contracts loaded per batch and concurrent actions of the pending charges daemon
+PENDING_CHARGES_BATCH_SIZE = 100
+PENDING_CHARGES_WORKERS = 4
+
+# Outgoing mail queue: emails sent per connection, recipients per email and retries.
+# SMTP connections are pooled and closed after SMTP_IDLE_TIMEOUT seconds without use
+MAIL_BATCH_SIZE = 50
+MAIL_MAX_RECIPIENTS = 50
+MAIL_MAX_ATTEMPTS = 10
+MAIL_RETRY_BACKOFF = 60
+SMTP_POOL_SIZE = 2
+SMTP_IDLE_TIMEOUT = 60
+SMTP_TIMEOUT = 30
+
+# Asset uploads are written in chunks of ASSET_UPLOAD_CHUNK_SIZE bytes. If ASSET_HASH_ALGORITHM
+# is set (e.g. sha256) the hash of the uploaded files is computed while they are written
+ASSET_UPLOAD_CHUNK_SIZE = 1024 * 1024
+ASSET_HASH_ALGORITHM = None
+
+# Resumable uploads: seconds an upload session is kept without activity and maximum file size
+UPLOAD_SESSION_TTL = 24 * 3600
+UPLOAD_SESSION_MAX_SIZE = 10 * 1024 ** 3
+
+# Seconds between the renewals of the upload session lock while a chunk is written or
+# the upload is finalized, it must be lower than DOCUMENT_LOCK_LEASE
+UPLOAD_SESSION_LOCK_RENEWAL = 60
+
+# Shared HTTP session used by the API clients: connection pools (hosts and
+# connections per host), timeouts in seconds and retries of idempotent requests
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 20
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+HTTP_MAX_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.5
+
+# Maximum number of concurrent downloads of the catalog and billing info of an order
+ORDERING_DOWNLOAD_WORKERS = 8
+
+# Cache of the product offerings downloaded while processing orders, expired
+# offerings are revalidated with the catalog (time to live in seconds and max entries)
+OFFERING_CACHE_TTL = 60
+OFFERING_CACHE_SIZE = 500
+
+# Cache of the identities provided by the proxy that are already stored in the database
+IDENTITY_CACHE_TTL = 300
+IDENTITY_CACHE_SIZE = 1000
+
+# Cache of the asset accesses granted by the entitlement index
+ENTITLEMENT_CACHE_TTL = 60
+ENTITLEMENT_CACHE_SIZE = 1000
+
+# Durable deadline scheduler: handlers by kind, poll interval and claimed batch size
+DEADLINE_HANDLERS = {
+    'payment_timeout': 'wstore.charging_engine.charging_engine.payment_timeout_handler',
+    'asset_upgrade_timeout': 'wstore.asset_manager.asset_manager.upgrade_timeout_handler',
+    'usage_rating': 'wstore.charging_engine.accounting.usage_rater.usage_rating_handler',
+    'cdr_dispatch': 'wstore.rss_adaptor.cdr_outbox.cdr_dispatch_handler',
+    'mail_dispatch': 'wstore.admin.users.mail_queue.mail_dispatch_handler',
+    'upload_session_expiry': 'wstore.asset_manager.upload_session.upload_session_expiry_handler'
+}
+DEADLINE_SCHEDULER_ENABLED = True
+DEADLINE_POLL_INTERVAL = 5
+DEADLINE_BATCH_SIZE = 50
+DEADLINE_LEASE = 300
+DEADLINE_MAX_ATTEMPTS = 5
+DEADLINE_RETRY_DELAY = 60
+
 BASEDIR = path.dirname(path.abspath(__file__))
 
 STORE_NAME = 'WStore'
@@ -206,6 +343,13 @@ DATABASES['default']['USER'] = environ.get('BAE_CB_MONGO_USER', DATABASES['defau
 DATABASES['default']['PASSWORD'] = environ.get('BAE_CB_MONGO_PASS', DATABASES['default']['PASSWORD'])
 DATABASES['default']['HOST'] = environ.get('BAE_CB_MONGO_SERVER', DATABASES['default']['HOST'])
 DATABASES['default']['PORT'] = environ.get('BAE_CB_MONGO_PORT', DATABASES['default']['PORT'])
+MONGO_MAX_POOL_SIZE = int(environ.get('BAE_CB_MONGO_MAX_POOL_SIZE', MONGO_MAX_POOL_SIZE))
+MONGO_ENSURE_INDEXES = environ.get('BAE_CB_MONGO_ENSURE_INDEXES', MONGO_ENSURE_INDEXES)
+if isinstance(MONGO_ENSURE_INDEXES, str) or isinstance(MONGO_ENSURE_INDEXES, unicode):
+    MONGO_ENSURE_INDEXES = MONGO_ENSURE_INDEXES == 'True'
+DEADLINE_SCHEDULER_ENABLED = environ.get('BAE_CB_DEADLINE_SCHEDULER', DEADLINE_SCHEDULER_ENABLED)
+if isinstance(DEADLINE_SCHEDULER_ENABLED, str) or isinstance(DEADLINE_SCHEDULER_ENABLED, unicode):
+    DEADLINE_SCHEDULER_ENABLED = DEADLINE_SCHEDULER_ENABLED == 'True'
 
 ADMIN_ROLE = environ.get('BAE_LP_OAUTH2_ADMIN_ROLE', ADMIN_ROLE)
 PROVIDER_ROLE = environ.get('BAE_LP_OAUTH2_SELLER_ROLE', PROVIDER_ROLE)
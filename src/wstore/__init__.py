@@ -29,6 +29,8 @@ from wstore.models import Context
 from wstore.store_commons.utils.url import is_valid_url
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.rss_adaptor.rss_manager import ProviderManager
+from wstore.store_commons.indexes import ensure_indexes, get_missing_indexes
+from wstore.store_commons.scheduler import get_scheduler
 
 
 testing = sys.argv[1:2] == ['test']
@@ -62,3 +64,15 @@ if not testing:
     except Exception as e:  # If the error is a conflict means that the aggregator is already registered
         if e.response.status_code != 409:
             raise e
+
+    # Verify the indexes used by the hot lookups
+    if settings.MONGO_ENSURE_INDEXES:
+        ensure_indexes()
+    else:
+        for collection, keys in get_missing_indexes():
+            sys.stderr.write('Missing index in {}: {}. Run the ensure_indexes command\n'.format(
+                collection, ', '.join([field for field, direction in keys])))
+
+    # Start processing the deadlines pending from previous executions
+    if settings.DEADLINE_SCHEDULER_ENABLED:
+        get_scheduler().start()
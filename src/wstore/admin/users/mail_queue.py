@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import os
+import smtplib
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+
+from django.conf import settings
+
+from wstore.store_commons.database import get_database_connection, DistributedLock
+from wstore.store_commons.scheduler import schedule_deadline
+
+
+MAIL_COLLECTION = 'wstore_mail_queue'
+DISPATCH_DEADLINE = 'mail_dispatch'
+
+
+class _SMTPConnectionPool(object):
+    """
+    Process wide pool of authenticated SMTP connections, so the TLS handshake
+    and the login are not made for every email
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = None
+
+    def _check_fork(self):
+        # Connections opened by the parent process are not reused
+        if self._pid != os.getpid():
+            self._idle = []
+            self._pid = os.getpid()
+
+    def _close(self, server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, socket.error):
+            server.close()
+
+    def _connect(self):
+        server = smtplib.SMTP(settings.SMTPSERVER, int(settings.SMTPPORT), timeout=getattr(settings, 'SMTP_TIMEOUT', 30))
+        server.starttls()
+        server.login(settings.WSTOREMAILUSER, settings.WSTOREMAILPASS)
+        return server
+
+    def acquire(self):
+        idle_timeout = getattr(settings, 'SMTP_IDLE_TIMEOUT', 60)
+        expired = []
+        server = None
+
+        with self._lock:
+            self._check_fork()
+
+            while server is None and len(self._idle):
+                candidate, last_used = self._idle.pop()
+
+                # SMTP servers close idle connections, so they are not reused after a while
+                if time.time() - last_used < idle_timeout:
+                    server = candidate
+                else:
+                    expired.append(candidate)
+
+        for candidate in expired:
+            self._close(candidate)
+
+        return server if server is not None else self._connect()
+
+    def release(self, server, discard=False):
+        with self._lock:
+            self._check_fork()
+
+            if not discard and len(self._idle) < getattr(settings, 'SMTP_POOL_SIZE', 2):
+                self._idle.append((server, time.time()))
+                return
+
+        self._close(server)
+
+
+_smtp_pool = _SMTPConnectionPool()
+
+
+class MailQueue(object):
+    """
+    Persisted queue of outgoing emails. Emails are sent in background by a single
+    dispatcher that reuses the pooled SMTP connections, retrying failed deliveries
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection()[MAIL_COLLECTION]
+        self._collection.create_index([('state', ASCENDING), ('next_attempt', ASCENDING)])
+
+    def _schedule_dispatch(self, delay=0):
+        schedule_deadline(DISPATCH_DEADLINE, 'queue', delay)
+
+    def enqueue(self, sender, recipients, message):
+        """
+        Saves an email in the queue and schedules its delivery
+        :param sender: Address of the sender
+        :param recipients: List of recipient addresses
+        :param message: Serialized MIME message
+        """
+        if not len(recipients):
+            return
+
+        now = datetime.utcnow()
+        max_recipients = getattr(settings, 'MAIL_MAX_RECIPIENTS', 50)
+
+        # Recipients are sent in batches in order not to exceed the limits of the server
+        self._collection.insert_many([{
+            'sender': sender,
+            'recipients': recipients[i:i + max_recipients],
+            'message': message,
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': now,
+            'created': now
+        } for i in range(0, len(recipients), max_recipients)], ordered=False)
+
+        self._schedule_dispatch()
+
+    def _discard(self, mail, error):
+        self._collection.update_one({'_id': mail['_id']}, {
+            '$set': {'state': 'failed', 'error': unicode(error)}
+        })
+
+    def _failed(self, mail, error):
+        attempts = mail['attempts'] + 1
+        update = {
+            'attempts': attempts,
+            'error': unicode(error)
+        }
+
+        if attempts < getattr(settings, 'MAIL_MAX_ATTEMPTS', 10):
+            # Exponential backoff between attempts
+            backoff = getattr(settings, 'MAIL_RETRY_BACKOFF', 60) * (2 ** (attempts - 1))
+            update['next_attempt'] = datetime.utcnow() + timedelta(seconds=backoff)
+        else:
+            update['state'] = 'failed'
+
+        self._collection.update_one({'_id': mail['_id']}, {'$set': update})
+
+    def _send_batch(self, mails):
+        """
+        Sends a batch of emails using a single SMTP connection
+        :return: False if the connection with the SMTP server failed
+        """
+        try:
+            server = _smtp_pool.acquire()
+        except (smtplib.SMTPException, socket.error) as e:
+            for mail in mails:
+                self._failed(mail, e)
+            return False
+
+        sent = []
+        connected = True
+        for i, mail in enumerate(mails):
+            try:
+                server.sendmail(mail['sender'], mail['recipients'], mail['message'])
+            except smtplib.SMTPRecipientsRefused as e:
+                self._discard(mail, e)
+            except smtplib.SMTPResponseException as e:
+                # Permanent errors are not retried
+                if e.smtp_code >= 500:
+                    self._discard(mail, e)
+                else:
+                    self._failed(mail, e)
+            except (smtplib.SMTPException, socket.error) as e:
+                # The connection is broken, the rest of the batch is retried later
+                for failed in mails[i:]:
+                    self._failed(failed, e)
+
+                connected = False
+                break
+            else:
+                sent.append(mail['_id'])
+
+        _smtp_pool.release(server, discard=not connected)
+
+        if len(sent):
+            self._collection.delete_many({'_id': {'$in': sent}})
+
+        return connected
+
+    def dispatch(self):
+        """
+        Sends the pending emails in batches until there are not emails ready to be sent
+        :return: Number of seconds until the next retry, None if the queue is empty
+        """
+        lock = DistributedLock(MAIL_COLLECTION, 'dispatcher', '_lock', create=True)
+
+        # Other process is dispatching, check again later in case it has already
+        # read the queue when new emails were included
+        if not lock.acquire(blocking=False):
+            return getattr(settings, 'DEADLINE_POLL_INTERVAL', 5)
+
+        batch_size = getattr(settings, 'MAIL_BATCH_SIZE', 50)
+        try:
+            connected = True
+            while connected:
+                mails = list(self._collection.find({
+                    'state': 'pending',
+                    'next_attempt': {'$lte': datetime.utcnow()}
+                }).sort([('next_attempt', ASCENDING)]).limit(batch_size))
+
+                if not len(mails):
+                    break
+
+                connected = self._send_batch(mails)
+                lock.renew()
+        finally:
+            lock.release()
+
+        next_mail = self._collection.find_one({'state': 'pending'}, sort=[('next_attempt', ASCENDING)])
+
+        if next_mail is None:
+            return None
+
+        return max((next_mail['next_attempt'] - datetime.utcnow()).total_seconds(), 0)
+
+
+def mail_dispatch_handler(ref, data):
+    """
+    Deadline handler that sends the emails of the queue
+    """
+    queue = MailQueue()
+    delay = queue.dispatch()
+
+    if delay is not None:
+        queue._schedule_dispatch(delay)
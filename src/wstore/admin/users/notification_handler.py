@@ -22,7 +22,6 @@
 from __future__ import unicode_literals
 
 import os
-import smtplib
 from email import encoders
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -32,7 +31,8 @@ from urlparse import urljoin
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
-from wstore.models import User
+from wstore.admin.users.mail_queue import MailQueue
+from wstore.admin.users.recipient_resolver import RecipientResolver
 
 
 class NotificationsHandler:
@@ -48,12 +48,19 @@ class NotificationsHandler:
         if not len(self._mailuser) or not len(self._password) or not len(self._fromaddr) or not len(self._server):
             raise ImproperlyConfigured('Missing email configuration')
 
-    def _send_email(self, recipient, msg):
-        server = smtplib.SMTP(self._server, self._port)
-        server.starttls()
-        server.login(self._mailuser, self._password)
+        # Users are cached for the lifetime of the handler
+        self._recipients = RecipientResolver()
+
+    def prefetch_recipients(self, orders):
+        """
+        Retrieves with a single query the managers of the organizations of a batch of orders
+        :param orders: Orders whose customers are going to be notified
+        """
+        self._recipients.prefetch('pk', [pk for order in orders for pk in order.owner_organization.managers])
 
-        server.sendmail(self._fromaddr, recipient, msg.as_string())
+    def _send_email(self, recipient, msg):
+        # Emails are queued and sent in background in order not to block the request
+        MailQueue().enqueue(self._fromaddr, recipient, msg.as_string())
 
     def _send_text_email(self, text, recipients, subject):
         msg = MIMEText(text)
@@ -92,7 +99,7 @@ class NotificationsHandler:
 
     def send_acquired_notification(self, order):
         org = order.owner_organization
-        recipients = [User.objects.get(pk=pk).email for pk in org.managers]
+        recipients = self._recipients.get_emails(org.managers)
         domain = settings.SITE
 
         order_url = urljoin(domain, '/#/inventory/order')
@@ -112,7 +119,7 @@ class NotificationsHandler:
 
     def send_product_upgraded_notification(self, order, contract, product_name):
         org = order.owner_organization
-        recipients = [User.objects.get(pk=pk).email for pk in org.managers]
+        recipients = self._recipients.get_emails(org.managers)
         domain = settings.SITE
 
         product_url = urljoin(domain, '/#/inventory/product/{}'.format(contract.product_id))
@@ -125,7 +132,7 @@ class NotificationsHandler:
     def send_provider_notification(self, order, contract):
         # Get destination email
         org = contract.offering.owner_organization
-        recipients = [User.objects.get(pk=pk).email for pk in org.managers]
+        recipients = self._recipients.get_emails(org.managers)
         domain = settings.SITE
 
         url = urljoin(domain, '/#/inventory/order')
@@ -138,7 +145,7 @@ class NotificationsHandler:
 
     def send_payment_required_notification(self, order, contract):
         org = order.owner_organization
-        recipients = [User.objects.get(pk=pk).email for pk in org.managers]
+        recipients = self._recipients.get_emails(org.managers)
 
         domain = settings.SITE
         url = urljoin(domain, '/#/inventory/order/' + order.order_id)
@@ -152,7 +159,7 @@ class NotificationsHandler:
 
     def send_near_expiration_notification(self, order, contract, days):
         org = order.owner_organization
-        recipients = [User.objects.get(pk=pk).email for pk in org.managers]
+        recipients = self._recipients.get_emails(org.managers)
 
         domain = settings.SITE
         url = urljoin(domain, '/#/inventory/order/' + order.order_id)
@@ -167,7 +174,7 @@ class NotificationsHandler:
 
     def send_renovation_notification(self, order, transactions):
         org = order.owner_organization
-        recipients = [User.objects.get(pk=pk).email for pk in org.managers]
+        recipients = self._recipients.get_emails(org.managers)
         domain = settings.SITE
 
         order_url = urljoin(domain, '/#/inventory/order')
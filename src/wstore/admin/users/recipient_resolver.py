@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from django.core.exceptions import ObjectDoesNotExist
+
+from wstore.models import User
+
+
+class RecipientResolver(object):
+    """
+    Resolves the email addresses of users in bulk. Users are retrieved with a single
+    query and cached for the lifetime of the resolver, so it is intended to be used
+    for a batch of notifications or reports
+    """
+
+    def __init__(self):
+        self._emails = {
+            'pk': {},
+            'username': {}
+        }
+
+    def prefetch(self, field, keys):
+        """
+        Retrieves the users not yet cached in a single query
+        :param field: User field used as key, pk or username
+        :param keys: Values of the field of the users to be retrieved
+        """
+        cache = self._emails[field]
+
+        missing = []
+        seen = set()
+        for key in keys:
+            if key not in cache and key not in seen:
+                missing.append(key)
+                seen.add(key)
+
+        if len(missing):
+            for user in User.objects.filter(**{field + '__in': missing}):
+                cache[getattr(user, field)] = user.email
+
+    def _get_emails(self, field, keys):
+        self.prefetch(field, keys)
+        cache = self._emails[field]
+
+        for key in keys:
+            if key not in cache:
+                raise ObjectDoesNotExist('The user with {} {} does not exist'.format(field, key))
+
+        return [cache[key] for key in keys]
+
+    def get_emails(self, pks):
+        """
+        Returns the emails of the given users keeping its order
+        :param pks: List of user ids
+        """
+        return self._get_emails('pk', pks)
+
+    def get_emails_by_username(self, usernames):
+        return self._get_emails('username', usernames)
+
+    def get_email_by_username(self, username):
+        return self._get_emails('username', [username])[0]
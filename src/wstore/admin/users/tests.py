@@ -20,14 +20,17 @@
 
 from __future__ import unicode_literals
 
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+
+import smtplib
+from datetime import datetime
 
 from mock import MagicMock, mock_open, call
 from nose_parameterized import parameterized
 
 from django.test import TestCase
 
-from wstore.admin.users import notification_handler
+from wstore.admin.users import notification_handler, mail_queue, recipient_resolver
 
 __test__ = False
 
@@ -73,20 +76,23 @@ class NotificationsTestCase(TestCase):
 
         self._order.contracts = [contract1, contract2]
 
-        # Mock user
-        notification_handler.User = MagicMock()
-        self._user1 = MagicMock()
-        self._user1.email = 'user1@email.com'
-        self._user2 = MagicMock()
-        self._user2.email = 'user2@email.com'
-        notification_handler.User.objects.get.side_effect = [self._user1, self._user2]
+        # Mock users, customer and provider managers have the same emails
+        emails = {
+            '11111': 'user1@email.com',
+            '22222': 'user2@email.com',
+            '33333': 'user1@email.com',
+            '44444': 'user2@email.com'
+        }
+        recipient_resolver.User = MagicMock()
+        recipient_resolver.User.objects.filter.side_effect = lambda pk__in: [
+            MagicMock(pk=pk, email=emails[pk]) for pk in pk__in if pk in emails]
 
         # Mock email libs
         notification_handler.MIMEMultipart = MagicMock()
         notification_handler.MIMEText = MagicMock()
         notification_handler.MIMEBase = MagicMock()
         notification_handler.encoders = MagicMock()
-        notification_handler.smtplib = MagicMock()
+        notification_handler.MailQueue = MagicMock()
 
         # Mock open method
         self._mock_open = mock_open()
@@ -96,6 +102,7 @@ class NotificationsTestCase(TestCase):
     def tearDown(self):
         notification_handler.__builtins__['open'] = self._old_open
         reload(notification_handler)
+        reload(recipient_resolver)
 
     def _empty_email(self):
         notification_handler.settings.WSTOREMAIL = ''
@@ -128,16 +135,10 @@ class NotificationsTestCase(TestCase):
         self.assertEquals('Missing email configuration', unicode(error))
 
     def _validate_user_call(self):
-        self.assertEquals([
-            call(pk='11111'),
-            call(pk='22222')
-        ], notification_handler.User.objects.get.call_args_list)
+        recipient_resolver.User.objects.filter.assert_called_once_with(pk__in=['11111', '22222'])
 
     def _validate_provider_call(self):
-        self.assertEquals([
-            call(pk='33333'),
-            call(pk='44444')
-        ], notification_handler.User.objects.get.call_args_list)
+        recipient_resolver.User.objects.filter.assert_called_once_with(pk__in=['33333', '44444'])
 
     def _validate_mime_text_info(self, subject):
         self.assertEquals([
@@ -149,10 +150,7 @@ class NotificationsTestCase(TestCase):
     def _validate_email_call(self, mime, emails=None):
         if emails is None:
             emails = ['user1@email.com', 'user2@email.com']
-        notification_handler.smtplib.SMTP.assert_called_once_with('smtp.gmail.com', 587)
-        notification_handler.smtplib.SMTP().starttls.assert_called_once_with()
-        notification_handler.smtplib.SMTP().login.assert_called_once_with('wstore', 'passwd')
-        notification_handler.smtplib.SMTP().sendmail.assert_called_once_with(
+        notification_handler.MailQueue().enqueue.assert_called_once_with(
             'wstore@email.com',
             emails,
             mime().as_string()
@@ -295,3 +293,142 @@ class NotificationsTestCase(TestCase):
         notification_handler.MIMEText.assert_called_once_with(text)
 
         self._validate_mime_text_info('Product upgraded')
+
+    def test_recipients_cached(self):
+        handler = notification_handler.NotificationsHandler()
+        handler.send_payment_required_notification(self._order, self._order.contracts[0])
+        handler.send_near_expiration_notification(self._order, self._order.contracts[0], 3)
+
+        # Users are retrieved once for all the notifications of the handler
+        self._validate_user_call()
+
+    def test_prefetch_recipients(self):
+        order = MagicMock()
+        order.owner_organization.managers = ['22222', '33333']
+
+        handler = notification_handler.NotificationsHandler()
+        handler.prefetch_recipients([self._order, order])
+        handler.send_payment_required_notification(self._order, self._order.contracts[0])
+        handler.send_near_expiration_notification(order, self._order.contracts[0], 3)
+
+        # The managers of all the orders are retrieved at once
+        recipient_resolver.User.objects.filter.assert_called_once_with(pk__in=['11111', '22222', '33333'])
+
+    def test_recipients_not_found(self):
+        self._order.owner_organization.managers = ['11111', '55555']
+        handler = notification_handler.NotificationsHandler()
+
+        error = None
+        try:
+            handler.send_payment_required_notification(self._order, self._order.contracts[0])
+        except ObjectDoesNotExist as e:
+            error = e
+
+        self.assertEquals('The user with pk 55555 does not exist', unicode(error))
+
+
+class MailQueueTestCase(TestCase):
+    tags = ('notifications', 'mail-queue')
+
+    def setUp(self):
+        self._collection = MagicMock()
+        mail_queue.get_database_connection = MagicMock(return_value={'wstore_mail_queue': self._collection})
+        mail_queue.schedule_deadline = MagicMock()
+
+        self._lock = MagicMock()
+        self._lock.acquire.return_value = True
+        mail_queue.DistributedLock = MagicMock(return_value=self._lock)
+
+        self._server = MagicMock()
+        mail_queue.smtplib = MagicMock()
+        mail_queue.smtplib.SMTP.return_value = self._server
+        mail_queue.smtplib.SMTPException = smtplib.SMTPException
+        mail_queue.smtplib.SMTPResponseException = smtplib.SMTPResponseException
+        mail_queue.smtplib.SMTPRecipientsRefused = smtplib.SMTPRecipientsRefused
+
+        mail_queue.settings.SMTPSERVER = 'smtp.gmail.com'
+        mail_queue.settings.SMTPPORT = '587'
+        mail_queue.settings.WSTOREMAILUSER = 'wstore'
+        mail_queue.settings.WSTOREMAILPASS = 'passwd'
+
+        self._mails = [{
+            '_id': '1',
+            'sender': 'wstore@email.com',
+            'recipients': ['user1@email.com', 'user2@email.com'],
+            'message': 'message 1',
+            'attempts': 0
+        }, {
+            '_id': '2',
+            'sender': 'wstore@email.com',
+            'recipients': ['user3@email.com'],
+            'message': 'message 2',
+            'attempts': 0
+        }]
+        self._collection.find.return_value.sort.return_value.limit.side_effect = [self._mails, []]
+        self._collection.find_one.return_value = None
+
+    def tearDown(self):
+        reload(mail_queue)
+
+    def test_enqueue_batches_recipients(self):
+        mail_queue.settings.MAIL_MAX_RECIPIENTS = 2
+
+        mail_queue.MailQueue().enqueue('wstore@email.com', ['user1@email.com', 'user2@email.com', 'user3@email.com'], 'message')
+
+        mails = self._collection.insert_many.call_args[0][0]
+        self.assertEquals([['user1@email.com', 'user2@email.com'], ['user3@email.com']], [mail['recipients'] for mail in mails])
+        self.assertEquals(['pending', 'pending'], [mail['state'] for mail in mails])
+
+        mail_queue.schedule_deadline.assert_called_once_with('mail_dispatch', 'queue', 0)
+
+    def test_dispatch_reuses_connection(self):
+        delay = mail_queue.MailQueue().dispatch()
+        self.assertEquals(None, delay)
+
+        # A single authenticated connection is used for all the emails
+        mail_queue.smtplib.SMTP.assert_called_once_with('smtp.gmail.com', 587, timeout=30)
+        self._server.starttls.assert_called_once_with()
+        self._server.login.assert_called_once_with('wstore', 'passwd')
+
+        self.assertEquals([
+            call('wstore@email.com', ['user1@email.com', 'user2@email.com'], 'message 1'),
+            call('wstore@email.com', ['user3@email.com'], 'message 2')
+        ], self._server.sendmail.call_args_list)
+
+        self._collection.delete_many.assert_called_once_with({'_id': {'$in': ['1', '2']}})
+        self._lock.release.assert_called_once_with()
+
+        # The connection is kept for the next emails
+        self.assertEquals(0, self._server.quit.call_count)
+        self.assertEquals(self._server, mail_queue._smtp_pool.acquire())
+
+    def test_dispatch_connection_error(self):
+        self._server.sendmail.side_effect = [None, smtplib.SMTPServerDisconnected('Connection lost')]
+        self._collection.find_one.return_value = {'next_attempt': datetime(2017, 1, 1)}
+
+        delay = mail_queue.MailQueue().dispatch()
+        self.assertEquals(0, delay)
+
+        self._collection.delete_many.assert_called_once_with({'_id': {'$in': ['1']}})
+        self.assertEquals('2', self._collection.update_one.call_args[0][0]['_id'])
+        self.assertEquals(1, self._collection.update_one.call_args[0][1]['$set']['attempts'])
+
+        # The broken connection is discarded
+        self._server.quit.assert_called_once_with()
+
+    def test_dispatch_refused_recipients(self):
+        self._server.sendmail.side_effect = [smtplib.SMTPRecipientsRefused({}), None]
+
+        mail_queue.MailQueue().dispatch()
+
+        self._collection.update_one.assert_called_once_with({'_id': '1'}, {
+            '$set': {'state': 'failed', 'error': '{}'}
+        })
+        self._collection.delete_many.assert_called_once_with({'_id': {'$in': ['2']}})
+
+    def test_dispatch_locked(self):
+        self._lock.acquire.return_value = False
+
+        mail_queue.MailQueue().dispatch()
+
+        self.assertEquals(0, mail_queue.smtplib.SMTP.call_count)
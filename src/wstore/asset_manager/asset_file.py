@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import base64
+import binascii
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+
+
+def _get_chunk_size():
+    return getattr(settings, 'ASSET_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+
+
+class Base64Decoder(object):
+    """
+    Incremental base64 decoder, the characters that do not complete a group of
+    four are kept until the next chunk is provided
+    """
+
+    def __init__(self):
+        self._pending = ''
+
+    def decode(self, data):
+        # Line breaks and spaces are ignored, as done by b64decode
+        data = self._pending + ''.join(data.split())
+        usable = len(data) - (len(data) % 4)
+        self._pending = data[usable:]
+
+        try:
+            return base64.b64decode(data[:usable])
+        except (TypeError, UnicodeError, binascii.Error):
+            raise ValueError('The provided asset data is not valid base64')
+
+    def flush(self):
+        if len(self._pending):
+            raise ValueError('The provided asset data is not valid base64')
+
+        return b''
+
+
+def iter_base64_chunks(data, chunk_size=None):
+    """
+    Decodes a base64 string in chunks, so the decoded content is never fully loaded
+    :param data: base64 encoded string
+    :param chunk_size: Number of encoded characters decoded at a time
+    """
+    if chunk_size is None:
+        chunk_size = _get_chunk_size()
+
+    decoder = Base64Decoder()
+    for i in range(0, len(data), chunk_size):
+        chunk = decoder.decode(data[i:i + chunk_size])
+
+        if len(chunk):
+            yield chunk
+
+    decoder.flush()
+
+
+def iter_file_chunks(file_, chunk_size=None):
+    """
+    Reads an uploaded file in chunks. Files bigger than FILE_UPLOAD_MAX_MEMORY_SIZE
+    have already been streamed to disk by Django, so they are not loaded in memory
+    :param file_: Django uploaded file or file-like object
+    :param chunk_size: Number of bytes read at a time
+    """
+    if chunk_size is None:
+        chunk_size = _get_chunk_size()
+
+    file_.seek(0)
+
+    if hasattr(file_, 'chunks'):
+        for chunk in file_.chunks(chunk_size):
+            yield chunk
+    else:
+        chunk = file_.read(chunk_size)
+        while len(chunk):
+            yield chunk
+            chunk = file_.read(chunk_size)
+
+
+class LocalAssetFile(object):
+    """
+    Asset file already stored in the server, as the partial file of an upload session.
+    It is moved to the assets directory instead of being copied
+    """
+
+    def __init__(self, path, name, callback=None):
+        self.path = path
+        self.name = name
+        self.callback = callback
+
+
+def move_asset_file(source_path, file_path, hash_algorithm=None, callback=None):
+    """
+    Moves a file already stored in the server to its final path, so its content is
+    not copied. The hash of the content is computed reading the file
+    :param source_path: Path of the stored file, in the same file system as the assets
+    :param file_path: Path of the asset file
+    :param hash_algorithm: Algorithm used to compute the hash of the content, if any
+    :param callback: Function called after every chunk is read
+    :return: Hash of the content as <algorithm>:<hex digest>, None if not computed
+    """
+    content_hash = None
+
+    if hash_algorithm:
+        hash_ = hashlib.new(hash_algorithm)
+
+        with open(source_path, 'rb') as f:
+            for chunk in iter_file_chunks(f):
+                hash_.update(chunk)
+
+                if callback is not None:
+                    callback()
+
+        content_hash = '{}:{}'.format(hash_algorithm, hash_.hexdigest())
+
+    os.chmod(source_path, 0o644)
+    os.rename(source_path, file_path)
+
+    return content_hash
+
+
+class AssetFileWriter(object):
+    """
+    Writes an asset file in chunks to a temporal file placed in the destination
+    directory, which is renamed atomically when complete. The hash of the content
+    can be computed while it is written
+    """
+
+    def __init__(self, directory, hash_algorithm=None):
+        fd, self._tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.new(hash_algorithm) if hash_algorithm else None
+        self._hash_algorithm = hash_algorithm
+        self.size = 0
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+        if self._hash is not None:
+            self._hash.update(chunk)
+
+    def commit(self, file_path):
+        """
+        Moves the written content to its final path
+        :param file_path: Path of the asset file
+        :return: Hash of the content as <algorithm>:<hex digest>, None if not computed
+        """
+        self._file.close()
+
+        # mkstemp creates the file only readable by the owner
+        os.chmod(self._tmp_path, 0o644)
+        os.rename(self._tmp_path, file_path)
+
+        if self._hash is None:
+            return None
+
+        return '{}:{}'.format(self._hash_algorithm, self._hash.hexdigest())
+
+    def abort(self):
+        self._file.close()
+
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
@@ -20,36 +20,57 @@
 
 from __future__ import unicode_literals
 
-import base64
 import os
-import threading
 from urlparse import urljoin
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 
+from wstore.asset_manager.asset_file import AssetFileWriter, LocalAssetFile, iter_base64_chunks, iter_file_chunks, \
+    move_asset_file
 from wstore.models import Resource, ResourceVersion, ResourcePlugin
 from wstore.store_commons.database import DocumentLock
 from wstore.store_commons.errors import ConflictError
 from wstore.store_commons.rollback import rollback, downgrade_asset_pa, downgrade_asset
+from wstore.store_commons.scheduler import schedule_deadline
 from wstore.store_commons.utils.name import is_valid_file
 from wstore.store_commons.utils.url import is_valid_url, url_fix
 
 
+def upgrade_timeout_handler(asset_id, data):
+    """
+    Deadline handler that downgrades an asset whose upgrade has not been completed in time
+    """
+    lock = DocumentLock('wstore_resource', asset_id, 'asset')
+    lock.wait_document()
+
+    try:
+        # Refresh asset info
+        asset = Resource.objects.get(pk=asset_id)
+
+        # If the asset is in upgrading state when the timer ends, rollback is called
+        if asset.state == 'upgrading':
+            downgrade_asset(asset)
+    finally:
+        lock.unlock_document()
+
+
 class AssetManager:
 
     def __init__(self):
         pass
 
     def _save_resource_file(self, provider, file_):
-        # Load file contents
+        # The file contents are not loaded, but read in chunks when written
         if isinstance(file_, dict):
             file_name = file_['name']
-            content = base64.b64decode(file_['data'])
+            chunks = iter_base64_chunks(file_['data'])
+        elif isinstance(file_, LocalAssetFile):
+            file_name = file_.name
+            chunks = None
         else:
             file_name = file_.name
-            file_.seek(0)
-            content = file_.read()
+            chunks = iter_file_chunks(file_)
 
         # Check file name
         if not is_valid_file(file_name):
@@ -76,14 +97,27 @@ class AssetManager:
                 raise ConflictError('The provided digital asset file (' + file_name + ') already exists')
             res.delete()
 
-        # Create file
-        with open(file_path, "wb") as f:
-            f.write(content)
+        hash_algorithm = getattr(settings, 'ASSET_HASH_ALGORITHM', None)
+
+        if chunks is None:
+            # Files already stored in the server are moved instead of copied
+            content_hash = move_asset_file(file_.path, file_path, hash_algorithm=hash_algorithm, callback=file_.callback)
+        else:
+            # Create file, the content is written to a temporal file which is renamed when complete
+            writer = AssetFileWriter(provider_dir, hash_algorithm=hash_algorithm)
+            try:
+                for chunk in chunks:
+                    writer.write(chunk)
+
+                content_hash = writer.commit(file_path)
+            except:
+                writer.abort()
+                raise
 
         self.rollback_logger['files'].append(file_path)
 
         site = settings.SITE
-        return resource_path, url_fix(urljoin(site, '/charging/' + resource_path))
+        return resource_path, url_fix(urljoin(site, '/charging/' + resource_path)), content_hash
 
     def _create_resource_model(self, provider, resource_data):
         # Create the resource
@@ -96,13 +130,22 @@ class AssetManager:
             resource_type=resource_data['resource_type'],
             state=resource_data['state'],
             is_public=resource_data['is_public'],
-            meta_info=resource_data['metadata']
+            meta_info=resource_data['metadata'],
+            content_hash=resource_data['content_hash']
         )
         self.rollback_logger['models'].append(resource)
 
         return resource
 
-    def _validate_asset_type(self, resource_type, content_type, provided_as, metadata):
+    def validate_asset_type(self, resource_type, content_type, provided_as, metadata):
+        """
+        Validates the content type, providing method and meta data of an asset
+        according to its asset type. Default values of the meta data are included
+        :param resource_type: Name of the asset type
+        :param content_type: Media type of the asset
+        :param provided_as: Providing method, FILE or URL
+        :param metadata: Meta data of the asset
+        """
 
         if not resource_type and metadata:
             raise ValueError('You have to specify a valid asset type for providing meta data')
@@ -175,7 +218,8 @@ class AssetManager:
             'resource_type': data.get('resourceType', ''),
             'state': '',
             'is_public': data.get('isPublic', False),
-            'content_path': ''
+            'content_path': '',
+            'content_hash': None
         }
 
         current_organization = provider.userprofile.current_organization
@@ -192,14 +236,15 @@ class AssetManager:
                 provided_as = 'URL'
 
             elif isinstance(data['content'], dict):
-                resource_data['content_path'], download_link = \
+                resource_data['content_path'], download_link, resource_data['content_hash'] = \
                     self._save_resource_file(current_organization.name, data['content'])
 
             else:
                 raise TypeError('content field has an unsupported type, expected string or object')
 
         elif file_ is not None:
-            resource_data['content_path'], download_link = self._save_resource_file(current_organization.name, file_)
+            resource_data['content_path'], download_link, resource_data['content_hash'] = \
+                self._save_resource_file(current_organization.name, file_)
 
         else:
             raise ValueError('The digital asset has not been provided')
@@ -210,7 +255,7 @@ class AssetManager:
         resource_data['link'] = download_link
 
         # Validate asset according to its type
-        self._validate_asset_type(
+        self.validate_asset_type(
             resource_data['resource_type'], resource_data['content_type'], provided_as, resource_data['metadata'])
 
         return resource_data, current_organization
@@ -237,7 +282,8 @@ class AssetManager:
             resource_path=asset.resource_path,
             download_link=asset.download_link,
             content_type=asset.content_type,
-            meta_info=asset.meta_info
+            meta_info=asset.meta_info,
+            content_hash=asset.content_hash
         )
         asset.old_versions.append(curr_version)
         asset.version = ''
@@ -247,17 +293,7 @@ class AssetManager:
         asset.save()
 
     def _upgrade_timer(self):
-        lock = DocumentLock('wstore_resource', self._to_downgrade.pk, 'asset')
-        lock.wait_document()
-
-        # Refresh asset info
-        asset = Resource.objects.get(pk=self._to_downgrade.pk)
-
-        # If the asset is in upgrading state when the timer ends, rollback is called
-        if asset.state == 'upgrading':
-            downgrade_asset(asset)
-
-        lock.unlock_document()
+        upgrade_timeout_handler(self._to_downgrade.pk, {})
 
     @rollback(downgrade_asset_pa)
     def upgrade_asset(self, asset_id, provider, data, file_=None):
@@ -295,13 +331,13 @@ class AssetManager:
         asset.resource_path = resource_data['content_path']
         asset.meta_info = resource_data['metadata']
         asset.content_type = resource_data['content_type']
+        asset.content_hash = resource_data['content_hash']
         asset.state = 'upgrading'
         asset.save()
 
         # If the upgrading process is not completed in 15 seconds the upgrade is canceled
         # in order to avoid an inconsistent state
-        t = threading.Timer(15, self._upgrade_timer)
-        t.start()
+        schedule_deadline('asset_upgrade_timeout', asset.pk, 15)
 
         return asset
 
@@ -314,7 +350,8 @@ class AssetManager:
             'href': resource.get_uri(),
             'location': resource.get_url(),
             'resourceType': resource.resource_type,
-            'metadata': resource.meta_info
+            'metadata': resource.meta_info,
+            'contentHash': resource.content_hash
         }
 
     def get_asset_info(self, asset_id):
@@ -37,6 +37,7 @@ class ResourceVersion(models.Model):
     download_link = models.URLField()
     content_type = models.CharField(max_length=100)
     meta_info = DictField()
+    content_hash = models.CharField(max_length=200, blank=True, null=True)
 
 
 class Resource(models.Model):
@@ -54,6 +55,9 @@ class Resource(models.Model):
     meta_info = DictField()
     bundled_assets = ListField()
 
+    # Hash of the uploaded file as <algorithm>:<hex digest>
+    content_hash = models.CharField(max_length=200, blank=True, null=True)
+
     def get_url(self):
         return self.download_link
 
@@ -20,7 +20,6 @@
 
 from __future__ import unicode_literals
 
-import requests
 
 from decimal import Decimal
 
@@ -28,6 +27,8 @@ from wstore.asset_manager.catalog_validator import CatalogValidator
 from wstore.asset_manager.models import Resource
 from wstore.asset_manager.resource_plugins.decorators import on_product_offering_validation
 from wstore.ordering.models import Offering
+from wstore.ordering.offering_cache import invalidate_offering
+from wstore.store_commons import http_client
 from wstore.store_commons.utils.units import ChargePeriod, CurrencyCode
 
 
@@ -96,7 +97,7 @@ class OfferingValidator(CatalogValidator):
                     raise ValueError('Invalid price, it must be greater than zero.')
 
     def _download(self, url):
-        r = requests.get(url)
+        r = http_client.get(url)
 
         if r.status_code != 200:
             raise ValueError('There has been a problem accessing the product spec included in the offering')
@@ -151,6 +152,8 @@ class OfferingValidator(CatalogValidator):
         offering.href = product_offering['href']
         offering.save()
 
+        invalidate_offering(product_offering['id'])
+
     def validate_creation(self, provider, product_offering):
         bundled_offerings = self._get_bundled_offerings(product_offering)
         self._validate_offering_pricing(provider, product_offering, bundled_offerings)
@@ -159,3 +162,7 @@ class OfferingValidator(CatalogValidator):
     def validate_update(self, provider, product_offering):
         bundled_offerings = self._get_bundled_offerings(product_offering)
         self._validate_offering_pricing(provider, product_offering, bundled_offerings)
+
+        # The cached copies of the offering used in the orders are outdated
+        if 'id' in product_offering:
+            invalidate_offering(product_offering['id'])
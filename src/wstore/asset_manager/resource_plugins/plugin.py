@@ -26,6 +26,7 @@ from requests.exceptions import HTTPError
 
 from wstore.asset_manager.resource_plugins.plugin_error import PluginError
 from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.ordering.contract_index import apply_contract_usage
 
 
 class Plugin(object):
@@ -183,9 +184,8 @@ class Plugin(object):
             # All the  information is known so the document is directly created in Guided state
             usage_client.update_usage_state(usage_doc['id'], 'Guided')
 
-            contract.correlation_number += 1
-            order.save()
+            # Only the usage of the contract is updated, failing if modified meanwhile
+            apply_contract_usage(order, contract)
 
         if last_usage is not None:
-            contract.last_usage = last_usage
-            order.save()
+            apply_contract_usage(order, contract, count=0, last_usage=last_usage)
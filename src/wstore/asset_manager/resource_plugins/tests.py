@@ -384,6 +384,7 @@ class PluginTestCase(TestCase):
 
         self._usage_client = MagicMock()
         plugin.UsageClient = MagicMock(return_value=self._usage_client)
+        plugin.apply_contract_usage = MagicMock()
 
     def _call_configured(self):
         self._model.options = self._option
@@ -523,9 +524,11 @@ class PluginTestCase(TestCase):
             self._usage_client.create_usage.assert_called_once_with(self._usage_record)
             self._usage_client.update_usage_state.assert_called_once_with('1', 'Guided')
 
-            self.assertEquals(1, contract.correlation_number)
-            self.assertEquals(usages[1], contract.last_usage)
-            self.assertEquals([call(), call()], order.save.call_args_list)
+            self.assertEquals([
+                call(order, contract),
+                call(order, contract, count=0, last_usage=usages[1])
+            ], plugin.apply_contract_usage.call_args_list)
+            self.assertEquals(0, order.save.call_count)
 
     def test_usage_refresh_error(self):
         plugin_handler = plugin.Plugin(self._model)
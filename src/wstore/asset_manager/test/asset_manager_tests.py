@@ -20,17 +20,22 @@
 
 from __future__ import unicode_literals
 
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
 import urllib
 
 from copy import deepcopy
-from mock import MagicMock, mock_open
+from mock import MagicMock
 from nose_parameterized import parameterized
 
 from django.test import TestCase
 from django.core.exceptions import ObjectDoesNotExist
 from django.test.utils import override_settings
 
-from wstore.asset_manager import asset_manager
+from wstore.asset_manager import asset_file, asset_manager, upload_session
 from wstore.asset_manager.test.resource_test_data import *
 from wstore.asset_manager import models
 from wstore.store_commons.errors import ConflictError
@@ -52,6 +57,7 @@ class ResourceRetrievingTestCase(TestCase):
         resource.download_link = info['download_link']
         resource.resource_type = info['type']
         resource.meta_info = {}
+        resource.content_hash = None
 
         resource.get_url.return_value = info['download_link']
         resource.get_uri.return_value = info['uri']
@@ -176,26 +182,30 @@ class UploadAssetTestCase(TestCase):
         asset_manager.os.path.exists = MagicMock()
         asset_manager.os.path.exists.return_value = False
 
-        self.open_mock = mock_open()
-        self._old_open = asset_manager.__builtins__['open']
-        asset_manager.__builtins__['open'] = self.open_mock
+        asset_manager.AssetFileWriter = MagicMock()
+        self._writer = asset_manager.AssetFileWriter.return_value
+        self._writer.commit.return_value = None
+        self._content_hash = None
 
     def tearDown(self):
         import wstore.store_commons.rollback
         reload(wstore.store_commons.rollback)
 
         self._file = None
-        asset_manager.__builtins__['open'] = self._old_open
         reload(asset_manager)
 
     def _use_file(self):
         # Mock file
         self._file = MagicMock(name="example.wgt")
         self._file.name = "example.wgt"
-        self._file.read.return_value = "Test data content"
+        self._file.chunks.return_value = ["Test data content"]
         asset_manager.os.path.isdir.return_value = False
         asset_manager.os.mkdir = MagicMock()
 
+    def _hashed_file(self):
+        self._content_hash = 'sha256:1234'
+        self._writer.commit.return_value = self._content_hash
+
     def _file_conflict(self):
         asset_manager.os.path.exists.return_value = True
         self.res_mock.product_id = None
@@ -207,13 +217,15 @@ class UploadAssetTestCase(TestCase):
     def _check_file_calls(self, file_name='example.wgt'):
         asset_manager.os.path.isdir.assert_called_once_with("/home/test/media/assets/test_user")
         asset_manager.os.path.exists.assert_called_once_with("/home/test/media/assets/test_user/{}".format(file_name))
-        self.open_mock.assert_called_once_with("/home/test/media/assets/test_user/{}".format(file_name), "wb")
-        self.open_mock().write.assert_called_once_with("Test data content")
+        asset_manager.AssetFileWriter.assert_called_once_with("/home/test/media/assets/test_user", hash_algorithm=None)
+        self._writer.write.assert_called_once_with("Test data content")
+        self._writer.commit.assert_called_once_with("/home/test/media/assets/test_user/{}".format(file_name))
 
     @parameterized.expand([
         ('basic', UPLOAD_CONTENT),
         ('whitespce_name', UPLOAD_CONTENT_WHITESPACE, None, None, None, None, 'example file.wgt'),
         ('file', {'contentType': 'application/x-widget'}, _use_file),
+        ('hashed', UPLOAD_CONTENT, _hashed_file),
         ('existing_override', UPLOAD_CONTENT, _file_conflict, True),
         ('inv_file_name', MISSING_TYPE, None, False, ValueError, 'Missing required field: contentType'),
         ('inv_file_name', UPLOAD_INV_FILENAME, None, False, ValueError, 'Invalid file name format: Unsupported character'),
@@ -278,12 +290,37 @@ class UploadAssetTestCase(TestCase):
                 resource_type='',
                 state='',
                 is_public=False,
-                meta_info={}
+                meta_info={},
+                content_hash=self._content_hash
             )
         else:
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(err_msg, unicode(error))
 
+    @override_settings(MEDIA_ROOT='/home/test/media', ASSET_HASH_ALGORITHM='sha256')
+    def test_upload_asset_local_file(self):
+        asset_manager.move_asset_file = MagicMock(return_value='sha256:1234')
+        asset_manager.os.mkdir = MagicMock()
+        callback = MagicMock()
+
+        am = asset_manager.AssetManager()
+        am.rollback_logger = {
+            'files': [],
+            'models': []
+        }
+
+        am.upload_asset(self._user, {'contentType': 'application/x-widget'}, file_=asset_manager.LocalAssetFile(
+            '/home/test/media/uploads/1.part', 'example.wgt', callback=callback))
+
+        # The file is moved instead of written
+        asset_manager.move_asset_file.assert_called_once_with(
+            '/home/test/media/uploads/1.part', '/home/test/media/assets/test_user/example.wgt',
+            hash_algorithm='sha256', callback=callback)
+
+        self.assertEquals(0, asset_manager.AssetFileWriter.call_count)
+        self.assertEquals(['/home/test/media/assets/test_user/example.wgt'], am.rollback_logger['files'])
+        self.assertEquals('sha256:1234', asset_manager.Resource.objects.create.call_args[1]['content_hash'])
+
     def _mock_resource_type(self, form):
         asset_manager.ResourcePlugin = MagicMock()
         asset_manager.Resource.objects.filter.return_value = []
@@ -374,7 +411,8 @@ class UploadAssetTestCase(TestCase):
             resource_type='service',
             state='',
             is_public=False,
-            meta_info=exp_meta
+            meta_info=exp_meta,
+            content_hash=None
         )
 
     def test_upload_asset_pending(self):
@@ -488,11 +526,7 @@ class UploadAssetTestCase(TestCase):
         self.assertEquals(err_msg, unicode(error))
 
     def _mock_timer(self):
-        timer = MagicMock()
-        asset_manager.threading = MagicMock()
-        asset_manager.threading.Timer = MagicMock(return_value=timer)
-
-        return timer
+        asset_manager.schedule_deadline = MagicMock()
 
     @override_settings(MEDIA_ROOT='/home/test/media')
     def test_upgrade_asset(self):
@@ -516,7 +550,7 @@ class UploadAssetTestCase(TestCase):
 
         asset_manager.Resource.objects.filter.return_value = [asset]
 
-        timer = self._mock_timer()
+        self._mock_timer()
 
         am = asset_manager.AssetManager()
         am.rollback_logger = {
@@ -555,8 +589,7 @@ class UploadAssetTestCase(TestCase):
         self.assertEquals(prev_type, old_version.content_type)
         self.assertEquals(prev_version, old_version.version)
 
-        asset_manager.threading.Timer.assert_called_once_with(15, am._upgrade_timer)
-        timer.start.assert_called_once_with()
+        asset_manager.schedule_deadline.assert_called_once_with('asset_upgrade_timeout', asset.pk, 15)
 
     def _asset_empty(self):
         return []
@@ -666,3 +699,368 @@ class ResourceModelTestCase(TestCase):
         self.assertEquals(uri, res.get_uri())
 
         reload(models)
+
+
+class AssetFileTestCase(TestCase):
+
+    tags = ('asset-manager', )
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir, True)
+
+    @parameterized.expand([
+        ('aligned', 'Test data content', 4),
+        ('unaligned', 'Test data content', 7),
+        ('line_breaks', 'Test data content' * 10, 5, True),
+        ('single_chunk', 'Test data content', 1024)
+    ])
+    def test_base64_chunks(self, name, content, chunk_size, wrapped=False):
+        data = base64.encodestring(content) if wrapped else base64.b64encode(content)
+
+        chunks = list(asset_file.iter_base64_chunks(data, chunk_size=chunk_size))
+
+        self.assertEquals(content, b''.join(chunks))
+        self.assertTrue(all([len(chunk) <= chunk_size for chunk in chunks]))
+
+    def test_base64_chunks_invalid(self):
+        error = None
+        try:
+            list(asset_file.iter_base64_chunks('VGVzdCBkYXRh!', chunk_size=4))
+        except ValueError as e:
+            error = e
+
+        self.assertEquals('The provided asset data is not valid base64', unicode(error))
+
+    def test_file_chunks(self):
+        file_ = MagicMock()
+        file_.chunks.return_value = ['Test ', 'data']
+
+        self.assertEquals(['Test ', 'data'], list(asset_file.iter_file_chunks(file_, chunk_size=5)))
+        file_.seek.assert_called_once_with(0)
+        file_.chunks.assert_called_once_with(5)
+
+    @parameterized.expand([
+        ('plain', None, None),
+        ('hashed', 'sha256', 'sha256:' + hashlib.sha256(b'Test data content').hexdigest())
+    ])
+    def test_file_writer(self, name, algorithm, expected_hash):
+        file_path = os.path.join(self._dir, 'example.wgt')
+
+        writer = asset_file.AssetFileWriter(self._dir, hash_algorithm=algorithm)
+        writer.write(b'Test data ')
+        writer.write(b'content')
+
+        # The file is not visible until committed
+        self.assertFalse(os.path.exists(file_path))
+
+        content_hash = writer.commit(file_path)
+
+        with open(file_path, 'rb') as f:
+            self.assertEquals(b'Test data content', f.read())
+
+        self.assertEquals(17, writer.size)
+        self.assertEquals(['example.wgt'], os.listdir(self._dir))
+        self.assertEquals(expected_hash, content_hash)
+
+    @parameterized.expand([
+        ('plain', None, None),
+        ('hashed', 'sha256', 'sha256:' + hashlib.sha256(b'Test data content').hexdigest())
+    ])
+    def test_move_asset_file(self, name, algorithm, expected_hash):
+        source_path = os.path.join(self._dir, '1.part')
+        file_path = os.path.join(self._dir, 'example.wgt')
+
+        with open(source_path, 'wb') as f:
+            f.write(b'Test data content')
+
+        callback = MagicMock()
+        with self.settings(ASSET_UPLOAD_CHUNK_SIZE=5):
+            content_hash = asset_file.move_asset_file(source_path, file_path, hash_algorithm=algorithm, callback=callback)
+
+        with open(file_path, 'rb') as f:
+            self.assertEquals(b'Test data content', f.read())
+
+        self.assertEquals(['example.wgt'], os.listdir(self._dir))
+        self.assertEquals(expected_hash, content_hash)
+        self.assertEquals(4 if algorithm else 0, callback.call_count)
+
+    def test_file_writer_abort(self):
+        writer = asset_file.AssetFileWriter(self._dir)
+        writer.write(b'Test data')
+        writer.abort()
+
+        self.assertEquals([], os.listdir(self._dir))
+
+
+class UploadSessionTestCase(TestCase):
+
+    tags = ('asset-manager', 'upload-session')
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self._dir, 'uploads'))
+        self._session_id = '58a4a6b3d5c6e1a2b3c4d5e6'
+
+        self._collection = MagicMock()
+        upload_session.get_database_connection = MagicMock()
+        upload_session.get_database_connection.return_value = {
+            upload_session.SESSION_COLLECTION: self._collection
+        }
+
+        self._lock = MagicMock()
+        self._lock.acquire.return_value = True
+        upload_session.DistributedLock = MagicMock(return_value=self._lock)
+
+        upload_session.schedule_deadline = MagicMock()
+        upload_session.AssetManager = MagicMock()
+
+        self._user = MagicMock(pk='1111')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir, True)
+        reload(upload_session)
+
+    def _mock_session(self, offset=0, content=b''):
+        session = {
+            '_id': upload_session.ObjectId(self._session_id),
+            'user': '1111',
+            'name': 'example.zip',
+            'size': 10,
+            'offset': offset,
+            'data': {'contentType': 'application/zip'},
+            'expires': upload_session.datetime.utcnow()
+        }
+        self._collection.find_one.return_value = session
+        self._lock.document = session
+
+        with open(os.path.join(self._dir, 'uploads', self._session_id + '.part'), 'wb') as f:
+            f.write(content)
+
+        return session
+
+    def _read_part(self):
+        with open(os.path.join(self._dir, 'uploads', self._session_id + '.part'), 'rb') as f:
+            return f.read()
+
+    def test_create_session(self):
+        self._collection.insert_one.return_value = MagicMock(inserted_id=upload_session.ObjectId(self._session_id))
+
+        with self.settings(MEDIA_ROOT=self._dir, SITE='http://localhost:8004/', UPLOAD_SESSION_TTL=3600):
+            info = upload_session.UploadSessionManager().create_session(self._user, {
+                'name': 'example.zip',
+                'size': 10,
+                'contentType': 'application/zip',
+                'resourceType': 'basic'
+            })
+            self.assertEquals(b'', self._read_part())
+
+        self.assertEquals(self._session_id, info['id'])
+        self.assertEquals('http://localhost:8004/charging/api/assetManagement/assets/uploadJob/sessions/' + self._session_id, info['href'])
+        self.assertEquals(0, info['offset'])
+        self.assertEquals(10, info['size'])
+
+        upload_session.AssetManager().validate_asset_type.assert_called_once_with('basic', 'application/zip', 'FILE', {})
+        inserted = self._collection.insert_one.call_args[0][0]
+        self.assertEquals('1111', inserted['user'])
+        self.assertEquals({'contentType': 'application/zip', 'resourceType': 'basic'}, inserted['data'])
+        upload_session.schedule_deadline.assert_called_once_with(upload_session.EXPIRY_DEADLINE, self._session_id, 3600)
+
+    @parameterized.expand([
+        ('missing_size', {'name': 'example.zip', 'contentType': 'application/zip'}, 'Missing required field: name and size'),
+        ('invalid_name', {'name': 'exam/ple.zip', 'size': 10, 'contentType': 'application/zip'}, 'Invalid file name format: Unsupported character'),
+        ('invalid_size', {'name': 'example.zip', 'size': '10', 'contentType': 'application/zip'}, 'Invalid file size, it must be a positive integer'),
+        ('too_big', {'name': 'example.zip', 'size': 11, 'contentType': 'application/zip'}, 'The file exceeds the maximum allowed size'),
+        ('missing_type', {'name': 'example.zip', 'size': 10}, 'Missing required field: contentType')
+    ])
+    def test_create_session_invalid(self, name, data, msg):
+        error = None
+        try:
+            with self.settings(MEDIA_ROOT=self._dir, UPLOAD_SESSION_MAX_SIZE=10):
+                upload_session.UploadSessionManager().create_session(self._user, data)
+        except ValueError as e:
+            error = e
+
+        self.assertEquals(msg, unicode(error))
+        self.assertEquals(0, self._collection.insert_one.call_count)
+
+    @parameterized.expand([
+        ('first', 0, b'', 0, 4, [b'01234'], b'01234', 5),
+        ('next', 5, b'01234', 5, 9, [b'567', b'89'], b'0123456789', 10),
+        ('resent', 5, b'01234', 3, 6, [b'3456'], b'0123456', 7)
+    ])
+    def test_upload_chunk(self, name, offset, content, start, end, chunks, expected, expected_offset):
+        with self.settings(MEDIA_ROOT=self._dir, SITE='http://localhost:8004/'):
+            session = self._mock_session(offset=offset, content=content)
+            info = upload_session.UploadSessionManager().upload_chunk(self._user, self._session_id, start, end, 10, chunks)
+
+            self.assertEquals(expected, self._read_part())
+
+        self.assertEquals(expected_offset, info['offset'])
+        upload_session.DistributedLock.assert_called_once_with(upload_session.SESSION_COLLECTION, self._session_id, '_lock')
+        self._lock.acquire.assert_called_once_with(blocking=False)
+        self._lock.release.assert_called_once_with()
+
+        self._lock.update.assert_called_once_with({
+            '$set': {
+                'offset': expected_offset,
+                'expires': session['expires']
+            }
+        })
+
+    @parameterized.expand([
+        ('renewed', True, None),
+        ('lease_lost', False, 'The upload session has been modified by other request')
+    ])
+    def test_upload_chunk_renew_lease(self, name, renewed, msg):
+        self._lock.renew.return_value = renewed
+
+        error = None
+        try:
+            with self.settings(MEDIA_ROOT=self._dir, SITE='http://localhost:8004/', UPLOAD_SESSION_LOCK_RENEWAL=0):
+                self._mock_session()
+                upload_session.UploadSessionManager().upload_chunk(self._user, self._session_id, 0, 4, 10, [b'012', b'34'])
+        except ConflictError as e:
+            error = e
+
+        # The lease is renewed while the chunks are written
+        if renewed:
+            self.assertTrue(error is None)
+            self.assertEquals(2, self._lock.renew.call_count)
+            self.assertEquals(1, self._lock.update.call_count)
+        else:
+            self.assertEquals(msg, unicode(error))
+            self.assertEquals(1, self._lock.renew.call_count)
+            self.assertEquals(0, self._lock.update.call_count)
+
+        self._lock.release.assert_called_once_with()
+
+    @parameterized.expand([
+        ('invalid_size', 0, 4, 11, [b'01234'], ValueError, 'The file size does not match the size of the upload session'),
+        ('invalid_range', 4, 2, 10, [b'01234'], ValueError, 'Invalid chunk range'),
+        ('gap', 3, 5, 10, [b'345'], ConflictError, 'Invalid chunk start, expected: 0'),
+        ('exceeded', 0, 2, 10, [b'01234'], ValueError, 'The chunk content exceeds the specified range'),
+        ('incomplete', 0, 4, 10, [b'012'], ValueError, 'The chunk content does not match the specified range'),
+        ('locked', 0, 4, 10, [b'01234'], ConflictError, 'The upload session is being modified by other request', True)
+    ])
+    def test_upload_chunk_invalid(self, name, start, end, size, chunks, err_type, msg, locked=False):
+        self._lock.acquire.return_value = not locked
+
+        error = None
+        try:
+            with self.settings(MEDIA_ROOT=self._dir):
+                self._mock_session()
+                upload_session.UploadSessionManager().upload_chunk(self._user, self._session_id, start, end, size, chunks)
+        except err_type as e:
+            error = e
+
+        self.assertEquals(msg, unicode(error))
+        self.assertEquals(0, self._collection.update_one.call_count)
+        self.assertEquals(0 if locked else 1, self._lock.release.call_count)
+
+    def test_upload_chunk_not_owner(self):
+        error = None
+        try:
+            with self.settings(MEDIA_ROOT=self._dir):
+                self._mock_session()
+                upload_session.UploadSessionManager().upload_chunk(MagicMock(pk='2222'), self._session_id, 0, 4, 10, [b'01234'])
+        except upload_session.PermissionDenied as e:
+            error = e
+
+        self.assertEquals('You are not the owner of the upload session', unicode(error))
+        self.assertEquals(0, upload_session.DistributedLock.call_count)
+
+    def test_session_not_found(self):
+        error = None
+        try:
+            upload_session.UploadSessionManager().get_session_info(self._user, 'invalid')
+        except ObjectDoesNotExist as e:
+            error = e
+
+        self.assertEquals('The specified upload session does not exist', unicode(error))
+        self.assertEquals(0, self._collection.find_one.call_count)
+
+    def test_finalize_session(self):
+        resource = MagicMock()
+        upload_session.AssetManager().upload_asset.return_value = resource
+
+        with self.settings(MEDIA_ROOT=self._dir):
+            session = self._mock_session(offset=10, content=b'0123456789')
+            result = upload_session.UploadSessionManager().finalize_session(self._user, self._session_id)
+
+            # The partial file is removed once the asset has been created
+            self.assertEquals([], os.listdir(os.path.join(self._dir, 'uploads')))
+
+        self.assertEquals((resource, session['data']), result)
+
+        # The path of the partial file is provided, so it is moved instead of copied
+        call_args = upload_session.AssetManager().upload_asset.call_args
+        self.assertEquals((self._user, session['data']), call_args[0])
+        self.assertEquals('example.zip', call_args[1]['file_'].name)
+        self.assertEquals(os.path.join(self._dir, 'uploads', self._session_id + '.part'), call_args[1]['file_'].path)
+
+        # The lease is renewed while the asset file is processed
+        with self.settings(UPLOAD_SESSION_LOCK_RENEWAL=0):
+            call_args[1]['file_'].callback()
+
+        self._lock.renew.assert_called_once_with()
+
+        self._lock.release.assert_called_once_with()
+        self._collection.delete_one.assert_called_once_with({'_id': session['_id']})
+
+    def _move_part(self, user, data, file_=None):
+        os.remove(file_.path)
+        raise ValueError('Invalid asset')
+
+    @parameterized.expand([
+        ('not_moved', None, 0),
+        ('moved', _move_part, 1)
+    ])
+    def test_finalize_session_error(self, name, side_effect, removed):
+        upload_session.AssetManager().upload_asset.side_effect = ValueError('Invalid asset') \
+            if side_effect is None else lambda *args, **kwargs: side_effect(self, *args, **kwargs)
+
+        error = None
+        try:
+            with self.settings(MEDIA_ROOT=self._dir):
+                self._mock_session(offset=10, content=b'0123456789')
+                upload_session.UploadSessionManager().finalize_session(self._user, self._session_id)
+        except ValueError as e:
+            error = e
+
+        # The session is kept only if the upload can be resumed
+        self.assertEquals('Invalid asset', unicode(error))
+        self.assertEquals(removed, self._collection.delete_one.call_count)
+        self._lock.release.assert_called_once_with()
+
+    def test_finalize_session_incomplete(self):
+        error = None
+        try:
+            with self.settings(MEDIA_ROOT=self._dir):
+                self._mock_session(offset=5, content=b'01234')
+                upload_session.UploadSessionManager().finalize_session(self._user, self._session_id)
+        except ValueError as e:
+            error = e
+
+        self.assertEquals('The upload is not complete, received 5 of 10 bytes', unicode(error))
+        self.assertEquals(0, upload_session.AssetManager().upload_asset.call_count)
+        self.assertEquals(0, self._collection.delete_one.call_count)
+        self._lock.release.assert_called_once_with()
+
+    @parameterized.expand([
+        ('expired', -10, False),
+        ('renewed', 600, True)
+    ])
+    def test_expiry_handler(self, name, remaining, rescheduled):
+        with self.settings(MEDIA_ROOT=self._dir):
+            session = self._mock_session(content=b'01234')
+            session['expires'] = upload_session.datetime.utcnow() + upload_session.timedelta(seconds=remaining)
+
+            upload_session.upload_session_expiry_handler(self._session_id, None)
+
+            self.assertEquals(not rescheduled, [] == os.listdir(os.path.join(self._dir, 'uploads')))
+
+        self.assertEquals(rescheduled, upload_session.schedule_deadline.called)
+        self.assertEquals(0 if rescheduled else 1, self._collection.delete_one.call_count)
@@ -464,11 +464,11 @@ class ValidatorTestCase(TestCase):
         self._validate_bundle_offering_calls(offering, False)
 
     def _mock_product_request(self):
-        offering_validator.requests = MagicMock()
+        offering_validator.http_client = MagicMock()
         product = deepcopy(BASIC_PRODUCT['product'])
         product['id'] = '20'
         resp = MagicMock()
-        offering_validator.requests.get.return_value = resp
+        offering_validator.http_client.get.return_value = resp
         resp.json.return_value = product
         resp.status_code = 200
 
@@ -494,7 +494,7 @@ class ValidatorTestCase(TestCase):
                                                                   [MagicMock(id='7', is_digital=False)]]
 
     def _catalog_api_error(self):
-        offering_validator.requests.get().status_code = 500
+        offering_validator.http_client.get().status_code = 500
 
     @parameterized.expand([
         ('valid_pricing', BASIC_OFFERING, _validate_single_offering_calls, None),
@@ -547,6 +547,7 @@ class ValidatorTestCase(TestCase):
         offering = MagicMock()
         offering_validator.Offering = MagicMock()
         offering_validator.Offering.objects.filter.return_value = [offering]
+        offering_validator.invalidate_offering = MagicMock()
 
         validator = offering_validator.OfferingValidator()
         validator.validate('attach', self._provider, BASIC_OFFERING)
@@ -555,6 +556,21 @@ class ValidatorTestCase(TestCase):
         self.assertEquals(BASIC_OFFERING['id'], offering.off_id)
 
         offering.save.assert_called_once_with()
+        offering_validator.invalidate_offering.assert_called_once_with(BASIC_OFFERING['id'])
+
+    def test_offering_update(self):
+        self._mock_validator_imports(offering_validator)
+        offering_validator.Resource.objects.filter.return_value = [self._asset_instance]
+
+        self._mock_product_request()
+        self._mock_offering_bundle(BASIC_OFFERING)
+        offering_validator.invalidate_offering = MagicMock()
+
+        validator = offering_validator.OfferingValidator()
+        validator.validate('update', self._provider, BASIC_OFFERING)
+
+        # The cached copies of the offering are removed
+        offering_validator.invalidate_offering.assert_called_once_with(BASIC_OFFERING['id'])
 
     def test_offering_attachment_missing(self):
         offering_validator.Offering = MagicMock()
@@ -62,7 +62,8 @@ RESOURCE_DATA1 = {
     'location': 'http://localhost/media/resources/resource1',
     'href': 'http://location/charging/assetManagement/assets/resource1',
     'resourceType': 'API',
-    'metadata': {}
+    'metadata': {},
+    'contentHash': None
 }
 
 RESOURCE_DATA2 = {
@@ -73,7 +74,8 @@ RESOURCE_DATA2 = {
     'location': 'http://localhost/media/resources/resource2',
     'href': 'http://location/charging/assetManagement/assets/resource2',
     'resourceType': 'API',
-    'metadata': {}
+    'metadata': {},
+    'contentHash': None
 }
 
 RESOURCE_DATA3 = {
@@ -84,7 +86,8 @@ RESOURCE_DATA3 = {
     'location': 'http://localhost/media/resources/resource3',
     'href': 'http://location/charging/assetManagement/assets/resource3',
     'resourceType': 'API',
-    'metadata': {}
+    'metadata': {},
+    'contentHash': None
 }
 
 RESOURCE_DATA4 = {
@@ -95,7 +98,8 @@ RESOURCE_DATA4 = {
     'location': 'http://localhost/media/resources/resource4',
     'href': 'http://location/charging/assetManagement/assets/resource4',
     'resourceType': 'API',
-    'metadata': {}
+    'metadata': {},
+    'contentHash': None
 }
 
 UPLOAD_CONTENT = {
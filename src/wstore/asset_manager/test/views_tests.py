@@ -472,3 +472,93 @@ class AssetCollectionTestCase(TestCase):
             off_validator.validate.assert_called_once_with('create', self.user.userprofile.current_organization, {})
 
         self._test_post_api(views.ValidateOfferingCollection, data, 'application/json', None, 200, validator)
+
+    def _mock_session_manager(self):
+        views.UploadSessionManager = MagicMock()
+        session_manager = MagicMock()
+        views.UploadSessionManager.return_value = session_manager
+        return session_manager
+
+    def test_create_upload_session(self):
+        session_manager = self._mock_session_manager()
+        session_manager.create_session.return_value = {'id': '1111', 'offset': 0}
+
+        data = {
+            'name': 'example.zip',
+            'size': 10,
+            'contentType': 'application/zip'
+        }
+
+        def validator(request, body_response):
+            session_manager.create_session.assert_called_once_with(self.user, data)
+            self.assertEquals({'id': '1111', 'offset': 0}, body_response)
+
+        self._test_post_api(views.UploadSessionCollection, json.dumps(data), 'application/json', None, 201, validator)
+
+    @parameterized.expand([
+        ('basic', 'bytes 0-4/10', 200, None),
+        ('missing_range', None, 422, 'Missing or invalid Content-Range header, expected bytes <start>-<end>/<size>'),
+        ('invalid_unit', 'items 0-4/10', 422, 'Missing or invalid Content-Range header, expected bytes <start>-<end>/<size>'),
+        ('conflict', 'bytes 5-9/10', 409, 'Invalid chunk start, expected: 0', ConflictError('Invalid chunk start, expected: 0')),
+        ('not_found', 'bytes 0-4/10', 404, 'Not found', ObjectDoesNotExist('Not found'))
+    ])
+    def test_upload_session_chunk(self, name, content_range, code, error_msg, err=None):
+        session_manager = self._mock_session_manager()
+
+        def upload_chunk(user, session_id, start, end, size, chunks):
+            if err is not None:
+                raise err
+
+            self.assertEquals(b'01234', b''.join(chunks))
+            return {'id': session_id, 'offset': end + 1}
+
+        session_manager.upload_chunk.side_effect = upload_chunk
+
+        extra = {'HTTP_ACCEPT': 'application/json'}
+        if content_range is not None:
+            extra['HTTP_CONTENT_RANGE'] = content_range
+
+        request = self.factory.put('/api/offering/resources', b'01234', content_type='application/octet-stream', **extra)
+        request.user = self.user
+
+        response = views.UploadSessionEntry(permitted_methods=('GET', 'PUT', 'DELETE')).update(request, '1111')
+
+        self.assertEquals(code, response.status_code)
+        body_response = json.loads(response.content)
+
+        if error_msg is None:
+            self.assertEquals({'id': '1111', 'offset': 5}, body_response)
+            self.assertEquals(('1111', 0, 4, 10), session_manager.upload_chunk.call_args[0][1:5])
+        else:
+            self.assertEquals({'result': 'error', 'error': error_msg}, body_response)
+
+    def test_delete_upload_session(self):
+        session_manager = self._mock_session_manager()
+
+        request = self.factory.delete('/api/offering/resources', HTTP_ACCEPT='application/json')
+        request.user = self.user
+
+        response = views.UploadSessionEntry(permitted_methods=('GET', 'PUT', 'DELETE')).delete(request, '1111')
+
+        self.assertEquals(204, response.status_code)
+        self.assertEquals(b'', response.content)
+        session_manager.delete_session.assert_called_once_with(self.user, '1111')
+
+    def test_finalize_upload_session(self):
+        session_manager = self._mock_session_manager()
+
+        resource = MagicMock(pk='2222')
+        resource.get_url.return_value = 'http://locationurl.com/'
+        resource.get_uri.return_value = 'http://uri.com/'
+        session_manager.finalize_session.return_value = (resource, {'contentType': 'application/zip'})
+
+        def validator(request, body_response):
+            session_manager.finalize_session.assert_called_once_with(self.user, '1111')
+            self.assertEquals({
+                'content': 'http://locationurl.com/',
+                'contentType': 'application/zip',
+                'id': '2222',
+                'href': 'http://uri.com/'
+            }, body_response)
+
+        self._test_post_api(views.UploadSessionFinalizeCollection, '', 'application/json', None, 200, validator, param='1111')
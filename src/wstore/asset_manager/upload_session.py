@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import os
+import time
+from copy import deepcopy
+from datetime import datetime, timedelta
+from urlparse import urljoin
+
+from bson import ObjectId
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+
+from wstore.asset_manager.asset_file import LocalAssetFile
+from wstore.asset_manager.asset_manager import AssetManager
+from wstore.store_commons.database import get_database_connection, DistributedLock
+from wstore.store_commons.errors import ConflictError
+from wstore.store_commons.scheduler import schedule_deadline
+from wstore.store_commons.utils.name import is_valid_file
+
+
+SESSION_COLLECTION = 'wstore_upload_session'
+EXPIRY_DEADLINE = 'upload_session_expiry'
+
+
+def _get_upload_dir():
+    upload_dir = os.path.join(settings.MEDIA_ROOT, 'uploads')
+
+    if not os.path.isdir(upload_dir):
+        os.mkdir(upload_dir)
+
+    return upload_dir
+
+
+def _get_part_path(session_id):
+    return os.path.join(_get_upload_dir(), unicode(session_id) + '.part')
+
+
+def _get_ttl():
+    return getattr(settings, 'UPLOAD_SESSION_TTL', 24 * 3600)
+
+
+class LeaseKeeper(object):
+    """
+    Renews the lease of the lock of an upload session while the chunks are written or
+    the file is moved, every UPLOAD_SESSION_LOCK_RENEWAL seconds
+    """
+
+    def __init__(self, lock):
+        self._lock = lock
+        self._renewed = time.time()
+
+    def __call__(self):
+        if time.time() - self._renewed < getattr(settings, 'UPLOAD_SESSION_LOCK_RENEWAL', 60):
+            return
+
+        if not self._lock.renew():
+            raise ConflictError('The upload session has been modified by other request')
+
+        self._renewed = time.time()
+
+
+class UploadSessionManager(object):
+    """
+    Manages resumable uploads of digital assets. The state of the sessions is stored
+    in the database and the received data in a partial file, so the chunks can be
+    uploaded in different requests and the upload resumed after a failure
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection()[SESSION_COLLECTION]
+
+    def _get_info(self, session):
+        return {
+            'id': unicode(session['_id']),
+            'href': urljoin(settings.SITE, 'charging/api/assetManagement/assets/uploadJob/sessions/' + unicode(session['_id'])),
+            'name': session['name'],
+            'size': session['size'],
+            'offset': session['offset'],
+            'expires': session['expires'].isoformat() + 'Z'
+        }
+
+    def _get_session(self, user, session_id):
+        session = None
+        if ObjectId.is_valid(session_id):
+            session = self._collection.find_one({'_id': ObjectId(session_id)})
+
+        if session is None:
+            raise ObjectDoesNotExist('The specified upload session does not exist')
+
+        if session['user'] != user.pk:
+            raise PermissionDenied('You are not the owner of the upload session')
+
+        return session
+
+    def _lock_session(self, session_id):
+        lock = DistributedLock(SESSION_COLLECTION, session_id, '_lock')
+
+        # Chunks of the same session are not written concurrently
+        if not lock.acquire(blocking=False):
+            raise ConflictError('The upload session is being modified by other request')
+
+        return lock
+
+    def create_session(self, user, data):
+        """
+        Creates an upload session for a digital asset file
+        :param user: User uploading the digital asset
+        :param data: Information of the asset, including the name and size of the file
+        :return: Information of the upload session
+        """
+        if 'name' not in data or 'size' not in data:
+            raise ValueError('Missing required field: name and size')
+
+        if not is_valid_file(data['name']):
+            raise ValueError('Invalid file name format: Unsupported character')
+
+        if not isinstance(data['size'], (int, long)) or data['size'] <= 0:
+            raise ValueError('Invalid file size, it must be a positive integer')
+
+        if data['size'] > getattr(settings, 'UPLOAD_SESSION_MAX_SIZE', 10 * 1024 ** 3):
+            raise ValueError('The file exceeds the maximum allowed size')
+
+        if 'contentType' not in data:
+            raise ValueError('Missing required field: contentType')
+
+        asset_data = dict([(k, v) for k, v in data.iteritems() if k not in ('name', 'size', 'content')])
+
+        # The asset type is validated before receiving the file, it is validated
+        # again when the upload is finalized
+        AssetManager().validate_asset_type(
+            asset_data.get('resourceType', ''), asset_data['contentType'], 'FILE', deepcopy(asset_data.get('metadata', {})))
+
+        now = datetime.utcnow()
+        session = {
+            'user': user.pk,
+            'name': data['name'],
+            'size': data['size'],
+            'offset': 0,
+            'data': asset_data,
+            'created': now,
+            'expires': now + timedelta(seconds=_get_ttl())
+        }
+        session['_id'] = self._collection.insert_one(session).inserted_id
+
+        # Create the partial file where the chunks are written
+        open(_get_part_path(session['_id']), 'wb').close()
+
+        schedule_deadline(EXPIRY_DEADLINE, unicode(session['_id']), _get_ttl())
+        return self._get_info(session)
+
+    def get_session_info(self, user, session_id):
+        return self._get_info(self._get_session(user, session_id))
+
+    def upload_chunk(self, user, session_id, start, end, size, chunks):
+        """
+        Writes a chunk of the file. Chunks can be resent, but they cannot start after
+        the data already received
+        :param user: User uploading the digital asset
+        :param session_id: Id of the upload session
+        :param start: Position of the first byte of the chunk
+        :param end: Position of the last byte of the chunk
+        :param size: Size of the complete file
+        :param chunks: Iterable with the content of the chunk
+        :return: Information of the upload session
+        """
+        self._get_session(user, session_id)
+        lock = self._lock_session(session_id)
+
+        try:
+            session = lock.document
+
+            if size != session['size']:
+                raise ValueError('The file size does not match the size of the upload session')
+
+            if start < 0 or end < start or end >= size:
+                raise ValueError('Invalid chunk range')
+
+            if start > session['offset']:
+                raise ConflictError('Invalid chunk start, expected: ' + unicode(session['offset']))
+
+            written = 0
+            keep_lease = LeaseKeeper(lock)
+            with open(_get_part_path(session['_id']), 'r+b') as f:
+                f.seek(start)
+
+                for chunk in chunks:
+                    if start + written + len(chunk) > end + 1:
+                        raise ValueError('The chunk content exceeds the specified range')
+
+                    f.write(chunk)
+                    written += len(chunk)
+                    keep_lease()
+
+            if written != end - start + 1:
+                raise ValueError('The chunk content does not match the specified range')
+
+            session['offset'] = max(session['offset'], end + 1)
+            session['expires'] = datetime.utcnow() + timedelta(seconds=_get_ttl())
+
+            updated = lock.update({
+                '$set': {
+                    'offset': session['offset'],
+                    'expires': session['expires']
+                }
+            })
+
+            if not updated:
+                raise ConflictError('The upload session has been modified by other request')
+        finally:
+            lock.release()
+
+        return self._get_info(session)
+
+    def finalize_session(self, user, session_id):
+        """
+        Creates the digital asset from the uploaded file, validating it as a regular upload
+        :param user: User uploading the digital asset
+        :param session_id: Id of the upload session
+        :return: Tuple (resource, asset info)
+        """
+        self._get_session(user, session_id)
+        lock = self._lock_session(session_id)
+
+        try:
+            session = lock.document
+
+            if session['offset'] != session['size']:
+                raise ValueError('The upload is not complete, received {} of {} bytes'.format(session['offset'], session['size']))
+
+            # The partial file is moved to the assets directory, renewing the lease
+            # while its hash is computed
+            part_path = _get_part_path(session['_id'])
+            file_ = LocalAssetFile(part_path, session['name'], callback=LeaseKeeper(lock))
+
+            try:
+                resource = AssetManager().upload_asset(user, session['data'], file_=file_)
+            except:
+                # If the file was moved before the failure, the upload cannot be resumed
+                if not os.path.exists(part_path):
+                    remove_session(session['_id'])
+                raise
+        finally:
+            lock.release()
+
+        remove_session(session['_id'])
+        return resource, session['data']
+
+    def delete_session(self, user, session_id):
+        session = self._get_session(user, session_id)
+        remove_session(session['_id'])
+
+
+def remove_session(session_id):
+    """
+    Removes an upload session and its partial file
+    """
+    get_database_connection()[SESSION_COLLECTION].delete_one({'_id': ObjectId(session_id)})
+
+    part_path = _get_part_path(session_id)
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+
+def upload_session_expiry_handler(session_id, data):
+    """
+    Deadline handler that removes the upload sessions not used in UPLOAD_SESSION_TTL seconds
+    """
+    session = get_database_connection()[SESSION_COLLECTION].find_one({'_id': ObjectId(session_id)})
+
+    if session is None:
+        return
+
+    remaining = (session['expires'] - datetime.utcnow()).total_seconds()
+    if remaining > 0:
+        # The session has been used since the deadline was scheduled
+        schedule_deadline(EXPIRY_DEADLINE, session_id, remaining)
+    else:
+        remove_session(session_id)
@@ -22,6 +22,7 @@ from __future__ import unicode_literals
 
 import json
 
+from django.conf import settings
 from django.http import HttpResponse
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.contrib.auth.models import User
@@ -32,6 +33,7 @@ from wstore.store_commons.resource import Resource
 from wstore.store_commons.utils.http import build_response, get_content_type, supported_request_mime_types, \
     authentication_required
 from wstore.asset_manager.asset_manager import AssetManager
+from wstore.asset_manager.upload_session import UploadSessionManager
 from wstore.asset_manager.product_validator import ProductValidator
 from wstore.asset_manager.offering_validator import OfferingValidator
 from wstore.store_commons.errors import ConflictError
@@ -181,6 +183,124 @@ class UploadCollection(Resource):
         return _manage_digital_asset(request, upload_asset)
 
 
+def _manage_upload_session(request, manager, code=200):
+    user = request.user
+
+    if 'provider' not in user.userprofile.get_current_roles() and not user.is_staff:
+        return build_response(request, 403, "You don't have the seller role")
+
+    try:
+        response = manager(request, user)
+    except ValueError as e:
+        return build_response(request, 422, unicode(e))
+    except ConflictError as e:
+        return build_response(request, 409, unicode(e))
+    except ObjectDoesNotExist as e:
+        return build_response(request, 404, unicode(e))
+    except PermissionDenied as e:
+        return build_response(request, 403, unicode(e))
+    except Exception as e:
+        return build_response(request, 400, unicode(e))
+
+    if response is None:
+        return HttpResponse(status=code)
+
+    return HttpResponse(json.dumps(response), status=code, mimetype='application/json; charset=utf-8')
+
+
+def _parse_content_range(request):
+    # Content-Range: bytes <start>-<end>/<size>
+    content_range = request.META.get('HTTP_CONTENT_RANGE', '')
+
+    try:
+        unit, byte_range = content_range.split(' ', 1)
+        positions, size = byte_range.split('/')
+        start, end = positions.split('-')
+
+        if unit != 'bytes':
+            raise ValueError()
+
+        return int(start), int(end), int(size)
+    except ValueError:
+        raise ValueError('Missing or invalid Content-Range header, expected bytes <start>-<end>/<size>')
+
+
+class UploadSessionCollection(Resource):
+
+    @supported_request_mime_types(('application/json',))
+    @authentication_required
+    def create(self, request):
+        """
+        Creates a resumable upload session for a downloadable digital asset
+        :param request:
+        :return: 201 Created, including the upload session info
+        """
+
+        def create_session(req, user):
+            try:
+                data = json.loads(req.body)
+            except:
+                raise ValueError('The provided data is not a valid JSON object')
+
+            return UploadSessionManager().create_session(user, data)
+
+        return _manage_upload_session(request, create_session, code=201)
+
+
+class UploadSessionEntry(Resource):
+
+    @authentication_required
+    def read(self, request, session_id):
+        """
+        Retrieves the state of an upload session, including the number of bytes received
+        """
+        return _manage_upload_session(
+            request, lambda req, user: UploadSessionManager().get_session_info(user, session_id))
+
+    @authentication_required
+    def update(self, request, session_id):
+        """
+        Uploads a chunk of the file, whose position is given in the Content-Range header
+        """
+
+        def upload_chunk(req, user):
+            start, end, size = _parse_content_range(req)
+
+            # The request body is read in chunks, not loaded in memory
+            chunk_size = getattr(settings, 'ASSET_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+            chunks = iter(lambda: req.read(chunk_size), b'')
+
+            return UploadSessionManager().upload_chunk(user, session_id, start, end, size, chunks)
+
+        return _manage_upload_session(request, upload_chunk)
+
+    @authentication_required
+    def delete(self, request, session_id):
+        """
+        Cancels an upload session removing the received data
+        """
+
+        def delete_session(req, user):
+            UploadSessionManager().delete_session(user, session_id)
+
+        return _manage_upload_session(request, delete_session, code=204)
+
+
+class UploadSessionFinalizeCollection(Resource):
+
+    @authentication_required
+    def create(self, request, session_id):
+        """
+        Creates the digital asset once all the chunks of the file have been uploaded
+        :return: 200 Created, including the new URL of the asset in the location header
+        """
+
+        def finalize_session(req, user, content_type):
+            return UploadSessionManager().finalize_session(user, session_id)
+
+        return _manage_digital_asset(request, finalize_session)
+
+
 class UpgradeCollection(Resource):
 
     @supported_request_mime_types(('application/json', 'multipart/form-data'))
@@ -21,37 +21,70 @@
 from __future__ import unicode_literals
 
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth.models import User
 
+from wstore.charging_engine.accounting.usage_client import UsageClient
 from wstore.models import Organization
+from wstore.ordering.contract_index import advance_contract_usage, locate_product_contract, rollback_contract_usage
 from wstore.ordering.models import Order
 
 
+CONCURRENT_UPDATE_MSG = 'The contract has been modified by other request, the SDR must be sent again'
+CONTRACT_REMOVED_MSG = 'The contract does not exist anymore, the SDR cannot be applied'
+NOT_GUIDED_MSG = 'The usage state could not be updated, the SDR must be sent again'
+NOT_REVERTED_MSG = 'The usage state could not be updated and the contract has been modified by other request'
+
+
 class SDRManager(object):
 
     def __init__(self):
-        self._order = None
-        self._contract = None
+        self._location = None
         self._time_stamp = None
 
-    def _get_order_contract(self, order_id, product_id):
-        # Get the order
-        order = None
-        contract = None
+    def _get_location(self, order_id, product_id):
+        # The contract is located with its raw values without loading the whole order
+        location = locate_product_contract(
+            product_id, order_id=order_id, fields=('correlation_number', 'last_usage', 'pricing_model'))
 
-        try:
-            order = Order.objects.get(order_id=order_id)
-        except:
-            pass
+        if location is None:
+            if not Order.objects.filter(order_id=order_id).count():
+                raise ValueError('Invalid orderId, the order does not exists')
 
-        try:
-            contract = order.get_product_contract(product_id)
-        except:
-            pass
+            raise ValueError('Invalid productId, the contract does not exist')
+
+        return location
+
+    def _check_customer(self, customer_name, owner_organization):
+        # Check that the customer exist
+        customer = Organization.objects.filter(name=customer_name)
 
-        return order, contract
+        if not len(customer):
+            raise ValueError('The specified customer ' + customer_name + ' does not exist')
+
+        # Check if the user making the request belongs to the customer organization
+        user = User.objects.get(username=customer_name)
+
+        for org in user.userprofile.organizations:
+            if org['organization'] == owner_organization:
+                break
+        else:
+            raise PermissionDenied("You don't belong to the customer organization")
+
+    def _get_update_error(self, order_id, order_pk, product_id):
+        # The contract is located again to know why its usage could not be advanced
+        location = locate_product_contract(product_id, order_id=order_id)
+
+        if location is None or location.order_pk != order_pk:
+            return CONTRACT_REMOVED_MSG
+
+        return CONCURRENT_UPDATE_MSG
+
+    def _get_usage_state(self, location):
+        return location.contract.get('correlation_number'), location.contract.get('last_usage')
 
     def _get_datetime(self, raw_time):
         try:
@@ -100,13 +133,8 @@ class SDRManager(object):
             raise ValueError('Invalid initial status, must be Received')
 
         sdr_values = self.get_sdr_values(sdr)
-        self._order, self._contract = self._get_order_contract(sdr_values['orderid'], sdr_values['productid'])
-
-        if self._order is None:
-            raise ValueError('Invalid orderId, the order does not exists')
-
-        if self._contract is None:
-            raise ValueError('Invalid productId, the contract does not exist')
+        self._location = self._get_location(sdr_values['orderid'], sdr_values['productid'])
+        contract = self._location.contract
 
         # Check that the value field is a valid number
         try:
@@ -117,35 +145,22 @@ class SDRManager(object):
         if 'relatedParty' not in sdr:
             raise ValueError('Missing required field relatedParty')
 
-        # Check that the customer exist
-        customer_name = sdr['relatedParty'][0]['id']
-        customer = Organization.objects.filter(name=customer_name)
-
-        if not len(customer):
-            raise ValueError('The specified customer ' + customer_name + ' does not exist')
-
-        # Check if the user making the request belongs to the customer organization
-        user = User.objects.get(username=customer_name)
-
-        for org in user.userprofile.organizations:
-            if org['organization'] == self._order.owner_organization.pk:
-                break
-        else:
-            raise PermissionDenied("You don't belong to the customer organization")
+        self._check_customer(sdr['relatedParty'][0]['id'], self._location.owner_organization)
 
         # Validate that the price mode included in the contract correspond to the one specified in the SDR
-        price_model = self._contract.pricing_model
+        price_model = contract.get('pricing_model', {})
         if 'pay_per_use' not in price_model:
             raise ValueError('The pricing model of the offering does not define pay-per-use components')
 
         # Check the correlation number and timestamp
-        if int(sdr_values['correlationnumber']) != self._contract.correlation_number:
-            raise ValueError('Invalid correlation number, expected: ' + unicode(self._contract.correlation_number))
+        correlation_number, last_usage = self._get_usage_state(self._location)
+        if int(sdr_values['correlationnumber']) != correlation_number:
+            raise ValueError('Invalid correlation number, expected: ' + unicode(correlation_number))
 
         # Truncate ms to 3 decimals (database supported)
         self._time_stamp = self._get_datetime(sdr['date'])
 
-        if self._contract.last_usage is not None and self._contract.last_usage > self._time_stamp:
+        if last_usage is not None and last_usage > self._time_stamp:
             raise ValueError('The provided timestamp specifies a lower timing than the last SDR received')
 
         # Check that the pricing model contains the specified unit
@@ -156,7 +171,221 @@ class SDRManager(object):
             raise ValueError('The specified unit is not included in the pricing model')
 
     def update_usage(self):
-        # Save new usage information
-        self._contract.last_usage = self._time_stamp
-        self._contract.correlation_number += 1
-        self._order.save()
+        # Save new usage information, the update fails if other SDR has been applied meanwhile
+        updated = advance_contract_usage(
+            self._location.order_pk,
+            self._location.contract['product_id'],
+            self._location.contract.get('correlation_number'),
+            last_usage=self._time_stamp
+        )
+
+        if not updated:
+            raise ValueError(self._get_update_error(
+                self._location.order_id, self._location.order_pk, self._location.contract['product_id']))
+
+    def rollback_usage(self):
+        """
+        Reverts the usage applied with update_usage, so the SDR can be sent again
+        :return: False if other usage has been applied meanwhile
+        """
+        return rollback_contract_usage(
+            self._location.order_pk,
+            self._location.contract['product_id'],
+            self._location.contract.get('correlation_number') + 1,
+            last_usage=self._location.contract.get('last_usage')
+        )
+
+
+class SDRBatchManager(SDRManager):
+    """
+    Validates and applies a batch of SDRs in one pass. Orders, customers and users are
+    looked up once per batch, the usage of every contract is advanced with a single
+    atomic update and the states of the usage documents are updated concurrently. The
+    usage documents of a contract that cannot be guided are reverted from the contract
+    """
+
+    def __init__(self):
+        super(SDRBatchManager, self).__init__()
+        self._locations = {}
+        self._customers = {}
+        self._contracts = {}
+
+    def _get_location(self, order_id, product_id):
+        key = (order_id, product_id)
+
+        if key not in self._locations:
+            try:
+                self._locations[key] = super(SDRBatchManager, self)._get_location(order_id, product_id)
+            except ValueError as e:
+                self._locations[key] = e
+
+        if isinstance(self._locations[key], Exception):
+            raise self._locations[key]
+
+        return self._locations[key]
+
+    def _check_customer(self, customer_name, owner_organization):
+        if customer_name not in self._customers:
+            if not len(Organization.objects.filter(name=customer_name)):
+                self._customers[customer_name] = None
+            else:
+                user = User.objects.get(username=customer_name)
+                self._customers[customer_name] = set([org['organization'] for org in user.userprofile.organizations])
+
+        organizations = self._customers[customer_name]
+        if organizations is None:
+            raise ValueError('The specified customer ' + customer_name + ' does not exist')
+
+        if owner_organization not in organizations:
+            raise PermissionDenied("You don't belong to the customer organization")
+
+    def _get_contract_key(self, location):
+        return location.order_pk, location.contract['product_id']
+
+    def _get_usage_state(self, location):
+        # SDRs of the batch already accepted for the contract are taken into account
+        key = self._get_contract_key(location)
+        if key in self._contracts:
+            return self._contracts[key]['correlation_number'], self._contracts[key]['last_usage']
+
+        return super(SDRBatchManager, self)._get_usage_state(location)
+
+    def _accept(self, position):
+        key = self._get_contract_key(self._location)
+
+        if key not in self._contracts:
+            self._contracts[key] = {
+                'order_pk': key[0],
+                'order_id': self._location.order_id,
+                'product_id': key[1],
+                'initial': self._location.contract.get('correlation_number'),
+                'initial_usage': self._location.contract.get('last_usage'),
+                'correlation_number': self._location.contract.get('correlation_number'),
+                'last_usage': None,
+                'records': [],
+                'timestamps': [],
+                'applied': False
+            }
+
+        contract = self._contracts[key]
+        contract['correlation_number'] += 1
+        contract['last_usage'] = self._time_stamp
+        contract['records'].append(position)
+        contract['timestamps'].append(self._time_stamp)
+
+    def _validate_records(self, records, results):
+        for position, sdr in enumerate(records):
+            result = {
+                'id': sdr.get('id') if isinstance(sdr, dict) else None
+            }
+            results.append(result)
+
+            try:
+                if not isinstance(sdr, dict):
+                    raise ValueError('The SDR is not a valid JSON object')
+
+                self.validate_sdr(sdr)
+            except (ValueError, PermissionDenied) as e:
+                result['error'] = unicode(e)
+            except:
+                result['error'] = 'The SDR document could not be processed due to an unexpected error'
+            else:
+                self._accept(position)
+
+    def _apply_usage(self, results):
+        for contract in self._contracts.values():
+            contract['applied'] = advance_contract_usage(
+                contract['order_pk'], contract['product_id'], contract['initial'],
+                len(contract['records']), contract['last_usage'])
+
+            if not contract['applied']:
+                error = self._get_update_error(contract['order_id'], contract['order_pk'], contract['product_id'])
+
+                for position in contract['records']:
+                    results[position]['error'] = error
+
+    def _update_state(self, client, result):
+        try:
+            client.update_usage_state(result['id'], result['status'])
+        except Exception as e:
+            return result, e
+
+        return result, None
+
+    def _guide_contract(self, client, contract, results):
+        # The usage documents of a contract are guided in order, stopping at the first
+        # failure, so the ones not guided can be reverted from the contract
+        for guided, position in enumerate(contract['records']):
+            result = results[position]
+
+            # Documents without id cannot be updated in the Usage API
+            if result['id'] is None:
+                continue
+
+            try:
+                client.update_usage_state(result['id'], 'Guided')
+            except Exception as e:
+                return contract, guided, e
+
+        return contract, len(contract['records']), None
+
+    def _revert_usage(self, contract, guided, error, results):
+        not_guided = contract['records'][guided:]
+        last_usage = contract['timestamps'][guided - 1] if guided > 0 else contract['initial_usage']
+
+        reverted = rollback_contract_usage(
+            contract['order_pk'], contract['product_id'], contract['initial'] + len(contract['records']),
+            len(not_guided), last_usage)
+
+        for position in not_guided:
+            results[position]['status'] = 'Received'
+            results[position]['error'] = (NOT_GUIDED_MSG if reverted else NOT_REVERTED_MSG) + ': ' + unicode(error)
+
+    def _update_states(self, results):
+        rejected = []
+        for result in results:
+            result['status'] = 'Rejected' if 'error' in result else 'Guided'
+
+            # Documents without id cannot be updated in the Usage API
+            if result['status'] == 'Rejected' and result['id'] is not None:
+                rejected.append(result)
+
+        contracts = [contract for contract in self._contracts.values() if contract['applied']]
+
+        if not len(rejected) and not len(contracts):
+            return
+
+        workers = getattr(settings, 'SDR_BATCH_WORKERS', 8)
+        client = UsageClient()
+        pool = ThreadPool(workers)
+
+        try:
+            for result, error in pool.imap_unordered(lambda r: self._update_state(client, r), rejected):
+                if error is not None:
+                    result['stateError'] = 'The usage state could not be updated: ' + unicode(error)
+
+            # Different contracts are guided concurrently
+            for contract, guided, error in pool.imap_unordered(lambda c: self._guide_contract(client, c, results), contracts):
+                if error is not None:
+                    self._revert_usage(contract, guided, error, results)
+        finally:
+            pool.close()
+            pool.join()
+
+    def process(self, records):
+        """
+        Validates and applies a batch of SDRs. SDRs of the same contract must be
+        included in the order of their correlation numbers
+        :param records: List of SDR documents
+        :return: List with the result of every SDR, in the same order
+        """
+        results = []
+
+        self._validate_records(records, results)
+        self._apply_usage(results)
+        self._update_states(results)
+
+        for result in results:
+            result['result'] = 'error' if 'error' in result else 'correct'
+
+        return results
@@ -23,15 +23,17 @@ from __future__ import unicode_literals
 import json
 
 from copy import deepcopy
-from datetime import datetime
-from mock import MagicMock
+from datetime import datetime, timedelta
+from mock import MagicMock, call
 from nose_parameterized import parameterized
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.exceptions import PermissionDenied
 
 from wstore.charging_engine.accounting import sdr_manager
 from wstore.charging_engine.accounting import usage_client
+from wstore.charging_engine.accounting import usage_rater
 from wstore.charging_engine.accounting.errors import UsageError
 from wstore.charging_engine.accounting import views
 
@@ -70,22 +72,25 @@ class SDRManagerTestCase(TestCase):
         org.pk = '1111'
         sdr_manager.Organization.objects.filter.return_value = [org]
 
-        # Create Order mock
-        self._order = MagicMock()
-        self._order.owner_organization = org
-
-        self._contract = MagicMock()
-        self._contract.pricing_model = {
-            'pay_per_use': [{
-                'unit': 'invocation'
-            }]
+        # Create contract location mock
+        self._location = MagicMock()
+        self._location.owner_organization = '1111'
+        self._location.order_pk = '5'
+        self._location.order_id = '1'
+        self._location.index = 0
+        self._location.contract = {
+            'pricing_model': {
+                'pay_per_use': [{
+                    'unit': 'invocation'
+                }]
+            },
+            'correlation_number': 1,
+            'last_usage': None
         }
-        self._contract.correlation_number = 1
-        self._contract.last_usage = None
 
+        sdr_manager.locate_product_contract = MagicMock(return_value=self._location)
         sdr_manager.Order = MagicMock()
-        sdr_manager.Order.objects.get.return_value = self._order
-        self._order.get_product_contract.return_value = self._contract
+        sdr_manager.Order.objects.filter.return_value.count.return_value = 1
 
         self._user = MagicMock()
         self._user.is_staff = True
@@ -106,7 +111,7 @@ class SDRManagerTestCase(TestCase):
         }]
 
     def _side_inv_purchase(self):
-        self._contract.pricing_model = {
+        self._location.contract['pricing_model'] = {
             'global_currency': 'EUR',
             'single_payment': [{
                 'value': 10
@@ -114,7 +119,7 @@ class SDRManagerTestCase(TestCase):
         }
 
     def _side_inv_label(self):
-        self._contract.pricing_model = {
+        self._location.contract['pricing_model'] = {
             'global_currency': 'EUR',
             'pay_per_use': [{
                 'value': 10,
@@ -123,13 +128,14 @@ class SDRManagerTestCase(TestCase):
         }
 
     def _side_inv_time(self):
-        self._contract.last_usage = datetime.strptime('2016-05-01 11:10:01.234', '%Y-%m-%d %H:%M:%S.%f')
+        self._location.contract['last_usage'] = datetime.strptime('2016-05-01 11:10:01.234', '%Y-%m-%d %H:%M:%S.%f')
 
     def _side_inv_order(self):
-        sdr_manager.Order.objects.get.side_effect = Exception()
+        sdr_manager.locate_product_contract.return_value = None
+        sdr_manager.Order.objects.filter.return_value.count.return_value = 0
 
     def _side_inv_product(self):
-        self._order.get_product_contract.side_effect = Exception()
+        sdr_manager.locate_product_contract.return_value = None
 
     def _mod_inc_corr(self, sdr):
         sdr['usageCharacteristic'][2]['value'] = '2'
@@ -198,11 +204,10 @@ class SDRManagerTestCase(TestCase):
             self.assertTrue(error is None)
             sdr_manager.Organization.objects.filter.assert_called_once_with(name='test_user')
 
-            sdr_manager.Order.objects.get.assert_called_once_with(order_id='1')
-            self._order.get_product_contract.assert_called_once_with('2')
+            sdr_manager.locate_product_contract.assert_called_once_with(
+                '2', order_id='1', fields=('correlation_number', 'last_usage', 'pricing_model'))
 
-            self.assertEquals(self._contract, sdr_mng._contract)
-            self.assertEquals(self._order, sdr_mng._order)
+            self.assertEquals(self._location, sdr_mng._location)
             self.assertEquals(self._timestamp, sdr_mng._time_stamp)
 
             sdr_manager.User.objects.get.assert_called_once_with(username='test_user')
@@ -210,19 +215,228 @@ class SDRManagerTestCase(TestCase):
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(unicode(e), err_msg)
 
-    def test_update_usage(self):
+    def _test_update_usage(self, updated):
+        sdr_manager.advance_contract_usage = MagicMock(return_value=updated)
+        self._location.contract['product_id'] = '2'
+
         sdr_mng = sdr_manager.SDRManager()
-        sdr_mng._contract = self._contract
-        sdr_mng._order = self._order
+        sdr_mng._location = self._location
         sdr_mng._time_stamp = self._timestamp
 
-        sdr_mng.update_usage()
+        error = None
+        try:
+            sdr_mng.update_usage()
+        except ValueError as e:
+            error = e
+
+        sdr_manager.advance_contract_usage.assert_called_once_with('5', '2', 1, last_usage=self._timestamp)
+        self.assertEquals(0, sdr_manager.Order.objects.get.call_count)
+        return error
+
+    def test_update_usage(self):
+        self.assertTrue(self._test_update_usage(True) is None)
+
+    def test_update_usage_concurrent(self):
+        error = self._test_update_usage(False)
+        self.assertEquals(sdr_manager.CONCURRENT_UPDATE_MSG, unicode(error))
+
+        # The contract is located again to check the cause of the error
+        sdr_manager.locate_product_contract.assert_called_once_with('2', order_id='1')
+
+    def test_update_usage_contract_removed(self):
+        sdr_manager.locate_product_contract.return_value = None
+
+        error = self._test_update_usage(False)
+        self.assertEquals(sdr_manager.CONTRACT_REMOVED_MSG, unicode(error))
+
+    def test_rollback_usage(self):
+        sdr_manager.rollback_contract_usage = MagicMock(return_value=True)
+        self._location.contract['product_id'] = '2'
+        self._location.contract['last_usage'] = self._timestamp
+
+        sdr_mng = sdr_manager.SDRManager()
+        sdr_mng._location = self._location
 
-        self.assertEquals(2, self._contract.correlation_number)
-        self.assertEquals(
-            self._timestamp, self._contract.last_usage)
+        self.assertTrue(sdr_mng.rollback_usage())
+        sdr_manager.rollback_contract_usage.assert_called_once_with('5', '2', 2, last_usage=self._timestamp)
+
+
+def _build_sdr(sdr_id, correlation_number, date, order_id='1'):
+    sdr = deepcopy(BASIC_SDR)
+    sdr['id'] = sdr_id
+    sdr['date'] = date
+    sdr['usageCharacteristic'][0]['value'] = order_id
+    sdr['usageCharacteristic'][2]['value'] = correlation_number
+    return sdr
+
+
+class SDRBatchManagerTestCase(TestCase):
+
+    tags = ('sdr',)
+
+    def setUp(self):
+        sdr_manager.Organization = MagicMock()
+        sdr_manager.Organization.objects.filter.return_value = [MagicMock()]
+
+        self._location = MagicMock()
+        self._location.owner_organization = '1111'
+        self._location.order_pk = '5'
+        self._location.order_id = '1'
+        self._location.contract = {
+            'product_id': '2',
+            'pricing_model': {
+                'pay_per_use': [{
+                    'unit': 'invocation'
+                }]
+            },
+            'correlation_number': 1,
+            'last_usage': None
+        }
+
+        sdr_manager.locate_product_contract = MagicMock(side_effect=lambda product_id, order_id=None, fields=(): self._location if order_id == '1' else None)
+        sdr_manager.advance_contract_usage = MagicMock(return_value=True)
+        sdr_manager.rollback_contract_usage = MagicMock(return_value=True)
+
+        sdr_manager.Order = MagicMock()
+        sdr_manager.Order.objects.filter.return_value.count.return_value = 0
+
+        user = MagicMock()
+        user.userprofile.organizations = [{
+            'organization': '1111'
+        }]
+        sdr_manager.User = MagicMock()
+        sdr_manager.User.objects.get.return_value = user
 
-        self._order.save.assert_called_once_with()
+        sdr_manager.UsageClient = MagicMock()
+
+        self._records = [
+            _build_sdr('1', '1', '2015-10-20 17:31:57.100000'),
+            _build_sdr('2', '2', '2015-10-20 17:32:57.100000'),
+            _build_sdr('3', '2', '2015-10-20 17:33:57.100000'),
+            _build_sdr('4', '3', '2015-10-20 17:34:57.100000', order_id='2'),
+            _build_sdr('5', '3', '2015-10-20 17:35:57.100000'),
+            'invalid'
+        ]
+
+    def tearDown(self):
+        reload(sdr_manager)
+
+    def test_process_batch(self):
+        results = sdr_manager.SDRBatchManager().process(self._records)
+
+        self.assertEquals([{
+            'id': '1',
+            'status': 'Guided',
+            'result': 'correct'
+        }, {
+            'id': '2',
+            'status': 'Guided',
+            'result': 'correct'
+        }, {
+            'id': '3',
+            'status': 'Rejected',
+            'result': 'error',
+            'error': 'Invalid correlation number, expected: 3'
+        }, {
+            'id': '4',
+            'status': 'Rejected',
+            'result': 'error',
+            'error': 'Invalid orderId, the order does not exists'
+        }, {
+            'id': '5',
+            'status': 'Guided',
+            'result': 'correct'
+        }, {
+            'id': None,
+            'status': 'Rejected',
+            'result': 'error',
+            'error': 'The SDR is not a valid JSON object'
+        }], results)
+
+        # Lookups are shared by the whole batch
+        self.assertEquals(2, sdr_manager.locate_product_contract.call_count)
+        sdr_manager.Organization.objects.filter.assert_called_once_with(name='test_user')
+        sdr_manager.User.objects.get.assert_called_once_with(username='test_user')
+
+        # The usage of the contract is advanced once
+        sdr_manager.advance_contract_usage.assert_called_once_with(
+            '5', '2', 1, 3, datetime(2015, 10, 20, 17, 35, 57, 100000))
+
+        self.assertEquals(sorted([
+            call('1', 'Guided'),
+            call('2', 'Guided'),
+            call('3', 'Rejected'),
+            call('4', 'Rejected'),
+            call('5', 'Guided')
+        ]), sorted(sdr_manager.UsageClient().update_usage_state.call_args_list))
+        self.assertEquals(0, sdr_manager.rollback_contract_usage.call_count)
+
+    def test_process_batch_concurrent_update(self):
+        sdr_manager.advance_contract_usage.return_value = False
+
+        results = sdr_manager.SDRBatchManager().process(self._records[:2])
+
+        self.assertEquals(['error', 'error'], [result['result'] for result in results])
+        self.assertEquals(['Rejected', 'Rejected'], [result['status'] for result in results])
+        self.assertEquals([
+            'The contract has been modified by other request, the SDR must be sent again',
+            'The contract has been modified by other request, the SDR must be sent again'
+        ], [result['error'] for result in results])
+
+    def test_process_batch_contract_removed(self):
+        sdr_manager.advance_contract_usage.return_value = False
+        sdr_manager.locate_product_contract.side_effect = [self._location, None]
+
+        results = sdr_manager.SDRBatchManager().process(self._records[:2])
+
+        # The records of a contract removed meanwhile are not asked to be sent again
+        self.assertEquals(['Rejected', 'Rejected'], [result['status'] for result in results])
+        self.assertEquals([
+            'The contract does not exist anymore, the SDR cannot be applied',
+            'The contract does not exist anymore, the SDR cannot be applied'
+        ], [result['error'] for result in results])
+
+    def test_process_batch_state_error(self):
+        sdr_manager.UsageClient().update_usage_state.side_effect = Exception('Server error')
+
+        results = sdr_manager.SDRBatchManager().process(self._records[2:3])
+
+        self.assertEquals([{
+            'id': '3',
+            'status': 'Rejected',
+            'result': 'error',
+            'error': 'Invalid correlation number, expected: 1',
+            'stateError': 'The usage state could not be updated: Server error'
+        }], results)
+
+    def _guided_state_error(self, state_id, state):
+        if state_id == '2':
+            raise Exception('Server error')
+
+    @parameterized.expand([
+        ('reverted', True, sdr_manager.NOT_GUIDED_MSG),
+        ('not_reverted', False, sdr_manager.NOT_REVERTED_MSG)
+    ])
+    def test_process_batch_guided_error(self, name, reverted, msg):
+        sdr_manager.rollback_contract_usage.return_value = reverted
+        sdr_manager.UsageClient().update_usage_state.side_effect = self._guided_state_error
+
+        results = sdr_manager.SDRBatchManager().process(self._records[:2])
+
+        self.assertEquals([{
+            'id': '1',
+            'status': 'Guided',
+            'result': 'correct'
+        }, {
+            'id': '2',
+            'status': 'Received',
+            'result': 'error',
+            'error': msg + ': Server error'
+        }], results)
+
+        # Only the usage documents not guided are reverted
+        sdr_manager.rollback_contract_usage.assert_called_once_with(
+            '5', '2', 3, 1, datetime(2015, 10, 20, 17, 31, 57, 100000))
 
 BASIC_USAGE = {
     'id': '3',
@@ -252,7 +466,7 @@ class UsageClientTestCase(TestCase):
 
     def setUp(self):
         usage_client.settings.USAGE = 'http://example.com/DSUsageManagement'
-        usage_client.requests = MagicMock()
+        usage_client.http_client = MagicMock()
         self._old_inv = usage_client.settings.INVENTORY
         usage_client.settings.INVENTORY = 'http://localhost:8080/DSProductInventory'
 
@@ -271,7 +485,7 @@ class UsageClientTestCase(TestCase):
         # Create mocks
         mock_response = MagicMock()
         mock_response.json.return_value = response
-        usage_client.requests.get.return_value = mock_response
+        usage_client.http_client.get.return_value = mock_response
         client = usage_client.UsageClient()
 
         cust_usage = client.get_customer_usage(self._customer, self._product_id, state=state)
@@ -280,14 +494,77 @@ class UsageClientTestCase(TestCase):
         self.assertEquals(exp_resp, cust_usage)
 
         # Verify calls
-        usage_client.requests.get.assert_called_once_with(
-            usage_client.settings.USAGE + '/api/usageManagement/v2/usage?relatedParty.id=' + self._customer + extra_query,
+        usage_client.http_client.get.assert_called_once_with(
+            usage_client.settings.USAGE + '/api/usageManagement/v2/usage?relatedParty.id=' + self._customer + extra_query + '&offset=0&size=500',
             headers={u'Accept': u'application/json'}
         )
 
         mock_response.raise_for_status.assert_called_once_with()
         mock_response.json.assert_called_once_with()
 
+    def _get_usage_page(self, ids, product_id):
+        page = []
+        for usage_id in ids:
+            usage = deepcopy(BASIC_USAGE)
+            usage['id'] = usage_id
+            usage['usageCharacteristic'][1]['value'] = product_id
+            page.append(usage)
+
+        return page
+
+    def test_retrieve_usage_paged(self):
+        pages = [
+            self._get_usage_page(['1', '2'], self._product_id),
+            self._get_usage_page(['3', '4'], '2'),
+            self._get_usage_page(['5'], self._product_id)
+        ]
+        responses = [MagicMock(), MagicMock(), MagicMock()]
+        for response, page in zip(responses, pages):
+            response.json.return_value = page
+
+        usage_client.http_client.get.side_effect = responses
+        client = usage_client.UsageClient()
+
+        cust_usage = client.iter_customer_usage(self._customer, self._product_id, state='Guided', page_size=2)
+
+        # Usage documents are lazily retrieved
+        self.assertEquals(0, usage_client.http_client.get.call_count)
+        self.assertEquals(['1', '2', '5'], [usage['id'] for usage in cust_usage])
+
+        url = usage_client.settings.USAGE + '/api/usageManagement/v2/usage?relatedParty.id=' + self._customer + '&status=Guided'
+        self.assertEquals([
+            call(url + '&offset=0&size=2', headers={u'Accept': u'application/json'}),
+            call(url + '&offset=2&size=2', headers={u'Accept': u'application/json'}),
+            call(url + '&offset=4&size=2', headers={u'Accept': u'application/json'})
+        ], usage_client.http_client.get.call_args_list)
+
+    def test_retrieve_usage_paging_not_supported(self):
+        response = MagicMock()
+        response.json.return_value = self._get_usage_page(['1', '2'], self._product_id)
+        usage_client.http_client.get.return_value = response
+
+        client = usage_client.UsageClient()
+        cust_usage = list(client.iter_customer_usage(self._customer, self._product_id, page_size=2))
+
+        # The same page is returned again, so the usage is not duplicated
+        self.assertEquals(['1', '2'], [usage['id'] for usage in cust_usage])
+        self.assertEquals(2, usage_client.http_client.get.call_count)
+
+    @override_settings(USAGE_PRODUCT_FILTER=True)
+    def test_retrieve_usage_product_filter(self):
+        response = MagicMock()
+        response.json.return_value = []
+        usage_client.http_client.get.return_value = response
+
+        client = usage_client.UsageClient()
+        self.assertEquals([], client.get_customer_usage(self._customer, self._product_id))
+
+        usage_client.http_client.get.assert_called_once_with(
+            usage_client.settings.USAGE + '/api/usageManagement/v2/usage?relatedParty.id=' + self._customer +
+            '&usageCharacteristic.value=' + self._product_id + '&offset=0&size=500',
+            headers={u'Accept': u'application/json'}
+        )
+
     def _test_invalid_state(self, method, args, kwargs):
         error = None
         try:
@@ -304,12 +581,12 @@ class UsageClientTestCase(TestCase):
 
     def _test_patch(self, expected_json, method, args):
         mock_response = MagicMock()
-        usage_client.requests.patch.return_value = mock_response
+        usage_client.http_client.patch.return_value = mock_response
 
         method(*args)
 
         # Verify calls
-        usage_client.requests.patch.assert_called_once_with(
+        usage_client.http_client.patch.assert_called_once_with(
             usage_client.settings.USAGE + '/api/usageManagement/v2/usage/' + BASIC_USAGE['id'],
             json=expected_json
         )
@@ -367,6 +644,175 @@ class UsageClientTestCase(TestCase):
         reload(usage_client)
 
 
+class UsageRaterTestCase(TestCase):
+
+    tags = ('usage-rater',)
+
+    def setUp(self):
+        self._now = datetime(2017, 10, 30, 10, 0, 0)
+        self._collection = MagicMock()
+        usage_rater.get_database_connection = MagicMock()
+        usage_rater.get_database_connection().__getitem__.return_value = self._collection
+
+        usage_rater.datetime = MagicMock()
+        usage_rater.datetime.utcnow.return_value = self._now
+        usage_rater.uuid4 = MagicMock()
+        usage_rater.uuid4().hex = 'batch'
+        usage_rater.schedule_deadline = MagicMock()
+        usage_rater.UsageClient = MagicMock()
+
+    def tearDown(self):
+        reload(usage_rater)
+
+    def _get_rate(self, usage_id, attempts=0, saved=True):
+        rate = {
+            'batch': 'batch',
+            'state': 'pending',
+            'attempts': attempts,
+            'next_attempt': self._now,
+            'usage_id': usage_id,
+            'timestamp': '2016-04-15',
+            'duty_free': '10',
+            'price': '12',
+            'rate': '20',
+            'currency': 'EUR',
+            'product_id': self._product_id
+        }
+
+        if saved:
+            rate['_id'] = 'rate' + usage_id
+
+        return rate
+
+    _product_id = '1'
+
+    def _get_staged_rate(self, usage_id):
+        rate = self._get_rate(usage_id, saved=False)
+        rate['state'] = 'staged'
+        rate['discard_at'] = self._now + timedelta(seconds=3600)
+        del rate['next_attempt']
+        del rate['timestamp']
+        return rate
+
+    @override_settings(USAGE_RATING_CHUNK=2, USAGE_RATING_STAGE_TTL=3600)
+    def test_stage_rates(self):
+        rater = usage_rater.UsageRater()
+        stage = rater.stage(self._product_id, 'EUR')
+
+        stage.add({'tax_rate': '20'}, {'usage_id': '1', 'value': '1', 'duty_free': '10', 'price': '12'})
+        stage.add({'tax_rate': '20'}, {'usage_id': '2', 'value': '1', 'duty_free': '10', 'price': '12'})
+        stage.add({'tax_rate': '20'}, {'usage_id': '3', 'value': '1', 'duty_free': '10', 'price': '12'})
+        stage.flush()
+
+        self.assertEquals('batch', stage.batch_id)
+
+        # Rates are inserted in chunks while they are added
+        self.assertEquals([
+            call([self._get_staged_rate('1'), self._get_staged_rate('2')], ordered=False),
+            call([self._get_staged_rate('3')], ordered=False)
+        ], self._collection.insert_many.call_args_list)
+
+        self.assertEquals(0, usage_rater.schedule_deadline.call_count)
+
+    def test_enqueue_rates(self):
+        rater = usage_rater.UsageRater()
+        rater.enqueue('batch', '2016-04-15')
+
+        self._collection.update_many.assert_called_once_with({'batch': 'batch', 'state': 'staged'}, {
+            '$set': {'state': 'pending', 'timestamp': '2016-04-15', 'next_attempt': self._now},
+            '$unset': {'discard_at': ''}
+        })
+        usage_rater.schedule_deadline.assert_called_once_with('usage_rating', 'batch', 0)
+
+    def test_discard_rates(self):
+        rater = usage_rater.UsageRater()
+        rater.discard(['batch1', 'batch2'])
+        rater.discard([])
+
+        self._collection.delete_many.assert_called_once_with({'batch': {'$in': ['batch1', 'batch2']}, 'state': 'staged'})
+
+    def test_process_batch(self):
+        rates = [self._get_rate('1'), self._get_rate('2', attempts=1)]
+        self._collection.find().limit.side_effect = [rates, []]
+        self._collection.find_one.return_value = None
+
+        def rate_usage(usage_id, *args):
+            if usage_id == '2':
+                raise Exception('Connection error')
+
+        client = usage_rater.UsageClient()
+        client.rate_usage.side_effect = rate_usage
+
+        rater = usage_rater.UsageRater()
+        delay = rater.process_batch('batch')
+
+        self.assertEquals(None, delay)
+        self.assertEquals(2, client.rate_usage.call_count)
+        usage_rater.UsageClient.assert_called_with()
+
+        self._collection.delete_many.assert_called_once_with({'_id': {'$in': ['rate1']}})
+        self._collection.update_one.assert_called_once_with({'_id': 'rate2'}, {
+            '$set': {
+                'attempts': 2,
+                'error': 'Connection error',
+                'next_attempt': self._now + timedelta(seconds=10)
+            }
+        })
+
+    def test_process_batch_failed(self):
+        self._collection.find().limit.side_effect = [[self._get_rate('1', attempts=9)], []]
+        self._collection.find_one.return_value = None
+
+        usage_rater.UsageClient().rate_usage.side_effect = Exception('Connection error')
+
+        rater = usage_rater.UsageRater()
+        rater.process_batch('batch')
+
+        self.assertEquals(0, self._collection.delete_many.call_count)
+        self._collection.update_one.assert_called_once_with({'_id': 'rate1'}, {
+            '$set': {
+                'attempts': 10,
+                'error': 'Connection error',
+                'state': 'failed'
+            }
+        })
+
+    def test_get_rated_usage_ids(self):
+        self._collection.distinct.return_value = ['1', '2']
+
+        rater = usage_rater.UsageRater()
+
+        self.assertEquals(set(['1', '2']), rater.get_rated_usage_ids(self._product_id))
+        self._collection.distinct.assert_called_once_with('usage_id', {'product_id': self._product_id, 'state': {'$ne': 'staged'}})
+
+    def test_retry_failed(self):
+        self._collection.distinct.return_value = ['batch1', 'batch2']
+        self._collection.update_many.return_value = MagicMock(modified_count=3)
+
+        rater = usage_rater.UsageRater()
+        retried = rater.retry_failed()
+
+        self.assertEquals(3, retried)
+        self._collection.distinct.assert_called_once_with('batch', {'state': 'failed'})
+        self._collection.update_many.assert_called_once_with({'state': 'failed'}, {
+            '$set': {'state': 'pending', 'attempts': 0, 'next_attempt': self._now}
+        })
+        self.assertEquals([
+            call('usage_rating', 'batch1', 0),
+            call('usage_rating', 'batch2', 0)
+        ], usage_rater.schedule_deadline.call_args_list)
+
+    def test_rating_handler_reschedule(self):
+        self._collection.find().limit.return_value = []
+        rate = self._get_rate('1')
+        rate['next_attempt'] = self._now + timedelta(seconds=20)
+        self._collection.find_one.return_value = rate
+
+        usage_rater.usage_rating_handler('batch', {})
+
+        usage_rater.schedule_deadline.assert_called_once_with('usage_rating', 'batch', 20)
+
+
 MANAGER_DENIED_RESP = {
     'result': 'error',
     'error': 'Permission denied'
@@ -384,7 +830,9 @@ class SDRCollectionTestCase(TestCase):
 
     def setUp(self):
         views.Order = MagicMock()
+        views.get_product_contract = MagicMock(return_value=(MagicMock(), MagicMock()))
         views.SDRManager = MagicMock()
+        views.SDRBatchManager = MagicMock()
 
         self._manager_inst = MagicMock()
         views.SDRManager.return_value = self._manager_inst
@@ -399,10 +847,11 @@ class SDRCollectionTestCase(TestCase):
         self.request.GET.get.return_value = None
 
     def _inv_order(self):
-        views.Order.objects.get.side_effect = Exception('Not found')
+        views.get_product_contract.side_effect = Exception('Not found')
+        views.Order.objects.filter.return_value.count.return_value = 0
 
     def _inv_product(self):
-        views.Order.objects.get().get_product_contract.side_effect = Exception('Not found')
+        views.get_product_contract.side_effect = Exception('Not found')
 
     def _permission_denied(self):
         self._manager_inst.validate_sdr.side_effect = PermissionDenied('Permission denied')
@@ -413,6 +862,9 @@ class SDRCollectionTestCase(TestCase):
     def _exception(self):
         self._manager_inst.validate_sdr.side_effect = Exception('error')
 
+    def _update_error(self):
+        self._manager_inst.update_usage.side_effect = ValueError('Value error')
+
     def _validate_response(self, response, exp_code, exp_response):
         # Validate response
         self.assertEquals(exp_code, response.status_code)
@@ -431,6 +883,7 @@ class SDRCollectionTestCase(TestCase):
         }),
         ('manager_permission_denied', BASIC_SDR, 403, MANAGER_DENIED_RESP, _permission_denied),
         ('manager_value_error', BASIC_SDR, 422, MANAGER_VALUE_RESP, _value_error),
+        ('manager_update_error', BASIC_SDR, 422, MANAGER_VALUE_RESP, _update_error),
         ('manager_exception', BASIC_SDR, 500, {
             'result': 'error',
             'error': 'The SDR document could not be processed due to an unexpected error'
@@ -461,6 +914,68 @@ class SDRCollectionTestCase(TestCase):
                 self._manager_inst.validate_sdr.assert_called_once_with(parsed_data)
                 views.UsageClient().update_usage_state.assert_called_once_with('1', 'Guided')
                 self._manager_inst.update_usage.assert_called_once_with()
+                self.assertEquals(0, self._manager_inst.rollback_usage.call_count)
+            elif name != 'manager_update_error':
+                views.UsageClient().update_usage_state.assert_called_once_with('1', 'Rejected')
+                self.assertEquals(0, self._manager_inst.update_usage.call_count)
             else:
                 views.UsageClient().update_usage_state.assert_called_once_with('1', 'Rejected')
-                self.assertEquals(0, self._manager_inst.update_usage.call_count)
\ No newline at end of file
+
+    def test_feed_sdr_guided_error(self):
+        data = deepcopy(BASIC_SDR)
+        data['id'] = '1'
+        self.request.body = json.dumps(data)
+
+        views.UsageClient().update_usage_state.side_effect = Exception('Server error')
+
+        collection = views.ServiceRecordCollection(permitted_methods=('POST',))
+        response = collection.create(self.request)
+
+        self._validate_response(response, 500, {
+            'result': 'error',
+            'error': views.NOT_GUIDED_MSG
+        })
+
+        # The usage is reverted so the SDR can be sent again
+        self._manager_inst.update_usage.assert_called_once_with()
+        self._manager_inst.rollback_usage.assert_called_once_with()
+
+    @parameterized.expand([
+        ('array', 'application/json', json.dumps([BASIC_SDR, BASIC_SDR])),
+        ('ndjson', 'application/x-ndjson', json.dumps(BASIC_SDR) + '\n\n' + json.dumps(BASIC_SDR) + '\n')
+    ])
+    def test_feed_sdr_batch(self, name, content_type, data):
+        self.request.META.get.side_effect = lambda key, default=None: content_type if key == 'CONTENT_TYPE' else 'application/json'
+        self.request.body = data
+
+        records = [{'id': '1', 'status': 'Guided', 'result': 'correct'}]
+        views.SDRBatchManager().process.return_value = records
+
+        collection = views.ServiceRecordBatchCollection(permitted_methods=('POST',))
+        response = collection.create(self.request)
+
+        self._validate_response(response, 200, {
+            'result': 'correct',
+            'records': records
+        })
+        views.SDRBatchManager().process.assert_called_once_with([BASIC_SDR, BASIC_SDR])
+
+    @parameterized.expand([
+        ('invalid_json', 'application/json', 'invalid', 400, 'The request does not contain a valid JSON array or NDJSON stream'),
+        ('not_array', 'application/json', json.dumps(BASIC_SDR), 400, 'The request does not contain a valid JSON array or NDJSON stream'),
+        ('invalid_ndjson', 'application/x-ndjson', json.dumps(BASIC_SDR) + '\ninvalid', 400, 'The request does not contain a valid JSON array or NDJSON stream'),
+        ('too_many', 'application/json', json.dumps([BASIC_SDR, BASIC_SDR, BASIC_SDR]), 413, 'The batch cannot contain more than 2 SDRs')
+    ])
+    @override_settings(SDR_BATCH_MAX_RECORDS=2)
+    def test_feed_sdr_batch_invalid(self, name, content_type, data, exp_code, exp_error):
+        self.request.META.get.side_effect = lambda key, default=None: content_type if key == 'CONTENT_TYPE' else 'application/json'
+        self.request.body = data
+
+        collection = views.ServiceRecordBatchCollection(permitted_methods=('POST',))
+        response = collection.create(self.request)
+
+        self._validate_response(response, exp_code, {
+            'result': 'error',
+            'error': exp_error
+        })
+        self.assertEquals(0, views.SDRBatchManager().process.call_count)
\ No newline at end of file
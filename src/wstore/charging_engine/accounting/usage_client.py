@@ -21,12 +21,12 @@
 
 from __future__ import unicode_literals
 
-import requests
 from urlparse import urljoin, urlparse
 
 from django.conf import settings
 
 from wstore.charging_engine.accounting.errors import UsageError
+from wstore.store_commons import http_client
 
 
 class UsageClient(object):
@@ -57,7 +57,7 @@ class UsageClient(object):
             'Host': urlparse(settings.SITE).netloc
         }
 
-        r = requests.post(url, headers=headers, json=usage_item)
+        r = http_client.post(url, headers=headers, json=usage_item)
         r.raise_for_status()
 
         return r.json()
@@ -92,17 +92,53 @@ class UsageClient(object):
         path = 'api/usageManagement/v2/usageSpecification/' + spec_id
         url = urljoin(self._usage_api, path)
 
-        r = requests.delete(url)
+        r = http_client.delete(url)
         r.raise_for_status()
 
-    def get_customer_usage(self, customer, product_id, state=None):
+    def _get_usage_page(self, url, offset, size):
+        r = http_client.get(url + '&offset=' + unicode(offset) + '&size=' + unicode(size), headers={
+            'Accept': 'application/json'
+        })
+
+        r.raise_for_status()
+        return r.json()
+
+    def _iter_usage_pages(self, url, product_id, page_size):
+        offset = 0
+        first_doc = None
+        while True:
+            page = self._get_usage_page(url, offset, page_size)
+
+            # The API may ignore paging parameters returning the same documents
+            if not len(page) or (offset > 0 and page[0] == first_doc):
+                break
+
+            first_doc = page[0]
+
+            # Filter only the usage belonging to the specified product
+            for usage_doc in page:
+                if self._belongs_to_product(usage_doc, product_id):
+                    yield usage_doc
+
+            # If the page is not full or bigger than requested there are no more pages
+            if len(page) != page_size:
+                break
+
+            offset += page_size
+
+    def iter_customer_usage(self, customer, product_id, state=None, page_size=None):
         """
-        Retrieves the usage made by a customer filtered by service and status
+        Lazily retrieves the usage made by a customer filtered by service and status. Usage
+        documents are requested in pages, so only a page is kept in memory at a time
         :param customer: username of the customer
         :param product_id: id of the acquired product being used
         :param state: state of the usage to be retrieved
-        :return: List of customer usages
+        :param page_size: number of usage documents requested per page
+        :return: Generator of customer usages
         """
+        if page_size is None:
+            page_size = getattr(settings, 'USAGE_PAGE_SIZE', 500)
+
         # Get customer usage filtered by state
         path = 'api/usageManagement/v2/usage'
         url = urljoin(self._usage_api, path) + '?relatedParty.id=' + customer
@@ -111,21 +147,27 @@ class UsageClient(object):
             self._validate_state(state)
             url += '&status=' + state
 
-        r = requests.get(url, headers={
-            'Accept': 'application/json'
-        })
+        # Filter by product in the Usage API if supported
+        if getattr(settings, 'USAGE_PRODUCT_FILTER', False):
+            url += '&usageCharacteristic.value=' + product_id
 
-        r.raise_for_status()
+        return self._iter_usage_pages(url, product_id, page_size)
 
-        raw_usage = r.json()
-        # Filter only the usage belonging to the specified product
-        return [usage_doc for usage_doc in raw_usage if self._belongs_to_product(usage_doc, product_id)]
+    def get_customer_usage(self, customer, product_id, state=None):
+        """
+        Retrieves the usage made by a customer filtered by service and status
+        :param customer: username of the customer
+        :param product_id: id of the acquired product being used
+        :param state: state of the usage to be retrieved
+        :return: List of customer usages
+        """
+        return list(self.iter_customer_usage(customer, product_id, state=state))
 
     def _patch_usage(self, usage_id, patch):
         path = 'api/usageManagement/v2/usage/' + unicode(usage_id)
         url = urljoin(self._usage_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = http_client.patch(url, json=patch)
         r.raise_for_status()
 
     def update_usage_state(self, usage_id, state):
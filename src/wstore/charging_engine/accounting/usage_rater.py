@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
+
+from pymongo import ASCENDING
+
+from django.conf import settings
+
+from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.scheduler import schedule_deadline
+
+
+RATING_COLLECTION = 'wstore_usage_rating'
+
+
+class RatingStage(object):
+    """
+    Stages the rates of the usage documents of a charge in the journal while they are
+    priced, so the usage documents are not kept in memory until the charge is confirmed
+    """
+
+    def __init__(self, collection, product_id, currency):
+        self._collection = collection
+        self._product_id = product_id
+        self._currency = currency
+        self._rates = []
+        self._discard_at = datetime.utcnow() + timedelta(seconds=getattr(settings, 'USAGE_RATING_STAGE_TTL', 24 * 3600))
+        self.batch_id = uuid4().hex
+
+    def add(self, model, sdr_info):
+        """
+        Stages the rate of a usage document
+        :param model: Pricing component applied to the usage document
+        :param sdr_info: Usage id, value, price and duty free of the usage document
+        """
+        self._rates.append({
+            'batch': self.batch_id,
+            'state': 'staged',
+            'discard_at': self._discard_at,
+            'attempts': 0,
+            'usage_id': sdr_info['usage_id'],
+            'duty_free': sdr_info['duty_free'],
+            'price': sdr_info['price'],
+            'rate': model['tax_rate'],
+            'currency': self._currency,
+            'product_id': self._product_id
+        })
+
+        if len(self._rates) == getattr(settings, 'USAGE_RATING_CHUNK', 500):
+            self.flush()
+
+    def flush(self):
+        if len(self._rates):
+            self._collection.insert_many(self._rates, ordered=False)
+            self._rates = []
+
+
+class UsageRater(object):
+    """
+    Rates usage documents asynchronously. The rates to be applied are persisted in a
+    journal, so the rating can be resumed if the process dies, and are sent to the
+    Usage API concurrently by a bounded pool of workers sharing the keep-alive session
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection()[RATING_COLLECTION]
+        self._collection.create_index([('batch', ASCENDING), ('state', ASCENDING), ('next_attempt', ASCENDING)])
+        self._collection.create_index([('product_id', ASCENDING), ('usage_id', ASCENDING)])
+
+        # Staged rates of charges never confirmed nor discarded are removed by MongoDB
+        self._collection.create_index([('discard_at', ASCENDING)], expireAfterSeconds=0)
+
+    def stage(self, product_id, currency):
+        """
+        Creates a rating batch whose rates are staged until the charge is confirmed
+        :param product_id: Id of the product that generates the usage
+        :param currency: currency of the charge
+        :return: RatingStage where the rates of the usage documents are added
+        """
+        return RatingStage(self._collection, product_id, currency)
+
+    def enqueue(self, batch_id, timestamp):
+        """
+        Moves the staged rates of a confirmed charge to pending and schedules their processing
+        :param batch_id: Id of the rating batch
+        :param timestamp: Timestamp when the used was rated
+        """
+        self._collection.update_many({'batch': batch_id, 'state': 'staged'}, {
+            '$set': {'state': 'pending', 'timestamp': timestamp, 'next_attempt': datetime.utcnow()},
+            '$unset': {'discard_at': ''}
+        })
+
+        schedule_deadline('usage_rating', batch_id, 0)
+
+    def discard(self, batch_ids):
+        """
+        Removes the staged rates of charges that have not been confirmed
+        :param batch_ids: Ids of the rating batches
+        """
+        if len(batch_ids):
+            self._collection.delete_many({'batch': {'$in': batch_ids}, 'state': 'staged'})
+
+    def get_rated_usage_ids(self, product_id):
+        """
+        Returns the usage documents of a product included in the journal. They have been
+        already charged, even if they are still Guided until their rating ends. Staged
+        rates belong to charges not confirmed yet
+        :param product_id: Id of the product that generates the usage
+        :return: Set with the ids of the usage documents
+        """
+        return set(self._collection.distinct('usage_id', {'product_id': product_id, 'state': {'$ne': 'staged'}}))
+
+    def retry_failed(self):
+        """
+        Moves the rates that exceeded the maximum number of attempts back to pending
+        :return: Number of rates to be retried
+        """
+        batches = self._collection.distinct('batch', {'state': 'failed'})
+        result = self._collection.update_many({'state': 'failed'}, {
+            '$set': {'state': 'pending', 'attempts': 0, 'next_attempt': datetime.utcnow()}
+        })
+
+        for batch_id in batches:
+            schedule_deadline('usage_rating', batch_id, 0)
+
+        return result.modified_count
+
+    def get_metrics(self):
+        """
+        Returns the number of pending and failed rates
+        """
+        return {
+            'pending': self._collection.count({'state': 'pending'}),
+            'failed': self._collection.count({'state': 'failed'})
+        }
+
+    def _rate(self, client, rate):
+        try:
+            client.rate_usage(
+                rate['usage_id'],
+                rate['timestamp'],
+                rate['duty_free'],
+                rate['price'],
+                rate['rate'],
+                rate['currency'],
+                rate['product_id']
+            )
+        except Exception as e:
+            return rate, e
+
+        return rate, None
+
+    def _failed(self, rate, error):
+        attempts = rate['attempts'] + 1
+        update = {
+            'attempts': attempts,
+            'error': unicode(error)
+        }
+
+        if attempts < getattr(settings, 'USAGE_RATING_MAX_ATTEMPTS', 10):
+            # Exponential backoff between attempts
+            backoff = getattr(settings, 'USAGE_RATING_BACKOFF', 5) * (2 ** (attempts - 1))
+            update['next_attempt'] = datetime.utcnow() + timedelta(seconds=backoff)
+        else:
+            # Failed rates are kept in the journal, so the usage is not charged
+            # again, until they are retried with the retry_usage_rating command
+            update['state'] = 'failed'
+
+        self._collection.update_one({'_id': rate['_id']}, {'$set': update})
+
+    def process_batch(self, batch_id):
+        """
+        Sends the pending rates of a batch that are ready to be retried
+        :return: Number of seconds until the next retry, None if there are not pending rates
+        """
+        workers = getattr(settings, 'USAGE_RATING_WORKERS', 8)
+        chunk_size = getattr(settings, 'USAGE_RATING_CHUNK', 500)
+
+        client = UsageClient()
+        pool = ThreadPool(workers)
+
+        try:
+            while True:
+                rates = list(self._collection.find({
+                    'batch': batch_id,
+                    'state': 'pending',
+                    'next_attempt': {'$lte': datetime.utcnow()}
+                }).limit(chunk_size))
+
+                if not len(rates):
+                    break
+
+                rated = []
+                for rate, error in pool.imap_unordered(lambda r: self._rate(client, r), rates):
+                    if error is None:
+                        rated.append(rate['_id'])
+                    else:
+                        self._failed(rate, error)
+
+                if len(rated):
+                    self._collection.delete_many({'_id': {'$in': rated}})
+        finally:
+            pool.close()
+            pool.join()
+
+        next_rate = self._collection.find_one({
+            'batch': batch_id,
+            'state': 'pending'
+        }, sort=[('next_attempt', ASCENDING)])
+
+        if next_rate is None:
+            return None
+
+        return max((next_rate['next_attempt'] - datetime.utcnow()).total_seconds(), 0)
+
+
+def usage_rating_handler(batch_id, data):
+    """
+    Deadline handler that processes a usage rating batch, rescheduling it while
+    there are rates waiting to be retried
+    """
+    delay = UsageRater().process_batch(batch_id)
+
+    if delay is not None:
+        schedule_deadline('usage_rating', batch_id, delay)
@@ -22,14 +22,16 @@ from __future__ import unicode_literals
 
 import json
 
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 
-from wstore.charging_engine.accounting.sdr_manager import SDRManager
+from wstore.charging_engine.accounting.sdr_manager import SDRManager, SDRBatchManager, NOT_GUIDED_MSG
 from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.ordering.contract_index import get_product_contract
 from wstore.ordering.models import Order
 from wstore.asset_manager.resource_plugins.decorators import on_usage_refreshed
 from wstore.store_commons.resource import Resource
-from wstore.store_commons.utils.http import build_response, supported_request_mime_types
+from wstore.store_commons.utils.http import build_response, get_content_type, supported_request_mime_types, JsonResponse
 
 
 class ServiceRecordCollection(Resource):
@@ -50,6 +52,7 @@ class ServiceRecordCollection(Resource):
         sdr_manager = SDRManager()
         try:
             sdr_manager.validate_sdr(data)
+            sdr_manager.update_usage()
         except PermissionDenied as e:
             response = build_response(request, 403, unicode(e))
         except ValueError as e:
@@ -62,15 +65,53 @@ class ServiceRecordCollection(Resource):
             # The usage document is not valid, change its state to Rejected
             usage_client.update_usage_state(data['id'], 'Rejected')
         else:
-            # The usage document is valid, change its state to Guided
-            usage_client.update_usage_state(data['id'], 'Guided')
-            sdr_manager.update_usage()
+            # The usage document is valid, change its state to Guided. If the state cannot
+            # be updated, the usage is reverted from the contract so the SDR can be sent again
+            try:
+                usage_client.update_usage_state(data['id'], 'Guided')
+            except Exception:
+                sdr_manager.rollback_usage()
+                return build_response(request, 500, NOT_GUIDED_MSG)
+
             response = build_response(request, 200, 'OK')
 
         # Update usage document state
         return response
 
 
+class ServiceRecordBatchCollection(Resource):
+
+    def _parse_records(self, request):
+        if get_content_type(request)[0] == 'application/x-ndjson':
+            return [json.loads(line) for line in request.body.splitlines() if line.strip()]
+
+        records = json.loads(request.body)
+        if not isinstance(records, list):
+            raise ValueError('The request does not contain a list of SDRs')
+
+        return records
+
+    # This method is used to load a batch of SDR documents given as a JSON
+    # array or as a NDJSON stream
+    @supported_request_mime_types(('application/json', 'application/x-ndjson'))
+    def create(self, request):
+        try:
+            records = self._parse_records(request)
+        except:
+            return build_response(request, 400, 'The request does not contain a valid JSON array or NDJSON stream')
+
+        max_records = getattr(settings, 'SDR_BATCH_MAX_RECORDS', 1000)
+        if len(records) > max_records:
+            return build_response(request, 413, 'The batch cannot contain more than {} SDRs'.format(max_records))
+
+        results = SDRBatchManager().process(records)
+
+        return JsonResponse(200, {
+            'result': 'correct',
+            'records': results
+        })
+
+
 class SDRRefreshCollection(Resource):
 
     @supported_request_mime_types(('application/json',))
@@ -83,15 +124,13 @@ class SDRRefreshCollection(Resource):
         if 'orderId' not in data or 'productId' not in data:
             return build_response(request, 422, 'Missing required field, it must include orderId and productId')
 
-        # Get order and product info
+        # Get order and product info using the index of product ids
         try:
-            order = Order.objects.get(order_id=data['orderId'])
+            order, contract = get_product_contract(data['productId'], order_id=data['orderId'])
         except:
-            return build_response(request, 404, 'The oid specified in the product name is not valid')
+            if not Order.objects.filter(order_id=data['orderId']).count():
+                return build_response(request, 404, 'The oid specified in the product name is not valid')
 
-        try:
-            contract = order.get_product_contract(data['productId'])
-        except:
             return build_response(request, 404, 'The specified product id is not valid')
 
         # Refresh accounting information
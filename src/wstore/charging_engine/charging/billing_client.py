@@ -21,11 +21,12 @@
 from __future__ import unicode_literals
 
 from decimal import Decimal
-from requests import Session, Request
 from urlparse import urlparse, urljoin
 
 from django.conf import settings
 
+from wstore.store_commons import http_client
+
 
 class BillingClient:
 
@@ -70,13 +71,9 @@ class BillingClient:
             }]
 
         url = self._billing_api + 'api/billingManagement/v2/appliedCustomerBillingCharge'
-        req = Request('POST', url, json=charge)
-
-        session = Session()
-        prepped = session.prepare_request(req)
 
         # Override host header to avoid inconsistent hrefs in the API
-        prepped.headers['Host'] = urlparse(domain).netloc
-
-        resp = session.send(prepped)
+        resp = http_client.post(url, json=charge, headers={
+            'Host': urlparse(domain).netloc
+        })
         resp.raise_for_status()
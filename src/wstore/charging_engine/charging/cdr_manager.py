@@ -20,13 +20,12 @@
 
 from __future__ import unicode_literals
 
-from bson import ObjectId
 from decimal import Decimal
 
 from django.conf import settings
 
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptorThread
-from wstore.store_commons.database import get_database_connection
+from wstore.rss_adaptor.cdr_outbox import CDROutbox
+from wstore.rss_adaptor.rss_adaptor import reserve_correlation_numbers
 
 
 class CDRManager(object):
@@ -57,18 +56,7 @@ class CDRManager(object):
             'order': order.order_id + ' ' + contract.item_id
         }
 
-    def _generate_cdr_part(self, part, event, description):
-        # Create connection for raw database access
-        db = get_database_connection()
-
-        # Take and increment the correlation number using
-        # the mongoDB atomic access in order to avoid race
-        # problems
-        corr_number = db.wstore_organization.find_and_modify(
-            query={'_id': ObjectId(self._offering.owner_organization.pk)},
-            update={'$inc': {'correlation_number': 1}}
-        )['correlation_number']
-
+    def _generate_cdr_part(self, part, event, description, corr_number):
         cdr_part = {
             'correlation': unicode(corr_number),
             'cost_value': unicode(part['value']),
@@ -80,9 +68,22 @@ class CDRManager(object):
         cdr_part.update(self._cdr_info)
         return cdr_part
 
+    def _generate_cdrs(self, parts):
+        if not len(parts):
+            return []
+
+        # Reserve a block of correlation numbers for all the CDRs using the
+        # mongoDB atomic access in order to avoid race problems
+        first_number = reserve_correlation_numbers(self._offering.owner_organization.pk, len(parts))
+
+        return [
+            self._generate_cdr_part(part, event, description, first_number + i)
+            for i, (part, event, description) in enumerate(parts)
+        ]
+
     def generate_cdr(self, applied_parts, time_stamp):
 
-        cdrs = []
+        parts = []
 
         self._cdr_info['time_stamp'] = time_stamp
         self._cdr_info['type'] = 'C'
@@ -93,7 +94,7 @@ class CDRManager(object):
             # A cdr is generated for every price part
             for part in applied_parts['single_payment']:
                 description = 'One time payment: ' + unicode(part['value']) + ' ' + self._cdr_info['cost_currency']
-                cdrs.append(self._generate_cdr_part(part, 'One time payment event', description))
+                parts.append((part, 'One time payment event', description))
 
         if 'subscription' in applied_parts:
 
@@ -102,7 +103,7 @@ class CDRManager(object):
                 description = 'Recurring payment: ' + unicode(part['value']) + ' ' + self._cdr_info['cost_currency'] \
                               + ' ' + part['unit']
 
-                cdrs.append(self._generate_cdr_part(part, 'Recurring payment event', description))
+                parts.append((part, 'Recurring payment event', description))
 
         if 'accounting' in applied_parts:
 
@@ -119,11 +120,12 @@ class CDRManager(object):
                     use += int(sdr['value'])
                     description = 'Fee per ' + part['model']['unit'] + ', Consumption: ' + unicode(use)
 
-                cdrs.append(self._generate_cdr_part(use_part, 'Pay per use event', description))
+                parts.append((use_part, 'Pay per use event', description))
+
+        cdrs = self._generate_cdrs(parts)
 
-        # Send the created CDRs to the Revenue Sharing System
-        r = RSSAdaptorThread(cdrs)
-        r.start()
+        # Queue the created CDRs to be sent to the Revenue Sharing System
+        CDROutbox().enqueue(cdrs)
 
     def refund_cdrs(self, price, duty_free, time_stamp):
         self._cdr_info['time_stamp'] = time_stamp
@@ -136,8 +138,7 @@ class CDRManager(object):
         }
 
         description = 'Refund event: ' + unicode(price) + ' ' + self._cdr_info['cost_currency']
-        cdrs = [self._generate_cdr_part(aggregated_part, 'Refund event', description)]
+        cdrs = self._generate_cdrs([(aggregated_part, 'Refund event', description)])
 
-        # Send the created CDRs to the Revenue Sharing System
-        r = RSSAdaptorThread(cdrs)
-        r.start()
+        # Queue the created CDRs to be sent to the Revenue Sharing System
+        CDROutbox().enqueue(cdrs)
@@ -20,7 +20,6 @@
 
 from __future__ import unicode_literals
 
-from bson.objectid import ObjectId
 from decimal import Decimal
 from datetime import datetime
 from mock import MagicMock
@@ -85,13 +84,9 @@ class CDRGenerationTestCase(TestCase):
 
     def setUp(self):
         # Create Mocks
-        cdr_manager.RSSAdaptorThread = MagicMock()
+        cdr_manager.CDROutbox = MagicMock()
 
-        self._conn = MagicMock()
-        cdr_manager.get_database_connection = MagicMock()
-        cdr_manager.get_database_connection.return_value = self._conn
-
-        self._conn.wstore_organization.find_and_modify.side_effect = [{'correlation_number': 1}, {'correlation_number': 2}]
+        cdr_manager.reserve_correlation_numbers = MagicMock(return_value=1)
 
         self._order = MagicMock()
         self._order.order_id = '1'
@@ -158,13 +153,35 @@ class CDRGenerationTestCase(TestCase):
         cdr_m.generate_cdr(applied_parts, '2015-10-21 06:13:26.661650')
 
         # Validate calls
-        self._conn.wstore_organization.find_and_modify.assert_called_once_with(
-            query={'_id': ObjectId('61004aba5e05acc115f022f0')},
-            update={'$inc': {'correlation_number': 1}}
-        )
+        cdr_manager.reserve_correlation_numbers.assert_called_once_with('61004aba5e05acc115f022f0', 1)
+
+        cdr_manager.CDROutbox().enqueue.assert_called_once_with(exp_cdrs)
 
-        cdr_manager.RSSAdaptorThread.assert_called_once_with(exp_cdrs)
-        cdr_manager.RSSAdaptorThread().start.assert_called_once_with()
+    def test_cdr_generation_block(self):
+        cdr_manager.reserve_correlation_numbers.return_value = 5
+
+        cdr_m = cdr_manager.CDRManager(self._order, self._contract)
+        cdr_m.generate_cdr({
+            'single_payment': [{
+                'value': Decimal('12'),
+                'duty_free': Decimal('10')
+            }],
+            'subscription': [{
+                'value': Decimal('12'),
+                'unit': 'monthly',
+                'duty_free': Decimal('10')
+            }, {
+                'value': Decimal('6'),
+                'unit': 'monthly',
+                'duty_free': Decimal('5')
+            }]
+        }, '2015-10-21 06:13:26.661650')
+
+        # A single block is reserved for all the CDRs
+        cdr_manager.reserve_correlation_numbers.assert_called_once_with('61004aba5e05acc115f022f0', 3)
+
+        cdrs = cdr_manager.CDROutbox().enqueue.call_args[0][0]
+        self.assertEquals(['5', '6', '7'], [cdr['correlation'] for cdr in cdrs])
 
     def test_refund_cdr_generation(self):
         exp_cdr = [{
@@ -187,13 +204,9 @@ class CDRGenerationTestCase(TestCase):
         cdr_m.refund_cdrs(Decimal('10'), Decimal('8'), '2015-10-21 06:13:26.661650')
 
         # Validate calls
-        self._conn.wstore_organization.find_and_modify.assert_called_once_with(
-            query={'_id': ObjectId('61004aba5e05acc115f022f0')},
-            update={'$inc': {'correlation_number': 1}}
-        )
+        cdr_manager.reserve_correlation_numbers.assert_called_once_with('61004aba5e05acc115f022f0', 1)
 
-        cdr_manager.RSSAdaptorThread.assert_called_once_with(exp_cdr)
-        cdr_manager.RSSAdaptorThread().start.assert_called_once_with()
+        cdr_manager.CDROutbox().enqueue.assert_called_once_with(exp_cdr)
 
 
 TIMESTAMP = datetime(2016, 06, 21, 10, 0, 0)
@@ -266,33 +279,18 @@ class BillingClientTestCase(TestCase):
         site = 'http://extpath.com:8080/'
         billing_client.settings.SITE = site
 
-        billing_client.Request = MagicMock()
-        billing_client.Session = MagicMock()
-        session = MagicMock()
-        billing_client.Session.return_value = session
-
-        preped = MagicMock()
-        preped.headers = {}
-        session.prepare_request.return_value = preped
+        billing_client.http_client = MagicMock()
 
         # Call the method to test
         client = billing_client.BillingClient()
         client.create_charge(charge, '1', start_date=start_date, end_date=end_date)
 
         # Validate calls
-        billing_client.Request.assert_called_once_with(
-            'POST',
+        billing_client.http_client.post.assert_called_once_with(
             'http://billing.api.com/api/billingManagement/v2/appliedCustomerBillingCharge',
-            json=exp_body
+            json=exp_body,
+            headers={
+                'Host': 'extpath.com:8080'
+            }
         )
-
-        billing_client.Session.assert_called_once_with()
-        session.prepare_request.assert_called_once_with(billing_client.Request())
-
-        self.assertEquals(
-            'extpath.com:8080',
-            preped.headers['Host']
-        )
-
-        session.send.assert_called_once_with(preped)
-        session.send().raise_for_status.assert_called_once_with()
+        billing_client.http_client.post().raise_for_status.assert_called_once_with()
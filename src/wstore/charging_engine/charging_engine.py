@@ -21,27 +21,57 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-import threading
 import importlib
-from bson import ObjectId
+import logging
+from itertools import chain
 from datetime import datetime, timedelta
 
 from django.conf import settings
 from wstore.charging_engine.accounting.sdr_manager import SDRManager
 from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.charging_engine.accounting.usage_rater import UsageRater
 
 from wstore.charging_engine.price_resolver import PriceResolver
 from wstore.charging_engine.charging.cdr_manager import CDRManager
 from wstore.charging_engine.charging.billing_client import BillingClient
 from wstore.charging_engine.invoice_builder import InvoiceBuilder
+from wstore.charging_engine.invoice_renderer import RenderGroup
+from wstore.ordering.entitlements import grant_offering
 from wstore.ordering.errors import OrderingError
 from wstore.ordering.models import Order, Charge, Payment
 from wstore.ordering.ordering_client import OrderingClient
-from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.database import DistributedLock
+from wstore.store_commons.scheduler import schedule_deadline
 from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.store_commons.utils.units import ChargePeriod
 
 
+logger = logging.getLogger(__name__)
+
+
+def payment_timeout_handler(order_id, data):
+    """
+    Deadline handler that cancels a payment not confirmed in time
+    """
+    orders = Order.objects.filter(pk=order_id)
+
+    # The order has been already removed
+    if not len(orders):
+        return
+
+    charging = ChargingEngine(orders[0])
+    charging._concept = data['concept']
+    charging._timeout_handler()
+
+
+def discard_usage_rates(transactions):
+    """
+    Removes the rates staged for the usage of a charge that has not been confirmed
+    :param transactions: Transactions of the pending charge
+    """
+    UsageRater().discard([transaction['rating_batch'] for transaction in transactions if 'rating_batch' in transaction])
+
+
 class ChargingEngine:
 
     def __init__(self, order):
@@ -74,35 +104,31 @@ class ChargingEngine:
 
         order.save()
 
-    def _timeout_handler(self):
+    def _use_charge_timeout(self, order):
+        # The usage of the charge has not been rated, so its staged rates are removed
+        discard_usage_rates(order.pending_payment.transactions)
+        self._renew_charge_timeout(order)
 
-        db = get_database_connection()
+    def _timeout_handler(self):
 
-        # Uses an atomic operation to get and set the _lock value in the purchase
-        # document
-        pre_value = db.wstore_order.find_one_and_update(
-            {'_id': ObjectId(self._order.pk)},
-            {'$set': {'_lock': True}}
-        )
+        # Uses an atomic lease on the order document so the timeout and the
+        # payment confirmation cannot process the order at the same time
+        lock = DistributedLock('wstore_order', self._order.pk, '_lock', lease=getattr(settings, 'ORDER_LOCK_LEASE', 1800))
 
-        # If _lock not exists or is set to false means that this function has
-        # acquired the resource
-        if '_lock' not in pre_value or not pre_value['_lock']:
-
-            # Only rollback if the state is pending
-            if pre_value['state'] == 'pending':
-                order = Order.objects.get(pk=self._order.pk)
-                timeout_processors = {
-                    'initial': self._initial_charge_timeout,
-                    'recurring': self._renew_charge_timeout,
-                    'usage': self._renew_charge_timeout
-                }
-                timeout_processors[self._concept](order)
-
-            db.wstore_order.find_one_and_update(
-                {'_id': ObjectId(self._order.pk)},
-                {'$set': {'_lock': False}}
-            )
+        # If the lock cannot be acquired the payment is being confirmed
+        if lock.acquire(blocking=False):
+            try:
+                # Only rollback if the state is pending
+                if lock.document['state'] == 'pending':
+                    order = Order.objects.get(pk=self._order.pk)
+                    timeout_processors = {
+                        'initial': self._initial_charge_timeout,
+                        'recurring': self._renew_charge_timeout,
+                        'usage': self._use_charge_timeout
+                    }
+                    timeout_processors[self._concept](order)
+            finally:
+                lock.release()
 
     def _charge_client(self, transactions):
 
@@ -119,8 +145,7 @@ class ChargingEngine:
         checkout_url = client.get_checkout_url()
 
         # Set timeout for PayPal transaction to 5 minutes
-        t = threading.Timer(300, self._timeout_handler)
-        t.start()
+        schedule_deadline('payment_timeout', self._order.pk, 300, {'concept': self._concept})
 
         return checkout_url
 
@@ -147,6 +172,7 @@ class ChargingEngine:
         # Save offerings in org profile
         self._order.owner_organization.acquired_offerings.append(contract.offering.pk)
         self._order.owner_organization.save()
+        grant_offering(self._order, contract)
 
         return None, valid_to
 
@@ -170,21 +196,10 @@ class ChargingEngine:
         return None, valid_to
 
     def _end_use_charge(self, contract, transaction):
-        # Change applied usage documents SDR Guided to Rated
-        usage_client = UsageClient()
-
-        for sdr_info in transaction['applied_accounting']:
-            for sdr in sdr_info['accounting']:
-
-                usage_client.rate_usage(
-                    sdr['usage_id'],
-                    unicode(contract.last_charge),
-                    sdr['duty_free'],
-                    sdr['price'],
-                    sdr_info['model']['tax_rate'],
-                    transaction['currency'],
-                    contract.product_id
-                )
+        # Change applied usage documents SDR Guided to Rated, the rating is
+        # made asynchronously in order not to block the payment confirmation
+        usage_rater = UsageRater()
+        usage_rater.enqueue(transaction['rating_batch'], unicode(contract.last_charge))
 
         transaction['related_model']['accounting'] = transaction['applied_accounting']
 
@@ -203,8 +218,8 @@ class ChargingEngine:
 
             elif concept == 'recurring' or concept == 'usage':
                 handler.send_renovation_notification(self._order, transactions)
-        except:
-            pass
+        except Exception:
+            logger.exception('Error sending the notifications of the order ' + unicode(self._order.pk))
 
     def end_charging(self, transactions, free_contracts, concept):
         """
@@ -225,6 +240,10 @@ class ChargingEngine:
         invoice_builder = InvoiceBuilder(self._order)
         billing_client = BillingClient() if concept != 'initial' else None
 
+        # The notifications attach the invoices, so they are sent once all of them
+        # have been rendered, which may happen in background
+        render_group = RenderGroup(lambda: self._send_notification(concept, transactions))
+
         for transaction in transactions:
             contract = self._order.get_item_contract(transaction['item'])
             contract.last_charge = time_stamp
@@ -238,7 +257,7 @@ class ChargingEngine:
             # Generate the invoice
             invoice_path = ''
             try:
-                invoice_path = invoice_builder.generate_invoice(contract, transaction, concept)
+                invoice_path = invoice_builder.generate_invoice(contract, transaction, concept, group=render_group)
             except:
                 pass
 
@@ -249,7 +268,8 @@ class ChargingEngine:
                 duty_free=transaction['duty_free'],
                 currency=transaction['currency'],
                 concept=concept,
-                invoice=invoice_path
+                invoice=invoice_path,
+                related_model=transaction['related_model']
             )
             contract.charges.append(charge)
 
@@ -261,9 +281,17 @@ class ChargingEngine:
         for free in free_contracts:
             self._order.owner_organization.acquired_offerings.append(free.offering.pk)
 
+        # Update the dates of the next payments used by the pending charges daemon
+        for contract in self._order.contracts:
+            contract.update_next_due(self._order.date)
+
         self._order.owner_organization.save()
+
+        for free in free_contracts:
+            grant_offering(self._order, free)
+
         self._order.save()
-        self._send_notification(concept, transactions)
+        render_group.close()
 
     def _save_pending_charge(self, transactions, free_contracts=[]):
         pending_payment = Payment(
@@ -275,9 +303,10 @@ class ChargingEngine:
         self._order.pending_payment = pending_payment
         self._order.save()
 
-    def _append_transaction(self, transactions, contract, related_model, accounting=None):
-        # Call the price resolver
-        price, duty_free = self._price_resolver.resolve_price(related_model, accounting)
+    def _append_transaction(self, transactions, contract, related_model, accounting=None, rating_stage=None):
+        # Call the price resolver, the rates of the SDRs are staged as they are priced
+        sdr_callback = rating_stage.add if rating_stage is not None else None
+        price, duty_free = self._price_resolver.resolve_price(related_model, accounting, sdr_callback=sdr_callback)
 
         if 'alteration' in related_model and not self._price_resolver.is_altered():
             del related_model['alteration']
@@ -295,6 +324,10 @@ class ChargingEngine:
         if accounting is not None:
             transaction['applied_accounting'] = self._price_resolver.get_applied_sdr()
 
+        if rating_stage is not None:
+            rating_stage.flush()
+            transaction['rating_batch'] = rating_stage.batch_id
+
         transactions.append(transaction)
 
     def _process_initial_charge(self, contracts):
@@ -392,14 +425,12 @@ class ChargingEngine:
 
     def _parse_raw_accounting(self, usage):
         sdr_manager = SDRManager()
-        sdrs = []
 
+        # SDR values are lazily generated as the usage documents are retrieved
         for usage_document in usage:
             sdr_values = sdr_manager.get_sdr_values(usage_document)
             sdr_values.update({'usage_id': usage_document['id']})
-            sdrs.append(sdr_values)
-
-        return sdrs
+            yield sdr_values
 
     def _process_use_charge(self, contracts):
         """
@@ -410,6 +441,7 @@ class ChargingEngine:
 
         transactions = []
         usage_client = UsageClient()
+        usage_rater = UsageRater()
         for contract in contracts:
             if 'pay_per_use' not in contract.pricing_model:
                 continue
@@ -418,22 +450,32 @@ class ChargingEngine:
                 'pay_per_use': contract.pricing_model['pay_per_use']
             }
 
-            accounting = self._parse_raw_accounting(usage_client.get_customer_usage(
-                self._order.owner_organization.name, contract.product_id, state='Guided'))
+            # Usage already charged remains Guided until its rating ends, so it is skipped
+            rated_ids = usage_rater.get_rated_usage_ids(contract.product_id)
+            usage = usage_client.iter_customer_usage(self._order.owner_organization.name, contract.product_id, state='Guided')
+
+            accounting = self._parse_raw_accounting(
+                usage_document for usage_document in usage if usage_document['id'] not in rated_ids)
+            first_sdr = next(accounting, None)
 
             if 'alteration' in contract.pricing_model and \
                contract.pricing_model['alteration'].get('period') == 'recurring':
                 related_model['alteration'] = contract.pricing_model['alteration']
 
-            if len(accounting) > 0:
+            if first_sdr is not None:
                 self._append_transaction(
                     transactions,
                     contract,
                     related_model,
-                    accounting=accounting
+                    accounting=chain([first_sdr], accounting),
+                    rating_stage=usage_rater.stage(contract.product_id, contract.pricing_model['general_currency'])
                 )
 
-        return self._execute_renovation_transactions(transactions, 'There is not usage payments to renovate')
+        try:
+            return self._execute_renovation_transactions(transactions, 'There is not usage payments to renovate')
+        except:
+            discard_usage_rates(transactions)
+            raise
 
     def resolve_charging(self, type_='initial', related_contracts=None):
         """
@@ -22,7 +22,8 @@ from __future__ import unicode_literals
 
 import os
 import codecs
-import subprocess
+import errno
+import tempfile
 from copy import deepcopy
 from datetime import datetime
 from decimal import Decimal
@@ -30,6 +31,8 @@ from decimal import Decimal
 from django.template import loader, Context
 from django.conf import settings
 
+from wstore.charging_engine.invoice_renderer import render_invoice
+
 
 class InvoiceBuilder(object):
 
@@ -193,16 +196,26 @@ class InvoiceBuilder(object):
         new_name = name + '_' + unicode(ix) + '.pdf'
         path = os.path.join(settings.BILL_ROOT, new_name)
 
-        if os.path.exists(path):
-            path, new_name = self._avoid_existing_name(name, ix + 1)
+        # The file is atomically created to reserve the name for concurrent builds
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise e
+
+            return self._avoid_existing_name(name, ix + 1)
 
+        os.close(fd)
         return path, new_name
 
-    def generate_invoice(self, contract, transaction, type_):
+    def generate_invoice(self, contract, transaction, type_, charge_date=None, sync=False, group=None):
         """
         Create a PDF invoice based on the price components used to charge the user
         :param transaction: Total amount charged to the customer
         :param type_: Type of the charge, initial, renovation, pay-per-use
+        :param charge_date: Date of the charge, by default the last charge of the contract
+        :param sync: Whether the PDF must be rendered before returning
+        :param group: RenderGroup notified when the PDF has been rendered
         """
 
         # Get invoice context parts and invoice template
@@ -211,12 +224,15 @@ class InvoiceBuilder(object):
         tax = self._order.tax_address
         customer_profile = self._order.customer.userprofile
 
-        if contract.last_charge is None:
+        if charge_date is None:
+            charge_date = contract.last_charge
+
+        if charge_date is None:
             # If last charge is None means that it is the invoice generation
             # associated with a free offering
             date = unicode(datetime.utcnow()).split(' ')[0]
         else:
-            date = unicode(contract.last_charge).split(' ')[0]
+            date = unicode(charge_date).split(' ')[0]
 
         # Calculate total taxes applied
         tax_value = Decimal(transaction['price']) - Decimal(transaction['duty_free'])
@@ -249,9 +265,10 @@ class InvoiceBuilder(object):
         # Render the invoice template
         bill_code = bill_template.render(Context(context))
 
-        # Create the bill code file
+        # Create the bill code file in a temporal directory of the invoice
         invoice_id = self._order.pk + '_' + contract.item_id + '_' + date
-        raw_invoice_path = os.path.join(settings.BILL_ROOT, invoice_id + '.html')
+        tmp_dir = tempfile.mkdtemp(prefix='invoice_')
+        raw_invoice_path = os.path.join(tmp_dir, invoice_id + '.html')
 
         f = codecs.open(raw_invoice_path, 'wb', 'utf-8')
         f.write(bill_code)
@@ -259,13 +276,47 @@ class InvoiceBuilder(object):
 
         invoice_path, invoice_name = self._avoid_existing_name(invoice_id, 0)
 
-        # Compile the bill file
-        subprocess.call([settings.BASEDIR + '/create_invoice.sh', raw_invoice_path, invoice_path])
+        # Compile the bill file, the temporal directory is removed when finished
+        render_invoice(raw_invoice_path, invoice_path, tmp_dir, sync=sync, group=group)
 
-        # Remove temporal files
-        for file_ in os.listdir(settings.BILL_ROOT):
+        return os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name)
 
-            if not file_.endswith('.pdf'):
-                os.remove(os.path.join(settings.BILL_ROOT, file_))
+    def _get_charge_transaction(self, contract, charge):
+        related_model = charge.related_model
+
+        if not related_model:
+            # Charges made before storing the applied model are built
+            # from the current pricing model of the contract
+            if charge.concept == 'usage':
+                raise ValueError('The usage applied in the charge is not available')
+
+            pricing = contract.pricing_model
+            related_model = {}
+            if charge.concept == 'initial' and 'single_payment' in pricing:
+                related_model['single_payment'] = pricing['single_payment']
+
+            if 'subscription' in pricing:
+                related_model['subscription'] = [
+                    dict(part, renovation_date=part.get('renovation_date', '')) for part in pricing['subscription']
+                ]
+
+            if 'alteration' in pricing:
+                related_model['alteration'] = pricing['alteration']
+
+        return {
+            'price': charge.cost,
+            'duty_free': charge.duty_free,
+            'currency': charge.currency,
+            'related_model': related_model,
+            'applied_accounting': related_model.get('accounting', [])
+        }
 
-        return os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name)
+    def regenerate_invoice(self, contract, charge):
+        """
+        Creates again the PDF invoice of a charge already made to the customer
+        :param contract: Contract the charge belongs to
+        :param charge: Charge whose invoice is generated
+        :return: URL of the new invoice
+        """
+        transaction = self._get_charge_transaction(contract, charge)
+        return self.generate_invoice(contract, transaction, charge.concept, charge_date=charge.date, sync=True)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import importlib
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class InvoiceRenderingError(Exception):
+    pass
+
+
+class ScriptRenderer(object):
+    """
+    Renders invoices using the create_invoice.sh script, which may start
+    a new X server for every invoice
+    """
+
+    def render(self, html_path, pdf_path):
+        if subprocess.call([settings.BASEDIR + '/create_invoice.sh', html_path, pdf_path]) != 0:
+            raise InvoiceRenderingError('Error rendering invoice ' + pdf_path)
+
+
+class WkhtmltopdfRenderer(object):
+    """
+    Renders invoices calling wkhtmltopdf directly. The binary is located once, and if
+    a virtual display is required it is started once and shared by all the invoices and
+    by the rest of processes of the host using the same display
+    """
+
+    _binaries = ['/usr/local/bin/wkhtmltopdf', '/usr/bin/wkhtmltopdf']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._display = None
+        self._xvfb = None
+        self._binary = getattr(settings, 'WKHTMLTOPDF_PATH', None)
+
+        if self._binary is None:
+            available = [binary for binary in self._binaries if os.path.exists(binary)]
+            self._binary = available[0] if len(available) else 'wkhtmltopdf'
+
+    def _get_socket(self, display):
+        # Socket created by the X server once it accepts clients
+        return '/tmp/.X11-unix/X' + display.lstrip(':').split('.')[0]
+
+    def _start_display(self, display):
+        socket_path = self._get_socket(display)
+
+        # The display may have been started by other process, e.g. other worker of the server
+        if not os.path.exists(socket_path):
+            self._xvfb = subprocess.Popen(['Xvfb', display])
+
+        # Wait until the display is ready, if the server fails because other process
+        # has started it meanwhile, the display of the other process is used
+        timeout = time.time() + getattr(settings, 'INVOICE_XVFB_TIMEOUT', 10)
+        while not os.path.exists(socket_path):
+            if time.time() >= timeout:
+                raise InvoiceRenderingError('The virtual display ' + display + ' is not available')
+
+            time.sleep(0.1)
+
+        self._display = display
+
+    def _get_env(self):
+        env = dict(os.environ)
+
+        display = getattr(settings, 'INVOICE_XVFB_DISPLAY', None)
+        if 'DISPLAY' in env or display is None:
+            return env
+
+        with self._lock:
+            # Start the shared virtual display if not running
+            if self._display is None or not os.path.exists(self._get_socket(display)):
+                self._start_display(display)
+
+        env['DISPLAY'] = self._display
+        return env
+
+    def render(self, html_path, pdf_path):
+        if subprocess.call([self._binary, '--quiet', html_path, pdf_path], env=self._get_env()) != 0:
+            raise InvoiceRenderingError('Error rendering invoice ' + pdf_path)
+
+
+class RenderGroup(object):
+    """
+    Runs an action once all the invoices of a group have been rendered, successfully
+    or not. The action is run when the group is closed if there are no invoices pending,
+    or by the worker that renders the last invoice otherwise
+    """
+
+    def __init__(self, action):
+        self._lock = threading.Lock()
+        self._pending = 1
+        self._action = action
+
+    def add(self):
+        with self._lock:
+            self._pending += 1
+
+    def done(self):
+        with self._lock:
+            self._pending -= 1
+            finished = self._pending == 0
+
+        if finished:
+            try:
+                self._action()
+            except Exception:
+                # The action runs in the worker of the last invoice, so its errors are not
+                # raised to the charging process
+                logger.exception('Error running the action of the rendered invoices')
+
+    def close(self):
+        self.done()
+
+
+class _RendererPool(object):
+    """
+    Process wide invoice renderer and bounded pool of workers used to render
+    invoices asynchronously
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._renderer = None
+        self._pool = None
+        self._pid = None
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._renderer = None
+            self._pool = None
+            self._pid = os.getpid()
+
+    def get_renderer(self):
+        with self._lock:
+            self._check_fork()
+
+            if self._renderer is None:
+                renderer_str = getattr(settings, 'INVOICE_RENDERER', 'wstore.charging_engine.invoice_renderer.WkhtmltopdfRenderer')
+                renderer_package, renderer_class = renderer_str.rsplit('.', 1)
+                self._renderer = getattr(importlib.import_module(renderer_package), renderer_class)()
+
+            return self._renderer
+
+    def _get_pool(self):
+        with self._lock:
+            self._check_fork()
+
+            if self._pool is None:
+                self._pool = ThreadPool(getattr(settings, 'INVOICE_RENDER_WORKERS', 2))
+
+            return self._pool
+
+    def render(self, html_path, pdf_path, tmp_dir):
+        """
+        Renders an invoice removing its temporal directory
+        """
+        try:
+            self.get_renderer().render(html_path, pdf_path)
+        except:
+            # Remove the file reserved for the invoice
+            if os.path.exists(pdf_path):
+                os.remove(pdf_path)
+            raise
+        finally:
+            shutil.rmtree(tmp_dir, True)
+
+    def render_group(self, html_path, pdf_path, tmp_dir, group):
+        try:
+            self.render(html_path, pdf_path, tmp_dir)
+        finally:
+            if group is not None:
+                group.done()
+
+    def _render_task(self, html_path, pdf_path, tmp_dir, group):
+        # The pool discards the errors of the tasks, so they are logged here. The PDF of a
+        # failed invoice is removed, so the regenerate_invoices command generates it again
+        try:
+            self.render_group(html_path, pdf_path, tmp_dir, group)
+        except Exception:
+            logger.exception('Error rendering invoice ' + pdf_path)
+
+    def render_async(self, html_path, pdf_path, tmp_dir, group=None):
+        self._get_pool().apply_async(self._render_task, (html_path, pdf_path, tmp_dir, group))
+
+
+_renderer_pool = _RendererPool()
+
+
+def render_invoice(html_path, pdf_path, tmp_dir, sync=False, group=None):
+    """
+    Renders a PDF invoice from its HTML code. If INVOICE_ASYNC is enabled the invoice
+    is rendered in background and the PDF is filled in when it is ready
+    :param html_path: Path to the HTML code of the invoice
+    :param pdf_path: Path where the PDF is created
+    :param tmp_dir: Temporal directory of the invoice, removed when rendered
+    :param sync: Whether the invoice must be rendered before returning regardless of INVOICE_ASYNC
+    :param group: RenderGroup the invoice belongs to, notified when the invoice has been rendered
+    """
+    if group is not None:
+        group.add()
+
+    if not sync and getattr(settings, 'INVOICE_ASYNC', False):
+        _renderer_pool.render_async(html_path, pdf_path, tmp_dir, group)
+    else:
+        _renderer_pool.render_group(html_path, pdf_path, tmp_dir, group)
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-# Copyright (c) 2016 CoNWeT Lab., Universidad Politécnica de Madrid
+# Copyright (c) 2016 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
 
 # This file belongs to the business-charging-backend
 # of the Business API Ecosystem.
@@ -20,64 +20,155 @@
 
 from __future__ import unicode_literals
 
+import threading
+import time
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
 
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from wstore.ordering.models import Order
 from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.asset_manager.resource_plugins.decorators import on_product_suspended
+from wstore.store_commons.database import get_database_connection
 
 
-class Command(BaseCommand):
-
-    def _check_renovation_date(self, renovation_date, order, contract):
-        now = datetime.utcnow()
-
-        timed = renovation_date - now
+class _StepMetrics(object):
+    """
+    Latency and failure counters of the steps run by the daemon
+    """
 
-        if timed.days < 7:
-            handler = NotificationsHandler()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
 
-            if timed.days < 0:
-                # Suspend the access to the service
-                on_product_suspended(order, contract)
+    def record(self, step, elapsed, failed=False):
+        with self._lock:
+            if step not in self._metrics:
+                self._metrics[step] = {
+                    'done': 0,
+                    'failed': 0,
+                    'time': 0.0,
+                    'max_time': 0.0
+                }
 
-                # Notify that the subscription has finished
-                handler.send_payment_required_notification(order, contract)
+            entry = self._metrics[step]
+            entry['failed' if failed else 'done'] += 1
+            entry['time'] += elapsed
+            entry['max_time'] = max(entry['max_time'], elapsed)
 
-                # Set the product as suspended
-                client = InventoryClient()
-                client.suspend_product(contract.product_id)
+    def to_dict(self):
+        with self._lock:
+            return {step: dict(entry) for step, entry in self._metrics.iteritems()}
 
-            else:
-                # There is less than a week remaining
-                handler.send_near_expiration_notification(order, contract, timed.days)
 
-    def _process_subscription_item(self, order, contract, item):
-        try:
-            self._check_renovation_date(item['renovation_date'], order, contract)
-        except:
-            pass
+class Command(BaseCommand):
 
-    def _process_usage_item(self, order, contract):
-        try:
-            # Search last usage charge
-            last_charge = None
-            for charge in reversed(contract.charges):
-                if charge.concept == 'usage':
-                    last_charge = charge.date
-                    break
-
-            # No use charge has been applied yet
-            if last_charge is None:
-                last_charge = order.date
-
-            # Usage payments are renovated every 30 days
-            self._check_renovation_date(last_charge + timedelta(days=30), order, contract)
-        except:
-            pass
+    option_list = BaseCommand.option_list + (
+        make_option('--backfill', action='store_true', dest='backfill', default=False,
+                    help='Calculate again the next due date of all the existing contracts'),
+    )
+
+    def _get_state(self, contract):
+        # The state of previous due dates is discarded once the contract is renovated
+        state = contract.suspension or {}
+        return dict(state) if state.get('due') == contract.next_due else {'due': contract.next_due}
+
+    def _save_state(self, order, index, contract, state):
+        # The state is only saved if the contract has not been renovated meanwhile
+        self._collection.update_one({
+            '_id': ObjectId(order.pk),
+            'contracts.{}.item_id'.format(index): contract.item_id,
+            'contracts.{}.next_due'.format(index): contract.next_due
+        }, {
+            '$set': {'contracts.{}.suspension'.format(index): state}
+        })
+
+    def _get_steps(self, handler, order, contract, days):
+        if days < 0:
+            return [
+                # Suspend the access to the service
+                ('asset_suspended', lambda: on_product_suspended(order, contract)),
+                # Notify that the subscription has finished
+                ('notified_expired', lambda: handler.send_payment_required_notification(order, contract)),
+                # Set the product as suspended
+                ('suspended', lambda: InventoryClient().suspend_product(contract.product_id))
+            ]
+
+        # There is less than a week remaining
+        return [('notified_7d', lambda: handler.send_near_expiration_notification(order, contract, days))]
+
+    def _process_contract(self, task):
+        order, index, contract = task
+
+        days = (contract.next_due - datetime.utcnow()).days
+        if days >= 7:
+            return
+
+        state = self._get_state(contract)
+        for step, action in self._get_steps(self._handler, order, contract, days):
+            # Steps already made in previous executions are not repeated
+            if step in state:
+                continue
+
+            start = time.time()
+            try:
+                action()
+            except Exception:
+                # The following steps are retried in the next execution
+                self._metrics.record(step, time.time() - start, failed=True)
+                break
+
+            self._metrics.record(step, time.time() - start)
+
+            state[step] = datetime.utcnow()
+            self._save_state(order, index, contract, state)
+
+    def _get_orders(self, collection, query, batch_size):
+        # Orders are streamed in batches, only loading the ones matching the query
+        pks = []
+        for doc in collection.find(query, {'_id': True}).batch_size(batch_size):
+            pks.append(unicode(doc['_id']))
+
+            if len(pks) == batch_size:
+                yield Order.objects.filter(pk__in=pks)
+                pks = []
+
+        if len(pks):
+            yield Order.objects.filter(pk__in=pks)
+
+    def _backfill(self, orders, collection, force=False):
+        for order in orders:
+            for i, contract in enumerate(order.contracts):
+                # Unless forced, only the active contracts without a due date are calculated
+                if not force and (contract.terminated or contract.next_due is not None):
+                    continue
+
+                next_due = contract.update_next_due(order.date)
+
+                query = {
+                    '_id': ObjectId(order.pk),
+                    'contracts.{}.item_id'.format(i): contract.item_id
+                }
+
+                if not force:
+                    # Contracts with no due date yet are not updated, null matches
+                    # both the due dates never stored and the ones stored as null
+                    if next_due is None:
+                        continue
+
+                    query['contracts.{}.next_due'.format(i)] = {'$in': [None]}
+
+                # Only the due date is updated in order not to overwrite concurrent changes
+                collection.update_one(query, {
+                    '$set': {'contracts.{}.next_due'.format(i): next_due}
+                })
 
     def handle(self, *args, **options):
         """
@@ -85,14 +176,55 @@ class Command(BaseCommand):
         in order to notify customers and suspend services if needed
         :return:
         """
+        collection = get_database_connection()['wstore_order']
+        collection.create_index([('contracts.next_due', ASCENDING)])
+
+        self._collection = collection
+        self._metrics = _StepMetrics()
+
+        # The handler caches the recipients, so it is shared by all the contracts
+        self._handler = NotificationsHandler()
+
+        batch_size = getattr(settings, 'PENDING_CHARGES_BATCH_SIZE', 100)
+
+        if options.get('backfill'):
+            self._backfill(Order.objects.all(), collection, force=True)
+        else:
+            # Contracts created before the due date was stored do not include it or
+            # include it as null, so it is calculated before they are checked
+            missing = {
+                'contracts': {
+                    '$elemMatch': {
+                        'next_due': {'$in': [None]},
+                        'terminated': {'$ne': True},
+                        '$or': [
+                            {'pricing_model.subscription': {'$exists': True}},
+                            {'pricing_model.pay_per_use': {'$exists': True}}
+                        ]
+                    }
+                }
+            }
+            for orders in self._get_orders(collection, missing, batch_size):
+                self._backfill(orders, collection)
+
+        # Only contracts expired or that expire within the notification window are processed
+        limit = datetime.utcnow() + timedelta(days=7)
+        pool = ThreadPool(getattr(settings, 'PENDING_CHARGES_WORKERS', 4))
 
-        # Check contracts
-        for order in Order.objects.all():
-            for contract in order.contracts:
-                if 'pay_per_use' in contract.pricing_model and not contract.terminated:
-                        self._process_usage_item(order, contract)
-
-                if 'subscription' in contract.pricing_model and not contract.terminated:
-                    # Validate renovation date
-                    for item in contract.pricing_model['subscription']:
-                        self._process_subscription_item(order, contract, item)
+        try:
+            for orders in self._get_orders(collection, {'contracts.next_due': {'$lte': limit}}, batch_size):
+                tasks = [(order, index, contract) for order in orders for index, contract in enumerate(order.contracts)
+                         if not contract.terminated and contract.next_due is not None and contract.next_due <= limit]
+
+                # The recipients of the batch are retrieved at once before notifying them
+                self._handler.prefetch_recipients([order for order, index, contract in tasks])
+
+                # Independent contracts are processed concurrently
+                pool.map(self._process_contract, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for step, entry in sorted(self._metrics.to_dict().items()):
+            print('{}: {} done, {} failed, {:.3f}s avg, {:.3f}s max'.format(
+                step, entry['done'], entry['failed'], entry['time'] / (entry['done'] + entry['failed']), entry['max_time']))
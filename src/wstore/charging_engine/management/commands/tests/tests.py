@@ -20,7 +20,9 @@
 
 from __future__ import unicode_literals
 
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from bson import ObjectId
 
 from mock import MagicMock, call
 
@@ -47,13 +49,33 @@ class ChargesDaemonTestCase(TestCase):
         # Mock orders
         pending_charges_daemon.Order = MagicMock()
 
+        self._missing = []
+        self._collection = MagicMock()
+        self._collection.find.side_effect = self._find
+        pending_charges_daemon.get_database_connection = MagicMock(return_value={'wstore_order': self._collection})
+
         pending_charges_daemon.on_product_suspended = MagicMock()
 
-    def _build_contract(self, pricing, id_):
+    def tearDown(self):
+        reload(pending_charges_daemon)
+
+    def _find(self, query, projection):
+        cursor = MagicMock()
+        if 'contracts' in query:
+            # Orders with contracts without due date
+            cursor.batch_size.return_value = self._missing
+        else:
+            cursor.batch_size.return_value = [{'_id': ObjectId('58a447608e05ac5752d96d98')}]
+        return cursor
+
+    def _build_contract(self, pricing, id_, next_due):
         contract = MagicMock()
         contract.terminated = False
         contract.pricing_model = pricing
         contract.product_id = id_
+        contract.item_id = id_
+        contract.next_due = next_due
+        contract.suspension = {}
         return contract
 
     def _build_subscription_contract(self, date, id_):
@@ -61,12 +83,12 @@ class ChargesDaemonTestCase(TestCase):
             'subscription': [{
                 'renovation_date': date
             }]
-        }, id_)
+        }, id_, date)
 
     def _build_usage_contract(self, date, id_):
         contract = self._build_contract({
             'pay_per_use': []
-        }, id_)
+        }, id_, date + timedelta(days=30))
 
         charge1 = MagicMock()
         charge1.concept = 'initial'
@@ -84,17 +106,33 @@ class ChargesDaemonTestCase(TestCase):
         contract1.pricing_model = {
             'single_payment': []
         }
+        contract1.next_due = None
 
-        order = MagicMock()
+        order = MagicMock(pk='58a447608e05ac5752d96d98')
         order.contracts = [contract1] + contracts
-        pending_charges_daemon.Order.objects.all.return_value = [order]
+        pending_charges_daemon.Order.objects.filter.return_value = [order]
 
         # Execute commands
         command = pending_charges_daemon.Command()
         command.handle()
 
         # Validate calls
-        self.assertEquals([call(), call()], pending_charges_daemon.NotificationsHandler.call_args_list)
+        self.assertEquals([
+            call({'contracts': {'$elemMatch': {
+                'next_due': {'$in': [None]},
+                'terminated': {'$ne': True},
+                '$or': [
+                    {'pricing_model.subscription': {'$exists': True}},
+                    {'pricing_model.pay_per_use': {'$exists': True}}
+                ]
+            }}}, {'_id': True}),
+            call({'contracts.next_due': {'$lte': datetime(2016, 02, 15)}}, {'_id': True})
+        ], self._collection.find.call_args_list)
+        pending_charges_daemon.Order.objects.filter.assert_called_once_with(pk__in=['58a447608e05ac5752d96d98'])
+
+        # A single handler is used, retrieving the recipients of the batch in advance
+        pending_charges_daemon.NotificationsHandler.assert_called_once_with()
+        pending_charges_daemon.NotificationsHandler().prefetch_recipients.assert_called_once_with([order, order])
 
         pending_charges_daemon.NotificationsHandler().send_payment_required_notification.assert_called_once_with(order, contracts[2])
         pending_charges_daemon.InventoryClient.assert_called_once_with()
@@ -104,6 +142,73 @@ class ChargesDaemonTestCase(TestCase):
 
         pending_charges_daemon.on_product_suspended.assert_called_once_with(order, contracts[2])
 
+        # The steps made are saved for every contract
+        states = {}
+        for update_call in self._collection.update_one.call_args_list:
+            query, update = update_call[0]
+            self.assertEquals(ObjectId('58a447608e05ac5752d96d98'), query['_id'])
+            states.update(update['$set'])
+
+        self.assertEquals({
+            'contracts.2.suspension': {'due': contracts[1].next_due, 'notified_7d': datetime(2016, 02, 8)},
+            'contracts.3.suspension': {
+                'due': contracts[2].next_due,
+                'asset_suspended': datetime(2016, 02, 8),
+                'notified_expired': datetime(2016, 02, 8),
+                'suspended': datetime(2016, 02, 8)
+            }
+        }, states)
+        self.assertEquals(4, self._collection.update_one.call_count)
+
+    def _build_expired_order(self, suspension):
+        contract = self._build_subscription_contract(datetime(2016, 01, 31), '1')
+        contract.suspension = suspension
+
+        order = MagicMock(pk='58a447608e05ac5752d96d98', contracts=[contract])
+        pending_charges_daemon.Order.objects.filter.return_value = [order]
+        return order, contract
+
+    def test_suspension_already_made(self):
+        self._build_expired_order({
+            'due': datetime(2016, 01, 31),
+            'asset_suspended': datetime(2016, 02, 1),
+            'notified_expired': datetime(2016, 02, 1),
+            'suspended': datetime(2016, 02, 1)
+        })
+
+        pending_charges_daemon.Command().handle()
+
+        self.assertEquals(0, pending_charges_daemon.on_product_suspended.call_count)
+        self.assertEquals(0, pending_charges_daemon.NotificationsHandler().send_payment_required_notification.call_count)
+        self.assertEquals(0, pending_charges_daemon.InventoryClient().suspend_product.call_count)
+        self.assertEquals(0, self._collection.update_one.call_count)
+
+    def test_suspension_previous_due_date(self):
+        # The state of a previous due date is not applied
+        order, contract = self._build_expired_order({
+            'due': datetime(2015, 12, 31),
+            'asset_suspended': datetime(2016, 01, 1)
+        })
+
+        pending_charges_daemon.Command().handle()
+
+        pending_charges_daemon.on_product_suspended.assert_called_once_with(order, contract)
+        pending_charges_daemon.InventoryClient().suspend_product.assert_called_once_with('1')
+
+    def test_suspension_step_failure(self):
+        order, contract = self._build_expired_order({
+            'due': datetime(2016, 01, 31),
+            'asset_suspended': datetime(2016, 02, 1)
+        })
+        pending_charges_daemon.NotificationsHandler().send_payment_required_notification.side_effect = Exception('SMTP error')
+
+        pending_charges_daemon.Command().handle()
+
+        # The product is not suspended until the customer is notified
+        self.assertEquals(0, pending_charges_daemon.on_product_suspended.call_count)
+        self.assertEquals(0, pending_charges_daemon.InventoryClient().suspend_product.call_count)
+        self.assertEquals(0, self._collection.update_one.call_count)
+
     def test_subscription_renovation(self):
 
         # Not expired
@@ -130,3 +235,81 @@ class ChargesDaemonTestCase(TestCase):
 
         self._test_charging_daemon([contract1, contract2, contract3])
 
+
+    def test_terminated_contract(self):
+        contract = self._build_subscription_contract(datetime(2016, 01, 31), '1')
+        contract.terminated = True
+
+        order = MagicMock(contracts=[contract])
+        pending_charges_daemon.Order.objects.filter.return_value = [order]
+
+        pending_charges_daemon.Command().handle()
+
+        pending_charges_daemon.NotificationsHandler().prefetch_recipients.assert_called_once_with([])
+        self.assertEquals(0, pending_charges_daemon.NotificationsHandler().send_payment_required_notification.call_count)
+        self.assertEquals(0, pending_charges_daemon.on_product_suspended.call_count)
+
+    def test_backfill(self):
+        contract = MagicMock(item_id='1')
+        contract.update_next_due.return_value = datetime(2016, 03, 01)
+
+        order = MagicMock(pk='58a447608e05ac5752d96d98', date=datetime(2016, 01, 01), contracts=[contract])
+        pending_charges_daemon.Order.objects.all.return_value = [order]
+        pending_charges_daemon.Order.objects.filter.return_value = []
+
+        pending_charges_daemon.Command().handle(backfill=True)
+
+        contract.update_next_due.assert_called_once_with(datetime(2016, 01, 01))
+        self._collection.update_one.assert_called_once_with({
+            '_id': ObjectId('58a447608e05ac5752d96d98'),
+            'contracts.0.item_id': '1'
+        }, {
+            '$set': {'contracts.0.next_due': datetime(2016, 03, 01)}
+        })
+
+        # All the contracts are calculated, so orders without due date are not searched
+        self.assertEquals(1, self._collection.find.call_count)
+
+    def _build_missing_order(self, next_due):
+        contract = MagicMock(item_id='1', terminated=False, next_due=None)
+        contract.update_next_due.return_value = next_due
+
+        order = MagicMock(pk='58a447608e05ac5752d96d98', date=datetime(2016, 01, 01), contracts=[contract])
+        pending_charges_daemon.Order.objects.filter.side_effect = [[order], []]
+        self._missing = [{'_id': ObjectId('58a447608e05ac5752d96d98')}]
+        return contract
+
+    def test_backfill_missing(self):
+        contract = self._build_missing_order(datetime(2016, 03, 01))
+
+        pending_charges_daemon.Command().handle()
+
+        self.assertEquals(0, pending_charges_daemon.Order.objects.all.call_count)
+        contract.update_next_due.assert_called_once_with(datetime(2016, 01, 01))
+
+        # The due date is only set if it is still missing
+        self._collection.update_one.assert_called_once_with({
+            '_id': ObjectId('58a447608e05ac5752d96d98'),
+            'contracts.0.item_id': '1',
+            'contracts.0.next_due': {'$in': [None]}
+        }, {
+            '$set': {'contracts.0.next_due': datetime(2016, 03, 01)}
+        })
+
+    def test_backfill_missing_no_due_date(self):
+        contract = self._build_missing_order(None)
+
+        pending_charges_daemon.Command().handle()
+
+        # Contracts without payments due are not updated
+        contract.update_next_due.assert_called_once_with(datetime(2016, 01, 01))
+        self.assertEquals(0, self._collection.update_one.call_count)
+
+    def test_backfill_missing_terminated(self):
+        contract = self._build_missing_order(datetime(2016, 03, 01))
+        contract.terminated = True
+
+        pending_charges_daemon.Command().handle()
+
+        self.assertEquals(0, contract.update_next_due.call_count)
+        self.assertEquals(0, self._collection.update_one.call_count)
@@ -30,15 +30,15 @@ from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from paypalrestsdk import Payout
 
-from wstore.models import User, Context
+from wstore.models import Context
 from wstore.admin.users.notification_handler import NotificationsHandler
+from wstore.admin.users.recipient_resolver import RecipientResolver
 from wstore.charging_engine.models import ReportsPayout, ReportSemiPaid
 from wstore.charging_engine.payment_client.paypal_client import PayPalClient
-from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.database import DistributedLock
+from wstore.store_commons import http_client
 from wstore.ordering.errors import PayoutError
 
-import requests
-
 
 class PayoutWatcher(threading.Thread):
 
@@ -47,6 +47,7 @@ class PayoutWatcher(threading.Thread):
         self.payouts = payouts
         self.reports = reports
         self.notifications = NotificationsHandler()
+        self._recipients = RecipientResolver()
 
     def _mark_as_paid(self, report, paid=True):
         headers = {
@@ -69,7 +70,7 @@ class PayoutWatcher(threading.Thread):
 
         url += 'rss/settlement/reports/{}'.format(report)
 
-        response = requests.patch(url, json=data, headers=headers)
+        response = http_client.patch(url, json=data, headers=headers)
 
         if response.status_code != 200:
             print("Error mark as paid report {}: {}".format(report, response.reason))
@@ -147,8 +148,8 @@ class PayoutWatcher(threading.Thread):
                 continue
 
             report = filtered[0]
-            reportmails = [User.objects.get(username=report['ownerProviderId']).email]
-            reportmails.extend([User.objects.get(username=stake['stakeholderId']).email for stake in report.get('stakeholders', [])])
+            reportmails = self._recipients.get_emails_by_username(
+                [report['ownerProviderId']] + [stake['stakeholderId'] for stake in report.get('stakeholders', [])])
 
             semipaid = self._safe_get_semi_paid(report_id)
             semipaid.failed = [x for x in semipaid.failed if x in reportmails]  # Clean mails not in report
@@ -223,7 +224,7 @@ class PayoutEngine(object):
 
         url += 'rss/settlement/reports'
 
-        response = requests.get(url, params=data, headers=headers)
+        response = http_client.get(url, params=data, headers=headers)
 
         if response.status_code != 200:
             print("Error retrieving reports: {}".format(response.reason))
@@ -233,6 +234,17 @@ class PayoutEngine(object):
 
     def _process_reports(self, reports):
         new_reports = defaultdict(lambda: defaultdict(list))
+
+        # Retrieve all the users involved in the reports at once
+        recipients = RecipientResolver()
+        usernames = []
+        for report in reports:
+            if not report['paid']:
+                usernames.append(report['ownerProviderId'])
+                usernames.extend([stake['stakeholderId'] for stake in report['stakeholders']])
+
+        recipients.prefetch('username', usernames)
+
         # Divide by currency
         for report in reports:
             if report['paid']:
@@ -244,13 +256,13 @@ class PayoutEngine(object):
                 pass
 
             currency = report['currency']
-            usermail = User.objects.get(username=report['ownerProviderId']).email
+            usermail = recipients.get_email_by_username(report['ownerProviderId'])
 
             if semipaid is None or usermail not in semipaid.success:
                 new_reports[currency][usermail].append((report['ownerValue'], report['id']))
 
             for stake in report['stakeholders']:
-                stakemail = User.objects.get(username=stake['stakeholderId']).email
+                stakemail = recipients.get_email_by_username(stake['stakeholderId'])
 
                 if semipaid is None or stakemail not in semipaid.success:
                     new_reports[currency][stakemail].append((stake['modelValue'], report['id']))
@@ -258,58 +270,42 @@ class PayoutEngine(object):
         return new_reports
 
     def _process_payouts(self, data):
-        db = get_database_connection()
         reference = "__payout__engine__context__lock__"
-        # Uses an atomic operation to get and set the _lock value in the purchase
-        # document
-        pre_value = db.wstore_payout.find_one_and_update(
-            {'_id': reference},
-            {'$set': {'_lock': True}}
-        )
-
-        # If no reference exists, create it
-        if pre_value is None:
-            db.wstore_payout.insert_one({'_id': reference, '_lock': False})
-            pre_value = db.wstore_payout.find_one_and_update(
-                {'_id': reference},
-                {'$set': {'_lock': True}}
-            )
-
-        # If the value of _lock before setting it to true was true, means
-        # that the time out function has acquired it previously so the
-        # view ends
-        if '_lock' in pre_value and pre_value['_lock']:
+
+        # Uses an atomic lease on the payout context document, which is
+        # created if it does not exist, so only one payout can be processed
+        lock = DistributedLock('wstore_payout', reference, '_lock', create=True)
+
+        # If the lock cannot be acquired there is other payout being processed
+        if not lock.acquire(blocking=False):
             raise PayoutError('There is a payout running.')
 
-        payments = []
-        context = Context.objects.all()[0]
-        current_id = context.payouts_n
-
-        for currency, users in data.items():
-            payments.append([])
-            for user, values in users.items():
-                for value, report in values:
-                    sender_id = '{}_{}'.format(report, current_id)
-                    payment = {
-                        'recipient_type': 'EMAIL',
-                        'amount': {
-                            'value': "{0:.2f}".format(round(Decimal(value), 2)),
-                            'currency': currency
-                        },
-                        'receiver': user,
-                        'sender_item_id': sender_id
-                    }
-                    current_id += 1
-                    payments[-1].append(payment)
-
-        context.payouts_n = current_id
-        context.save()
-
-        # _lock is set to false
-        db.wstore_payout.find_one_and_update(
-            {'_id': reference},
-            {'$set': {'_lock': False}}
-        )
+        try:
+            payments = []
+            context = Context.objects.all()[0]
+            current_id = context.payouts_n
+
+            for currency, users in data.items():
+                payments.append([])
+                for user, values in users.items():
+                    for value, report in values:
+                        sender_id = '{}_{}'.format(report, current_id)
+                        payment = {
+                            'recipient_type': 'EMAIL',
+                            'amount': {
+                                'value': "{0:.2f}".format(round(Decimal(value), 2)),
+                                'currency': currency
+                            },
+                            'receiver': user,
+                            'sender_item_id': sender_id
+                        }
+                        current_id += 1
+                        payments[-1].append(payment)
+
+            context.payouts_n = current_id
+            context.save()
+        finally:
+            lock.release()
 
         return [self.paypal.batch_payout(paybatch) for paybatch in payments]
 
@@ -31,50 +31,65 @@ class PriceResolver:
         self._applied_sdrs = []
         self._alteration_applied = False
 
-    def _pay_per_use_preprocesing(self, use_models, accounting_info):
+    def _pay_per_use_preprocesing(self, use_models, accounting_info, sdr_callback=None):
         """
            Process pay-per-use payments and call the corresponding
-           price calculator
+           price calculator. Only the aggregated usage of every
+           component is kept, the info of every SDR is provided
+           to sdr_callback
        """
 
         price = Decimal('0')
         duty_free = Decimal('0')
 
+        # Accounting info is processed in a single pass, so it can be lazily generated
+        components = []
+        unit_components = {}
         for component in use_models:
-            related_accounting = []
-
-            # Get the related accounting info
-            partial_price = Decimal('0')
-            partial_duty_free = Decimal('0')
-
-            for sdr in accounting_info:
-                if sdr['unit'].lower() == component['unit'].lower():
-                    sdr_info = {
-                        'usage_id': sdr['usage_id'],
-                        'value': sdr['value']
-                    }
-                    comp_price = (Decimal(sdr['value']) * Decimal(component['value']))
-                    partial_price += comp_price
-                    sdr_info['price'] = unicode(comp_price)
-
-                    comp_duty_free = (Decimal(sdr['value']) * Decimal(component['duty_free']))
-                    partial_duty_free += comp_duty_free
-                    sdr_info['duty_free'] = unicode(comp_duty_free)
-
-                    # Save the information of the SDR document which is needed for further precessing
-                    related_accounting.append(sdr_info)
-
-            # Include the applied SDRs
-            self._applied_sdrs.append({
+            applied = {
                 'model': component,
-                'accounting': related_accounting,
-                'price': unicode(partial_price),
-                'duty_free': unicode(partial_duty_free)
+                'value': Decimal('0'),
+                'price': Decimal('0'),
+                'duty_free': Decimal('0')
+            }
+            components.append(applied)
+            unit_components.setdefault(component['unit'].lower(), []).append(applied)
+
+        for sdr in accounting_info:
+            for applied in unit_components.get(sdr['unit'].lower(), []):
+                component = applied['model']
+                sdr_info = {
+                    'usage_id': sdr['usage_id'],
+                    'value': sdr['value']
+                }
+                comp_price = (Decimal(sdr['value']) * Decimal(component['value']))
+                applied['price'] += comp_price
+                sdr_info['price'] = unicode(comp_price)
+
+                comp_duty_free = (Decimal(sdr['value']) * Decimal(component['duty_free']))
+                applied['duty_free'] += comp_duty_free
+                sdr_info['duty_free'] = unicode(comp_duty_free)
+
+                applied['value'] += Decimal(sdr['value'])
+
+                # Provide the information of the SDR document which is needed for further precessing
+                if sdr_callback is not None:
+                    sdr_callback(component, sdr_info)
+
+        for applied in components:
+            price += applied['price']
+            duty_free += applied['duty_free']
+
+            # Include the aggregated usage of the applied SDRs
+            self._applied_sdrs.append({
+                'model': applied['model'],
+                'price': unicode(applied['price']),
+                'duty_free': unicode(applied['duty_free']),
+                'accounting': [{
+                    'value': unicode(applied['value'])
+                }]
             })
 
-            price += partial_price
-            duty_free += partial_duty_free
-
         return price, duty_free
 
     def is_altered(self):
@@ -121,7 +136,7 @@ class PriceResolver:
        """
         return self._applied_sdrs
 
-    def resolve_price(self, pricing_model, accounting_info=None):
+    def resolve_price(self, pricing_model, accounting_info=None, sdr_callback=None):
         """
            Calculates a price to be charged using a pricing
            model and accounting info.
@@ -143,7 +158,7 @@ class PriceResolver:
         if 'pay_per_use' in pricing_model:
             # Calculate the payment associated with the price component
             partial_price, partial_duty_free = self._pay_per_use_preprocesing(
-                pricing_model['pay_per_use'], accounting_info)
+                pricing_model['pay_per_use'], accounting_info, sdr_callback=sdr_callback)
 
             price += partial_price
             duty_free += partial_duty_free
@@ -22,9 +22,8 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 import json
-from bson.objectid import ObjectId
 from datetime import datetime
-from mock import MagicMock, call
+from mock import MagicMock, call, ANY
 from copy import deepcopy
 from nose_parameterized import parameterized
 
@@ -67,11 +66,14 @@ class ChargingEngineTestCase(TestCase):
         mock_payment_client(self, charging_engine)
         self._payment_inst.get_checkout_url.return_value = self._paypal_url
 
-        # Mock threading
-        charging_engine.threading = MagicMock()
+        # Mock deadline scheduler
+        charging_engine.schedule_deadline = MagicMock()
 
-        self._thread = MagicMock()
-        charging_engine.threading.Timer.return_value = self._thread
+        # Mock usage rater
+        charging_engine.UsageRater = MagicMock()
+
+        # Mock entitlements
+        charging_engine.grant_offering = MagicMock()
 
         # Mock invoice builder
         charging_engine.InvoiceBuilder = MagicMock()
@@ -274,7 +276,7 @@ class ChargingEngineTestCase(TestCase):
 
         # Mock usage client
         charging_engine.UsageClient = MagicMock()
-        charging_engine.UsageClient().get_customer_usage.return_value = [{
+        charging_engine.UsageClient().iter_customer_usage.return_value = [{
             'id': '1'
         }, {
             'id': '2'
@@ -320,19 +322,12 @@ class ChargingEngineTestCase(TestCase):
                     'duty_free': '8.33'
                 },
                 'accounting': [{
-                    'usage_id': '1',
-                    'price': '100.00',
-                    'duty_free': '83.30',
-                    'value': '10'
-                }, {
-                    'usage_id': '3',
-                    'price': '100.00',
-                    'duty_free': '83.30',
-                    'value': '10'
+                    'value': '20'
                 }],
                 'price': '200.00',
                 'duty_free': '166.60'
-            }]
+            }],
+            'rating_batch': charging_engine.UsageRater().stage.return_value.batch_id
         }], [])
 
     def _set_usage_alteration_contracts(self):
@@ -372,7 +367,7 @@ class ChargingEngineTestCase(TestCase):
 
         # Mock usage client
         charging_engine.UsageClient = MagicMock()
-        charging_engine.UsageClient().get_customer_usage.return_value = [{
+        charging_engine.UsageClient().iter_customer_usage.return_value = [{
             'id': '1'
         }, {
             'id': '2'
@@ -436,15 +431,7 @@ class ChargingEngineTestCase(TestCase):
                     'duty_free': '8.33'
                 },
                 'accounting': [{
-                    'usage_id': '1',
-                    'price': '100.00',
-                    'duty_free': '83.30',
-                    'value': '10'
-                }, {
-                    'usage_id': '4',
-                    'price': '100.00',
-                    'duty_free': '83.30',
-                    'value': '10'
+                    'value': '20'
                 }],
                 'price': '200.00',
                 'duty_free': '166.60'
@@ -456,14 +443,12 @@ class ChargingEngineTestCase(TestCase):
                     'duty_free': '8.33'
                 },
                 'accounting': [{
-                    'price': '10.00',
-                    'value': '1',
-                    'usage_id': '3',
-                    'duty_free': '8.33'
+                    'value': '1'
                 }],
                 'price': '10.00',
                 'duty_free': '8.33'
-            }]
+            }],
+            'rating_batch': charging_engine.UsageRater().stage.return_value.batch_id
         }, {
             'price': '30.00',
             'duty_free': '28.33',
@@ -498,15 +483,7 @@ class ChargingEngineTestCase(TestCase):
                     'duty_free': '8.33'
                 },
                 'accounting': [{
-                    'usage_id': '1',
-                    'price': '100.00',
-                    'duty_free': '83.30',
-                    'value': '10'
-                }, {
-                    'usage_id': '4',
-                    'price': '100.00',
-                    'duty_free': '83.30',
-                    'value': '10'
+                    'value': '20'
                 }],
                 'price': '200.00',
                 'duty_free': '166.60'
@@ -518,14 +495,12 @@ class ChargingEngineTestCase(TestCase):
                     'duty_free': '8.33'
                 },
                 'accounting': [{
-                    'price': '10.00',
-                    'value': '1',
-                    'usage_id': '3',
-                    'duty_free': '8.33'
+                    'value': '1'
                 }],
                 'price': '10.00',
                 'duty_free': '8.33'
-            }]}], [])
+            }],
+            'rating_batch': charging_engine.UsageRater().stage.return_value.batch_id}], [])
 
     def _set_alterations(self, name, unit="one time", renovation_date=None):
         component = {
@@ -729,9 +704,8 @@ class ChargingEngineTestCase(TestCase):
         self._payment_class.assert_called_once_with(self._order)
         self._payment_inst.start_redirection_payment.assert_called_once_with(transactions)
 
-        # Check timer call
-        charging_engine.threading.Timer.assert_called_once_with(300, charging._timeout_handler)
-        self._thread.start.assert_called_once_with()
+        # Check timeout scheduling
+        charging_engine.schedule_deadline.assert_called_once_with('payment_timeout', self._order.pk, 300, {'concept': name})
 
         # Check payment saving
         self.assertEquals(Payment(
@@ -742,6 +716,50 @@ class ChargingEngineTestCase(TestCase):
         self.assertEquals('pending', self._order.state)
         self._order.save.assert_called_once_with()
 
+    def test_usage_payment_rated_sdrs(self):
+        self._order.state = 'pending'
+        self._set_usage_contracts()
+
+        # The second usage document is being rated
+        charging_engine.UsageRater().get_rated_usage_ids.return_value = set(['2'])
+
+        charging = charging_engine.ChargingEngine(self._order)
+        charging.resolve_charging('usage')
+
+        charging_engine.UsageRater().get_rated_usage_ids.assert_called_once_with('product1')
+
+        transactions = self._payment_inst.start_redirection_payment.call_args[0][0]
+        self.assertEquals('100.00', transactions[0]['price'])
+        self.assertEquals([{'value': '10'}], transactions[0]['applied_accounting'][0]['accounting'])
+
+        # The rates of the SDRs are staged as they are priced
+        stage = charging_engine.UsageRater().stage
+        stage.assert_called_once_with('product1', 'EUR')
+        stage().add.assert_called_once_with(transactions[0]['applied_accounting'][0]['model'], {
+            'usage_id': '1',
+            'value': '10',
+            'price': '100.00',
+            'duty_free': '83.30'
+        })
+        stage().flush.assert_called_once_with()
+
+    def test_usage_payment_error(self):
+        self._order.state = 'pending'
+        self._set_usage_contracts()
+        self._payment_inst.start_redirection_payment.side_effect = Exception('Payment error')
+
+        charging = charging_engine.ChargingEngine(self._order)
+
+        error = None
+        try:
+            charging.resolve_charging('usage')
+        except Exception as e:
+            error = e
+
+        # The staged rates are removed if the charge cannot be started
+        self.assertEquals('Payment error', unicode(error))
+        charging_engine.UsageRater().discard.assert_called_once_with([charging_engine.UsageRater().stage.return_value.batch_id])
+
     def test_renovation_error(self):
         self._order.state = 'pending'
         self._set_subscription_contract()
@@ -803,6 +821,10 @@ class ChargingEngineTestCase(TestCase):
             call()
         ], self._order.owner_organization.save.call_args_list)
 
+        self.assertEquals([
+            call(self._order, contract) for contract in self._order.contracts
+        ], charging_engine.grant_offering.call_args_list)
+
         self.assertEquals([
             call(self._order, self._order.contracts[0]),
             call(self._order, self._order.contracts[1]),
@@ -827,7 +849,8 @@ class ChargingEngineTestCase(TestCase):
             currency='EUR',
             concept='initial',
             duty_free='10.00',
-            invoice=INVOICE_PATH
+            invoice=INVOICE_PATH,
+            related_model=ANY
         )
 
         self.assertEquals([
@@ -863,7 +886,8 @@ class ChargingEngineTestCase(TestCase):
                         currency='EUR',
                         concept='initial',
                         duty_free=d,
-                        invoice=INVOICE_PATH)
+                        invoice=INVOICE_PATH,
+                        related_model=ANY)
 
         self.assertEquals([
             charge_call('20.00', '20.00'), charge_call('15.00', '15.00'), charge_call('9.00', '9.00'), charge_call('10.00', '10.00'), charge_call('9.00', '9.00')
@@ -882,6 +906,7 @@ class ChargingEngineTestCase(TestCase):
 
         # No new offering has been included
         self.assertEquals([], self._order.owner_organization.acquired_offerings)
+        self.assertEquals(0, charging_engine.grant_offering.call_count)
         charging_engine.CDRManager().generate_cdr.assert_called_once_with(transactions[0]['related_model'], '2016-01-20T13:12:39Z')
 
         self.assertEquals(0, self._order.contracts[0].call_count)
@@ -897,7 +922,8 @@ class ChargingEngineTestCase(TestCase):
             currency='EUR',
             concept='recurring',
             duty_free='10.00',
-            invoice=INVOICE_PATH
+            invoice=INVOICE_PATH,
+            related_model=ANY
         )
 
         self.assertEquals([self._charge], self._order.contracts[1].charges)
@@ -928,7 +954,8 @@ class ChargingEngineTestCase(TestCase):
                         currency='EUR',
                         concept='recurring',
                         duty_free=d,
-                        invoice=INVOICE_PATH)
+                        invoice=INVOICE_PATH,
+                        related_model=ANY)
 
         self.assertEquals([
             charge_call('20.00', '20.00'), charge_call('15.00', '15.00'), charge_call('9.00', '9.00'), charge_call('10.00', '10.00'), charge_call('10.00', '10.00')
@@ -959,13 +986,22 @@ class ChargingEngineTestCase(TestCase):
              validate_sub('10.00', '10.00', 1, {'type': 'discount', 'period': 'one time', 'value': {'value': '1.00', 'duty_free': '1.00'}})], map(lambda x: x.pricing_model, self._order.contracts))
 
     def _validate_end_usage_payment(self, transactions):
-        self.assertEquals([
-            call('1', unicode(datetime(2016, 1, 20, 13, 12, 39)), '83.30', '100.00', '20.00', 'EUR', self._order.contracts[0].product_id),
-            call('3', unicode(datetime(2016, 1, 20, 13, 12, 39)), '83.30', '100.00', '20.00', 'EUR', self._order.contracts[0].product_id)
-        ],
-            charging_engine.UsageClient().rate_usage.call_args_list
+        charging_engine.UsageRater().enqueue.assert_called_once_with(
+            transactions[0]['rating_batch'],
+            unicode(datetime(2016, 1, 20, 13, 12, 39))
         )
 
+        # The charge keeps the aggregated usage to regenerate the invoice
+        self.assertEquals({
+            'pay_per_use': transactions[0]['related_model']['pay_per_use'],
+            'accounting': [{
+                'model': transactions[0]['applied_accounting'][0]['model'],
+                'price': '200.00',
+                'duty_free': '166.60',
+                'accounting': [{'value': '20'}]
+            }]
+        }, charging_engine.Charge.call_args[1]['related_model'])
+
         charging_engine.BillingClient.assert_called_once_with()
         charging_engine.BillingClient().create_charge.assert_called_once_with(
             self._charge, self._order.contracts[0].product_id, start_date=datetime(2016, 1, 20, 13, 12, 39), end_date=None)
@@ -1008,6 +1044,62 @@ class ChargingEngineTestCase(TestCase):
         self.assertFalse(error is None)
         self.assertEquals('Invalid charge type, must be initial, recurring, or usage', unicode(e))
 
+    def _mock_timeout(self, state):
+        lock = MagicMock()
+        lock.acquire.return_value = True
+        lock.document = {'state': state}
+        charging_engine.DistributedLock = MagicMock(return_value=lock)
+
+        order = MagicMock(pk='order_id')
+        charging_engine.Order = MagicMock()
+        charging_engine.Order.objects.filter.return_value = [order]
+        charging_engine.Order.objects.get.return_value = order
+
+        return lock, order
+
+    def test_payment_timeout_renovation(self):
+        lock, order = self._mock_timeout('pending')
+
+        charging_engine.payment_timeout_handler('order_id', {'concept': 'recurring'})
+
+        charging_engine.Order.objects.filter.assert_called_once_with(pk='order_id')
+        charging_engine.DistributedLock.assert_called_once_with('wstore_order', 'order_id', '_lock', lease=1800)
+        lock.acquire.assert_called_once_with(blocking=False)
+        lock.release.assert_called_once_with()
+
+        self.assertEquals('paid', order.state)
+        self.assertEquals(None, order.pending_payment)
+        order.save.assert_called_once_with()
+
+    def test_payment_timeout_usage(self):
+        lock, order = self._mock_timeout('pending')
+        order.pending_payment.transactions = [{'item': '1', 'rating_batch': 'batch1'}, {'item': '2'}]
+
+        charging_engine.payment_timeout_handler('order_id', {'concept': 'usage'})
+
+        # The staged rates of the usage are removed
+        charging_engine.UsageRater().discard.assert_called_once_with(['batch1'])
+
+        self.assertEquals('paid', order.state)
+        self.assertEquals(None, order.pending_payment)
+        order.save.assert_called_once_with()
+
+    def test_payment_timeout_paid(self):
+        lock, order = self._mock_timeout('paid')
+
+        charging_engine.payment_timeout_handler('order_id', {'concept': 'recurring'})
+
+        lock.release.assert_called_once_with()
+        self.assertEquals(0, order.save.call_count)
+
+    def test_payment_timeout_deleted_order(self):
+        self._mock_timeout('pending')
+        charging_engine.Order.objects.filter.return_value = []
+
+        charging_engine.payment_timeout_handler('order_id', {'concept': 'initial'})
+
+        self.assertEquals(0, charging_engine.DistributedLock.call_count)
+
 BASIC_PAYPAL = {
     'reference': '111111111111111111111111',
     'payerId': 'payer',
@@ -1072,14 +1164,13 @@ class PayPalConfirmationTestCase(TestCase):
         views.OrderingClient = MagicMock()
         views.OrderingClient.return_value = self._ordering_inst
 
-        # Mock database connection
-        views.get_database_connection = MagicMock()
-        self._connection_inst = MagicMock()
-        self._connection_inst.wstore_order.find_one_and_update.return_value = {
-            '_lock': False,
+        # Mock order lock
+        self._lock_inst = MagicMock()
+        self._lock_inst.acquire.return_value = True
+        self._lock_inst.document = {
             'state': 'pending'
         }
-        views.get_database_connection.return_value = self._connection_inst
+        views.DistributedLock = MagicMock(return_value=self._lock_inst)
 
         # Mock Order
         views.Order = MagicMock()
@@ -1111,6 +1202,9 @@ class PayPalConfirmationTestCase(TestCase):
 
         views.settings.PAYMENT_CLIENT = 'wstore.charging_engine.payment_client.payment_client.PaymentClient'
 
+        views.cancel_deadline = MagicMock()
+        views.discard_usage_rates = MagicMock()
+
     def tearDown(self):
         reload(wstore.store_commons.utils.http)
         reload(views)
@@ -1119,16 +1213,22 @@ class PayPalConfirmationTestCase(TestCase):
         views.Order.objects.filter.return_value = []
 
     def _lock_closed(self):
-        self._connection_inst.wstore_order.find_one_and_update.return_value = {
-            '_lock': True
-        }
+        self._lock_inst.acquire.return_value = False
 
     def _timeout(self):
-        self._connection_inst.wstore_order.find_one_and_update.return_value = {
-            '_lock': False,
+        self._lock_inst.document = {
             'state': 'paid'
         }
 
+    def _lease_lost(self):
+        self._lock_inst.renew.return_value = False
+
+    def _update_lost(self):
+        self._lock_inst.update.return_value = False
+
+    def _charging_lease_lost(self):
+        self._lock_inst.renew.side_effect = [True, False]
+
     def _unauthorized(self):
         self.user.userprofile.current_organization = MagicMock()
 
@@ -1158,6 +1258,9 @@ class PayPalConfirmationTestCase(TestCase):
         }, None, _invalid_ref, True),
         ('lock_closed', BASIC_PAYPAL, LOCK_CLOSED_RESP, None, _lock_closed, True),
         ('timeout_finished', BASIC_PAYPAL, LOCK_CLOSED_RESP, None, _timeout, True, True),
+        ('lease_lost', BASIC_PAYPAL, LOCK_CLOSED_RESP, None, _lease_lost, True, True),
+        ('update_lost', BASIC_PAYPAL, LOCK_CLOSED_RESP, None, _update_lost, True, True),
+        ('charging_lease_lost', BASIC_PAYPAL, LOCK_CLOSED_RESP, None, _charging_lease_lost, True, True),
         ('unauthorized', BASIC_PAYPAL, {
             'result': 'error',
             'error': 'The payment has been canceled: PaymentError: You are not authorized to execute the payment'
@@ -1194,12 +1297,16 @@ class PayPalConfirmationTestCase(TestCase):
         views.OrderingClient.assert_called_once_with()
 
         if not error:
-            views.get_database_connection.assert_called_once_with()
-            self.assertEquals([
-                call({'_id': ObjectId('111111111111111111111111')}, {'$set': {'_lock': True}}),
-                call({'_id': ObjectId('111111111111111111111111')}, {'$set': {'_lock': False}})],
-                self._connection_inst.wstore_order.find_one_and_update.call_args_list
-            )
+            views.DistributedLock.assert_called_once_with('wstore_order', '111111111111111111111111', '_lock', lease=1800)
+            self._lock_inst.acquire.assert_called_once_with(blocking=False)
+            self.assertEquals([call(), call()], self._lock_inst.renew.call_args_list)
+
+            # The sales are saved through the lock, so the lock fields are kept
+            self._lock_inst.update.assert_called_once_with({
+                '$set': {'sales_ids': self._payment_inst.end_redirection_payment.return_value}
+            })
+            self.assertEquals(0, self._order_inst.save.call_count)
+            self._lock_inst.release.assert_called_once_with()
 
             views.Order.objects.filter.assert_called_once_with(pk='111111111111111111111111')
             views.Order.objects.get.assert_called_once_with(pk='111111111111111111111111')
@@ -1209,6 +1316,7 @@ class PayPalConfirmationTestCase(TestCase):
 
             views.ChargingEngine.assert_called_once_with(self._order_inst)
             self._charging_inst.end_charging.assert_called_once_with([{'item': '1'}, {'item': '2'}], self._free_contracts, 'initial')
+            views.cancel_deadline.assert_called_once_with('payment_timeout', '111111111111111111111111')
 
             self._ordering_inst.get_order.assert_called_once_with('1')
 
@@ -1227,6 +1335,37 @@ class PayPalConfirmationTestCase(TestCase):
             ], self._ordering_inst.update_items_state.call_args_list)
             self._order_inst.delete.assert_called_once_with()
 
+            # The order lock must be released when the payment is canceled
+            self.assertTrue(self._lock_inst.release.called)
+            self.assertEquals(0, views.cancel_deadline.call_count)
+
+            # The charge is not processed without the lock
+            if name in ('update_lost', 'charging_lease_lost'):
+                self.assertEquals(0, self._charging_inst.end_charging.call_count)
+
+    def test_paypal_confirmation_usage_error(self):
+        transactions = [{'item': '1', 'rating_batch': 'batch1'}]
+        self._order_inst.pending_payment = Payment(transactions=transactions, free_contracts=[], concept='usage')
+        self._charging_inst.end_charging.side_effect = Exception('Unexpected')
+
+        request = self.factory.post(
+            'charging/api/orderManagement/orders/accept/',
+            json.dumps(BASIC_PAYPAL),
+            content_type='application/json',
+            HTTP_ACCEPT='application/json'
+        )
+        request.user = self.user
+
+        response = views.PayPalConfirmation(permitted_methods=('POST',)).create(request)
+
+        self.assertEquals(500, response.status_code)
+
+        # The staged rates of the usage are removed and the order is kept
+        views.discard_usage_rates.assert_called_once_with(transactions)
+        self.assertEquals('paid', self._order_inst.state)
+        self.assertEquals(None, self._order_inst.pending_payment)
+        self.assertEquals(0, self._order_inst.delete.call_count)
+
 
 MISSING_FIELD_RESP = {
     'result': 'error',
@@ -20,12 +20,16 @@
 
 from __future__ import unicode_literals
 
-from mock import MagicMock
+import errno
+import os
+
+from mock import MagicMock, ANY, call
 from nose_parameterized import parameterized
 
 from django.test import TestCase
+from django.test.utils import override_settings
 
-from wstore.charging_engine import invoice_builder
+from wstore.charging_engine import invoice_builder, invoice_renderer
 
 
 TEMPLATE = '<html></html>'
@@ -40,6 +44,7 @@ OWNER_NAME = 'owner-user'
 
 BASEDIR = '/home/test'
 BILL_ROOT = '/home/test/media/invoices'
+TMP_DIR = '/tmp/invoice_1234'
 MEDIA_URL = '/charging/media/'
 
 TAX = {
@@ -320,13 +325,17 @@ class InvoiceBuilderTestCase(TestCase):
         self._file_handler = MagicMock()
         invoice_builder.codecs.open.return_value = self._file_handler
 
-        invoice_builder.os.path.exists = MagicMock()
-        invoice_builder.os.path.exists.side_effect = [True, True, False]
-        invoice_builder.os.listdir = MagicMock()
-        invoice_builder.os.listdir.return_value = ['file1.pdf', 'file1.html']
-        invoice_builder.os.remove = MagicMock()
+        invoice_builder.os = MagicMock()
+        invoice_builder.os.path.join = os.path.join
+        invoice_builder.os.open.side_effect = [
+            OSError(errno.EEXIST, 'File exists'), OSError(errno.EEXIST, 'File exists'), 3]
+
+        invoice_builder.tempfile = MagicMock()
+        invoice_builder.tempfile.mkdtemp.return_value = TMP_DIR
+        invoice_builder.render_invoice = MagicMock()
 
-        invoice_builder.subprocess = MagicMock()
+    def tearDown(self):
+        reload(invoice_builder)
 
     @parameterized.expand([
         ('initial_one_time', 'initial', SINGLE_PAYMENT_TRANS, SINGLE_PAYMENT_CONTEXT),
@@ -353,7 +362,7 @@ class InvoiceBuilderTestCase(TestCase):
         invoice_name = "{}_{}_{}_2.pdf".format(self._order.pk, self._contract.item_id, TIMESTAMP.split()[0])
 
         exp_path = MEDIA_URL + 'bills/' + invoice_name
-        html_path = BILL_ROOT + '/' + invoice_name.replace('_2.pdf', '.html')
+        html_path = TMP_DIR + '/' + invoice_name.replace('_2.pdf', '.html')
 
         self.assertEquals(exp_path, invoice_path)
 
@@ -366,11 +375,210 @@ class InvoiceBuilderTestCase(TestCase):
         self._file_handler.write.assert_called_once_with(TEMPLATE)
         self._file_handler.close.assert_called_once_with()
 
-        invoice_builder.subprocess.call.assert_called_once_with([
-            BASEDIR + '/create_invoice.sh',
-            html_path,
-            BILL_ROOT + '/' + invoice_name
-        ])
+        # The invoice name is reserved
+        invoice_builder.tempfile.mkdtemp.assert_called_once_with(prefix='invoice_')
+        self.assertEquals(3, invoice_builder.os.open.call_count)
+        invoice_builder.os.open.assert_called_with(BILL_ROOT + '/' + invoice_name, ANY)
+        invoice_builder.os.close.assert_called_once_with(3)
+
+        invoice_builder.render_invoice.assert_called_once_with(html_path, BILL_ROOT + '/' + invoice_name, TMP_DIR, sync=False, group=None)
+
+    def test_regenerate_invoice_stored_model(self):
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        builder.generate_invoice = MagicMock(return_value='/charging/media/bills/invoice_1.pdf')
+
+        charge = MagicMock(cost='12.00', duty_free='10.00', currency='EUR', concept='usage', date=TIMESTAMP)
+        charge.related_model = {
+            'pay_per_use': [{'value': '10.00'}],
+            'accounting': [{'model': {'unit': 'call'}, 'accounting': [{'value': '2'}]}]
+        }
+
+        path = builder.regenerate_invoice(self._contract, charge)
+
+        self.assertEquals('/charging/media/bills/invoice_1.pdf', path)
+        builder.generate_invoice.assert_called_once_with(self._contract, {
+            'price': '12.00',
+            'duty_free': '10.00',
+            'currency': 'EUR',
+            'related_model': charge.related_model,
+            'applied_accounting': charge.related_model['accounting']
+        }, 'usage', charge_date=TIMESTAMP, sync=True)
+
+    def test_regenerate_invoice_pricing_model(self):
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        builder.generate_invoice = MagicMock()
+
+        self._contract.pricing_model = {
+            'general_currency': 'EUR',
+            'single_payment': [{'value': '5.00'}],
+            'subscription': [{'value': '7.00', 'unit': 'monthly'}]
+        }
+        charge = MagicMock(cost='7.00', duty_free='7.00', currency='EUR', concept='recurring', date=TIMESTAMP, related_model={})
+
+        builder.regenerate_invoice(self._contract, charge)
+
+        self.assertEquals({
+            'subscription': [{'value': '7.00', 'unit': 'monthly', 'renovation_date': ''}]
+        }, builder.generate_invoice.call_args[0][1]['related_model'])
+
+    def test_regenerate_invoice_usage_not_stored(self):
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        charge = MagicMock(concept='usage', related_model={})
+
+        error = None
+        try:
+            builder.regenerate_invoice(self._contract, charge)
+        except ValueError as e:
+            error = e
+
+        self.assertEquals('The usage applied in the charge is not available', unicode(error))
+
+
+class InvoiceRendererTestCase(TestCase):
+
+    tags = ('invoices', 'invoice-renderer')
+
+    def setUp(self):
+        invoice_renderer.subprocess = MagicMock()
+        invoice_renderer.subprocess.call.return_value = 0
+        invoice_renderer.shutil = MagicMock()
+        invoice_renderer.settings.BASEDIR = BASEDIR
+
+    def tearDown(self):
+        reload(invoice_renderer)
+
+    @override_settings(WKHTMLTOPDF_PATH='/usr/bin/wkhtmltopdf', INVOICE_XVFB_DISPLAY=':98', INVOICE_ASYNC=False,
+                       INVOICE_RENDERER='wstore.charging_engine.invoice_renderer.WkhtmltopdfRenderer')
+    def test_render_invoice(self):
+        invoice_renderer.os = MagicMock()
+        invoice_renderer.os.environ = {}
+        # The display socket is created after starting the server
+        invoice_renderer.os.path.exists.side_effect = [False, False, True, True]
+        invoice_renderer.time = MagicMock()
+        invoice_renderer.time.time.return_value = 10.0
+
+        invoice_renderer.render_invoice(TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_0.pdf', TMP_DIR)
+        invoice_renderer.render_invoice(TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_1.pdf', TMP_DIR)
+
+        # The virtual display is only started once, waiting until it is ready
+        invoice_renderer.subprocess.Popen.assert_called_once_with(['Xvfb', ':98'])
+        invoice_renderer.time.sleep.assert_called_once_with(0.1)
+        self.assertEquals([call('/tmp/.X11-unix/X98')] * 4, invoice_renderer.os.path.exists.call_args_list)
+        self.assertEquals([
+            call(['/usr/bin/wkhtmltopdf', '--quiet', TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_0.pdf'], env={'DISPLAY': ':98'}),
+            call(['/usr/bin/wkhtmltopdf', '--quiet', TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_1.pdf'], env={'DISPLAY': ':98'})
+        ], invoice_renderer.subprocess.call.call_args_list)
+
+        self.assertEquals([call(TMP_DIR, True), call(TMP_DIR, True)], invoice_renderer.shutil.rmtree.call_args_list)
+
+    @override_settings(INVOICE_XVFB_DISPLAY=':98', INVOICE_XVFB_TIMEOUT=5)
+    def test_shared_display(self):
+        invoice_renderer.os = MagicMock()
+        invoice_renderer.os.environ = {}
+        invoice_renderer.os.path.exists.return_value = True
+
+        renderer = invoice_renderer.WkhtmltopdfRenderer()
+        self.assertEquals({'DISPLAY': ':98'}, renderer._get_env())
+
+        # The display started by other process is used
+        self.assertEquals(0, invoice_renderer.subprocess.Popen.call_count)
+
+    @override_settings(INVOICE_XVFB_DISPLAY=':98', INVOICE_XVFB_TIMEOUT=5)
+    def test_display_not_available(self):
+        invoice_renderer.os = MagicMock()
+        invoice_renderer.os.environ = {}
+        invoice_renderer.os.path.exists.return_value = False
+        invoice_renderer.time = MagicMock()
+        invoice_renderer.time.time.side_effect = [10.0, 12.0, 15.0]
+
+        error = None
+        try:
+            invoice_renderer.WkhtmltopdfRenderer()._get_env()
+        except invoice_renderer.InvoiceRenderingError as e:
+            error = e
+
+        self.assertEquals('The virtual display :98 is not available', unicode(error))
+        invoice_renderer.subprocess.Popen.assert_called_once_with(['Xvfb', ':98'])
+        self.assertEquals(1, invoice_renderer.time.sleep.call_count)
+
+    @override_settings(INVOICE_ASYNC=False, INVOICE_RENDERER='wstore.charging_engine.invoice_renderer.ScriptRenderer')
+    def test_render_invoice_error(self):
+        invoice_renderer.os = MagicMock()
+        invoice_renderer.os.path.exists.return_value = True
+        invoice_renderer.subprocess.call.return_value = 1
+
+        error = None
+        try:
+            invoice_renderer.render_invoice(TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_0.pdf', TMP_DIR)
+        except invoice_renderer.InvoiceRenderingError as e:
+            error = e
+
+        self.assertEquals('Error rendering invoice ' + BILL_ROOT + '/invoice_0.pdf', unicode(error))
+        invoice_renderer.subprocess.call.assert_called_once_with(
+            [BASEDIR + '/create_invoice.sh', TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_0.pdf'])
+
+        # The reserved file and the temporal directory are removed
+        invoice_renderer.os.remove.assert_called_once_with(BILL_ROOT + '/invoice_0.pdf')
+        invoice_renderer.shutil.rmtree.assert_called_once_with(TMP_DIR, True)
+
+    @override_settings(INVOICE_ASYNC=True)
+    def test_render_invoice_async(self):
+        invoice_renderer.ThreadPool = MagicMock()
+
+        invoice_renderer.render_invoice(TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_0.pdf', TMP_DIR)
+
+        invoice_renderer.ThreadPool.assert_called_once_with(2)
+        invoice_renderer.ThreadPool().apply_async.assert_called_once_with(
+            invoice_renderer._renderer_pool._render_task, (TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_0.pdf', TMP_DIR, None))
+        self.assertEquals(0, invoice_renderer.subprocess.call.call_count)
+
+    @override_settings(INVOICE_ASYNC=True)
+    def test_render_invoice_async_error(self):
+        invoice_renderer.ThreadPool = MagicMock()
+        invoice_renderer.logger = MagicMock()
+        invoice_renderer.os = MagicMock()
+        invoice_renderer.os.path.exists.return_value = True
+
+        action = MagicMock()
+        group = invoice_renderer.RenderGroup(action)
+
+        invoice_renderer.render_invoice(TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_0.pdf', TMP_DIR, group=group)
+        group.close()
+
+        invoice_renderer._renderer_pool.get_renderer = MagicMock()
+        invoice_renderer._renderer_pool.get_renderer().render.side_effect = invoice_renderer.InvoiceRenderingError('Error')
+
+        render_call = invoice_renderer.ThreadPool().apply_async.call_args
+        render_call[0][0](*render_call[0][1])
+
+        # The error is logged and the reserved file removed, so the invoice can be regenerated
+        invoice_renderer.logger.exception.assert_called_once_with('Error rendering invoice ' + BILL_ROOT + '/invoice_0.pdf')
+        invoice_renderer.os.remove.assert_called_once_with(BILL_ROOT + '/invoice_0.pdf')
+        action.assert_called_once_with()
+
+    def test_render_group_action_error(self):
+        invoice_renderer.logger = MagicMock()
+        group = invoice_renderer.RenderGroup(MagicMock(side_effect=Exception('SMTP error')))
+
+        group.close()
+
+        invoice_renderer.logger.exception.assert_called_once_with('Error running the action of the rendered invoices')
+
+    @override_settings(INVOICE_ASYNC=True)
+    def test_render_group(self):
+        invoice_renderer.ThreadPool = MagicMock()
+        action = MagicMock()
+        group = invoice_renderer.RenderGroup(action)
+
+        invoice_renderer.render_invoice(TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_0.pdf', TMP_DIR, group=group)
+        invoice_renderer.render_invoice(TMP_DIR + '/invoice.html', BILL_ROOT + '/invoice_1.pdf', TMP_DIR, group=group)
+        group.close()
+
+        # The action waits for the invoices being rendered in background
+        self.assertEquals(0, action.call_count)
 
-        invoice_builder.os.listdir.assert_called_once_with(BILL_ROOT)
-        invoice_builder.os.remove.assert_called_once_with(BILL_ROOT + '/file1.html')
+        invoice_renderer._renderer_pool.get_renderer = MagicMock()
+        for render_call in invoice_renderer.ThreadPool().apply_async.call_args_list:
+            render_call[0][0](*render_call[0][1])
+
+        action.assert_called_once_with()
@@ -30,6 +30,7 @@ from django.test import TestCase
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 
+from wstore.admin.users import recipient_resolver
 from wstore.charging_engine import payout_engine
 from wstore.ordering.errors import PayoutError
 
@@ -56,8 +57,14 @@ def createMail(i):
     return "user{}@email.com".format(i)
 
 
-def createUsers(*args):
-    return [namedtuple('User', ['email'])(createMail(x)) for x in args]
+def mockUsers(*args):
+    users = {createMail(x): namedtuple('User', ['username', 'email'])(createMail(x), createMail(x)) for x in args}
+    recipient_resolver.User.objects.filter.side_effect = lambda username__in: [
+        users[username] for username in username__in if username in users]
+
+
+def checkUsersQuery(*args):
+    recipient_resolver.User.objects.filter.assert_called_once_with(username__in=[createMail(x) for x in args])
 
 
 def createReport(ids, owner=1, stakeholders=None):
@@ -108,11 +115,11 @@ def RSSUrl():
 def setUp():
     # Libraries
     payout_engine.threading = MagicMock()
-    payout_engine.requests = MagicMock()
+    payout_engine.http_client = MagicMock()
     payout_engine.Payout = MagicMock()
 
     # Models
-    payout_engine.User = MagicMock()
+    recipient_resolver.User = MagicMock()
     payout_engine.Context = MagicMock()
     payout_engine.ReportsPayout = MagicMock()
     payout_engine.ReportSemiPaid = MagicMock()
@@ -120,7 +127,7 @@ def setUp():
     # Inner library
     payout_engine.NotificationsHandler = MagicMock()
     payout_engine.PayPalClient = MagicMock()
-    payout_engine.get_database_connection = MagicMock()
+    payout_engine.DistributedLock = MagicMock()
 
 
 class PayoutWatcherTestCase(TestCase):
@@ -132,16 +139,16 @@ class PayoutWatcherTestCase(TestCase):
 
     def test_mark_as_paid(self):
         watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.requests.patch().status_code = 200
-        payout_engine.requests.patch().json.return_value = [{'test': 'case'}]
+        payout_engine.http_client.patch().status_code = 200
+        payout_engine.http_client.patch().json.return_value = [{'test': 'case'}]
 
-        payout_engine.requests.patch.reset_mock()
+        payout_engine.http_client.patch.reset_mock()
 
         result = watcher._mark_as_paid("report1")
 
         url = "{}/rss/settlement/reports/{}".format(RSSUrl(), "report1")
 
-        payout_engine.requests.patch.assert_called_once_with(
+        payout_engine.http_client.patch.assert_called_once_with(
             url,
             json=[{'op': 'replace', 'path': '/paid', 'value': True}],
             headers={
@@ -150,22 +157,22 @@ class PayoutWatcherTestCase(TestCase):
                 'X-Roles': 'admin',
                 'X-Email': settings.WSTOREMAIL})
 
-        payout_engine.requests.patch().json.assert_called_once_with()
+        payout_engine.http_client.patch().json.assert_called_once_with()
 
         assert result == [{'test': 'case'}]
 
     def test_mark_as_paid_error(self):
         watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.requests.patch().status_code = 404
-        payout_engine.requests.patch().json.return_value = [{'test': 'case'}]
+        payout_engine.http_client.patch().status_code = 404
+        payout_engine.http_client.patch().json.return_value = [{'test': 'case'}]
 
-        payout_engine.requests.patch.reset_mock()
+        payout_engine.http_client.patch.reset_mock()
 
         result = watcher._mark_as_paid("report1")
 
         url = "{}/rss/settlement/reports/{}".format(RSSUrl(), "report1")
 
-        payout_engine.requests.patch.assert_called_once_with(
+        payout_engine.http_client.patch.assert_called_once_with(
             url,
             json=[{'op': 'replace', 'path': '/paid', 'value': True}],
             headers={
@@ -174,7 +181,7 @@ class PayoutWatcherTestCase(TestCase):
                 'X-Roles': 'admin',
                 'X-Email': settings.WSTOREMAIL})
 
-        payout_engine.requests.patch().json.assert_not_called()
+        payout_engine.http_client.patch().json.assert_not_called()
 
         assert result == []
 
@@ -309,11 +316,11 @@ class PayoutWatcherTestCase(TestCase):
         semipaid = ReportSemiPaid(1, ['user1@email.com', 'user2@email.com'])
         watcher._safe_get_semi_paid.return_value = semipaid
         watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        mockUsers(1)
 
         watcher._check_reports_payout(payout)
 
-        payout_engine.User.objects.get.assert_called_once_with(username='user1@email.com')
+        checkUsersQuery(1)
         watcher._safe_get_semi_paid.assert_called_once_with('9')
 
         assert semipaid.failed == ['user1@email.com']  # Bad emails cleaned
@@ -332,11 +339,11 @@ class PayoutWatcherTestCase(TestCase):
         watcher._safe_get_semi_paid.return_value = semipaid
 
         watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        mockUsers(1)
 
         watcher._check_reports_payout(payout)
 
-        payout_engine.User.objects.get.assert_called_once_with(username='user1@email.com')
+        checkUsersQuery(1)
         watcher._safe_get_semi_paid.assert_called_once_with('9')
 
         assert semipaid.failed == []  # Bad emails cleaned
@@ -354,11 +361,11 @@ class PayoutWatcherTestCase(TestCase):
         watcher._safe_get_semi_paid = MagicMock(return_value=semipaid)
 
         watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3)
+        mockUsers(1, 2, 3)
 
         watcher._check_reports_payout(payout)
 
-        payout_engine.User.objects.get.assert_has_calls([call(username='user1@email.com'), call(username='user2@email.com'), call(username='user3@email.com')])
+        checkUsersQuery(1, 2, 3)
         watcher._safe_get_semi_paid.assert_called_once_with('9')
 
         assert semipaid.failed == ['user2@email.com', 'user3@email.com']  # Bad emails cleaned
@@ -376,11 +383,11 @@ class PayoutWatcherTestCase(TestCase):
         watcher._safe_get_semi_paid = MagicMock(return_value=semipaid)
 
         watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3)
+        mockUsers(1, 2, 3)
 
         watcher._check_reports_payout(payout)
 
-        payout_engine.User.objects.get.assert_has_calls([call(username='user1@email.com'), call(username='user2@email.com'), call(username='user3@email.com')])
+        checkUsersQuery(1, 2, 3)
         watcher._safe_get_semi_paid.assert_called_once_with('9')
 
         assert semipaid.failed == []  # Bad emails cleaned
@@ -456,16 +463,16 @@ class PayoutEngineTestCase(TestCase):
 
     def test_get_reports_not_paid(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.requests.get().status_code = 200
-        payout_engine.requests.get().json.return_value = [{'test': 'case'}]
+        payout_engine.http_client.get().status_code = 200
+        payout_engine.http_client.get().json.return_value = [{'test': 'case'}]
 
-        payout_engine.requests.get.reset_mock()
+        payout_engine.http_client.get.reset_mock()
 
         result = engine._get_reports()
 
         url = "{}/rss/settlement/reports".format(RSSUrl())
 
-        payout_engine.requests.get.assert_called_once_with(
+        payout_engine.http_client.get.assert_called_once_with(
             url,
             params={'aggregatorId': None, 'providerId': None, 'productClass': None, 'onlyPaid': "true"},
             headers={
@@ -474,7 +481,7 @@ class PayoutEngineTestCase(TestCase):
                 'X-Roles': 'admin',
                 'X-Email': settings.WSTOREMAIL})
 
-        payout_engine.requests.get().json.assert_called_once_with()
+        payout_engine.http_client.get().json.assert_called_once_with()
 
         assert result == [{'test': 'case'}]
 
@@ -499,12 +506,12 @@ class PayoutEngineTestCase(TestCase):
         assert new_reports == {}
 
         payout_engine.ReportSemiPaid.objets.get.assert_not_called()
-        payout_engine.User.objets.get.assert_not_called()
+        recipient_resolver.User.objects.filter.assert_not_called()
 
     def test_process_reports_simple(self):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        mockUsers(1)
 
         reports = [{
             'paid': False,
@@ -519,7 +526,7 @@ class PayoutEngineTestCase(TestCase):
         # Just one report
         assert new_reports == {'EUR': {'user1@email.com': [(10, 1)]}}
         payout_engine.ReportSemiPaid.objects.get.assert_called_once_with(report=1)
-        payout_engine.User.objects.get.assert_called_once_with(username=createMail(1))
+        checkUsersQuery(1)
 
     @parameterized.expand([
         (('EUR', 'EUR'), {'EUR': {'user1@email.com': [(10, 1), (20, 2)]}}),
@@ -528,7 +535,7 @@ class PayoutEngineTestCase(TestCase):
     def test_process_reports_multiple_pays_user(self, currencies, result):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 1)
+        mockUsers(1, 1)
 
         reports = [{
             'paid': False,
@@ -549,12 +556,12 @@ class PayoutEngineTestCase(TestCase):
 
         assert new_reports == result
         payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1), call(report=2)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1)), call(username=createMail(1))])
+        checkUsersQuery(1)
 
     def test_process_reports_with_stakeholders(self):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3, 2, 1)
+        mockUsers(1, 2, 3, 2, 1)
 
         reports = [{
             'paid': False,
@@ -585,12 +592,12 @@ class PayoutEngineTestCase(TestCase):
 
         assert new_reports == {'EUR': {'user1@email.com': [(10, 1), (10, 2)], 'user2@email.com': [(2, 1), (20, 2)], 'user3@email.com': [(4, 1)]}}
         payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1), call(report=2)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1)), call(username=createMail(2)), call(username=createMail(3)), call(username=createMail(2)), call(username=createMail(1))])
+        checkUsersQuery(1, 2, 3)
 
     def test_process_reports_user_in_semipaid(self):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.return_value = ReportSemiPaid(1, None, [createMail(1)])
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        mockUsers(1)
 
         reports = [{
             'paid': False,
@@ -605,12 +612,12 @@ class PayoutEngineTestCase(TestCase):
 
         assert new_reports == {}
         payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1))])
+        checkUsersQuery(1)
 
     def test_process_reports_user_in_semipaid_and_stakeholders(self):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.return_value = ReportSemiPaid(1, None, [createMail(1), createMail(3)])
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3)
+        mockUsers(1, 2, 3)
 
         reports = [{
             'paid': False,
@@ -631,31 +638,31 @@ class PayoutEngineTestCase(TestCase):
 
         assert new_reports == {'EUR': {'user2@email.com': [(5, 1)]}}
         payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1)), call(username=createMail(2))])
+        checkUsersQuery(1, 2, 3)
+
+    def _check_lock(self, released=True):
+        payout_engine.DistributedLock.assert_called_once_with('wstore_payout', self.reference, '_lock', create=True)
+        payout_engine.DistributedLock().acquire.assert_called_once_with(blocking=False)
+
+        if released:
+            payout_engine.DistributedLock().release.assert_called_once_with()
+        else:
+            payout_engine.DistributedLock().release.assert_not_called()
 
-    def test_process_payouts_create_lock(self):
+    def test_process_payouts_lock(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.get_database_connection().wstore_payout.find_one_and_update.side_effect = [None, MagicMock(), None]
         payout_engine.Context.objects.all()[0].payouts_n = 10
 
         data = {}
         engine._process_payouts(data)
 
         assert payout_engine.Context.objects.all()[0].payouts_n == 10
-
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_called_once_with({'_id': self.reference, '_lock': False})
-
-        payout_engine.get_database_connection().wstore_payout.find_one_and_update.assert_has_calls([
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': False}})])
+        self._check_lock()
 
     def test_process_payouts_raise_in_lock(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.get_database_connection().wstore_payout.find_one_and_update.return_value = {'_lock': True}
+        payout_engine.DistributedLock().acquire.return_value = False
+        payout_engine.DistributedLock.reset_mock()
         payout_engine.Context.objects.all()[0].payouts_n = 10
 
         data = {}
@@ -664,12 +671,16 @@ class PayoutEngineTestCase(TestCase):
             engine._process_payouts(data)
 
         assert payout_engine.Context.objects.all()[0].payouts_n == 10
+        self._check_lock(released=False)
+
+    def test_process_payouts_release_on_error(self):
+        engine = payout_engine.PayoutEngine()
+        payout_engine.Context.objects.all.side_effect = IndexError('list index out of range')
 
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_not_called()
+        with self.assertRaises(IndexError):
+            engine._process_payouts({})
 
-        payout_engine.get_database_connection().wstore_payout.find_one_and_update.assert_has_calls([
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}})])
+        self._check_lock()
 
     def test_process_payouts_single_payout(self):
         engine = payout_engine.PayoutEngine()
@@ -684,12 +695,7 @@ class PayoutEngineTestCase(TestCase):
 
         assert payout_engine.Context.objects.all()[0].payouts_n == 11
 
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_not_called()
-        assert payout_engine.get_database_connection().wstore_payout.find_one_and_update.call_args_list == [
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': False}})]
+        self._check_lock()
 
     def test_process_payouts_multiple_currencies_payouts(self):
         engine = payout_engine.PayoutEngine()
@@ -706,12 +712,7 @@ class PayoutEngineTestCase(TestCase):
 
         assert payout_engine.Context.objects.all()[0].payouts_n == 12
 
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_not_called()
-        assert payout_engine.get_database_connection().wstore_payout.find_one_and_update.call_args_list == [
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': False}})]
+        self._check_lock()
 
     def test_process_payouts_multiple_payouts(self):
         engine = payout_engine.PayoutEngine()
@@ -734,12 +735,7 @@ class PayoutEngineTestCase(TestCase):
 
         assert payout_engine.Context.objects.all()[0].payouts_n == 15
 
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_not_called()
-        assert payout_engine.get_database_connection().wstore_payout.find_one_and_update.call_args_list == [
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': False}})]
+        self._check_lock()
 
     def test_process_reports_empty(self):
         engine = payout_engine.PayoutEngine()
@@ -24,7 +24,6 @@ from __future__ import unicode_literals
 import json
 import importlib
 from copy import deepcopy
-from bson import ObjectId
 
 from django.conf import settings
 from wstore.charging_engine.charging.cdr_manager import CDRManager
@@ -35,8 +34,9 @@ from wstore.store_commons.resource import Resource
 from wstore.store_commons.utils.http import build_response, supported_request_mime_types, authentication_required
 from wstore.ordering.models import Order
 from wstore.ordering.errors import PaymentError
-from wstore.charging_engine.charging_engine import ChargingEngine
-from wstore.store_commons.database import get_database_connection
+from wstore.charging_engine.charging_engine import ChargingEngine, discard_usage_rates
+from wstore.store_commons.database import DistributedLock
+from wstore.store_commons.scheduler import cancel_deadline
 from wstore.asset_manager.resource_plugins.decorators import on_product_acquired
 
 
@@ -76,6 +76,8 @@ class PayPalConfirmation(Resource):
     def create(self, request):
 
         order = None
+        raw_order = None
+        lock = None
         concept = None
         self.ordering_client = OrderingClient()
         try:
@@ -92,19 +94,13 @@ class PayPalConfirmation(Resource):
             if not Order.objects.filter(pk=reference):
                 raise ValueError('The provided reference does not identify a valid order')
 
-            db = get_database_connection()
+            # Uses an atomic lease on the order document so the timeout and the
+            # payment confirmation cannot process the order at the same time
+            lock = DistributedLock('wstore_order', reference, '_lock', lease=getattr(settings, 'ORDER_LOCK_LEASE', 1800))
 
-            # Uses an atomic operation to get and set the _lock value in the purchase
-            # document
-            pre_value = db.wstore_order.find_one_and_update(
-                {'_id': ObjectId(reference)},
-                {'$set': {'_lock': True}}
-            )
-
-            # If the value of _lock before setting it to true was true, means
-            # that the time out function has acquired it previously so the
-            # view ends
-            if not pre_value or '_lock' in pre_value and pre_value['_lock']:
+            # If the lock cannot be acquired, means that the timeout function
+            # has acquired it previously so the view ends
+            if not lock.acquire(blocking=False):
                 raise PaymentError('The timeout set to process the payment has finished')
 
             order = Order.objects.get(pk=reference)
@@ -114,12 +110,9 @@ class PayPalConfirmation(Resource):
 
             # If the order state value is different from pending means that
             # the timeout function has completely ended before acquiring the resource
-            # so _lock is set to false and the view ends
-            if pre_value['state'] != 'pending':
-                db.wstore_order.find_one_and_update(
-                    {'_id': ObjectId(reference)},
-                    {'$set': {'_lock': False}}
-                )
+            # so the lock is released and the view ends
+            if lock.document['state'] != 'pending':
+                lock.release()
                 raise PaymentError('The timeout set to process the payment has finished')
 
             # Check that the request user is authorized to end the payment
@@ -135,14 +128,27 @@ class PayPalConfirmation(Resource):
 
             payment_client = getattr(importlib.import_module(client_package), client_class)
 
+            # The lease is renewed before executing the payment, failing if the
+            # timeout has taken the lock over in the meantime
+            if not lock.renew():
+                raise PaymentError('The timeout set to process the payment has finished')
+
             # build the payment client
             client = payment_client(order)
             order.sales_ids = client.end_redirection_payment(token, payer_id)
-            order.save()
+
+            # The sales are saved through the lock, saving the whole order would remove
+            # the lock fields. Then the lease is renewed for the charging process, which
+            # sets the order as paid before anything else
+            if not lock.update({'$set': {'sales_ids': order.sales_ids}}) or not lock.renew():
+                raise PaymentError('The timeout set to process the payment has finished')
 
             charging_engine = ChargingEngine(order)
             charging_engine.end_charging(transactions, pending_info.free_contracts, concept)
 
+            # The payment has been confirmed, so its timeout is no longer needed
+            cancel_deadline('payment_timeout', reference)
+
         except Exception as e:
 
             # Rollback the purchase if existing
@@ -153,10 +159,18 @@ class PayPalConfirmation(Resource):
                     self.ordering_client.update_items_state(raw_order, 'Failed')
                     order.delete()
                 else:
+                    # The usage of a not confirmed charge is not rated
+                    if order.pending_payment is not None:
+                        discard_usage_rates(order.pending_payment.transactions)
+
                     order.state = 'paid'
                     order.pending_payment = None
                     order.save()
 
+            # Release the order if it has been locked by this request
+            if lock is not None:
+                lock.release()
+
             expl = ' due to an unexpected error'
             err_code = 500
             if isinstance(e, PaymentError) or isinstance(e, ValueError):
@@ -180,11 +194,7 @@ class PayPalConfirmation(Resource):
 
         states_processors[concept](ext_transactions, raw_order, order)
 
-        # _lock is set to false
-        db.wstore_order.find_one_and_update(
-            {'_id': ObjectId(reference)},
-            {'$set': {'_lock': False}}
-        )
+        lock.release()
 
         return build_response(request, 200, 'Ok')
 
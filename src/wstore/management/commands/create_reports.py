@@ -20,11 +20,11 @@
 
 from __future__ import unicode_literals
 
-import requests
-
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
+from wstore.store_commons import http_client
+
 
 class Command(BaseCommand):
     def handle(self, *args, **kargs):
@@ -46,7 +46,7 @@ class Command(BaseCommand):
 
         url += 'rss/settlement'
 
-        response = requests.post(url, json=data, headers=headers)
+        response = http_client.post(url, json=data, headers=headers)
 
         if response.status_code != 202:
             print("Some error asking to generate reports:\n{}: {}".format(response.reason, response.text))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wstore.store_commons.indexes import ensure_indexes, explain_lookups, get_missing_indexes
+
+
+def _format_keys(keys):
+    return ', '.join([field for field, direction in keys])
+
+
+class Command(BaseCommand):
+
+    help = 'Creates the database indexes required by the charging backend'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check', default=False,
+                    help='Only verify that the indexes exist'),
+        make_option('--explain', action='store_true', dest='explain', default=False,
+                    help='Print the query plans of the critical lookups'),
+    )
+
+    def handle(self, *args, **options):
+        if options['check']:
+            missing = get_missing_indexes()
+
+            for collection, keys in missing:
+                print('Missing index in {}: {}'.format(collection, _format_keys(keys)))
+        else:
+            for collection, keys in ensure_indexes():
+                print('Created index in {}: {}'.format(collection, _format_keys(keys)))
+
+            missing = []
+
+        scans = []
+        if options['explain']:
+            for collection, query, stages, uses_index in explain_lookups():
+                print('{} {}: {}'.format(collection, ', '.join(query.keys()), ' > '.join(stages)))
+
+                if not uses_index:
+                    scans.append(collection)
+
+        if len(missing) or len(scans):
+            raise CommandError('{} missing indexes, {} lookups scanning the whole collection'.format(len(missing), len(scans)))
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 - 2016 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from wstore.store_commons.scheduler import get_scheduler
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **kargs):
+        """
+        Process the deadlines that are due, for deployments where the scheduler loop is disabled
+        """
+        scheduler = get_scheduler()
+
+        processed = scheduler.process_due()
+        total = processed
+
+        # Keep claiming batches until there are not due deadlines
+        while processed > 0:
+            processed = scheduler.process_due()
+            total += processed
+
+        print('{} deadlines processed'.format(total))
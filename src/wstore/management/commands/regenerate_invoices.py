@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import json
+import os
+import time
+from datetime import datetime
+from itertools import imap
+from multiprocessing import Pool
+from optparse import make_option
+
+from bson import ObjectId
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from wstore.charging_engine.invoice_builder import InvoiceBuilder
+from wstore.ordering.models import Order
+from wstore.store_commons.database import get_database_connection
+
+
+def _init_worker():
+    # Database connections inherited from the parent process must not be reused
+    for connection in connections.all():
+        connection.close()
+
+
+def _regenerate_invoice(job):
+    try:
+        order = Order.objects.get(pk=job['order'])
+        contract = order.contracts[job['contract']]
+        invoice = InvoiceBuilder(order).regenerate_invoice(contract, contract.charges[job['charge']])
+    except Exception as e:
+        return job, None, unicode(e)
+
+    return job, invoice, None
+
+
+def _get_invoice_file(invoice):
+    return os.path.join(settings.BILL_ROOT, os.path.basename(invoice))
+
+
+class Command(BaseCommand):
+
+    help = 'Generates the missing or stale invoices of the charges made to the customers'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Regenerate existing invoices too, e.g. after changing the invoice templates'),
+        make_option('--since', dest='since', default=None,
+                    help='Only process charges made since the given date (YYYY-MM-DD)'),
+        make_option('--order', dest='order', default=None,
+                    help='Only process the charges of the given order'),
+        make_option('--workers', dest='workers', type='int', default=4,
+                    help='Number of processes rendering invoices'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File where the progress is saved, an interrupted run is resumed from it'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only list the charges whose invoice would be generated'),
+    )
+
+    def _read_checkpoint(self, path):
+        if path is None or not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            return json.load(f).get('last_order')
+
+    def _write_checkpoint(self, path, order_pk):
+        if path is None:
+            return
+
+        # The checkpoint is replaced atomically so it is never left truncated
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_order': order_pk}, f)
+
+        os.rename(tmp_path, path)
+
+    def _get_orders(self, options, last_order):
+        if options['order'] is not None:
+            return Order.objects.filter(pk=options['order'])
+
+        orders = Order.objects.all()
+        if last_order is not None:
+            orders = orders.filter(pk__gt=last_order)
+
+        return orders.order_by('pk')
+
+    def _is_pending(self, charge, options, since):
+        if since is not None and charge.date < since:
+            return False
+
+        if options['all'] or not charge.invoice:
+            return True
+
+        # The file of the invoice is reserved empty until it is rendered, so an empty
+        # file belongs to a rendering interrupted before finishing
+        invoice_file = _get_invoice_file(charge.invoice)
+        return not os.path.exists(invoice_file) or not os.path.getsize(invoice_file)
+
+    def _get_jobs(self, order, options, since):
+        jobs = []
+        for c, contract in enumerate(order.contracts):
+            for i, charge in enumerate(contract.charges):
+                if self._is_pending(charge, options, since):
+                    jobs.append({
+                        'order': order.pk,
+                        'contract': c,
+                        'item_id': contract.item_id,
+                        'charge': i,
+                        'date': charge.date,
+                        'old_invoice': charge.invoice
+                    })
+        return jobs
+
+    def _save_invoice(self, collection, job, invoice):
+        contract_path = 'contracts.{}'.format(job['contract'])
+        charge_path = '{}.charges.{}'.format(contract_path, job['charge'])
+
+        # The invoice is only set if the charge has not been modified meanwhile
+        result = collection.update_one({
+            '_id': ObjectId(job['order']),
+            contract_path + '.item_id': job['item_id'],
+            charge_path + '.date': job['date'],
+            charge_path + '.invoice': job['old_invoice']
+        }, {
+            '$set': {charge_path + '.invoice': invoice}
+        })
+
+        if result.modified_count == 0:
+            os.remove(_get_invoice_file(invoice))
+            raise ValueError('The charge has been modified while generating its invoice')
+
+        if job['old_invoice'] and os.path.exists(_get_invoice_file(job['old_invoice'])):
+            os.remove(_get_invoice_file(job['old_invoice']))
+
+    def _process_jobs(self, jobs, mapper, collection, failures):
+        generated = 0
+        for job, invoice, error in mapper(_regenerate_invoice, jobs):
+            if error is None:
+                try:
+                    self._save_invoice(collection, job, invoice)
+                except Exception as e:
+                    error = unicode(e)
+
+            if error is None:
+                generated += 1
+            else:
+                failures.append((job, error))
+
+        return generated
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('The number of workers must be greater than 0')
+
+        since = None
+        if options['since'] is not None:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('Invalid date format, use YYYY-MM-DD')
+
+        checkpoint = options['checkpoint'] if options['order'] is None else None
+        last_order = self._read_checkpoint(checkpoint)
+
+        if last_order is not None:
+            print('Resuming after order {}'.format(last_order))
+
+        pool = None
+        mapper = imap
+        if not options['dry_run'] and options['workers'] > 1:
+            pool = Pool(options['workers'], initializer=_init_worker)
+            mapper = pool.imap_unordered
+
+        collection = get_database_connection()['wstore_order']
+        chunk_size = options['workers'] * 20
+
+        generated = 0
+        pending = 0
+        failures = []
+        start = time.time()
+
+        try:
+            jobs = []
+            for order in self._get_orders(options, last_order):
+                order_jobs = self._get_jobs(order, options, since)
+                pending += len(order_jobs)
+
+                if options['dry_run']:
+                    for job in order_jobs:
+                        print('Order {} item {} charge {}: {}'.format(
+                            job['order'], job['item_id'], job['date'], job['old_invoice'] or 'missing invoice'))
+                    continue
+
+                jobs.extend(order_jobs)
+
+                # The checkpoint is saved once all the charges of the processed orders are done
+                if len(jobs) >= chunk_size:
+                    generated += self._process_jobs(jobs, mapper, collection, failures)
+                    self._write_checkpoint(checkpoint, order.pk)
+                    jobs = []
+
+            if len(jobs):
+                generated += self._process_jobs(jobs, mapper, collection, failures)
+
+            if not options['dry_run'] and checkpoint is not None and os.path.exists(checkpoint):
+                # The run is complete
+                os.remove(checkpoint)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if options['dry_run']:
+            print('{} invoices to be generated'.format(pending))
+            return
+
+        elapsed = time.time() - start
+        throughput = generated / elapsed if elapsed > 0 else 0
+
+        for job, error in failures:
+            print('Error generating invoice of order {} item {} charge {}: {}'.format(
+                job['order'], job['item_id'], job['date'], error))
+
+        print('{} invoices generated, {} failed in {:.2f} seconds ({:.2f} invoices/s)'.format(
+            generated, len(failures), elapsed, throughput))
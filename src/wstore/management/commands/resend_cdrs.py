@@ -18,14 +18,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from bson import ObjectId
 from datetime import datetime
 
 from django.core.management.base import BaseCommand, CommandError
 
 
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptor
-from wstore.store_commons.database import get_database_connection
+from wstore.rss_adaptor.cdr_outbox import CDROutbox
+from wstore.rss_adaptor.rss_adaptor import reserve_correlation_numbers
 from wstore.models import Context, Organization
 
 
@@ -38,31 +37,37 @@ class Command(BaseCommand):
         if len(contexts) < 1:
             raise CommandError("No context")
 
+        outbox = CDROutbox()
+
+        # Move the failed CDRs stored by previous versions to the outbox
         context = contexts[0]
         cdrs = context.failed_cdrs
-        context.failed_cdrs = []
-        context.save()
+        if len(cdrs) > 0:
+            context.failed_cdrs = []
+            context.save()
 
-        if len(cdrs) == 0:
-            print("No failed cdrs to send")
-            exit(0)
+            time_stamp = datetime.utcnow().isoformat() + 'Z'
 
-        db = get_database_connection()
-        time_stamp = datetime.utcnow().isoformat() + 'Z'
+            # Group the CDRs by provider, so a block of correlation numbers
+            # is reserved per provider
+            provider_cdrs = {}
+            for cdr in cdrs:
+                # Modify time_stamp
+                cdr['time_stamp'] = time_stamp
+                provider_cdrs.setdefault(cdr['provider'], []).append(cdr)
 
-        for cdr in cdrs:
-            # Modify time_stamp
-            cdr['time_stamp'] = time_stamp
+            for provider, prov_cdrs in provider_cdrs.iteritems():
+                # Modify correlation numbers
+                org = Organization.objects.get(name=provider)
+                first_number = reserve_correlation_numbers(org.pk, len(prov_cdrs))
 
-            # Modify correlation number
-            org = Organization.objects.get(name=cdr['provider'])
+                for i, cdr in enumerate(prov_cdrs):
+                    cdr['correlation'] = first_number + i
 
-            new_org = db.wstore_organization.find_and_modify(
-                query={'_id': ObjectId(org.pk)},
-                update={'$inc': {'correlation_number': 1}}
-            )
+            outbox.enqueue(cdrs)
 
-            cdr['correlation'] = new_org['correlation_number']
+        # Retry the CDRs discarded by the dispatcher
+        retried = outbox.retry_failed()
+        metrics = outbox.get_metrics()
 
-        r = RSSAdaptor()
-        r.send_cdr(cdrs)
+        print('{} failed cdrs queued, {} cdrs pending to be sent'.format(len(cdrs) + retried, metrics['pending']))
@@ -21,15 +21,19 @@
 
 from __future__ import unicode_literals
 
+import os
+from datetime import datetime
+
 from bson import ObjectId
 from mock import MagicMock, call, ANY
 from nose_parameterized import parameterized
 
+from django.conf import settings
 from django.test import TestCase
 from django.core.management import call_command
 from django.core.management.base import CommandError
 
-from wstore.management.commands import loadplugin, removeplugin, resend_upgrade
+from wstore.management.commands import loadplugin, removeplugin, resend_upgrade, regenerate_invoices
 
 
 class FakeCommandError(Exception):
@@ -199,3 +203,85 @@ class ResendUpgradeTestCase(TestCase):
             msg = unicode(e)
 
         self.assertEquals('Context object is not yet created', msg)
+
+
+class RegenerateInvoicesTestCase(TestCase):
+    tags = ('management', 'invoices')
+
+    _order_pk = '58a447608e05ac5752d96d98'
+
+    def setUp(self):
+        self._missing = MagicMock(date=datetime(2017, 1, 1), invoice='')
+        self._existing = MagicMock(date=datetime(2017, 2, 1), invoice='/charging/media/bills/invoice_0.pdf')
+
+        self._contract = MagicMock(item_id='1', charges=[self._missing, self._existing])
+        self._order = MagicMock(pk=self._order_pk, contracts=[self._contract])
+
+        regenerate_invoices.Order = MagicMock()
+        regenerate_invoices.Order.objects.all.return_value.order_by.return_value = [self._order]
+        regenerate_invoices.Order.objects.get.return_value = self._order
+
+        regenerate_invoices.InvoiceBuilder = MagicMock()
+        regenerate_invoices.InvoiceBuilder().regenerate_invoice.return_value = '/charging/media/bills/invoice_1.pdf'
+
+        self._collection = MagicMock()
+        self._collection.update_one.return_value.modified_count = 1
+        regenerate_invoices.get_database_connection = MagicMock(return_value={'wstore_order': self._collection})
+
+        regenerate_invoices.os = MagicMock()
+        regenerate_invoices.os.path.join = os.path.join
+        regenerate_invoices.os.path.basename = os.path.basename
+        regenerate_invoices.os.path.exists.return_value = True
+
+    def tearDown(self):
+        reload(regenerate_invoices)
+
+    def test_regenerate_missing_invoices(self):
+        call_command('regenerate_invoices', workers=1)
+
+        regenerate_invoices.Order.objects.get.assert_called_once_with(pk=self._order_pk)
+        regenerate_invoices.InvoiceBuilder().regenerate_invoice.assert_called_once_with(self._contract, self._missing)
+
+        self._collection.update_one.assert_called_once_with({
+            '_id': ObjectId(self._order_pk),
+            'contracts.0.item_id': '1',
+            'contracts.0.charges.0.date': datetime(2017, 1, 1),
+            'contracts.0.charges.0.invoice': ''
+        }, {
+            '$set': {'contracts.0.charges.0.invoice': '/charging/media/bills/invoice_1.pdf'}
+        })
+        self.assertEquals(0, regenerate_invoices.os.remove.call_count)
+
+    def test_regenerate_empty_invoices(self):
+        # The rendering of the existing invoice was interrupted
+        regenerate_invoices.os.path.getsize.return_value = 0
+
+        call_command('regenerate_invoices', workers=1)
+
+        self.assertEquals([
+            call(self._contract, self._missing),
+            call(self._contract, self._existing)
+        ], regenerate_invoices.InvoiceBuilder().regenerate_invoice.call_args_list)
+        regenerate_invoices.os.path.getsize.assert_called_once_with(settings.BILL_ROOT + '/invoice_0.pdf')
+
+    def test_regenerate_all_invoices_since(self):
+        call_command('regenerate_invoices', workers=1, all=True, since='2017-01-15')
+
+        regenerate_invoices.InvoiceBuilder().regenerate_invoice.assert_called_once_with(self._contract, self._existing)
+
+        # The previous invoice is removed
+        regenerate_invoices.os.remove.assert_called_once_with(settings.BILL_ROOT + '/invoice_0.pdf')
+
+    def test_regenerate_invoices_dry_run(self):
+        call_command('regenerate_invoices', dry_run=True, all=True)
+
+        self.assertEquals(0, regenerate_invoices.InvoiceBuilder().regenerate_invoice.call_count)
+        self.assertEquals(0, self._collection.update_one.call_count)
+
+    def test_regenerate_invoices_modified_charge(self):
+        self._collection.update_one.return_value.modified_count = 0
+
+        call_command('regenerate_invoices', workers=1)
+
+        # The new invoice is discarded
+        regenerate_invoices.os.remove.assert_called_once_with(settings.BILL_ROOT + '/invoice_1.pdf')
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from bson import ObjectId
+
+from wstore.ordering.errors import OrderingError
+from wstore.ordering.models import Order
+from wstore.store_commons.database import get_database_connection
+
+
+class ContractLocation(object):
+    """
+    Position of a contract within its order, together with the raw values of the
+    contract fields requested in the lookup
+    """
+
+    def __init__(self, order_pk, order_id, index, owner_organization, customer, contract):
+        self.order_pk = order_pk
+        self.order_id = order_id
+        self.index = index
+        self.owner_organization = owner_organization
+        self.customer = customer
+        self.contract = contract
+
+    @property
+    def path(self):
+        # Path of the contract used in positional updates
+        return 'contracts.{}'.format(self.index)
+
+
+def _get_collection():
+    return get_database_connection()[Order._meta.db_table]
+
+
+def _to_pk(value):
+    return unicode(value) if value is not None else None
+
+
+def locate_product_contract(product_id, order_id=None, fields=()):
+    """
+    Locates the contract of a product using the index of contracts.product_id. Only
+    the product ids and the requested fields of the contracts are retrieved, so the
+    order is not deserialized
+    :param product_id: Id of the product in the inventory API
+    :param order_id: Id of the order the product must belong to, if known
+    :param fields: Contract fields included in the returned location
+    :return: ContractLocation, None if the product has not a contract
+    """
+    query = {'contracts.product_id': product_id}
+    if order_id is not None:
+        query['order_id'] = order_id
+
+    projection = {
+        'order_id': True,
+        'owner_organization_id': True,
+        'customer_id': True,
+        'contracts.product_id': True
+    }
+    for field in fields:
+        projection['contracts.' + field] = True
+
+    doc = _get_collection().find_one(query, projection)
+
+    if doc is None:
+        return None
+
+    for index, contract in enumerate(doc.get('contracts', [])):
+        if contract.get('product_id') == product_id:
+            return ContractLocation(
+                unicode(doc['_id']), doc.get('order_id'), index,
+                _to_pk(doc.get('owner_organization_id')), _to_pk(doc.get('customer_id')), contract)
+
+    return None
+
+
+def get_product_contract(product_id, order_id=None):
+    """
+    Returns the order and the contract of a product, the order is retrieved by its
+    primary key and the contract by its position
+    :param product_id: Id of the product in the inventory API
+    :param order_id: Id of the order the product must belong to, if known
+    :return: Tuple (order, contract)
+    """
+    location = locate_product_contract(product_id, order_id=order_id)
+
+    if location is None:
+        raise OrderingError('Invalid product id')
+
+    order = Order.objects.get(pk=location.order_pk)
+
+    # The order may have been modified between both queries
+    if len(order.contracts) <= location.index or order.contracts[location.index].product_id != product_id:
+        return order, order.get_product_contract(product_id)
+
+    return order, order.contracts[location.index]
+
+
+def advance_contract_usage(order_pk, product_id, correlation_number, count=1, last_usage=None):
+    """
+    Atomically advances the correlation number of a contract and sets its last usage,
+    only if its correlation number has not been modified meanwhile. Only the contract
+    is updated, the rest of the order document is not rewritten
+    :param order_pk: Primary key of the order
+    :param product_id: Id of the product of the contract
+    :param correlation_number: Expected current correlation number
+    :param count: Number of usage documents applied
+    :param last_usage: Timestamp of the last usage applied, if it has to be updated
+    :return: True if the contract has been updated
+    """
+    update = {
+        '$inc': {'contracts.$.correlation_number': count}
+    }
+
+    if last_usage is not None:
+        update['$set'] = {'contracts.$.last_usage': last_usage}
+
+    result = _get_collection().update_one({
+        '_id': ObjectId(order_pk),
+        'contracts': {
+            '$elemMatch': {
+                'product_id': product_id,
+                'correlation_number': correlation_number
+            }
+        }
+    }, update)
+
+    return result.matched_count > 0
+
+
+def rollback_contract_usage(order_pk, product_id, correlation_number, count=1, last_usage=None):
+    """
+    Atomically reverts the last advance of the usage of a contract, only if no other
+    usage has been applied since. It is used when the applied usage documents could
+    not be guided in the Usage API
+    :param order_pk: Primary key of the order
+    :param product_id: Id of the product of the contract
+    :param correlation_number: Correlation number of the contract after the advance
+    :param count: Number of usage documents reverted
+    :param last_usage: Timestamp of the last usage applied before the reverted ones
+    :return: True if the contract has been reverted
+    """
+    result = _get_collection().update_one({
+        '_id': ObjectId(order_pk),
+        'contracts': {
+            '$elemMatch': {
+                'product_id': product_id,
+                'correlation_number': correlation_number
+            }
+        }
+    }, {
+        '$inc': {'contracts.$.correlation_number': -count},
+        '$set': {'contracts.$.last_usage': last_usage}
+    })
+
+    return result.matched_count > 0
+
+
+def apply_contract_usage(order, contract, count=1, last_usage=None):
+    """
+    Advances the usage of a loaded contract in the database and in memory
+    :param order: Order of the contract
+    :param contract: Contract whose usage is advanced
+    :param count: Number of usage documents applied
+    :param last_usage: Timestamp of the last usage applied, if it has to be updated
+    """
+    if not advance_contract_usage(order.pk, contract.product_id, contract.correlation_number, count, last_usage):
+        raise OrderingError('The usage of the contract has been modified by other request')
+
+    contract.correlation_number += count
+    if last_usage is not None:
+        contract.last_usage = last_usage
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from pymongo import ReturnDocument
+
+from wstore.ordering.models import Offering, Order
+from wstore.store_commons.database import get_database_connection
+
+
+# Entitlement documents are keyed by organization and map every accessible
+# asset to the acquired offerings that grant access to it, and every offering
+# to the active contracts of the organization that include it:
+# {'_id': <org pk>, 'assets': {<asset pk>: [<offering pk>, ...]},
+#  'contracts': {<offering pk>: [<order pk>:<item id>, ...]}}
+ENTITLEMENT_COLLECTION = 'wstore_entitlement'
+
+
+class _EntitlementCache(object):
+    """
+    Bounded LRU cache of the granted accesses. Only positive results are cached, so a
+    new acquisition is available immediately and a termination is applied in other
+    processes after ENTITLEMENT_CACHE_TTL seconds at most
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            expires = self._entries.pop(key, None)
+
+            if expires is None or expires < time.time():
+                return False
+
+            # Move the entry to the end, so it is the most recently used
+            self._entries[key] = expires
+            return True
+
+    def set(self, key):
+        ttl = getattr(settings, 'ENTITLEMENT_CACHE_TTL', 60)
+        max_size = getattr(settings, 'ENTITLEMENT_CACHE_SIZE', 1000)
+
+        if ttl <= 0 or max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.time() + ttl
+
+            # Evict least recently used entries
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_organization(self, org_pk):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == org_pk]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_entitlement_cache = _EntitlementCache()
+
+
+def _get_collection():
+    return get_database_connection()[ENTITLEMENT_COLLECTION]
+
+
+def _get_contract_key(order, contract):
+    return '{}:{}'.format(order.pk, contract.item_id)
+
+
+def get_offering_assets(offering):
+    """
+    Returns the assets included in an offering, expanding offering and product bundles
+    :param offering: Offering model instance
+    :return: Set with the pks of the assets
+    """
+    if len(offering.bundled_offerings) > 0:
+        offerings = Offering.objects.filter(pk__in=offering.bundled_offerings)
+    else:
+        offerings = [offering]
+
+    assets = set()
+    for off in offerings:
+        if not off.is_digital or off.asset is None:
+            continue
+
+        if len(off.asset.bundled_assets) > 0:
+            assets.update([unicode(asset_pk) for asset_pk in off.asset.bundled_assets])
+        else:
+            assets.add(unicode(off.asset.pk))
+
+    return assets
+
+
+def get_active_contracts(organization):
+    """
+    Returns the active contracts of the acquired offerings of an organization, scanning
+    all its orders. It is only used to build the entitlements of the organization
+    :param organization: Organization model instance
+    :return: Dict mapping the pks of the offerings to the keys of their active contracts
+    """
+    acquired = set([unicode(offering_pk) for offering_pk in organization.acquired_offerings])
+    active = {}
+
+    for order in Order.objects.filter(owner_organization=organization):
+        for contract in order.contracts:
+            offering_pk = unicode(contract.offering_id)
+
+            if not contract.terminated and offering_pk in acquired:
+                active.setdefault(offering_pk, []).append(_get_contract_key(order, contract))
+
+    return active
+
+
+def build_entitlements(organization):
+    """
+    Computes the entitlements of an organization from its active contracts
+    :param organization: Organization model instance
+    :return: Dict mapping the accessible assets to the offerings granting them
+    """
+    contracts = get_active_contracts(organization)
+
+    assets = {}
+    for offering in Offering.objects.filter(pk__in=sorted(contracts.keys())):
+        for asset_pk in get_offering_assets(offering):
+            assets.setdefault(asset_pk, []).append(unicode(offering.pk))
+
+    _get_collection().replace_one({'_id': unicode(organization.pk)}, {
+        'assets': assets,
+        'contracts': contracts
+    }, upsert=True)
+    _entitlement_cache.invalidate_organization(unicode(organization.pk))
+
+    return assets
+
+
+def grant_offering(order, contract):
+    """
+    Includes the assets of an acquired offering in the entitlements of the organization
+    owning the order. It must be called once the offering has been saved in the acquired
+    offerings
+    :param order: Order including the contract
+    :param contract: Contract of the acquired offering
+    """
+    offering = contract.offering
+    assets = get_offering_assets(offering)
+
+    if not len(assets):
+        return
+
+    org_pk = unicode(order.owner_organization.pk)
+    collection = _get_collection()
+
+    # Entitlements built before the contracts were included are built again
+    collection.delete_one({'_id': org_pk, 'contracts': {'$exists': False}})
+
+    update = dict([('assets.' + asset_pk, unicode(offering.pk)) for asset_pk in assets])
+    update['contracts.' + unicode(offering.pk)] = _get_contract_key(order, contract)
+
+    # If the entitlements of the organization have not been built yet, they will be
+    # built from the acquired offerings, so the document is not created here
+    collection.update_one({'_id': org_pk}, {
+        '$addToSet': update
+    })
+
+
+def revoke_offering(order, contract):
+    """
+    Removes the access to the assets of an offering whose product has been terminated. It
+    must be called once the contract has been saved as terminated. The access is kept while
+    the organization has other active contracts of the offering, and the assets also included
+    in other active offerings are still accessible
+    :param order: Order including the contract
+    :param contract: Terminated contract
+    """
+    organization = order.owner_organization
+    offering = contract.offering
+    assets = get_offering_assets(offering)
+
+    if not len(assets):
+        return
+
+    org_pk, offering_pk = unicode(organization.pk), unicode(offering.pk)
+    collection = _get_collection()
+
+    # The active contracts of the offering are checked in the entitlements document
+    entitlements = collection.find_one_and_update({
+        '_id': org_pk,
+        'contracts': {'$exists': True}
+    }, {
+        '$pull': {'contracts.' + offering_pk: _get_contract_key(order, contract)}
+    }, projection={'contracts.' + offering_pk: True}, return_document=ReturnDocument.AFTER)
+
+    if entitlements is None:
+        # The entitlements are built from the saved contracts, so the terminated one
+        # is not included
+        build_entitlements(organization)
+        return
+
+    if len(entitlements.get('contracts', {}).get(offering_pk, [])):
+        return
+
+    # The assets are only removed if no contract of the offering has been granted meanwhile
+    collection.update_one({
+        '_id': org_pk,
+        'contracts.' + offering_pk + '.0': {'$exists': False}
+    }, {
+        '$pull': dict([('assets.' + asset_pk, offering_pk) for asset_pk in assets]),
+        '$unset': {'contracts.' + offering_pk: ''}
+    })
+
+    # Remove the assets not granted by other offerings
+    for asset_pk in assets:
+        collection.update_one({
+            '_id': org_pk,
+            'assets.' + asset_pk: {'$size': 0}
+        }, {
+            '$unset': {'assets.' + asset_pk: ''}
+        })
+
+    _entitlement_cache.invalidate_organization(org_pk)
+
+
+def has_asset_access(organization, asset):
+    """
+    Checks whether an organization has acquired a given asset
+    :param organization: Organization model instance
+    :param asset: Resource model instance
+    :return: True if the asset is included in any of the acquired offerings
+    """
+    org_pk, asset_pk = unicode(organization.pk), unicode(asset.pk)
+
+    if _entitlement_cache.get((org_pk, asset_pk)):
+        return True
+
+    entitlements = _get_collection().find_one({'_id': org_pk}, {'assets.' + asset_pk: True})
+
+    if entitlements is None:
+        # The entitlements of the organization are built on its first download
+        granted = asset_pk in build_entitlements(organization)
+    else:
+        granted = asset_pk in entitlements.get('assets', {})
+
+    if granted:
+        _entitlement_cache.set((org_pk, asset_pk))
+
+    return granted
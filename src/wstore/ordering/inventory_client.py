@@ -20,13 +20,14 @@
 
 from __future__ import unicode_literals
 
-import requests
 from datetime import datetime
 from urlparse import urljoin
 
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
+from wstore.store_commons import http_client
+
 
 class InventoryClient:
 
@@ -40,7 +41,7 @@ class InventoryClient:
         return urljoin(site, 'charging/api/orderManagement/products')
 
     def get_hubs(self):
-        r = requests.get(self._inventory_api + '/api/productInventory/v2/hub')
+        r = http_client.get(self._inventory_api + '/api/productInventory/v2/hub')
         r.raise_for_status()
         return r.json()
 
@@ -59,7 +60,7 @@ class InventoryClient:
                 'callback': callback_url
             }
 
-            r = requests.post(self._inventory_api + '/api/productInventory/v2/hub', json=callback)
+            r = http_client.post(self._inventory_api + '/api/productInventory/v2/hub', json=callback)
 
             if r.status_code != 201 and r.status_code != 409:
                 msg = "It hasn't been possible to create inventory subscription, "
@@ -70,7 +71,7 @@ class InventoryClient:
     def get_product(self, product_id):
         url = self._inventory_api + '/api/productInventory/v2/product/' + unicode(product_id)
 
-        r = requests.get(url)
+        r = http_client.get(url)
         r.raise_for_status()
 
         return r.json()
@@ -88,7 +89,7 @@ class InventoryClient:
 
         url = self._inventory_api + '/api/productInventory/v2/product' + qs[:-1]
 
-        r = requests.get(url)
+        r = http_client.get(url)
         r.raise_for_status()
 
         return r.json()
@@ -102,7 +103,7 @@ class InventoryClient:
         # Build product url
         url = self._inventory_api + '/api/productInventory/v2/product/' + unicode(product_id)
 
-        r = requests.patch(url, json=patch_body)
+        r = http_client.patch(url, json=patch_body)
         r.raise_for_status()
 
         return r.json()
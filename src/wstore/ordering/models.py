@@ -20,6 +20,8 @@
 
 from __future__ import unicode_literals
 
+from datetime import timedelta
+
 from django.db import models
 from django.contrib.auth.models import User
 from djangotoolbox.fields import DictField, EmbeddedModelField, ListField
@@ -47,6 +49,8 @@ class Charge(models.Model):
     currency = models.CharField(max_length=3)
     concept = models.CharField(max_length=100)
     invoice = models.CharField(max_length=200)
+    # Pricing model applied in the charge, used to regenerate the invoice
+    related_model = DictField()
 
 
 class Contract(models.Model):
@@ -70,6 +74,36 @@ class Contract(models.Model):
 
     terminated = models.BooleanField(default=False)
 
+    # Date when the next recurring or usage payment is due, denormalized
+    # so pending payments can be queried using an index
+    next_due = models.DateTimeField(blank=True, null=True)
+    # Steps of the suspension made for the current due date
+    suspension = DictField()
+
+    def update_next_due(self, order_date):
+        """
+        Calculates the date when the next payment of the contract is due
+        :param order_date: Date of the order, used for usage contracts without usage charges
+        :return: The due date, None if the contract has no payments due
+        """
+        dates = []
+
+        if 'subscription' in self.pricing_model:
+            dates.extend([item['renovation_date'] for item in self.pricing_model['subscription'] if 'renovation_date' in item])
+
+        if 'pay_per_use' in self.pricing_model:
+            last_charge = order_date
+            for charge in reversed(self.charges):
+                if charge.concept == 'usage':
+                    last_charge = charge.date
+                    break
+
+            # Usage payments are renovated every 30 days
+            dates.append(last_charge + timedelta(days=30))
+
+        self.next_due = min(dates) if len(dates) and not self.terminated else None
+        return self.next_due
+
 
 class Payment(models.Model):
     transactions = ListField()
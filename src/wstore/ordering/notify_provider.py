@@ -19,11 +19,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
-import requests
 
 from django.conf import settings
 
 from wstore.models import Resource
+from wstore.store_commons import http_client
 
 
 def notify_provider(purchase):
@@ -72,6 +72,6 @@ def notify_provider(purchase):
         headers = {'Content-type': 'application/json'}
 
         try:
-            requests.post(notification_url, data=body, headers=headers, cert=(settings.NOTIF_CERT_FILE, settings.NOTIF_CERT_KEY_FILE))
+            http_client.post(notification_url, data=body, headers=headers, cert=(settings.NOTIF_CERT_FILE, settings.NOTIF_CERT_KEY_FILE))
         except:
             pass
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+
+
+def _normalize(value):
+    # Missing and empty fields are equivalent when matching prices
+    return value.lower() if value else ''
+
+
+def get_price_key(price_type, unit, period, amount, currency):
+    """
+    Builds the key used to match the price chosen in an order item with the
+    prices of the offering
+    :return: Tuple with the normalized values, None if the values are not valid
+    """
+    try:
+        return (_normalize(price_type), _normalize(unit), _normalize(period), Decimal(amount), _normalize(currency))
+    except (AttributeError, TypeError, InvalidOperation):
+        return None
+
+
+def get_offering_price_keys(offering_info):
+    keys = []
+    for price in offering_info.get('productOfferingPrice', []):
+        try:
+            keys.append(get_price_key(
+                price['priceType'], price.get('unitOfMeasure'), price.get('recurringChargePeriod'),
+                price['price']['taxIncludedAmount'], price['price']['currencyCode']))
+        except (KeyError, TypeError):
+            keys.append(None)
+
+    return keys
+
+
+class CachedOffering(object):
+    """
+    Product offering downloaded from the catalog, together with the validators used
+    to revalidate it and the precomputed price matching keys. Cached offerings are
+    shared, so they must not be modified
+    """
+
+    def __init__(self, info, etag=None, last_modified=None):
+        self.info = info
+        self.etag = etag
+        self.last_modified = last_modified
+        self.price_keys = get_offering_price_keys(info)
+        self.expires = 0
+
+    def is_fresh(self):
+        return self.expires > time.time()
+
+    def get_validators(self):
+        """
+        Returns the headers of a conditional request for the offering
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+
+class OfferingCache(object):
+    """
+    Bounded LRU cache of the product offerings used in the orders, keyed by URL. When an
+    offering expires it is revalidated with its ETag or Last-Modified header
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _get_ttl(self):
+        return getattr(settings, 'OFFERING_CACHE_TTL', 60)
+
+    def get(self, url):
+        """
+        Returns the cached offering of the given URL, even if expired
+        """
+        with self._lock:
+            entry = self._entries.pop(url, None)
+
+            if entry is not None:
+                # Move the entry to the end, so it is the most recently used
+                self._entries[url] = entry
+
+            return entry
+
+    def set(self, url, info, headers={}):
+        """
+        Caches a downloaded offering
+        :param url: URL of the offering
+        :param info: Product offering
+        :param headers: Headers of the response including the validators
+        :return: The cached offering
+        """
+        entry = CachedOffering(info, headers.get('ETag'), headers.get('Last-Modified'))
+        max_size = getattr(settings, 'OFFERING_CACHE_SIZE', 500)
+
+        if self._get_ttl() <= 0 or max_size <= 0:
+            return entry
+
+        entry.expires = time.time() + self._get_ttl()
+
+        with self._lock:
+            self._entries.pop(url, None)
+            self._entries[url] = entry
+
+            # Evict least recently used entries
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def refresh(self, entry):
+        """
+        Extends the validity of an offering that has not been modified
+        """
+        entry.expires = time.time() + self._get_ttl()
+
+    def invalidate(self, offering_id):
+        """
+        Removes an offering from the cache
+        :param offering_id: Id of the offering in the catalog
+        """
+        with self._lock:
+            for url in [url for url, entry in self._entries.iteritems() if entry.info.get('id') == offering_id]:
+                del self._entries[url]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+offering_cache = OfferingCache()
+
+
+def invalidate_offering(offering_id):
+    """
+    Invalidation hook called when the catalog notifies that an offering has been modified
+    :param offering_id: Id of the offering in the catalog
+    """
+    offering_cache.invalidate(offering_id)
@@ -20,12 +20,13 @@
 
 from __future__ import unicode_literals
 
-import requests
 from urlparse import urljoin
 
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
+from wstore.store_commons import http_client
+
 
 class OrderingClient:
 
@@ -45,7 +46,7 @@ class OrderingClient:
             'callback': urljoin(site, 'charging/api/orderManagement/orders')
         }
 
-        r = requests.post(self._ordering_api + '/productOrdering/v2/hub', callback)
+        r = http_client.post(self._ordering_api + '/productOrdering/v2/hub', callback)
 
         if r.status_code != 200 and r.status_code != 409:
             msg = "It hasn't been possible to create ordering subscription, "
@@ -57,7 +58,7 @@ class OrderingClient:
         path = '/DSProductOrdering/api/productOrdering/v2/productOrder/' + unicode(order_id)
         url = urljoin(self._ordering_api, path)
 
-        r = requests.get(url)
+        r = http_client.get(url)
         r.raise_for_status()
 
         return r.json()
@@ -79,7 +80,7 @@ class OrderingClient:
         path = '/DSProductOrdering/api/productOrdering/v2/productOrder/' + unicode(order['id'])
         url = urljoin(self._ordering_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = http_client.patch(url, json=patch)
 
         r.raise_for_status()
 
@@ -112,6 +113,6 @@ class OrderingClient:
         path = '/DSProductOrdering/api/productOrdering/v2/productOrder/' + unicode(order['id'])
         url = urljoin(self._ordering_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = http_client.patch(url, json=patch)
 
         r.raise_for_status()
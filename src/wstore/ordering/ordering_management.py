@@ -21,17 +21,20 @@
 from __future__ import unicode_literals
 
 import re
-import requests
 from decimal import Decimal
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 
 from django.conf import settings
 
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.store_commons.rollback import rollback
+from wstore.store_commons import http_client
 from wstore.charging_engine.charging_engine import ChargingEngine
+from wstore.ordering.entitlements import revoke_offering
 from wstore.ordering.errors import OrderingError
+from wstore.ordering.offering_cache import offering_cache, get_offering_price_keys, get_price_key
 from wstore.ordering.models import Order, Contract, Offering
 from wstore.asset_manager.product_validator import ProductValidator
 from wstore.asset_manager.resource_plugins.decorators import on_product_suspended
@@ -42,46 +45,98 @@ class OrderingManager:
     def __init__(self):
         self._customer = None
         self._validator = ProductValidator()
+        self._offering_downloads = {}
+        self._acquired_offerings = None
+        self._loaded_offerings = {}
+        self._validated_offerings = set()
 
-    def _download(self, url, element, item_id):
-        r = requests.get(url, verify=settings.VERIFY_REQUESTS)
+    def _get_offering_url(self, item):
+        site = urlparse(settings.SITE)
+        off = urlparse(item['productOffering']['href'])
+
+        return '{}://{}{}'.format(site.scheme, site.netloc, off.path)
+
+    def _download_offering_info(self, url, item_id, revalidate=False):
+        # Offerings are cached for OFFERING_CACHE_TTL seconds and revalidated when expired
+        cached = offering_cache.get(url)
+
+        if cached is not None and cached.is_fresh() and not revalidate:
+            return cached
+
+        kwargs = {}
+        if cached is not None and len(cached.get_validators()):
+            kwargs['headers'] = cached.get_validators()
+
+        r = http_client.get(url, verify=settings.VERIFY_REQUESTS, **kwargs)
+        self._validated_offerings.add(url)
+
+        # The offering has not been modified since it was cached
+        if cached is not None and r.status_code == 304:
+            offering_cache.refresh(cached)
+            return cached
 
         if r.status_code != 200:
-            raise OrderingError('The ' + element + ' specified in order item ' + item_id + ' does not exists')
+            raise OrderingError('The product offering specified in order item ' + item_id + ' does not exists')
 
-        return r.json()
+        return offering_cache.set(url, r.json(), r.headers)
 
-    def _get_offering(self, item):
+    def _download_offering(self, item):
+        offering_url = self._get_offering_url(item)
 
-        # Download related product offering and product specification
-        site = urlparse(settings.SITE)
-        off = urlparse(item['productOffering']['href'])
+        # Use the offering already downloaded in the prefetch stage if possible
+        if offering_url in self._offering_downloads:
+            return self._offering_downloads[offering_url].get()
 
-        offering_url = '{}://{}{}'.format(site.scheme, site.netloc, off.path)
-        offering_info = self._download(offering_url, 'product offering', item['id'])
+        return self._download_offering_info(offering_url, item['id'])
 
-        offering_id = offering_info['id']
+    def _get_acquired_offerings(self):
+        # The acquired offerings are loaded once per order
+        if self._acquired_offerings is None:
+            self._acquired_offerings = set(self._customer.userprofile.current_organization.acquired_offerings)
 
-        # Check if the offering has been already loaded in the system
-        if len(Offering.objects.filter(off_id=offering_id)) > 0:
-            offering = Offering.objects.get(off_id=offering_id)
+        return self._acquired_offerings
+
+    def _load_offerings(self, offering_id):
+        """
+        Loads a registered offering together with its bundled offerings, the bundled
+        offerings are retrieved in a single query
+        :param offering_id: Id of the offering in the catalog
+        :return: Tuple (offering, list with the bundled offerings and the offering)
+        """
+        if offering_id not in self._loaded_offerings:
+            offerings = Offering.objects.filter(off_id=offering_id)
+
+            if not len(offerings):
+                raise OrderingError('The offering ' + offering_id + ' has not been previously registered')
+
+            offering = offerings[0]
+
+            included_offerings = []
+            if len(offering.bundled_offerings):
+                bundled = dict([(off.pk, off) for off in Offering.objects.filter(pk__in=offering.bundled_offerings)])
+                included_offerings = [bundled[off_pk] for off_pk in offering.bundled_offerings if off_pk in bundled]
 
-            # If the offering defines a digital product, check if the customer already owns it
-            included_offerings = [Offering.objects.get(pk=off_pk) for off_pk in offering.bundled_offerings]
             included_offerings.append(offering)
+            self._loaded_offerings[offering_id] = (offering, included_offerings)
 
-            def owned_digital(off):
-                if off.is_digital and off.pk in self._customer.userprofile.current_organization.acquired_offerings:
-                    raise OrderingError('The customer already owns the digital product offering ' + off.name + ' with id ' + off.off_id)
+        return self._loaded_offerings[offering_id]
 
-                return off
+    def _get_offering(self, item):
 
-            map(owned_digital, included_offerings)
+        # Download related product offering and product specification
+        cached_offering = self._download_offering(item)
+        offering_id = cached_offering.info['id']
 
-        else:
-            raise OrderingError('The offering ' + offering_id + ' has not been previously registered')
+        # Check if the offering has been already loaded in the system
+        offering, included_offerings = self._load_offerings(offering_id)
+
+        # If the offering defines a digital product, check if the customer already owns it
+        acquired_offerings = self._get_acquired_offerings()
+        for off in included_offerings:
+            if off.is_digital and off.pk in acquired_offerings:
+                raise OrderingError('The customer already owns the digital product offering ' + off.name + ' with id ' + off.off_id)
 
-        return offering, offering_info
+        return offering, cached_offering
 
     def _parse_price(self, model_mapper, price):
 
@@ -137,27 +192,26 @@ class OrderingManager:
 
         return alt_model
 
-    def _get_effective_pricing(self, item_id, product_price, offering_info):
+    def _get_effective_pricing(self, item_id, product_price, offering_info, price_keys=None):
         # Search the pricing chosen by the user
-        def field_included(pricing, field):
-            return field in pricing and len(pricing[field]) > 0
+        off_prices = offering_info['productOfferingPrice']
 
-        matches = 0
-        price = None
-        for off_price in offering_info['productOfferingPrice']:
+        if price_keys is None:
+            price_keys = get_offering_price_keys(offering_info)
 
+        if len(off_prices):
             # Change the price to string in order to avoid problems with floats
             product_price['price']['amount'] = unicode(product_price['price']['amount'])
 
-            # Validate that all pricing fields matches
-            if off_price['priceType'].lower() == product_price['priceType'].lower() and \
-                ((not field_included(off_price, 'unitOfMeasure') and not field_included(product_price, 'unitOfMeasure')) or
-                  (field_included(off_price, 'unitOfMeasure') and field_included(product_price, 'unitOfMeasure') and off_price['unitOfMeasure'].lower() == product_price['unitOfMeasure'].lower())) and \
-                    ((not field_included(off_price, 'recurringChargePeriod') and not field_included(product_price, 'recurringChargePeriod')) or
-                      (field_included(off_price, 'recurringChargePeriod') and field_included(product_price, 'recurringChargePeriod') and off_price['recurringChargePeriod'].lower() == product_price['recurringChargePeriod'].lower())) and \
-                        Decimal(off_price['price']['taxIncludedAmount']) == Decimal(product_price['price']['amount']) and \
-                          off_price['price']['currencyCode'].lower() == product_price['price']['currency'].lower():
+        # All the pricing fields must match
+        product_key = get_price_key(
+            product_price['priceType'], product_price.get('unitOfMeasure'), product_price.get('recurringChargePeriod'),
+            product_price['price']['amount'], product_price['price']['currency'])
 
+        matches = 0
+        price = None
+        for off_price, off_key in zip(off_prices, price_keys):
+            if product_key is not None and off_key == product_key:
                 matches += 1
                 price = off_price
 
@@ -172,7 +226,8 @@ class OrderingManager:
         # TODO: Check that the ordering API is actually validating that the chosen pricing and characteristics are valid for the given product
 
         # Build offering
-        offering, offering_info = self._get_offering(item)
+        offering, cached_offering = self._get_offering(item)
+        offering_info = cached_offering.info
 
         # Build pricing if included
         pricing = {}
@@ -186,7 +241,22 @@ class OrderingManager:
 
             # The productPrice field in the orderItem does not contain all the needed
             # information (neither taxes nor alterations), so extract pricing from the offering
-            price = self._get_effective_pricing(item['id'], item['product']['productPrice'][0], offering_info)
+            try:
+                price = self._get_effective_pricing(
+                    item['id'], item['product']['productPrice'][0], offering_info, cached_offering.price_keys)
+            except OrderingError:
+                offering_url = self._get_offering_url(item)
+
+                # The cached offering may be outdated, so it is revalidated before rejecting
+                # the item, unless it has been already validated while processing the order
+                if offering_url in self._validated_offerings:
+                    raise
+
+                cached_offering = self._download_offering_info(offering_url, item['id'], revalidate=True)
+                offering_info = cached_offering.info
+
+                price = self._get_effective_pricing(
+                    item['id'], item['product']['productPrice'][0], offering_info, cached_offering.price_keys)
 
             price_unit = self._parse_price(model_mapper, price)
 
@@ -237,7 +307,7 @@ class OrderingManager:
             if not self._customer.userprofile.current_organization.private:
                 headers['x-organization'] = self._customer.userprofile.current_organization.name
 
-            r = requests.get(url, headers=headers, verify=settings.VERIFY_REQUESTS)
+            r = http_client.get(url, headers=headers, verify=settings.VERIFY_REQUESTS)
 
             if r.status_code != 200:
                 raise OrderingError('There was an error at the time of retrieving the Billing Address')
@@ -270,22 +340,58 @@ class OrderingManager:
             'country': postal_address['country']
         }
 
-    def _process_add_items(self, items, order_id, description, terms_accepted):
+    def _get_offering_downloads(self, items):
+        # Every offering is downloaded once, even if included in several items
+        downloads = []
+        urls = set()
+        for item in items:
+            try:
+                offering_url = self._get_offering_url(item)
+            except Exception:
+                # Invalid items are reported when building its contract
+                continue
 
-        new_contracts = [self._build_contract(item) for item in items]
-        terms_found = [c for c in new_contracts if c.offering.asset is not None and c.offering.asset.has_terms]
+            if offering_url not in urls:
+                urls.add(offering_url)
+                downloads.append((offering_url, item['id']))
 
-        if terms_found and not terms_accepted:
-            raise OrderingError('You must accept the terms and conditions of the offering to acquire it')
+        return downloads
 
+    def _process_add_items(self, items, order_id, description, terms_accepted):
+        # The organization is loaded before starting the downloads, so the workers do not access the database
         current_org = self._customer.userprofile.current_organization
+
+        downloads = self._get_offering_downloads(items)
+        pool = ThreadPool(min(getattr(settings, 'ORDERING_DOWNLOAD_WORKERS', 8), len(downloads) + 1))
+
+        try:
+            # The billing address and the offerings are downloaded concurrently. Download errors
+            # are raised when the result is used, so they are reported as in a sequential download
+            billing_address = pool.apply_async(self._get_billing_address, (items, ))
+            self._offering_downloads = dict([
+                (offering_url, pool.apply_async(self._download_offering_info, (offering_url, item_id)))
+                for offering_url, item_id in downloads
+            ])
+
+            new_contracts = [self._build_contract(item) for item in items]
+            terms_found = [c for c in new_contracts if c.offering.asset is not None and c.offering.asset.has_terms]
+
+            if terms_found and not terms_accepted:
+                raise OrderingError('You must accept the terms and conditions of the offering to acquire it')
+
+            tax_address = billing_address.get()
+        finally:
+            pool.close()
+            pool.join()
+            self._offering_downloads = {}
+
         order = Order.objects.create(
             order_id=order_id,
             customer=self._customer,
             owner_organization=current_org,
             date=datetime.utcnow(),
             state='pending',
-            tax_address=self._get_billing_address(items),
+            tax_address=tax_address,
             contracts=new_contracts,
             description=description
         )
@@ -363,8 +469,12 @@ class OrderingManager:
             on_product_suspended(order, contract)
 
             contract.terminated = True
+            contract.next_due = None
             order.save()
 
+            # Remove the access to the digital assets of the product
+            revoke_offering(order, contract)
+
             # Terminate product in the inventory
             client.terminate_product(product['id'])
 
@@ -378,6 +488,9 @@ class OrderingManager:
         """
 
         self._customer = customer
+        self._acquired_offerings = None
+        self._loaded_offerings = {}
+        self._validated_offerings = set()
 
         # Check initial state of the order. It must be Acknowledged
         if order['state'].lower() != 'acknowledged':
@@ -24,8 +24,11 @@ from copy import deepcopy
 from nose_parameterized import parameterized
 from mock import MagicMock, call
 from datetime import datetime
+from decimal import Decimal
 from urlparse import urlparse
 
+from bson import ObjectId
+
 from django.contrib.auth.models import User
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
@@ -33,10 +36,11 @@ from django.test.utils import override_settings
 
 from wstore.models import Organization
 from wstore.ordering.errors import OrderingError
-from wstore.ordering.models import Order, Offering, Contract
+from wstore.ordering.models import Order, Offering, Contract, Charge
 
 from wstore.ordering.tests.test_data import *
-from wstore.ordering import ordering_client, ordering_management, inventory_client
+from wstore.store_commons.utils.testing import ThreadPoolMock
+from wstore.ordering import contract_index, entitlements, offering_cache, ordering_client, ordering_management, inventory_client
 
 
 @override_settings(SITE='http://extpath.com:8080/', VERIFY_REQUESTS=True)
@@ -72,11 +76,11 @@ class OrderingManagementTestCase(TestCase):
         ordering_management.ChargingEngine.return_value = self._charging_inst
 
         # Mock requests
-        ordering_management.requests = MagicMock()
+        ordering_management.http_client = MagicMock()
         self._response = MagicMock()
         self._response.status_code = 200
         self._response.json.side_effect = [OFFERING, BILLING_ACCOUNT, CUSTOMER_ACCOUNT, CUSTOMER]
-        ordering_management.requests.get.return_value = self._response
+        ordering_management.http_client.get.return_value = self._response
 
         # Mock organization model
         self._org_inst = MagicMock()
@@ -105,7 +109,12 @@ class OrderingManagementTestCase(TestCase):
 
         # Mock offering
         ordering_management.Offering.objects.filter.return_value = [self._offering_inst]
-        ordering_management.Offering.objects.get.return_value = self._offering_inst
+
+        # Downloads are executed in order when their result is used
+        ordering_management.ThreadPool = ThreadPoolMock
+
+        # The offering used in the tests is modified, so it is not cached between them
+        offering_cache.offering_cache.clear()
 
     def _check_contract_call(self, pricing):
         ordering_management.Contract.assert_called_once_with(
@@ -117,7 +126,6 @@ class OrderingManagementTestCase(TestCase):
 
     def _check_offering_retrieving_call(self):
         ordering_management.Offering.objects.filter.assert_called_once_with(off_id="5")
-        ordering_management.Offering.objects.get.assert_called_once_with(off_id="5")
 
     def _basic_add_checker(self):
         # Check offering creation
@@ -250,7 +258,7 @@ class OrderingManagementTestCase(TestCase):
         valid_response.json.side_effect = [OFFERING]
         invalid_response = MagicMock()
         invalid_response.status_code = 400
-        ordering_management.requests.get.side_effect = [valid_response, invalid_response]
+        ordering_management.http_client.get.side_effect = [valid_response, invalid_response]
 
     def _non_digital_offering(self):
         self._validator_inst.parse_characteristics.return_value = (None, None, None)
@@ -271,7 +279,7 @@ class OrderingManagementTestCase(TestCase):
                 result.status_code = 404
             return result
 
-        ordering_management.requests.get = get
+        ordering_management.http_client.get = get
 
     def _already_owned(self):
         self._offering_inst.pk = '11111'
@@ -287,7 +295,7 @@ class OrderingManagementTestCase(TestCase):
         self._offering_inst.bundled_offerings = ['111111']
         self._customer.userprofile.current_organization.acquired_offerings = ['111111']
 
-        ordering_management.Offering.objects.get.side_effect = [self._offering_inst, bundle_offering]
+        ordering_management.Offering.objects.filter.side_effect = [[self._offering_inst], [bundle_offering]]
 
     def _multiple_pricing(self):
         OFFERING['productOfferingPrice'].append(BASIC_PRICING)
@@ -354,7 +362,7 @@ class OrderingManagementTestCase(TestCase):
             ordering_management.ChargingEngine.assert_called_once_with(self._order_inst)
 
             # Check offering and product downloads
-            self.assertEquals(4, ordering_management.requests.get.call_count)
+            self.assertEquals(4, ordering_management.http_client.get.call_count)
 
             headers = {'Authorization': 'Bearer ' + self._customer.userprofile.access_token}
             exp_url = 'http://extpath.com:8080{}'
@@ -363,7 +371,7 @@ class OrderingManagementTestCase(TestCase):
                 call(exp_url.format(urlparse(BILLING_ACCOUNT_HREF).path), headers=headers, verify=True),
                 call(exp_url.format(urlparse(BILLING_ACCOUNT['customerAccount']['href']).path), headers=headers, verify=True),
                 call(exp_url.format(urlparse(CUSTOMER_ACCOUNT['customer']['href']).path), headers=headers, verify=True)
-            ], ordering_management.requests.get.call_args_list)
+            ], ordering_management.http_client.get.call_args_list)
 
             contact_medium = CUSTOMER['contactMedium'][0]['medium']
 
@@ -389,6 +397,114 @@ class OrderingManagementTestCase(TestCase):
         else:
             self.assertEquals(err_msg, unicode(error))
 
+    def test_process_order_concurrent_downloads(self):
+        OFFERING['productOfferingPrice'] = [BASIC_PRICING]
+
+        order = deepcopy(BASIC_ORDER)
+        order['orderItem'].append(deepcopy(order['orderItem'][0]))
+        order['orderItem'][1]['id'] = '2'
+
+        pool = ThreadPoolMock()
+        pool.apply_async = MagicMock(side_effect=ThreadPoolMock().apply_async)
+        ordering_management.ThreadPool = MagicMock(return_value=pool)
+
+        ordering_manager = ordering_management.OrderingManager()
+        ordering_manager.process_order(self._customer, order)
+
+        # The offering included in both items is downloaded once
+        offering_url = 'http://extpath.com:8080/DSProductCatalog/api/catalogManagement/v2/productOffering/20:(2.0)'
+        ordering_management.ThreadPool.assert_called_once_with(2)
+        self.assertEquals([
+            call(ordering_manager._get_billing_address, (order['orderItem'], )),
+            call(ordering_manager._download_offering_info, (offering_url, '1'))
+        ], pool.apply_async.call_args_list)
+
+        self.assertEquals(4, ordering_management.http_client.get.call_count)
+        self.assertEquals(2, ordering_management.Contract.call_count)
+        self.assertEquals({}, ordering_manager._offering_downloads)
+
+        # The offering models are loaded once for the whole order
+        ordering_management.Offering.objects.filter.assert_called_once_with(off_id='5')
+
+    def test_process_order_outdated_offering(self):
+        offering_url = 'http://extpath.com:8080/DSProductCatalog/api/catalogManagement/v2/productOffering/20:(2.0)'
+
+        # The cached copy of the offering includes a price that has been modified
+        outdated = deepcopy(OFFERING)
+        outdated['productOfferingPrice'] = [USAGE_PRICING]
+        offering_cache.offering_cache.set(offering_url, outdated)
+
+        OFFERING['productOfferingPrice'] = [BASIC_PRICING]
+
+        ordering_manager = ordering_management.OrderingManager()
+        ordering_manager.process_order(self._customer, BASIC_ORDER)
+
+        # The offering is revalidated instead of rejecting the item
+        self.assertEquals(call(offering_url, verify=True), ordering_management.http_client.get.call_args_list[0])
+        self.assertEquals(4, ordering_management.http_client.get.call_count)
+
+        self.assertEquals(OFFERING, offering_cache.offering_cache.get(offering_url).info)
+        self.assertEquals(1, ordering_management.Contract.call_count)
+
+    def test_load_bundle_offerings(self):
+        bundled1 = MagicMock(pk='111111')
+        bundled2 = MagicMock(pk='222222')
+        self._offering_inst.bundled_offerings = ['111111', '222222']
+        ordering_management.Offering.objects.filter.side_effect = [[self._offering_inst], [bundled2, bundled1]]
+
+        ordering_manager = ordering_management.OrderingManager()
+        offering, included = ordering_manager._load_offerings('5')
+
+        # The bundled offerings are retrieved in a single query
+        self.assertEquals([
+            call(off_id='5'),
+            call(pk__in=['111111', '222222'])
+        ], ordering_management.Offering.objects.filter.call_args_list)
+
+        self.assertEquals(self._offering_inst, offering)
+        self.assertEquals([bundled1, bundled2, self._offering_inst], included)
+
+        # Loaded offerings are reused by the rest of the items of the order
+        self.assertEquals((offering, included), ordering_manager._load_offerings('5'))
+        self.assertEquals(2, ordering_management.Offering.objects.filter.call_count)
+
+    @parameterized.expand([
+        ('fresh', False, None),
+        ('not_modified', True, 304),
+        ('modified', True, 200)
+    ])
+    def test_download_offering_cached(self, name, expired, status):
+        url = 'http://extpath.com:8080/DSProductCatalog/api/catalogManagement/v2/productOffering/5'
+        cached = offering_cache.offering_cache.set(url, OFFERING, {'ETag': '"1"'})
+
+        if expired:
+            cached.expires = 0
+
+        new_offering = {'id': '5', 'productOfferingPrice': []}
+        self._response.status_code = status
+        self._response.json.side_effect = None
+        self._response.json.return_value = new_offering
+        self._response.headers = {'ETag': '"2"'}
+
+        ordering_manager = ordering_management.OrderingManager()
+        result = ordering_manager._download_offering_info(url, '1')
+
+        if not expired:
+            self.assertTrue(result is cached)
+            self.assertEquals(0, ordering_management.http_client.get.call_count)
+            return
+
+        # Expired offerings are revalidated with a conditional request
+        ordering_management.http_client.get.assert_called_once_with(url, verify=True, headers={'If-None-Match': '"1"'})
+
+        if status == 304:
+            self.assertTrue(result is cached)
+            self.assertTrue(cached.is_fresh())
+        else:
+            self.assertEquals(new_offering, result.info)
+            self.assertEquals('"2"', result.etag)
+            self.assertTrue(offering_cache.offering_cache.get(url) is result)
+
     BASIC_MODIFY = {
         'state': 'Acknowledged',
         'orderItem': [{
@@ -494,6 +610,38 @@ class OrderingManagementTestCase(TestCase):
         else:
             self.assertEquals(err_msg, unicode(error))
 
+    def test_delete_order(self):
+        mock_contract = MagicMock()
+        mock_contract.pricing_model = {}
+        self._order_inst.get_product_contract.return_value = mock_contract
+
+        ordering_management.InventoryClient = MagicMock()
+        ordering_management.InventoryClient().get_product.return_value = {'id': '1', 'name': 'oid=35'}
+        ordering_management.on_product_suspended = MagicMock()
+        ordering_management.revoke_offering = MagicMock()
+
+        ordering = ordering_management.OrderingManager()
+        redirect_url = ordering.process_order(self._customer, {
+            'state': 'Acknowledged',
+            'orderItem': [{
+                'id': '1',
+                'action': 'delete',
+                'product': {
+                    'id': '89'
+                }
+            }]
+        })
+
+        self.assertTrue(redirect_url is None)
+        ordering_management.on_product_suspended.assert_called_once_with(self._order_inst, mock_contract)
+
+        self.assertTrue(mock_contract.terminated)
+        self.assertTrue(mock_contract.next_due is None)
+        self._order_inst.save.assert_called_once_with()
+
+        ordering_management.revoke_offering.assert_called_once_with(self._order_inst, mock_contract)
+        ordering_management.InventoryClient().terminate_product.assert_called_once_with('89')
+
 
 @override_settings(
     ORDERING='http://localhost:8080/DSProductOrdering'
@@ -506,15 +654,15 @@ class OrderingClientTestCase(TestCase):
         ordering_client.settings.LOCAL_SITE = 'http://testdomain.com'
 
         # Mock requests
-        ordering_client.requests = MagicMock()
+        ordering_client.http_client = MagicMock()
         self._response = MagicMock()
         self._response.status_code = 200
         self._response.json.return_value = {
             'id': '1'
         }
-        ordering_client.requests.post.return_value = self._response
-        ordering_client.requests.patch.return_value = self._response
-        ordering_client.requests.get.return_value = self._response
+        ordering_client.http_client.post.return_value = self._response
+        ordering_client.http_client.patch.return_value = self._response
+        ordering_client.http_client.get.return_value = self._response
 
     def test_ordering_subscription(self):
         client = ordering_client.OrderingClient()
@@ -522,7 +670,7 @@ class OrderingClientTestCase(TestCase):
         client.create_ordering_subscription()
 
         # Check calls
-        ordering_client.requests.post.assert_called_once_with('http://localhost:8080/DSProductOrdering/productOrdering/v2/hub', {
+        ordering_client.http_client.post.assert_called_once_with('http://localhost:8080/DSProductOrdering/productOrdering/v2/hub', {
             'callback': 'http://testdomain.com/charging/api/orderManagement/orders'
         })
 
@@ -577,7 +725,7 @@ class OrderingClientTestCase(TestCase):
         }
         client.update_items_state(order, 'InProgress', items)
 
-        ordering_client.requests.patch.assert_called_once_with(
+        ordering_client.http_client.patch.assert_called_once_with(
             'http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/20',
             json=expected)
 
@@ -593,7 +741,7 @@ class OrderingClientTestCase(TestCase):
 
         client.update_state(order, new_state)
 
-        ordering_client.requests.patch.assert_called_once_with(
+        ordering_client.http_client.patch.assert_called_once_with(
             'http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/' + order['id'],
             json={'state': new_state})
 
@@ -608,7 +756,7 @@ class OrderingClientTestCase(TestCase):
             'id': '1'
         }, response)
 
-        ordering_client.requests.get.assert_called_once_with(
+        ordering_client.http_client.get.assert_called_once_with(
             'http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/1'
         )
         self._response.raise_for_status.assert_called_once_with()
@@ -691,6 +839,502 @@ class OrderTestCase(TestCase):
         self.assertFalse(error is None)
         self.assertEquals('OrderingError: Invalid product id', unicode(e))
 
+    def test_update_next_due_subscription(self):
+        self._contract1.pricing_model = {
+            'subscription': [{
+                'renovation_date': datetime(2016, 3, 1)
+            }, {
+                'renovation_date': datetime(2016, 2, 1)
+            }]
+        }
+        self._contract1.update_next_due(datetime(2016, 1, 1))
+        self.assertEquals(datetime(2016, 2, 1), self._contract1.next_due)
+
+    def test_update_next_due_usage(self):
+        self._contract1.pricing_model = {
+            'pay_per_use': []
+        }
+        self._contract1.update_next_due(datetime(2016, 1, 1))
+        self.assertEquals(datetime(2016, 1, 31), self._contract1.next_due)
+
+        self._contract1.charges = [
+            Charge(date=datetime(2016, 1, 20), concept='usage'),
+            Charge(date=datetime(2016, 1, 25), concept='recurring')
+        ]
+        self._contract1.update_next_due(datetime(2016, 1, 1))
+        self.assertEquals(datetime(2016, 2, 19), self._contract1.next_due)
+
+    def test_update_next_due_terminated(self):
+        self._contract1.pricing_model = {
+            'pay_per_use': []
+        }
+        self._contract1.terminated = True
+        self._contract1.update_next_due(datetime(2016, 1, 1))
+        self.assertEquals(None, self._contract1.next_due)
+
+
+class ContractIndexTestCase(TestCase):
+
+    tags = ('ordering', )
+
+    def setUp(self):
+        self._collection = MagicMock()
+        self._collection.find_one.return_value = {
+            '_id': '5',
+            'order_id': '1',
+            'owner_organization_id': '6',
+            'customer_id': '7',
+            'contracts': [{
+                'product_id': '3'
+            }, {}, {
+                'product_id': '4',
+                'correlation_number': 2
+            }]
+        }
+
+        contract_index.get_database_connection = MagicMock()
+        contract_index.get_database_connection.return_value.__getitem__.return_value = self._collection
+
+        contract_index.Order = MagicMock()
+        contract_index.Order._meta.db_table = 'wstore_order'
+
+    def tearDown(self):
+        reload(contract_index)
+
+    def test_locate_product_contract(self):
+        location = contract_index.locate_product_contract('4', order_id='1', fields=('correlation_number', ))
+
+        contract_index.get_database_connection.return_value.__getitem__.assert_called_once_with('wstore_order')
+        self._collection.find_one.assert_called_once_with({
+            'contracts.product_id': '4',
+            'order_id': '1'
+        }, {
+            'order_id': True,
+            'owner_organization_id': True,
+            'customer_id': True,
+            'contracts.product_id': True,
+            'contracts.correlation_number': True
+        })
+
+        self.assertEquals('5', location.order_pk)
+        self.assertEquals('1', location.order_id)
+        self.assertEquals(2, location.index)
+        self.assertEquals('contracts.2', location.path)
+        self.assertEquals('6', location.owner_organization)
+        self.assertEquals('7', location.customer)
+        self.assertEquals({'product_id': '4', 'correlation_number': 2}, location.contract)
+
+    def test_locate_product_contract_not_found(self):
+        self._collection.find_one.return_value = None
+
+        self.assertTrue(contract_index.locate_product_contract('8') is None)
+        self._collection.find_one.assert_called_once_with({
+            'contracts.product_id': '8'
+        }, {
+            'order_id': True,
+            'owner_organization_id': True,
+            'customer_id': True,
+            'contracts.product_id': True
+        })
+
+    def _mock_order(self, product_ids):
+        order = MagicMock()
+        order.contracts = []
+        for product_id in product_ids:
+            contract = MagicMock()
+            contract.product_id = product_id
+            order.contracts.append(contract)
+
+        contract_index.Order.objects.get.return_value = order
+        return order
+
+    def test_get_product_contract(self):
+        order = self._mock_order(['3', None, '4'])
+
+        result = contract_index.get_product_contract('4')
+
+        self.assertEquals((order, order.contracts[2]), result)
+        contract_index.Order.objects.get.assert_called_once_with(pk='5')
+        self.assertEquals(0, order.get_product_contract.call_count)
+
+    def test_get_product_contract_moved(self):
+        # The contracts have changed after locating the product
+        order = self._mock_order(['3'])
+
+        result = contract_index.get_product_contract('4')
+
+        self.assertEquals((order, order.get_product_contract.return_value), result)
+        order.get_product_contract.assert_called_once_with('4')
+
+    def test_get_product_contract_not_found(self):
+        self._collection.find_one.return_value = None
+
+        error = None
+        try:
+            contract_index.get_product_contract('8')
+        except OrderingError as e:
+            error = e
+
+        self.assertFalse(error is None)
+        self.assertEquals('OrderingError: Invalid product id', unicode(error))
+        self.assertEquals(0, contract_index.Order.objects.get.call_count)
+
+    def test_advance_contract_usage(self):
+        self._collection.update_one.return_value.matched_count = 1
+
+        updated = contract_index.advance_contract_usage('57a8b6a2e1b2b9c1d5f4e3a1', '4', 2, 3, datetime(2016, 1, 1))
+
+        self.assertTrue(updated)
+        self._collection.update_one.assert_called_once_with({
+            '_id': ObjectId('57a8b6a2e1b2b9c1d5f4e3a1'),
+            'contracts': {
+                '$elemMatch': {
+                    'product_id': '4',
+                    'correlation_number': 2
+                }
+            }
+        }, {
+            '$inc': {'contracts.$.correlation_number': 3},
+            '$set': {'contracts.$.last_usage': datetime(2016, 1, 1)}
+        })
+
+    def test_advance_contract_usage_modified(self):
+        self._collection.update_one.return_value.matched_count = 0
+        self.assertFalse(contract_index.advance_contract_usage('57a8b6a2e1b2b9c1d5f4e3a1', '4', 2, 1, datetime(2016, 1, 1)))
+
+    def test_advance_contract_usage_no_timestamp(self):
+        self._collection.update_one.return_value.matched_count = 1
+
+        contract_index.advance_contract_usage('57a8b6a2e1b2b9c1d5f4e3a1', '4', 2)
+
+        self.assertEquals({
+            '$inc': {'contracts.$.correlation_number': 1}
+        }, self._collection.update_one.call_args[0][1])
+
+    def test_rollback_contract_usage(self):
+        self._collection.update_one.return_value.matched_count = 1
+
+        reverted = contract_index.rollback_contract_usage('57a8b6a2e1b2b9c1d5f4e3a1', '4', 5, 2, datetime(2016, 1, 1))
+
+        self.assertTrue(reverted)
+        self._collection.update_one.assert_called_once_with({
+            '_id': ObjectId('57a8b6a2e1b2b9c1d5f4e3a1'),
+            'contracts': {
+                '$elemMatch': {
+                    'product_id': '4',
+                    'correlation_number': 5
+                }
+            }
+        }, {
+            '$inc': {'contracts.$.correlation_number': -2},
+            '$set': {'contracts.$.last_usage': datetime(2016, 1, 1)}
+        })
+
+    def test_rollback_contract_usage_modified(self):
+        self._collection.update_one.return_value.matched_count = 0
+        self.assertFalse(contract_index.rollback_contract_usage('57a8b6a2e1b2b9c1d5f4e3a1', '4', 5))
+
+    def _test_apply_contract_usage(self, updated):
+        contract_index.advance_contract_usage = MagicMock(return_value=updated)
+        order = MagicMock(pk='5')
+        contract = MagicMock(product_id='4', correlation_number=2, last_usage=None)
+
+        error = None
+        try:
+            contract_index.apply_contract_usage(order, contract, count=3, last_usage=datetime(2016, 1, 1))
+        except OrderingError as e:
+            error = e
+
+        contract_index.advance_contract_usage.assert_called_once_with('5', '4', 2, 3, datetime(2016, 1, 1))
+        return contract, error
+
+    def test_apply_contract_usage(self):
+        contract, error = self._test_apply_contract_usage(True)
+
+        self.assertTrue(error is None)
+        self.assertEquals(5, contract.correlation_number)
+        self.assertEquals(datetime(2016, 1, 1), contract.last_usage)
+
+    def test_apply_contract_usage_modified(self):
+        contract, error = self._test_apply_contract_usage(False)
+
+        self.assertEquals('OrderingError: The usage of the contract has been modified by other request', unicode(error))
+        self.assertEquals(2, contract.correlation_number)
+        self.assertEquals(None, contract.last_usage)
+
+
+class OfferingCacheTestCase(TestCase):
+
+    tags = ('ordering', 'offering-cache')
+
+    def setUp(self):
+        self._cache = offering_cache.OfferingCache()
+
+    def _get_offering(self, off_id):
+        offering = deepcopy(OFFERING)
+        offering['id'] = off_id
+        offering['productOfferingPrice'] = [BASIC_PRICING, USAGE_PRICING]
+        return offering
+
+    def test_set_offering(self):
+        offering = self._get_offering('5')
+        entry = self._cache.set('http://catalog.com/offering/5', offering, {
+            'ETag': '"1"',
+            'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'
+        })
+
+        self.assertTrue(entry is self._cache.get('http://catalog.com/offering/5'))
+        self.assertTrue(entry.is_fresh())
+        self.assertEquals(offering, entry.info)
+        self.assertEquals({
+            'If-None-Match': '"1"',
+            'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'
+        }, entry.get_validators())
+
+        self.assertEquals([
+            ('one time', '', '', Decimal('12.00'), 'eur'),
+            ('usage', 'megabyte', '', Decimal('12.00'), 'eur')
+        ], entry.price_keys)
+
+    def test_invalid_price_keys(self):
+        offering = self._get_offering('5')
+        offering['productOfferingPrice'] = [{}, {'priceType': 'one time', 'price': {'taxIncludedAmount': 'invalid', 'currencyCode': 'EUR'}}]
+
+        self.assertEquals([None, None], offering_cache.get_offering_price_keys(offering))
+
+    @override_settings(OFFERING_CACHE_SIZE=2)
+    def test_cache_eviction(self):
+        self._cache.set('http://catalog.com/offering/1', self._get_offering('1'))
+        self._cache.set('http://catalog.com/offering/2', self._get_offering('2'))
+
+        # The first offering is the most recently used
+        self._cache.get('http://catalog.com/offering/1')
+        self._cache.set('http://catalog.com/offering/3', self._get_offering('3'))
+
+        self.assertFalse(self._cache.get('http://catalog.com/offering/1') is None)
+        self.assertTrue(self._cache.get('http://catalog.com/offering/2') is None)
+        self.assertFalse(self._cache.get('http://catalog.com/offering/3') is None)
+
+    @override_settings(OFFERING_CACHE_TTL=0)
+    def test_cache_disabled(self):
+        entry = self._cache.set('http://catalog.com/offering/1', self._get_offering('1'))
+
+        self.assertFalse(entry.is_fresh())
+        self.assertTrue(self._cache.get('http://catalog.com/offering/1') is None)
+
+    def test_invalidate_offering(self):
+        self._cache.set('http://catalog.com/offering/1', self._get_offering('1'))
+        self._cache.set('http://catalog.com/offering/1?fields=id', self._get_offering('1'))
+        self._cache.set('http://catalog.com/offering/2', self._get_offering('2'))
+
+        self._cache.invalidate('1')
+
+        self.assertTrue(self._cache.get('http://catalog.com/offering/1') is None)
+        self.assertTrue(self._cache.get('http://catalog.com/offering/1?fields=id') is None)
+        self.assertFalse(self._cache.get('http://catalog.com/offering/2') is None)
+
+
+class EntitlementsTestCase(TestCase):
+
+    tags = ('ordering', 'entitlements')
+
+    def setUp(self):
+        self._collection = MagicMock()
+        entitlements.get_database_connection = MagicMock()
+        entitlements.get_database_connection.return_value.__getitem__.return_value = self._collection
+
+        self._asset1 = MagicMock(pk='asset1', bundled_assets=[])
+        self._asset2 = MagicMock(pk='asset2', bundled_assets=[])
+        self._bundle_asset = MagicMock(pk='asset3', bundled_assets=['asset1', 'asset4'])
+
+        self._off1 = MagicMock(pk='off1', is_digital=True, asset=self._asset1, bundled_offerings=[])
+        self._off2 = MagicMock(pk='off2', is_digital=True, asset=self._bundle_asset, bundled_offerings=[])
+
+        entitlements.Offering = MagicMock()
+        entitlements.Order = MagicMock()
+        entitlements.Order.objects.filter.return_value = [
+            MagicMock(pk='order1', contracts=[
+                MagicMock(offering_id='off1', item_id='1', terminated=False),
+                MagicMock(offering_id='off3', item_id='2', terminated=True)]),
+            MagicMock(pk='order2', contracts=[
+                MagicMock(offering_id='off2', item_id='1', terminated=False),
+                MagicMock(offering_id='off5', item_id='2', terminated=False)])
+        ]
+
+        self._org = MagicMock(pk='org1', acquired_offerings=['off1', 'off2', 'off3'])
+        self._order = MagicMock(pk='order2', owner_organization=self._org)
+        self._contract = MagicMock(item_id='1', offering=self._off2)
+        entitlements._entitlement_cache.clear()
+
+    def _terminate_contract(self, offering_id):
+        for order in entitlements.Order.objects.filter.return_value:
+            for contract in order.contracts:
+                if contract.offering_id == offering_id:
+                    contract.terminated = True
+
+    def tearDown(self):
+        reload(entitlements)
+
+    def test_offering_assets(self):
+        self.assertEquals(set(['asset1']), entitlements.get_offering_assets(self._off1))
+        self.assertEquals(set(['asset1', 'asset4']), entitlements.get_offering_assets(self._off2))
+
+        # Non digital offerings do not include assets
+        self.assertEquals(set(), entitlements.get_offering_assets(MagicMock(is_digital=False, bundled_offerings=[])))
+        self.assertEquals(0, entitlements.Offering.objects.filter.call_count)
+
+    def test_offering_bundle_assets(self):
+        entitlements.Offering.objects.filter.return_value = [
+            MagicMock(is_digital=False), self._off1, MagicMock(is_digital=True, asset=self._asset2, bundled_offerings=[])]
+
+        bundle = MagicMock(pk='off3', asset=None, bundled_offerings=['off4', 'off1', 'off5'])
+
+        self.assertEquals(set(['asset1', 'asset2']), entitlements.get_offering_assets(bundle))
+        entitlements.Offering.objects.filter.assert_called_once_with(pk__in=['off4', 'off1', 'off5'])
+
+    def test_active_contracts(self):
+        # Terminated and not acquired contracts are not included
+        self.assertEquals({
+            'off1': ['order1:1'],
+            'off2': ['order2:1']
+        }, entitlements.get_active_contracts(self._org))
+        entitlements.Order.objects.filter.assert_called_once_with(owner_organization=self._org)
+
+        self._terminate_contract('off1')
+        self.assertEquals({'off2': ['order2:1']}, entitlements.get_active_contracts(self._org))
+
+    def test_build_entitlements(self):
+        entitlements.Offering.objects.filter.return_value = [self._off1, self._off2]
+
+        assets = entitlements.build_entitlements(self._org)
+
+        expected = {
+            'asset1': ['off1', 'off2'],
+            'asset4': ['off2']
+        }
+        self.assertEquals(expected, assets)
+
+        entitlements.get_database_connection.return_value.__getitem__.assert_called_once_with('wstore_entitlement')
+        entitlements.Offering.objects.filter.assert_called_once_with(pk__in=['off1', 'off2'])
+        self._collection.replace_one.assert_called_once_with({'_id': 'org1'}, {
+            'assets': expected,
+            'contracts': {
+                'off1': ['order1:1'],
+                'off2': ['order2:1']
+            }
+        }, upsert=True)
+
+    def test_grant_offering(self):
+        entitlements.grant_offering(self._order, MagicMock(item_id='3', offering=self._off2))
+
+        # Entitlements without the contracts of the offerings are built again
+        self._collection.delete_one.assert_called_once_with({'_id': 'org1', 'contracts': {'$exists': False}})
+
+        self._collection.update_one.assert_called_once_with({'_id': 'org1'}, {
+            '$addToSet': {
+                'assets.asset1': 'off2',
+                'assets.asset4': 'off2',
+                'contracts.off2': 'order2:3'
+            }
+        })
+
+    def test_grant_offering_no_assets(self):
+        entitlements.grant_offering(self._order, MagicMock(offering=MagicMock(is_digital=False, bundled_offerings=[])))
+
+        self.assertEquals(0, self._collection.delete_one.call_count)
+        self.assertEquals(0, self._collection.update_one.call_count)
+
+    def test_revoke_offering(self):
+        self._collection.find_one_and_update.return_value = {'_id': 'org1', 'contracts': {'off2': []}}
+
+        entitlements.revoke_offering(self._order, self._contract)
+
+        # The active contracts are checked in the index, without loading the orders
+        self._collection.find_one_and_update.assert_called_once_with({
+            '_id': 'org1',
+            'contracts': {'$exists': True}
+        }, {
+            '$pull': {'contracts.off2': 'order2:1'}
+        }, projection={'contracts.off2': True}, return_document=entitlements.ReturnDocument.AFTER)
+
+        self.assertEquals(0, entitlements.Order.objects.filter.call_count)
+        self.assertEquals(0, self._collection.replace_one.call_count)
+
+        self.assertEquals(call({
+            '_id': 'org1',
+            'contracts.off2.0': {'$exists': False}
+        }, {
+            '$pull': {
+                'assets.asset1': 'off2',
+                'assets.asset4': 'off2'
+            },
+            '$unset': {'contracts.off2': ''}
+        }), self._collection.update_one.call_args_list[0])
+
+        # Assets not granted by other offerings are removed
+        self.assertEquals(sorted([
+            call({'_id': 'org1', 'assets.asset1': {'$size': 0}}, {'$unset': {'assets.asset1': ''}}),
+            call({'_id': 'org1', 'assets.asset4': {'$size': 0}}, {'$unset': {'assets.asset4': ''}})
+        ]), sorted(self._collection.update_one.call_args_list[1:]))
+
+    def test_revoke_offering_not_built(self):
+        self._collection.find_one_and_update.return_value = None
+        entitlements.Offering.objects.filter.return_value = [self._off1]
+        self._terminate_contract('off2')
+
+        entitlements.revoke_offering(self._order, self._contract)
+
+        # The entitlements are built from the orders, without the terminated contract
+        self._collection.replace_one.assert_called_once_with({'_id': 'org1'}, {
+            'assets': {'asset1': ['off1']},
+            'contracts': {'off1': ['order1:1']}
+        }, upsert=True)
+        self.assertEquals(0, self._collection.update_one.call_count)
+
+    def test_revoke_offering_active_contract(self):
+        # Other product of the same offering is still active
+        self._collection.find_one_and_update.return_value = {'_id': 'org1', 'contracts': {'off2': ['order1:3']}}
+
+        entitlements.revoke_offering(self._order, self._contract)
+
+        self.assertEquals(0, entitlements.Order.objects.filter.call_count)
+        self.assertEquals(0, self._collection.update_one.call_count)
+        self.assertEquals(0, self._collection.replace_one.call_count)
+
+    @parameterized.expand([
+        ('granted', {'_id': 'org1', 'assets': {'asset1': ['off1']}}, True),
+        ('not_granted', {'_id': 'org1'}, False)
+    ])
+    def test_has_asset_access(self, name, doc, expected):
+        self._collection.find_one.return_value = doc
+
+        self.assertEquals(expected, entitlements.has_asset_access(self._org, self._asset1))
+        self.assertEquals(expected, entitlements.has_asset_access(self._org, self._asset1))
+
+        # Granted accesses are cached, denied ones are checked again
+        self.assertEquals([call({'_id': 'org1'}, {'assets.asset1': True})] * (1 if expected else 2),
+                          self._collection.find_one.call_args_list)
+        self.assertEquals(0, self._collection.replace_one.call_count)
+
+    def test_has_asset_access_not_built(self):
+        self._collection.find_one.return_value = None
+        entitlements.Offering.objects.filter.return_value = [self._off2]
+
+        self.assertTrue(entitlements.has_asset_access(self._org, MagicMock(pk='asset4')))
+        self.assertFalse(entitlements.has_asset_access(self._org, self._asset2))
+
+        self.assertEquals(2, self._collection.replace_one.call_count)
+
+    @override_settings(ENTITLEMENT_CACHE_SIZE=1)
+    def test_cache_eviction(self):
+        self._collection.find_one.return_value = {'_id': 'org1', 'assets': {'asset1': ['off1'], 'asset2': ['off1']}}
+
+        entitlements.has_asset_access(self._org, self._asset1)
+        entitlements.has_asset_access(self._org, self._asset2)
+        entitlements.has_asset_access(self._org, self._asset1)
+
+        self.assertEquals(3, self._collection.find_one.call_count)
+
 
 @override_settings(
     INVENTORY='http://localhost:8080/DSProductInventory'
@@ -701,11 +1345,11 @@ class InventoryClientTestCase(TestCase):
 
     def setUp(self):
         # Mock requests
-        inventory_client.requests = MagicMock()
+        inventory_client.http_client = MagicMock()
         self.response = MagicMock()
         self.response.status_code = 201
-        inventory_client.requests.post.return_value = self.response
-        inventory_client.requests.get.return_value = self.response
+        inventory_client.http_client.post.return_value = self.response
+        inventory_client.http_client.get.return_value = self.response
 
         inventory_client.settings.LOCAL_SITE = 'http://localhost:8004/'
 
@@ -732,17 +1376,17 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         client.create_inventory_subscription()
 
-        inventory_client.requests.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/hub')
+        inventory_client.http_client.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/hub')
 
         if created:
-            inventory_client.requests.post.assert_called_once_with(
+            inventory_client.http_client.post.assert_called_once_with(
                 'http://localhost:8080/DSProductInventory/api/productInventory/v2/hub',
                 json={
                     'callback': 'http://localhost:8004/charging/api/orderManagement/products'
                 }
             )
         else:
-            self.assertEquals(0, inventory_client.requests.post.call_count)
+            self.assertEquals(0, inventory_client.http_client.post.call_count)
 
     def test_create_subscription_error(self):
         self.response.json.return_value = []
@@ -765,20 +1409,20 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         client.activate_product('1')
 
-        inventory_client.requests.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
+        inventory_client.http_client.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
             'status': 'Active',
             'startDate': '2016-01-22T04:10:25.176751Z'
         })
-        inventory_client.requests.patch().raise_for_status.assert_called_once_with()
+        inventory_client.http_client.patch().raise_for_status.assert_called_once_with()
 
     def test_suspend_product(self):
         client = inventory_client.InventoryClient()
         client.suspend_product('1')
 
-        inventory_client.requests.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
+        inventory_client.http_client.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
             'status': 'Suspended'
         })
-        inventory_client.requests.patch().raise_for_status.assert_called_once_with()
+        inventory_client.http_client.patch().raise_for_status.assert_called_once_with()
 
     def test_terminate_product(self):
         client = inventory_client.InventoryClient()
@@ -793,16 +1437,16 @@ class InventoryClientTestCase(TestCase):
                 'status': 'Terminated',
                 'terminationDate': '2016-01-22T04:10:25.176751Z'
             })
-        ], inventory_client.requests.patch.call_args_list)
+        ], inventory_client.http_client.patch.call_args_list)
 
-        self.assertEquals([call(), call()], inventory_client.requests.patch().raise_for_status.call_args_list)
+        self.assertEquals([call(), call()], inventory_client.http_client.patch().raise_for_status.call_args_list)
 
     def test_get_product(self):
         client = inventory_client.InventoryClient()
         client.get_product('1')
 
-        inventory_client.requests.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1')
-        inventory_client.requests.get().raise_for_status.assert_called_once_with()
+        inventory_client.http_client.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1')
+        inventory_client.http_client.get().raise_for_status.assert_called_once_with()
 
     @parameterized.expand([
         ('all', {}, ''),
@@ -812,7 +1456,7 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         products = client.get_products(query=query)
 
-        inventory_client.requests.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product' + qs)
-        inventory_client.requests.get().raise_for_status.assert_called_once_with()
+        inventory_client.http_client.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product' + qs)
+        inventory_client.http_client.get().raise_for_status.assert_called_once_with()
 
-        self.assertEquals(inventory_client.requests.get().json(), products)
+        self.assertEquals(inventory_client.http_client.get().json(), products)
@@ -257,10 +257,10 @@ class RenovationCollectionTestCase(TestCase):
     tags = ('renovation', )
 
     def _order_not_found(self):
-        views.Order.objects.get.side_effect = Exception('Not found')
+        views.Order.objects.filter.return_value.count.return_value = 0
 
     def _product_not_found(self):
-        views.Order.objects.get().get_product_contract.side_effect = OrderingError('Not found')
+        views.get_product_contract.side_effect = OrderingError('Not found')
 
     def _charging_engine_value_error(self):
         self.charging_inst.resolve_charging.side_effect = ValueError('Value error')
@@ -333,6 +333,12 @@ class RenovationCollectionTestCase(TestCase):
     def test_renovate_product(self, name, data, url, concept, exp_code, exp_response, side_effect=None):
         # Create mocks
         views.Order = MagicMock()
+        views.Order.objects.filter.return_value.count.return_value = 1
+
+        self.order = MagicMock()
+        self.contract = MagicMock()
+        views.get_product_contract = MagicMock(return_value=(self.order, self.contract))
+
         views.ChargingEngine = MagicMock()
         self.charging_inst = MagicMock()
         self.charging_inst.resolve_charging.return_value = url
@@ -353,11 +359,10 @@ class RenovationCollectionTestCase(TestCase):
 
         # Validate calls if needed
         if concept is not None:
-            views.Order.objects.get.assert_called_once_with(order_id='1')
-            views.Order.objects.get().get_product_contract.assert_called_once_with('24')
-            views.ChargingEngine.assert_called_once_with(views.Order.objects.get())
+            views.Order.objects.filter.assert_called_once_with(order_id='1')
+            views.get_product_contract.assert_called_once_with('24', order_id='1')
+            views.ChargingEngine.assert_called_once_with(self.order)
             self.charging_inst.resolve_charging.assert_called_once_with(
-                type_=concept, related_contracts=[views.Order.objects.get().get_product_contract()])
+                type_=concept, related_contracts=[self.contract])
 
-            views.on_usage_refreshed.assert_called_once_with(
-                views.Order.objects.get(), views.Order.objects.get().get_product_contract())
\ No newline at end of file
+            views.on_usage_refreshed.assert_called_once_with(self.order, self.contract)
\ No newline at end of file
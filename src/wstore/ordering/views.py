@@ -31,6 +31,7 @@ from wstore.ordering.ordering_client import OrderingClient
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.store_commons.resource import Resource
 from wstore.store_commons.utils.http import build_response, supported_request_mime_types, authentication_required
+from wstore.ordering.contract_index import get_product_contract
 from wstore.ordering.models import Order
 from wstore.asset_manager.resource_plugins.decorators import on_product_acquired, on_usage_refreshed
 
@@ -170,9 +171,7 @@ class RenovationCollection(Resource):
         # Parse oid from product name
         parsed_name = task['name'].split('=')
 
-        try:
-            order = Order.objects.get(order_id=parsed_name[1])
-        except:
+        if len(parsed_name) < 2 or not Order.objects.filter(order_id=parsed_name[1]).count():
             return build_response(request, 404, 'The oid specified in the product name is not valid')
 
         # Get contract to renovate
@@ -180,7 +179,7 @@ class RenovationCollection(Resource):
             task['id'] = unicode(task['id'])
 
         try:
-            contract = order.get_product_contract(task['id'])
+            order, contract = get_product_contract(task['id'], order_id=parsed_name[1])
         except:
             return build_response(request, 404, 'The specified product id is not valid')
 
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+
+from django.conf import settings
+
+from wstore.rss_adaptor.rss_adaptor import RSSAdaptor
+from wstore.store_commons.database import get_database_connection, DistributedLock
+from wstore.store_commons.scheduler import schedule_deadline
+
+
+OUTBOX_COLLECTION = 'wstore_cdr_outbox'
+DISPATCH_DEADLINE = 'cdr_dispatch'
+
+
+class CDROutbox(object):
+    """
+    Durable queue of the CDRs to be sent to the RSS. CDRs of different orders are sent
+    in batches by a single dispatcher, ordered by provider and correlation number. The
+    CDRs of a provider are never sent before a previous CDR of the same provider, so
+    a provider is blocked while its oldest CDRs are waiting for a retry or have failed
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection()[OUTBOX_COLLECTION]
+        self._collection.create_index([('state', ASCENDING), ('provider', ASCENDING), ('correlation', ASCENDING)])
+        self._collection.create_index([('state', ASCENDING), ('next_attempt', ASCENDING)])
+
+    def _schedule_dispatch(self, delay=0, keep_due=False):
+        schedule_deadline(DISPATCH_DEADLINE, 'outbox', delay, keep_due=keep_due)
+
+    def enqueue(self, cdrs):
+        """
+        Saves CDRs in the outbox and schedules its delivery
+        """
+        if not len(cdrs):
+            return
+
+        now = datetime.utcnow()
+        self._collection.insert_many([{
+            'cdr': cdr,
+            'provider': cdr['provider'],
+            'correlation': int(cdr['correlation']),
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': now,
+            'created': now
+        } for cdr in cdrs], ordered=False)
+
+        # A dispatch already scheduled for a retry is not brought forward
+        self._schedule_dispatch(keep_due=True)
+
+    def retry_failed(self):
+        """
+        Moves the CDRs that exceeded the maximum number of attempts back to pending
+        :return: Number of CDRs to be retried
+        """
+        result = self._collection.update_many({'state': 'failed'}, {
+            '$set': {'state': 'pending', 'attempts': 0, 'next_attempt': datetime.utcnow()}
+        })
+        self._schedule_dispatch()
+        return result.modified_count
+
+    def _get_backoff(self, attempts):
+        base = getattr(settings, 'CDR_RETRY_BACKOFF', 30)
+        return min(base * (2 ** (attempts - 1)), getattr(settings, 'CDR_MAX_RETRY_BACKOFF', 3600))
+
+    def _send_batch(self, batch):
+        response = RSSAdaptor().post_cdrs([entry['cdr'] for entry in batch])
+        return response.status_code == 201
+
+    def _failed_batch(self, batch):
+        ids = [entry['_id'] for entry in batch]
+        attempts = max([entry['attempts'] for entry in batch]) + 1
+
+        if attempts < getattr(settings, 'CDR_MAX_ATTEMPTS', 10):
+            self._collection.update_many({'_id': {'$in': ids}}, {
+                '$set': {
+                    'attempts': attempts,
+                    'next_attempt': datetime.utcnow() + timedelta(seconds=self._get_backoff(attempts))
+                }
+            })
+        else:
+            # The providers of the batch are blocked until the CDRs are
+            # retried with the resend_cdrs command
+            self._collection.update_many({'_id': {'$in': ids}}, {'$set': {'state': 'failed', 'attempts': attempts}})
+
+    def _get_failed_providers(self):
+        return self._collection.distinct('provider', {'state': 'failed'})
+
+    def _get_blocked_providers(self, now):
+        # Providers whose pending CDRs are waiting for a retry
+        waiting = self._collection.distinct('provider', {'state': 'pending', 'next_attempt': {'$gt': now}})
+        return list(set(waiting) | set(self._get_failed_providers()))
+
+    def _get_next_delay(self):
+        # The CDRs of the providers with failed CDRs are not sent until they are retried
+        next_entry = self._collection.find_one({
+            'state': 'pending',
+            'provider': {'$nin': self._get_failed_providers()}
+        }, sort=[('next_attempt', ASCENDING)])
+
+        if next_entry is None:
+            return None
+
+        if next_entry.get('next_attempt') is None:
+            return 0
+
+        return max((next_entry['next_attempt'] - datetime.utcnow()).total_seconds(), 0)
+
+    def dispatch(self):
+        """
+        Sends the pending CDRs in batches until there are not CDRs ready to be sent
+        :return: Number of seconds until the next retry, None if the outbox is empty
+        """
+        lock = DistributedLock(OUTBOX_COLLECTION, 'dispatcher', '_lock', create=True)
+
+        # Other process is dispatching, check again later in case it has already
+        # read the outbox when new CDRs were included
+        if not lock.acquire(blocking=False):
+            return getattr(settings, 'DEADLINE_POLL_INTERVAL', 5)
+
+        batch_size = getattr(settings, 'CDR_BATCH_SIZE', 100)
+        try:
+            while True:
+                now = datetime.utcnow()
+
+                # CDRs of the same provider are sent in correlation order, skipping the
+                # providers blocked by a previous CDR
+                batch = list(self._collection.find({
+                    'state': 'pending',
+                    'next_attempt': {'$not': {'$gt': now}},
+                    'provider': {'$nin': self._get_blocked_providers(now)}
+                }).sort([
+                    ('provider', ASCENDING), ('correlation', ASCENDING)
+                ]).limit(batch_size))
+
+                if not len(batch):
+                    break
+
+                try:
+                    sent = self._send_batch(batch)
+                except Exception:
+                    sent = False
+
+                if not sent:
+                    self._failed_batch(batch)
+                else:
+                    self._collection.delete_many({'_id': {'$in': [entry['_id'] for entry in batch]}})
+
+                lock.renew()
+        finally:
+            lock.release()
+
+        return self._get_next_delay()
+
+    def get_metrics(self):
+        """
+        Returns the depth of the outbox
+        """
+        metrics = {
+            'pending': self._collection.count({'state': 'pending'}),
+            'failed': self._collection.count({'state': 'failed'}),
+            'providers': {},
+            'blocked': self._get_failed_providers(),
+            'oldest': None
+        }
+
+        for group in self._collection.aggregate([
+                {'$match': {'state': 'pending'}},
+                {'$group': {'_id': '$provider', 'count': {'$sum': 1}}}]):
+            metrics['providers'][group['_id']] = group['count']
+
+        oldest = self._collection.find_one({'state': 'pending'}, sort=[('created', ASCENDING)])
+        if oldest is not None:
+            metrics['oldest'] = oldest['created']
+
+        return metrics
+
+
+def cdr_dispatch_handler(ref, data):
+    """
+    Deadline handler that delivers the CDRs of the outbox
+    """
+    outbox = CDROutbox()
+    delay = outbox.dispatch()
+
+    if delay is not None:
+        outbox._schedule_dispatch(delay)
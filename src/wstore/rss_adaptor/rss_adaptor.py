@@ -20,30 +20,38 @@
 
 from __future__ import unicode_literals
 
-import requests
-import threading
 from bson import ObjectId
 
 from django.conf import settings
 
 from wstore.store_commons.database import get_database_connection
-from wstore.models import Context, Organization
+from wstore.store_commons import http_client
 
 
-class RSSAdaptorThread(threading.Thread):
+def reserve_correlation_numbers(provider_pk, count):
+    """
+    Atomically reserves a block of consecutive correlation numbers of a provider
+    :param provider_pk: pk of the provider organization
+    :param count: Number of correlation numbers to be reserved
+    :return: First correlation number of the reserved block
+    """
+    db = get_database_connection()
 
-    def __init__(self, cdr_info):
-        threading.Thread.__init__(self)
-        self.cdr = cdr_info
-
-    def run(self):
-        r = RSSAdaptor()
-        r.send_cdr(self.cdr)
+    # The document is returned before the update, so the block starts
+    # in the previous correlation number
+    return db.wstore_organization.find_and_modify(
+        query={'_id': ObjectId(provider_pk)},
+        update={'$inc': {'correlation_number': count}}
+    )['correlation_number']
 
 
 class RSSAdaptor:
 
-    def send_cdr(self, cdr_info):
+    def post_cdrs(self, cdr_info):
+        """
+        Sends a list of CDRs to the RSS in a single request
+        :return: The response of the RSS
+        """
         # Build CDRs
         data = []
         for cdr in cdr_info:
@@ -79,18 +87,4 @@ class RSSAdaptor:
             'X-Email': settings.WSTOREMAIL
         }
 
-        response = requests.post(url, json=data, headers=headers)
-
-        if response.status_code != 201:
-            db = get_database_connection()
-            # Restore correlation numbers
-            for cdr in cdr_info:
-                org = Organization.objects.get(name=cdr['provider'])
-                db.wstore_organization.find_and_modify(
-                    query={'_id': ObjectId(org.pk)},
-                    update={'$inc': {'correlation_number': -1}}
-                )['correlation_number']
-
-            context = Context.objects.all()[0]
-            context.failed_cdrs.extend(cdr_info)
-            context.save()
+        return http_client.post(url, json=data, headers=headers)
@@ -20,10 +20,10 @@
 
 from __future__ import unicode_literals
 
-import requests
-
 from django.conf import settings
 
+from wstore.store_commons import http_client
+
 
 class RSSManager(object):
 
@@ -51,8 +51,8 @@ class RSSManager(object):
         }
 
         methods = {
-            'POST': requests.post,
-            'PUT': requests.put
+            'POST': http_client.post,
+            'PUT': http_client.put
         }
 
         response = methods[method](url, json=data, headers=headers)
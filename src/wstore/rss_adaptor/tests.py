@@ -23,14 +23,16 @@ from __future__ import unicode_literals
 from bson import ObjectId
 
 from copy import deepcopy
+from datetime import datetime, timedelta
 from mock import MagicMock
 from mock import call
 from nose_parameterized import parameterized
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.conf import settings
 
-from wstore.rss_adaptor import rss_adaptor, rss_manager, model_manager
+from wstore.rss_adaptor import rss_adaptor, rss_manager, model_manager, cdr_outbox
 
 
 class RSSAdaptorTestCase(TestCase):
@@ -42,23 +44,17 @@ class RSSAdaptorTestCase(TestCase):
         settings.RSS = 'http://testhost.com/rssHost/'
         settings.STORE_NAME = 'wstore'
 
-        rss_adaptor.requests = MagicMock()
+        rss_adaptor.http_client = MagicMock()
         self._response = MagicMock()
-        rss_adaptor.requests.post.return_value = self._response
+        rss_adaptor.http_client.post.return_value = self._response
 
-        # Mocks for fail responses
-        rss_adaptor.get_database_connection = MagicMock()
-        rss_adaptor.Organization = MagicMock()
-        rss_adaptor.Organization.objects.get().pk = b"111111111111"
-        rss_adaptor.Context = MagicMock()
+    def tearDown(self):
+        reload(rss_adaptor)
 
     def test_rss_client(self):
-        # Create mocks
-        self._response.status_code = 201
-
         rss_ad = rss_adaptor.RSSAdaptor()
 
-        rss_ad.send_cdr([{
+        response = rss_ad.post_cdrs([{
             'provider': 'test_provider',
             'correlation': '2',
             'order': '1234567890',
@@ -74,7 +70,7 @@ class RSSAdaptorTestCase(TestCase):
             'type': 'C'
         }])
 
-        rss_adaptor.requests.post.assert_called_once_with(
+        rss_adaptor.http_client.post.assert_called_once_with(
             'http://testhost.com/rssHost/rss/cdrs', json=[{
                 'cdrSource': 'testmail@mail.com',
                 'productClass': 'SaaS',
@@ -98,40 +94,184 @@ class RSSAdaptorTestCase(TestCase):
                 'X-Email': 'testmail@mail.com'
             })
 
-        rss_adaptor.get_database_connection.assert_not_called()
-        rss_adaptor.Context.objects.all.assert_not_called()
+        self.assertEquals(self._response, response)
 
-    def test_rss_remote_error(self):
-        # Create Mocks
-        self._response.status_code = 500
 
-        cdr = {
-            'provider': 'test_provider',
-            'correlation': '2',
-            'order': '1234567890',
-            'offering': 'test_offering',
-            'product_class': 'SaaS',
-            'description': 'The description',
-            'cost_currency': 'EUR',
-            'cost_value': '10',
-            'tax_value': '0.0',
-            'time_stamp': '10-05-13T10:00:00Z',
-            'customer': 'test_customer',
-            'event': 'One time',
-            'type': 'C'
+class CorrelationNumberTestCase(TestCase):
+
+    tags = ('rss-adaptor',)
+
+    def setUp(self):
+        rss_adaptor.get_database_connection = MagicMock()
+        self._db = rss_adaptor.get_database_connection()
+
+    def tearDown(self):
+        reload(rss_adaptor)
+
+    def test_reserve_correlation_numbers(self):
+        self._db.wstore_organization.find_and_modify.return_value = {'correlation_number': 10}
+
+        first = rss_adaptor.reserve_correlation_numbers('111111111111111111111111', 3)
+
+        self.assertEquals(10, first)
+        self._db.wstore_organization.find_and_modify.assert_called_once_with(
+            query={'_id': ObjectId('111111111111111111111111')},
+            update={'$inc': {'correlation_number': 3}}
+        )
+
+
+class CDROutboxTestCase(TestCase):
+
+    tags = ('rss-adaptor', 'cdr-outbox')
+
+    def setUp(self):
+        self._now = datetime(2017, 10, 30, 10, 0, 0)
+        self._collection = MagicMock()
+        cdr_outbox.get_database_connection = MagicMock()
+        cdr_outbox.get_database_connection().__getitem__.return_value = self._collection
+
+        cdr_outbox.datetime = MagicMock()
+        cdr_outbox.datetime.utcnow.return_value = self._now
+        cdr_outbox.schedule_deadline = MagicMock()
+        cdr_outbox.RSSAdaptor = MagicMock()
+
+        self._lock = MagicMock()
+        self._lock.acquire.return_value = True
+        cdr_outbox.DistributedLock = MagicMock(return_value=self._lock)
+
+        self._collection.distinct.return_value = []
+        self._collection.find_one.return_value = None
+
+    def tearDown(self):
+        reload(cdr_outbox)
+
+    def _get_entry(self, id_, attempts=0):
+        return {
+            '_id': id_,
+            'cdr': {'provider': 'provider', 'correlation': id_},
+            'provider': 'provider',
+            'correlation': int(id_),
+            'state': 'pending',
+            'attempts': attempts
         }
-        cdrs = [cdr, cdr]
 
-        rss_ad = rss_adaptor.RSSAdaptor()
-        rss_ad.send_cdr(cdrs)
-
-        # Decrement correlation number for every cdr
-        calls = call(query={'_id': ObjectId(b"111111111111")}, update={'$inc': {'correlation_number': -1}})
-        rss_adaptor.get_database_connection().wstore_organization.find_and_modify.assert_has_calls([calls, calls], any_order=True)
-        # Save the failed cdrs
-        rss_adaptor.Context.objects.all.assert_called_once_with()
-        rss_adaptor.Context.objects.all()[0].failed_cdrs.extend.assert_called_once_with(cdrs)
-        rss_adaptor.Context.objects.all()[0].save.assert_called_once_with()
+    def test_enqueue(self):
+        outbox = cdr_outbox.CDROutbox()
+        outbox.enqueue([{'provider': 'provider', 'correlation': '1'}, {'provider': 'provider', 'correlation': '2'}])
+
+        self._collection.insert_many.assert_called_once_with([{
+            'cdr': {'provider': 'provider', 'correlation': '1'},
+            'provider': 'provider',
+            'correlation': 1,
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': self._now,
+            'created': self._now
+        }, {
+            'cdr': {'provider': 'provider', 'correlation': '2'},
+            'provider': 'provider',
+            'correlation': 2,
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': self._now,
+            'created': self._now
+        }], ordered=False)
+
+        # A retry already scheduled is not brought forward
+        cdr_outbox.schedule_deadline.assert_called_once_with('cdr_dispatch', 'outbox', 0, keep_due=True)
+
+    def test_enqueue_empty(self):
+        outbox = cdr_outbox.CDROutbox()
+        outbox.enqueue([])
+
+        self.assertEquals(0, self._collection.insert_many.call_count)
+        self.assertEquals(0, cdr_outbox.schedule_deadline.call_count)
+
+    @override_settings(CDR_BATCH_SIZE=2)
+    def test_dispatch(self):
+        batches = [[self._get_entry('1'), self._get_entry('2')], [self._get_entry('3')], []]
+        self._collection.find().sort().limit.side_effect = batches
+        cdr_outbox.RSSAdaptor().post_cdrs.return_value = MagicMock(status_code=201)
+
+        cdr_outbox.cdr_dispatch_handler('outbox', {})
+
+        self._collection.find.assert_called_with({
+            'state': 'pending',
+            'next_attempt': {'$not': {'$gt': self._now}},
+            'provider': {'$nin': []}
+        })
+        self._collection.find().sort.assert_called_with([('provider', 1), ('correlation', 1)])
+        self._collection.find().sort().limit.assert_called_with(2)
+
+        self.assertEquals([
+            call([{'provider': 'provider', 'correlation': '1'}, {'provider': 'provider', 'correlation': '2'}]),
+            call([{'provider': 'provider', 'correlation': '3'}])
+        ], cdr_outbox.RSSAdaptor().post_cdrs.call_args_list)
+
+        self.assertEquals([
+            call({'_id': {'$in': ['1', '2']}}),
+            call({'_id': {'$in': ['3']}})
+        ], self._collection.delete_many.call_args_list)
+
+        cdr_outbox.DistributedLock.assert_called_once_with('wstore_cdr_outbox', 'dispatcher', '_lock', create=True)
+        self._lock.release.assert_called_once_with()
+        self.assertEquals(0, cdr_outbox.schedule_deadline.call_count)
+
+    def test_dispatch_error(self):
+        self._collection.find().sort().limit.side_effect = [[self._get_entry('1', attempts=2)], []]
+        cdr_outbox.RSSAdaptor().post_cdrs.return_value = MagicMock(status_code=500)
+
+        entry = self._get_entry('1', attempts=3)
+        entry['next_attempt'] = self._now + timedelta(seconds=120)
+        self._collection.find_one.return_value = entry
+
+        cdr_outbox.cdr_dispatch_handler('outbox', {})
+
+        self._collection.update_many.assert_called_once_with({'_id': {'$in': ['1']}}, {
+            '$set': {'attempts': 3, 'next_attempt': self._now + timedelta(seconds=120)}
+        })
+        self.assertEquals(0, self._collection.delete_many.call_count)
+        self._lock.release.assert_called_once_with()
+
+        # The dispatch is retried when the CDRs are due
+        cdr_outbox.schedule_deadline.assert_called_once_with('cdr_dispatch', 'outbox', 120, keep_due=False)
+
+    def test_dispatch_discard(self):
+        self._collection.find().sort().limit.side_effect = [[self._get_entry('1', attempts=9)], []]
+        cdr_outbox.RSSAdaptor().post_cdrs.side_effect = Exception('Connection error')
+
+        cdr_outbox.cdr_dispatch_handler('outbox', {})
+
+        self._collection.update_many.assert_called_once_with({'_id': {'$in': ['1']}}, {'$set': {'state': 'failed', 'attempts': 10}})
+        self.assertEquals(0, cdr_outbox.schedule_deadline.call_count)
+
+    def test_dispatch_blocked_providers(self):
+        def distinct(field, query):
+            return ['failed_provider'] if query['state'] == 'failed' else ['waiting_provider']
+
+        self._collection.distinct.side_effect = distinct
+        self._collection.find().sort().limit.side_effect = [[]]
+
+        cdr_outbox.cdr_dispatch_handler('outbox', {})
+
+        # The CDRs of the providers waiting for a retry or with failed CDRs are not sent
+        query = self._collection.find.call_args[0][0]
+        self.assertEquals(set(['failed_provider', 'waiting_provider']), set(query['provider']['$nin']))
+        self.assertEquals(0, cdr_outbox.RSSAdaptor().post_cdrs.call_count)
+
+        # Providers with failed CDRs are not considered for the next dispatch
+        self._collection.find_one.assert_called_once_with({
+            'state': 'pending',
+            'provider': {'$nin': ['failed_provider']}
+        }, sort=[('next_attempt', 1)])
+
+    def test_dispatch_locked(self):
+        self._lock.acquire.return_value = False
+
+        cdr_outbox.cdr_dispatch_handler('outbox', {})
+
+        self.assertEquals(0, cdr_outbox.RSSAdaptor().post_cdrs.call_count)
+        cdr_outbox.schedule_deadline.assert_called_once_with('cdr_dispatch', 'outbox', 5, keep_due=False)
 
 
 BASIC_MODEL = {
@@ -20,63 +20,460 @@
 
 from __future__ import unicode_literals
 
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo import monitoring
+from pymongo.errors import DuplicateKeyError
 
 from django.conf import settings
 
+from wstore.store_commons.errors import LockTimeoutError
+
+
+class _PoolStatsListener(monitoring.CommandListener):
+    """
+    Command listener used to keep track of the activity of the shared client
+    """
+
+    def __init__(self, stats):
+        self._stats = stats
+
+    def started(self, event):
+        self._stats.inc('commands_started')
+        self._stats.inc('in_flight')
+
+    def succeeded(self, event):
+        self._stats.inc('commands_succeeded')
+        self._stats.inc('in_flight', -1)
+
+    def failed(self, event):
+        self._stats.inc('commands_failed')
+        self._stats.inc('in_flight', -1)
+
+
+class _PoolStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._counters = {
+            'clients_created': 0,
+            'connection_requests': 0,
+            'thread_handles': 0,
+            'forks_detected': 0,
+            'commands_started': 0,
+            'commands_succeeded': 0,
+            'commands_failed': 0,
+            'in_flight': 0
+        }
+
+    def inc(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] += value
+
+    def to_dict(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class _ClientRegistry(object):
+    """
+    Process wide registry of MongoDB clients. The client is created lazily the first
+    time it is needed and it is recreated if the process has been forked, since
+    pymongo clients cannot be shared between parent and child processes
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._client = None
+        self._db_name = None
+        self._pid = None
+        self._generation = 0
+        self.stats = _PoolStats()
+
+    def _get_client_options(self):
+        return {
+            'maxPoolSize': getattr(settings, 'MONGO_MAX_POOL_SIZE', 100),
+            'connectTimeoutMS': getattr(settings, 'MONGO_CONNECT_TIMEOUT_MS', 20000),
+            'socketTimeoutMS': getattr(settings, 'MONGO_SOCKET_TIMEOUT_MS', None),
+            'serverSelectionTimeoutMS': getattr(settings, 'MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000),
+            'waitQueueTimeoutMS': getattr(settings, 'MONGO_WAIT_QUEUE_TIMEOUT_MS', None),
+            'event_listeners': [_PoolStatsListener(self.stats)]
+        }
+
+    def _create_client(self):
+        # Get database info from settings
+        database_info = settings.DATABASES['default']
+        options = self._get_client_options()
+
+        # Create database connection
+        if database_info['HOST'] and database_info['PORT']:
+            client = MongoClient(database_info['HOST'], int(database_info['PORT']), **options)
+        elif database_info['HOST'] and not database_info['PORT']:
+            client = MongoClient(database_info['HOST'], **options)
+        elif not database_info['HOST'] and database_info['PORT']:
+            client = MongoClient('localhost', int(database_info['PORT']), **options)
+        else:
+            client = MongoClient(**options)
+
+        db_name = database_info['NAME']
+
+        # Authenticate if needed, credentials are cached by the client so
+        # this is only required once per client
+        if database_info['USER'] and database_info['PASSWORD']:
+            client[db_name].authenticate(database_info['USER'], database_info['PASSWORD'], mechanism='MONGODB-CR')
+
+        self.stats.inc('clients_created')
+        return client, db_name
+
+    def _check_fork(self):
+        pid = os.getpid()
+
+        if self._pid is not None and self._pid != pid:
+            # The process has been forked, the parent client and its lock
+            # cannot be used in the child
+            self._lock = threading.Lock()
+            self._client = None
+            self._pid = None
+            self.stats.inc('forks_detected')
+
+        return pid
+
+    def get_database(self):
+        pid = self._check_fork()
+        self.stats.inc('connection_requests')
+
+        # Reuse the database handle of the current thread if it belongs to the current client
+        if getattr(self._local, 'generation', None) == self._generation and \
+                getattr(self._local, 'pid', None) == pid and self._client is not None:
+            return self._local.db
+
+        with self._lock:
+            if self._client is None:
+                self._client, self._db_name = self._create_client()
+                self._pid = pid
+                self._generation += 1
+
+            db = self._client[self._db_name]
+            generation = self._generation
+
+        self._local.db = db
+        self._local.pid = pid
+        self._local.generation = generation
+        self.stats.inc('thread_handles')
+
+        return db
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+
+            self._client = None
+            self._pid = None
+            self._generation += 1
+
+    def get_stats(self):
+        stats = self.stats.to_dict()
+        stats['active'] = self._client is not None and self._pid == os.getpid()
+        stats['max_pool_size'] = getattr(settings, 'MONGO_MAX_POOL_SIZE', 100)
+        return stats
+
+
+_registry = _ClientRegistry()
+
 
 def get_database_connection():
     """
-    Gets a raw database connection to MongoDB
+    Gets a raw database connection to MongoDB. The underlying client is shared
+    by all the threads of the process
+    """
+    return _registry.get_database()
+
+
+def close_database_connection():
+    """
+    Closes the shared MongoDB client of the current process
     """
-    # Get database info from settings
-    database_info = settings.DATABASES['default']
+    _registry.close()
+
 
-    client = None
-    # Create database connection
-    if database_info['HOST'] and database_info['PORT']:
-        client = MongoClient(database_info['HOST'], int(database_info['PORT']))
-    elif database_info['HOST'] and not database_info['PORT']:
-        client = MongoClient(database_info['HOST'])
-    elif not database_info['HOST'] and database_info['PORT']:
-        client = MongoClient('localhost', int(database_info['PORT']))
-    else:
-        client = MongoClient()
+def get_database_pool_stats():
+    """
+    Returns usage statistics of the shared MongoDB client
+    """
+    return _registry.get_stats()
 
-    db_name = database_info['NAME']
-    db = client[db_name]
 
-    # Authenticate if needed
-    if database_info['USER'] and database_info['PASSWORD']:
-        db.authenticate(database_info['USER'], database_info['PASSWORD'], mechanism='MONGODB-CR')
+class _LockMetrics(object):
+    """
+    Wait and hold time statistics of the distributed locks used in the process
+    """
 
-    return db
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
 
+    def _get_entry(self, name):
+        if name not in self._metrics:
+            self._metrics[name] = {
+                'acquired': 0,
+                'contended': 0,
+                'timeouts': 0,
+                'lost': 0,
+                'deleted': 0,
+                'legacy': 0,
+                'wait_time': 0.0,
+                'max_wait_time': 0.0,
+                'hold_time': 0.0,
+                'max_hold_time': 0.0
+            }
+        return self._metrics[name]
 
-class DocumentLock:
+    def inc(self, name, counter):
+        with self._lock:
+            self._get_entry(name)[counter] += 1
 
-    def __init__(self, collection, doc_id, lock_id):
+    def record_time(self, name, kind, value):
+        with self._lock:
+            entry = self._get_entry(name)
+            entry[kind + '_time'] += value
+            entry['max_' + kind + '_time'] = max(entry['max_' + kind + '_time'], value)
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+
+    def to_dict(self):
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._metrics.iteritems()}
+
+
+_lock_metrics = _LockMetrics()
+
+
+def get_lock_metrics():
+    """
+    Returns lock wait and hold time metrics grouped by collection and lock field
+    """
+    return _lock_metrics.to_dict()
+
+
+# Owner of the boolean locks written by previous versions once they are given a lease
+LEGACY_OWNER = 'legacy'
+
+
+class DistributedLock(object):
+    """
+    Lock stored in a field of a MongoDB document. The lock is acquired with an expiring
+    lease so a crashed holder cannot keep the document locked forever. Every acquisition
+    increments a fencing token stored in the document. Renewals, releases and the updates
+    made through the lock are only applied if the lease still belongs to the current owner
+    and no other owner has acquired the lock since, according to the fencing token.
+
+    Boolean locks written by previous versions carry no lease, they may still be held by
+    a process running the previous version, so they are given a full lease the first time
+    they are found and they can only be taken over once it expires.
+    """
+
+    def __init__(self, collection, doc_id, lock_field, lease=None, create=False):
         self._collection = collection
-        self._doc_id = doc_id
-        self._lock_id = '_lock_{}'.format(lock_id)
+        self._doc_id = ObjectId(doc_id) if ObjectId.is_valid(doc_id) else doc_id
+        self._field = lock_field
+        self._fence_field = lock_field + '_fence'
+        self._lease = lease if lease is not None else getattr(settings, 'DOCUMENT_LOCK_LEASE', 300)
+        self._create = create
         self._db = get_database_connection()
+        self._name = collection + '.' + lock_field
 
-    def lock_document(self):
-        prev = self._db[self._collection].find_one_and_update(
-            {'_id': ObjectId(self._doc_id)},
-            {'$set': {self._lock_id: True}}
-        )
-        return self._lock_id in prev and prev[self._lock_id]
+        self.owner = None
+        self.token = None
+        self.document = None
+        self._acquired_at = None
+
+    def _new_owner(self):
+        return '{}:{}:{}:{}'.format(socket.gethostname(), os.getpid(), threading.current_thread().ident, uuid4().hex)
+
+    def _try_acquire(self):
+        now = datetime.utcnow()
+        owner = self._new_owner()
+
+        query = {
+            '_id': self._doc_id,
+            '$or': [
+                {self._field: {'$exists': False}},
+                {self._field: {'$in': [False, None]}},
+                {self._field + '.expires': {'$lt': now}}
+            ]
+        }
+        update = {
+            '$set': {
+                self._field: {
+                    'owner': owner,
+                    'acquired': now,
+                    'expires': now + timedelta(seconds=self._lease)
+                }
+            },
+            '$inc': {self._fence_field: 1}
+        }
+
+        try:
+            doc = self._db[self._collection].find_one_and_update(
+                query, update, upsert=self._create, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # The document exists, but the lock is held by other owner
+            doc = None
+
+        if doc is None:
+            self._expire_legacy_lock(now)
+            return False
+
+        self.owner = owner
+        self.token = doc.get(self._fence_field)
+        self.document = doc
+        self._acquired_at = time.time()
+        return True
+
+    def _expire_legacy_lock(self, now):
+        result = self._db[self._collection].update_one({'_id': self._doc_id, self._field: True}, {
+            '$set': {
+                self._field: {
+                    'owner': LEGACY_OWNER,
+                    'acquired': now,
+                    'expires': now + timedelta(seconds=self._lease)
+                }
+            }
+        })
+
+        if result.modified_count:
+            _lock_metrics.inc(self._name, 'legacy')
 
-    def wait_document(self):
-        locked = self.lock_document()
+    def _get_owner_filter(self):
+        return {
+            '_id': self._doc_id,
+            self._field + '.owner': self.owner,
+            self._fence_field: self.token
+        }
+
+    def _get_backoff(self, attempt):
+        base = getattr(settings, 'DOCUMENT_LOCK_BACKOFF', 0.05)
+        max_delay = getattr(settings, 'DOCUMENT_LOCK_MAX_BACKOFF', 2.0)
+
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(max_delay, base * (2 ** attempt)))
+
+    def acquire(self, blocking=True, timeout=None):
+        """
+        Acquires the lock
+        :param blocking: Whether to wait until the lock is released by its current holder
+        :param timeout: Maximum number of seconds to wait, None to wait indefinitely
+        :return: True if the lock has been acquired, False otherwise
+        """
+        start = time.time()
+        attempt = 0
+
+        while not self._try_acquire():
+            _lock_metrics.inc(self._name, 'contended')
+
+            elapsed = time.time() - start
+            if not blocking or (timeout is not None and elapsed >= timeout):
+                if blocking:
+                    _lock_metrics.inc(self._name, 'timeouts')
+                return False
+
+            delay = self._get_backoff(attempt)
+            if timeout is not None:
+                delay = min(delay, timeout - elapsed)
+
+            time.sleep(delay)
+            attempt += 1
+
+        _lock_metrics.inc(self._name, 'acquired')
+        _lock_metrics.record_time(self._name, 'wait', time.time() - start)
+        return True
+
+    def renew(self, lease=None):
+        """
+        Extends the lease of a held lock
+        :return: False if the lease has been lost
+        """
+        lease = lease if lease is not None else self._lease
+        return self.update({'$set': {self._field + '.expires': datetime.utcnow() + timedelta(seconds=lease)}})
+
+    def update(self, update):
+        """
+        Updates the locked document, the update is only applied if the lock has not
+        been lost since it was acquired
+        :param update: MongoDB update document
+        :return: False if the lease has been lost
+        """
+        if self.owner is None:
+            return False
+
+        result = self._db[self._collection].update_one(self._get_owner_filter(), update)
+
+        updated = result.matched_count > 0
+        if not updated:
+            _lock_metrics.inc(self._name, 'lost')
+
+        return updated
+
+    def release(self):
+        """
+        Releases the lock if it is still owned by the current holder
+        """
+        if self.owner is None:
+            return
+
+        result = self._db[self._collection].update_one(self._get_owner_filter(), {'$set': {self._field: False}})
+
+        if result.matched_count == 0:
+            if self._db[self._collection].find_one({'_id': self._doc_id}, {'_id': True}) is None:
+                # The document has been removed by the holder, there is nothing to release
+                _lock_metrics.inc(self._name, 'deleted')
+            else:
+                # The lease expired and the lock was taken by other owner
+                _lock_metrics.inc(self._name, 'lost')
+
+        _lock_metrics.record_time(self._name, 'hold', time.time() - self._acquired_at)
+        self.owner = None
+        self._acquired_at = None
+
+    def __enter__(self):
+        if not self.acquire(timeout=getattr(settings, 'DOCUMENT_LOCK_TIMEOUT', None)):
+            raise LockTimeoutError('Timeout waiting for lock ' + self._field + ' of ' + unicode(self._doc_id))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class DocumentLock(DistributedLock):
+
+    def __init__(self, collection, doc_id, lock_id, lease=None):
+        super(DocumentLock, self).__init__(collection, doc_id, '_lock_{}'.format(lock_id), lease=lease)
+
+    def lock_document(self):
+        """
+        Tries to lock the document once
+        :return: True if the document was already locked
+        """
+        return not self.acquire(blocking=False)
 
-        while locked:
-            locked = self.lock_document()
+    def wait_document(self, timeout=None):
+        if not self.acquire(timeout=timeout):
+            raise LockTimeoutError('Timeout waiting for document ' + unicode(self._doc_id))
 
     def unlock_document(self):
-        self._db[self._collection].find_one_and_update(
-            {'_id': ObjectId(self._doc_id)},
-            {'$set': {self._lock_id: False}}
-        )
+        self.release()
@@ -42,3 +42,14 @@ class RepositoryError(Exception):
 
     def __str__(self):
         return self.value
+
+
+class LockTimeoutError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __unicode__(self):
+        return self.value
+
+    def __str__(self):
+        return self.value
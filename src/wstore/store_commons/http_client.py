@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import os
+import re
+import threading
+import time
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.conf import settings
+
+
+# Only idempotent requests are retried when the connection fails while reading
+# the response or the server is temporally unavailable
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+RETRY_STATUS = (502, 503, 504)
+
+# Path segments identifying single resources, grouped in the metrics
+_ID_SEGMENT = re.compile('^(\d+|[0-9a-fA-F-]{16,})$')
+
+_session_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+def _build_retry(**kwargs):
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26 only supports the deprecated name of the parameter
+        return Retry(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+def _build_session():
+    retries = _build_retry(
+        total=getattr(settings, 'HTTP_MAX_RETRIES', 3),
+        backoff_factor=getattr(settings, 'HTTP_RETRY_BACKOFF', 0.5),
+        status_forcelist=RETRY_STATUS,
+        raise_on_status=False
+    )
+
+    # A connection pool is kept per host, pool_connections is the number of hosts
+    adapter = HTTPAdapter(
+        pool_connections=getattr(settings, 'HTTP_POOL_CONNECTIONS', 10),
+        pool_maxsize=getattr(settings, 'HTTP_POOL_MAXSIZE', 20),
+        max_retries=retries
+    )
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _check_fork():
+    global _session, _session_lock, _session_pid
+
+    pid = os.getpid()
+
+    if _session_pid is not None and _session_pid != pid:
+        # The process has been forked, the pooled sockets of the parent and
+        # its lock cannot be used in the child
+        _session_lock = threading.Lock()
+        _session = None
+        _session_pid = None
+
+    return pid
+
+
+def get_session():
+    """
+    Returns the keep-alive session shared by all the API clients of the process.
+    The session is created again if the process has been forked
+    """
+    global _session, _session_pid
+
+    pid = _check_fork()
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+                _session_pid = pid
+
+    return _session
+
+
+def close_session():
+    """
+    Closes the pooled connections, a new session is created in the next request
+    """
+    global _session, _session_pid
+
+    with _session_lock:
+        # The connections of a parent process are not closed from a child
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+
+        _session = None
+        _session_pid = None
+
+
+class _LatencyMetrics(object):
+    """
+    Accumulates the latency of the requests made to every endpoint. Endpoints are
+    identified by method, host and path, with resource ids replaced by {id}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _get_endpoint(self, method, url):
+        parsed_url = urlparse(url)
+        path = '/'.join(['{id}' if _ID_SEGMENT.match(segment) else segment for segment in parsed_url.path.split('/')])
+        return '{} {}{}'.format(method.upper(), parsed_url.netloc, path)
+
+    def record(self, method, url, elapsed, failed):
+        endpoint = self._get_endpoint(method, url)
+
+        with self._lock:
+            metric = self._endpoints.setdefault(endpoint, {
+                'count': 0,
+                'errors': 0,
+                'total_time': 0.0,
+                'max_time': 0.0
+            })
+
+            metric['count'] += 1
+            metric['total_time'] += elapsed
+            metric['max_time'] = max(metric['max_time'], elapsed)
+
+            if failed:
+                metric['errors'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict([(endpoint, {
+                'count': metric['count'],
+                'errors': metric['errors'],
+                'avg_time': metric['total_time'] / metric['count'],
+                'max_time': metric['max_time']
+            }) for endpoint, metric in self._endpoints.iteritems()])
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+_metrics = _LatencyMetrics()
+
+
+def get_metrics():
+    """
+    Returns the latency metrics of the endpoints used by the process
+    :return: Dict with the count, errors, average and max time in seconds by endpoint
+    """
+    return _metrics.snapshot()
+
+
+def reset_metrics():
+    _metrics.reset()
+
+
+def request(method, url, **kwargs):
+    """
+    Makes an HTTP request using the shared session. Accepts the same arguments
+    as requests, using the configured timeouts when not provided
+    """
+    kwargs.setdefault('timeout', (
+        getattr(settings, 'HTTP_CONNECT_TIMEOUT', 5),
+        getattr(settings, 'HTTP_READ_TIMEOUT', 30)
+    ))
+
+    start = time.time()
+    failed = True
+    try:
+        response = get_session().request(method, url, **kwargs)
+        failed = response.status_code >= 500
+        return response
+    finally:
+        _metrics.record(method, url, time.time() - start, failed)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    return request('POST', url, data=data, json=json, **kwargs)
+
+
+def put(url, data=None, **kwargs):
+    return request('PUT', url, data=data, **kwargs)
+
+
+def patch(url, data=None, **kwargs):
+    return request('PATCH', url, data=data, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
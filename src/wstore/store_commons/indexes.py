@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from pymongo import ASCENDING
+
+from wstore.asset_manager.models import Resource
+from wstore.charging_engine.models import ReportSemiPaid
+from wstore.models import Organization
+from wstore.ordering.models import Order, Offering
+from wstore.store_commons.database import get_database_connection
+
+
+# Indexes required by the lookups made in the hot paths
+INDEXES = [
+    (Order, [('order_id', ASCENDING)]),
+    (Order, [('contracts.next_due', ASCENDING)]),
+    (Order, [('contracts.product_id', ASCENDING)]),
+    (Offering, [('off_id', ASCENDING)]),
+    (Resource, [('download_link', ASCENDING)]),
+    (Resource, [('product_id', ASCENDING)]),
+    (Resource, [('resource_path', ASCENDING)]),
+    (Resource, [('provider_id', ASCENDING), ('state', ASCENDING)]),
+    (Organization, [('name', ASCENDING)]),
+    (ReportSemiPaid, [('report', ASCENDING)])
+]
+
+# Critical lookups whose query plans are checked, the plan does not depend on the values
+LOOKUPS = [
+    (Order, {'order_id': ''}),
+    (Order, {'contracts.next_due': {'$lte': 0}}),
+    (Order, {'contracts.product_id': '', 'order_id': ''}),
+    (Offering, {'off_id': ''}),
+    (Resource, {'download_link': ''}),
+    (Resource, {'product_id': ''}),
+    (Resource, {'resource_path': ''}),
+    (Resource, {'provider_id': '', 'state': ''}),
+    (Organization, {'name': ''}),
+    (ReportSemiPaid, {'report': 0})
+]
+
+
+def _get_collection(model):
+    return get_database_connection()[model._meta.db_table]
+
+
+def _has_index(collection, keys):
+    # Indexes created with other options, like the unique ones, are also valid
+    return any([index['key'] == keys for index in collection.index_information().values()])
+
+
+def get_missing_indexes():
+    """
+    Returns the declared indexes that do not exist in the database
+    :return: List of (collection name, keys) tuples
+    """
+    missing = []
+    for model, keys in INDEXES:
+        collection = _get_collection(model)
+
+        if not _has_index(collection, keys):
+            missing.append((collection.name, keys))
+
+    return missing
+
+
+def ensure_indexes():
+    """
+    Creates the declared indexes that do not exist yet
+    :return: List of (collection name, keys) tuples of the created indexes
+    """
+    created = []
+    for model, keys in INDEXES:
+        collection = _get_collection(model)
+
+        if not _has_index(collection, keys):
+            # Indexes are built in background in order not to block the database
+            collection.create_index(keys, background=True)
+            created.append((collection.name, keys))
+
+    return created
+
+
+def _summarize_plan(plan):
+    stages = []
+    while plan is not None:
+        stage = plan['stage']
+        if 'indexName' in plan:
+            stage += ' ' + plan['indexName']
+
+        stages.append(stage)
+        plan = plan.get('inputStage')
+
+    return stages
+
+
+def explain_lookups():
+    """
+    Returns the query plans of the critical lookups
+    :return: List of (collection name, query, stages, uses_index) tuples
+    """
+    plans = []
+    for model, query in LOOKUPS:
+        collection = _get_collection(model)
+        explain = collection.find(query).limit(1).explain()
+
+        stages = _summarize_plan(explain['queryPlanner']['winningPlan'])
+        plans.append((collection.name, query, stages, 'COLLSCAN' not in stages))
+
+    return plans
@@ -21,6 +21,11 @@
 
 from __future__ import unicode_literals
 
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
 from django.utils.importlib import import_module
 from django.utils.functional import SimpleLazyObject
 from django.utils.http import http_date, parse_http_date_safe
@@ -125,6 +130,101 @@ class URLMiddleware(object):
                 return response
 
 
+class _IdentityCache(object):
+    """
+    Bounded LRU cache of the identities already synchronized with the database. Entries
+    are keyed by the proxy supplied headers, so any change in them is a cache miss
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None or entry['expires'] < time.time():
+                return None
+
+            # Move the entry to the end, so it is the most recently used
+            self._entries[key] = entry
+            return entry
+
+    def set(self, key, user_id, org_id):
+        from django.conf import settings
+
+        ttl = getattr(settings, 'IDENTITY_CACHE_TTL', 300)
+        max_size = getattr(settings, 'IDENTITY_CACHE_SIZE', 1000)
+
+        if ttl <= 0 or max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                'user_id': user_id,
+                'org_id': org_id,
+                'expires': time.time() + ttl
+            }
+
+            # Evict least recently used entries
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_identity_cache = _IdentityCache()
+
+
+def _get_cached_user(key, token, user_roles):
+    from wstore.models import User
+
+    entry = _identity_cache.get(key)
+    if entry is None:
+        return None
+
+    try:
+        user = User.objects.get(pk=entry['user_id'])
+    except:
+        _identity_cache.invalidate(key)
+        return None
+
+    # The stored state matches the headers, the request values are only
+    # set in memory in case they have been modified by other process
+    user.userprofile.access_token = token
+    user.userprofile.current_roles = user_roles
+
+    # Other requests of the user may have selected a different organization, the
+    # one of the request is restored so the user never acts as other organization
+    if user.userprofile.current_organization_id != entry['org_id']:
+        user.userprofile.current_organization_id = entry['org_id']
+        user.userprofile.save()
+
+    return user
+
+
+def _update_fields(instance, values):
+    """
+    Sets the provided values in a model instance
+    :return: True if any of the values has been modified
+    """
+    modified = False
+    for field, value in values.iteritems():
+        if getattr(instance, field) != value:
+            setattr(instance, field, value)
+            modified = True
+
+    return modified
+
+
 def get_api_user(request):
     from django.contrib.auth.models import AnonymousUser
     from django.conf import settings
@@ -144,44 +244,64 @@ def get_api_user(request):
     if len(token_info) != 2 and token_info[0].lower() != 'bearer':
         return AnonymousUser()
 
+    user_roles = []
+
+    if settings.PROVIDER_ROLE in roles:
+        user_roles.append('provider')
+
+    if settings.CUSTOMER_ROLE in roles:
+        user_roles.append('customer')
+
+    # The access token is not kept in memory as part of the key
+    token_hash = hashlib.sha256(token_info[1].encode('utf-8')).hexdigest()
+    cache_key = (user_name, nick_name, display_name, email, tuple(roles), token_hash)
+    user = _get_cached_user(cache_key, token_info[1], user_roles)
+
+    if user is not None:
+        return user
+
     # Check if the user already exist
     try:
         user = User.objects.get(username=user_name)
     except:
         user = User.objects.create(username=user_name)
 
+    profile_modified = False
     if nick_name == user_name:
         # Update user info
-        user.email = email
-        user.userprofile.complete_name = display_name
-        user.userprofile.actor_id = nick_name
-        user.is_staff = settings.ADMIN_ROLE.lower() in roles
-        user.save()
-
-    user.userprofile.access_token = token_info[1]
-    
-    user_roles = []
+        profile_modified = _update_fields(user.userprofile, {
+            'complete_name': display_name,
+            'actor_id': nick_name
+        })
 
-    if settings.PROVIDER_ROLE in roles:
-        user_roles.append('provider')
-
-    if settings.CUSTOMER_ROLE in roles:
-        user_roles.append('customer')
+        if _update_fields(user, {'email': email, 'is_staff': settings.ADMIN_ROLE.lower() in roles}):
+            user.save()
 
     # Get or create current organization
     try:
         org = Organization.objects.get(name=nick_name)
+        org_created = False
     except:
         org = Organization.objects.create(name=nick_name)
+        org_created = True
 
-    org.private = nick_name == user_name
-    org.save()
+    if _update_fields(org, {'private': nick_name == user_name}) or org_created:
+        org.save()
 
-    user.userprofile.current_roles = user_roles
-    user.userprofile.current_organization = org
+    profile_modified = _update_fields(user.userprofile, {
+        'access_token': token_info[1],
+        'current_roles': user_roles
+    }) or profile_modified
 
     # change user.userprofile.current_organization
-    user.userprofile.save()
+    if user.userprofile.current_organization_id != org.pk:
+        user.userprofile.current_organization = org
+        profile_modified = True
+
+    if profile_modified:
+        user.userprofile.save()
+
+    _identity_cache.set(cache_key, user.pk, org.pk)
 
     return user
 
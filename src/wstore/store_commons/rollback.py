@@ -40,6 +40,7 @@ def downgrade_asset(asset):
     asset.download_link = prev_version.download_link
     asset.meta_info = prev_version.meta_info
     asset.content_type = prev_version.content_type
+    asset.content_hash = prev_version.content_hash
     asset.state = 'attached'
     asset.save()
 
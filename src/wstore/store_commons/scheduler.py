@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import importlib
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from pymongo import ASCENDING, ReturnDocument
+
+from django.conf import settings
+
+from wstore.store_commons.database import get_database_connection
+
+
+DEADLINE_COLLECTION = 'wstore_deadline'
+
+
+class DeadlineScheduler(object):
+    """
+    Durable scheduler of deadlines. Deadlines are stored in MongoDB indexed by its due date,
+    so they survive worker restarts, and are processed in batches by a single loop per process
+    (or by the process_deadlines command) using the handler registered for its kind
+    """
+
+    def __init__(self, handlers=None):
+        self._handlers = handlers
+        self._loaded_handlers = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._indexes_pid = None
+
+    def _get_collection(self):
+        collection = get_database_connection()[DEADLINE_COLLECTION]
+
+        # Indexes are created once per process
+        if self._indexes_pid != os.getpid():
+            collection.create_index([('state', ASCENDING), ('due', ASCENDING)])
+            collection.create_index([('kind', ASCENDING), ('ref', ASCENDING)], unique=True)
+            self._indexes_pid = os.getpid()
+
+        return collection
+
+    def _get_handler(self, kind):
+        if kind not in self._loaded_handlers:
+            handlers = self._handlers if self._handlers is not None else getattr(settings, 'DEADLINE_HANDLERS', {})
+
+            if kind not in handlers:
+                raise ValueError('There is not any handler registered for deadlines of kind ' + kind)
+
+            handler = handlers[kind]
+            if not callable(handler):
+                handler_package, handler_func = handler.rsplit('.', 1)
+                handler = getattr(importlib.import_module(handler_package), handler_func)
+
+            self._loaded_handlers[kind] = handler
+
+        return self._loaded_handlers[kind]
+
+    def _new_owner(self):
+        return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid4().hex)
+
+    def schedule(self, kind, ref, delay, data=None, keep_due=False):
+        """
+        Schedules a deadline, an existing deadline of the same kind and reference is replaced.
+        The failed attempts of an existing deadline are kept, so its retries are not reset
+        :param kind: Kind of the deadline, used to select its handler
+        :param ref: Reference of the object the deadline applies to
+        :param delay: Number of seconds until the deadline is due
+        :param data: Extra info provided to the handler
+        :param keep_due: If True, the due date of an existing deadline is not modified
+        """
+        update = {
+            '$set': {
+                'data': data or {},
+                'state': 'pending',
+                'owner': None,
+                'lease_expires': None
+            },
+            '$setOnInsert': {
+                'attempts': 0
+            }
+        }
+
+        due = datetime.utcnow() + timedelta(seconds=delay)
+        if keep_due:
+            update['$setOnInsert']['due'] = due
+        else:
+            update['$set']['due'] = due
+
+        self._get_collection().update_one({
+            'kind': kind,
+            'ref': ref
+        }, update, upsert=True)
+
+    def cancel(self, kind, ref):
+        self._get_collection().delete_one({
+            'kind': kind,
+            'ref': ref
+        })
+
+    def _claim(self, collection, owner, now):
+        lease = getattr(settings, 'DEADLINE_LEASE', 300)
+
+        # Deadlines claimed by a process that died while running them are claimed again
+        return collection.find_one_and_update({
+            '$or': [
+                {'state': 'pending', 'due': {'$lte': now}},
+                {'state': 'running', 'lease_expires': {'$lt': now}}
+            ]
+        }, {
+            '$set': {
+                'state': 'running',
+                'owner': owner,
+                'lease_expires': now + timedelta(seconds=lease)
+            }
+        }, sort=[('due', ASCENDING)], return_document=ReturnDocument.AFTER)
+
+    def claim_due(self, batch_size=None):
+        """
+        Atomically claims a batch of due deadlines
+        :return: List of claimed deadlines
+        """
+        if batch_size is None:
+            batch_size = getattr(settings, 'DEADLINE_BATCH_SIZE', 50)
+
+        collection = self._get_collection()
+        owner = self._new_owner()
+        now = datetime.utcnow()
+
+        claimed = []
+        while len(claimed) < batch_size:
+            deadline = self._claim(collection, owner, now)
+
+            if deadline is None:
+                break
+
+            claimed.append(deadline)
+
+        return claimed
+
+    def _fail(self, collection, deadline, error):
+        attempts = deadline.get('attempts', 0) + 1
+        update = {
+            'attempts': attempts,
+            'error': unicode(error),
+            'owner': None,
+            'lease_expires': None
+        }
+
+        if attempts < getattr(settings, 'DEADLINE_MAX_ATTEMPTS', 5):
+            update['state'] = 'pending'
+            update['due'] = datetime.utcnow() + timedelta(seconds=getattr(settings, 'DEADLINE_RETRY_DELAY', 60) * attempts)
+        else:
+            update['state'] = 'failed'
+
+        collection.update_one({'_id': deadline['_id'], 'owner': deadline['owner']}, {'$set': update})
+
+    def process_due(self, batch_size=None):
+        """
+        Runs the handlers of a batch of due deadlines
+        :return: Number of processed deadlines
+        """
+        collection = self._get_collection()
+        deadlines = self.claim_due(batch_size=batch_size)
+
+        for deadline in deadlines:
+            try:
+                self._get_handler(deadline['kind'])(deadline['ref'], deadline.get('data', {}))
+            except Exception as e:
+                self._fail(collection, deadline, e)
+            else:
+                # The deadline is only removed if it has not been rescheduled while running
+                collection.delete_one({'_id': deadline['_id'], 'owner': deadline['owner']})
+
+        return len(deadlines)
+
+    def _run(self):
+        interval = getattr(settings, 'DEADLINE_POLL_INTERVAL', 5)
+
+        while not self._stop_event.is_set():
+            try:
+                processed = self.process_due()
+            except Exception:
+                # Database errors must not kill the loop, the batch will be claimed again
+                processed = 0
+
+            # Keep processing while there are due deadlines
+            if processed == 0:
+                self._stop_event.wait(interval)
+
+    def start(self):
+        """
+        Starts the scheduler loop of the current process if it is not already running
+        """
+        with self._lock:
+            pid = os.getpid()
+
+            # Threads are not inherited by forked processes
+            if self._thread is not None and self._pid == pid and self._thread.is_alive():
+                return
+
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='deadline-scheduler')
+            self._thread.daemon = True
+            self._pid = pid
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stop_event.set()
+            self._thread = None
+            self._pid = None
+
+
+_scheduler = DeadlineScheduler()
+
+
+def get_scheduler():
+    return _scheduler
+
+
+def schedule_deadline(kind, ref, delay, data=None, keep_due=False):
+    """
+    Schedules a deadline and makes sure that the current process is running the scheduler loop
+    """
+    _scheduler.schedule(kind, ref, delay, data=data, keep_due=keep_due)
+
+    if getattr(settings, 'DEADLINE_SCHEDULER_ENABLED', True):
+        _scheduler.start()
+
+
+def cancel_deadline(kind, ref):
+    _scheduler.cancel(kind, ref)
@@ -20,15 +20,20 @@
 
 from __future__ import unicode_literals
 
+import os
+import threading
+from datetime import datetime, timedelta
+
 from bson import ObjectId
-from mock import MagicMock, call
+from pymongo import ReturnDocument, ASCENDING
+from mock import MagicMock, call, ANY
 from nose_parameterized import parameterized
 
 from django.contrib.auth.models import AnonymousUser
 from django.test.utils import override_settings
 from django.test import TestCase
 
-from wstore.store_commons import middleware, rollback, database
+from wstore.store_commons import middleware, rollback, database, scheduler, indexes, http_client
 from wstore.store_commons.utils.url import is_valid_url
 
 __test__ = False
@@ -64,9 +69,12 @@ class AuthenticationMiddlewareTestCase(TestCase):
 
         wstore.models.Organization = self._org_model
 
+        middleware._identity_cache.clear()
+
     def tearDown(self):
         import wstore.models
         reload(wstore.models)
+        middleware._identity_cache.clear()
 
     def _new_user(self):
         self._user_model.objects.get.side_effect = Exception('Not found')
@@ -153,6 +161,120 @@ class AuthenticationMiddlewareTestCase(TestCase):
 
         self.assertFalse(self._org_instance.private)
         self._org_instance.save.assert_called_once_with()
+
+    def _set_stored_state(self):
+        self.request.META['HTTP_X_ROLES'] = 'seller'
+        self.request.META['HTTP_AUTHORIZATION'] = 'Bearer 1234567890abcdf'
+        self.request.META['HTTP_X_EMAIL'] = 'user@email.com'
+
+        self._user_inst.pk = 'user_id'
+        self._user_inst.email = 'user@email.com'
+        self._user_inst.is_staff = False
+        self._user_inst.userprofile.complete_name = 'Test user'
+        self._user_inst.userprofile.actor_id = 'test-user'
+        self._user_inst.userprofile.access_token = '1234567890abcdf'
+        self._user_inst.userprofile.current_roles = ['provider']
+        self._user_inst.userprofile.current_organization_id = 'org'
+        self._org_instance.private = True
+
+    def _check_no_writes(self):
+        self.assertEquals(0, self._user_inst.save.call_count)
+        self.assertEquals(0, self._user_inst.userprofile.save.call_count)
+        self.assertEquals(0, self._org_instance.save.call_count)
+
+    def test_get_api_user_not_modified(self):
+        self._set_stored_state()
+
+        user = middleware.get_api_user(self.request)
+
+        self.assertEquals(self._user_inst, user)
+        self._check_no_writes()
+
+    def test_get_api_user_token_modified(self):
+        self._set_stored_state()
+        self.request.META['HTTP_AUTHORIZATION'] = 'Bearer newtoken'
+
+        middleware.get_api_user(self.request)
+
+        self.assertEquals('newtoken', self._user_inst.userprofile.access_token)
+        self._user_inst.userprofile.save.assert_called_once_with()
+        self.assertEquals(0, self._user_inst.save.call_count)
+        self.assertEquals(0, self._org_instance.save.call_count)
+
+    def test_get_api_user_cached(self):
+        self._set_stored_state()
+
+        middleware.get_api_user(self.request)
+        self._user_model.objects.get.reset_mock()
+
+        user = middleware.get_api_user(self.request)
+
+        self.assertEquals(self._user_inst, user)
+        self._user_model.objects.get.assert_called_once_with(pk='user_id')
+        self.assertEquals(0, self._org_model.objects.get.call_count)
+        self._check_no_writes()
+
+        # A different header value is a cache miss
+        self.request.META['HTTP_X_EMAIL'] = 'new@email.com'
+        middleware.get_api_user(self.request)
+
+        self._user_model.objects.get.assert_called_with(username='test-user')
+        self.assertEquals('new@email.com', self._user_inst.email)
+        self._user_inst.save.assert_called_once_with()
+
+    def test_get_api_user_cached_organization(self):
+        self._set_stored_state()
+
+        middleware.get_api_user(self.request)
+
+        # Other request of the user has selected a different organization
+        self._user_inst.userprofile.current_organization_id = 'other_org'
+
+        user = middleware.get_api_user(self.request)
+
+        self.assertEquals('org', user.userprofile.current_organization_id)
+        user.userprofile.save.assert_called_once_with()
+
+    def test_get_api_user_cache_key(self):
+        self._set_stored_state()
+
+        middleware.get_api_user(self.request)
+
+        # The raw access token is not used in the cache key
+        keys = list(middleware._identity_cache._entries)
+        self.assertEquals(1, len(keys))
+        self.assertFalse('1234567890abcdf' in keys[0])
+
+    @override_settings(IDENTITY_CACHE_SIZE=2)
+    def test_identity_cache_eviction(self):
+        cache = middleware._IdentityCache()
+
+        cache.set('key1', 'user1', 'org1')
+        cache.set('key2', 'user2', 'org2')
+
+        # Access the first key so the second one is evicted
+        cache.get('key1')
+        cache.set('key3', 'user3', 'org3')
+
+        self.assertEquals('user1', cache.get('key1')['user_id'])
+        self.assertEquals(None, cache.get('key2'))
+        self.assertEquals('user3', cache.get('key3')['user_id'])
+
+    @override_settings(IDENTITY_CACHE_TTL=60)
+    def test_identity_cache_expiration(self):
+        middleware.time = MagicMock()
+        middleware.time.time.return_value = 1000
+
+        cache = middleware._IdentityCache()
+        cache.set('key', 'user', 'org')
+
+        middleware.time.time.return_value = 1059
+        self.assertEquals('user', cache.get('key')['user_id'])
+
+        middleware.time.time.return_value = 1061
+        self.assertEquals(None, cache.get('key'))
+
+        reload(middleware)
         self._user_inst.userprofile.save.assert_called_once_with()
 
 
@@ -285,6 +407,95 @@ class RollbackTestCase(TestCase):
         rollback.downgrade_asset_pa(manager())
 
 
+@override_settings(DATABASES={
+    'default': {
+        'NAME': 'test_db',
+        'HOST': 'db_host',
+        'PORT': '27017',
+        'USER': 'user',
+        'PASSWORD': 'passwd'
+    }
+}, MONGO_MAX_POOL_SIZE=10)
+class DatabaseConnectionTestCase(TestCase):
+    tags = ('database',)
+
+    def setUp(self):
+        self._client = MagicMock()
+        self._db = MagicMock()
+        self._client.__getitem__.return_value = self._db
+
+        database.MongoClient = MagicMock(return_value=self._client)
+        database.os = MagicMock()
+        database.os.getpid.return_value = 100
+
+        self._old_registry = database._registry
+        database._registry = database._ClientRegistry()
+
+    def tearDown(self):
+        reload(database)
+        database._registry = self._old_registry
+
+    def test_connection_reused(self):
+        db1 = database.get_database_connection()
+        db2 = database.get_database_connection()
+
+        self.assertEquals(self._db, db1)
+        self.assertEquals(self._db, db2)
+
+        database.MongoClient.assert_called_once_with(
+            'db_host', 27017, maxPoolSize=10, connectTimeoutMS=20000, socketTimeoutMS=None,
+            serverSelectionTimeoutMS=30000, waitQueueTimeoutMS=None, event_listeners=ANY)
+
+        self._client.__getitem__.assert_called_with('test_db')
+        self._db.authenticate.assert_called_once_with('user', 'passwd', mechanism='MONGODB-CR')
+
+        stats = database.get_database_pool_stats()
+        self.assertEquals(1, stats['clients_created'])
+        self.assertEquals(2, stats['connection_requests'])
+        self.assertEquals(1, stats['thread_handles'])
+        self.assertEquals(10, stats['max_pool_size'])
+        self.assertTrue(stats['active'])
+
+    def test_connection_fork(self):
+        database.get_database_connection()
+
+        # Simulate the process being forked
+        database.os.getpid.return_value = 200
+        database.get_database_connection()
+
+        self.assertEquals(2, database.MongoClient.call_count)
+
+        stats = database.get_database_pool_stats()
+        self.assertEquals(2, stats['clients_created'])
+        self.assertEquals(1, stats['forks_detected'])
+
+    def test_close_connection(self):
+        database.get_database_connection()
+        database.close_database_connection()
+
+        self._client.close.assert_called_once_with()
+        self.assertFalse(database.get_database_pool_stats()['active'])
+
+        database.get_database_connection()
+        self.assertEquals(2, database.MongoClient.call_count)
+
+    def test_pool_listener(self):
+        stats = database._PoolStats()
+        listener = database._PoolStatsListener(stats)
+
+        listener.started(MagicMock())
+        listener.started(MagicMock())
+        listener.succeeded(MagicMock())
+
+        self.assertEquals(2, stats.to_dict()['commands_started'])
+        self.assertEquals(1, stats.to_dict()['commands_succeeded'])
+        self.assertEquals(1, stats.to_dict()['in_flight'])
+
+        listener.failed(MagicMock())
+        self.assertEquals(1, stats.to_dict()['commands_failed'])
+        self.assertEquals(0, stats.to_dict()['in_flight'])
+
+
 class DocumentLockTestCase(TestCase):
     tags = ('lock',)
 
@@ -293,27 +504,624 @@ class DocumentLockTestCase(TestCase):
     _lock_id = '_lock_test'
 
     def setUp(self):
+        self._now = datetime(2017, 10, 30, 10, 0, 0)
         self._connection = MagicMock()
+        self._connection[self._collection].find_one_and_update.return_value = {
+            '_id': ObjectId(self._id),
+            self._lock_id + '_fence': 3
+        }
+
         database.get_database_connection = MagicMock(return_value=self._connection)
+        database.datetime = MagicMock()
+        database.datetime.utcnow.return_value = self._now
+        database.time = MagicMock()
+        database.time.time.return_value = 10.0
+        database.random = MagicMock()
+        database.random.uniform.return_value = 0.05
+        database.uuid4 = MagicMock()
+        database.uuid4().hex = 'uuid'
+        database.socket = MagicMock()
+        database.socket.gethostname.return_value = 'host'
+
+        database._lock_metrics.reset()
+
+    def tearDown(self):
+        database._lock_metrics.reset()
+        old_registry = database._registry
+        reload(database)
+        database._registry = old_registry
+
+    def _get_owner(self):
+        return 'host:{}:{}:uuid'.format(os.getpid(), threading.current_thread().ident)
+
+    def _check_acquire_call(self, call_args, upsert=False):
+        self.assertEquals(call(
+            {
+                '_id': ObjectId(self._id),
+                '$or': [
+                    {self._lock_id: {'$exists': False}},
+                    {self._lock_id: {'$in': [False, None]}},
+                    {self._lock_id + '.expires': {'$lt': self._now}}
+                ]
+            }, {
+                '$set': {
+                    self._lock_id: {
+                        'owner': self._get_owner(),
+                        'acquired': self._now,
+                        'expires': self._now + timedelta(seconds=300)
+                    }
+                },
+                '$inc': {self._lock_id + '_fence': 1}
+            }, upsert=upsert, return_document=ReturnDocument.AFTER), call_args)
 
     def test_wait_for_document(self):
-        self._connection[self._collection].find_one_and_update.side_effect = [{self._lock_id: True}, {self._lock_id: False}]
+        self._connection[self._collection].find_one_and_update.side_effect = [None, {
+            '_id': ObjectId(self._id),
+            self._lock_id + '_fence': 4
+        }]
 
         lock = database.DocumentLock(self._collection, self._id, 'test')
         lock.wait_document()
 
         # Check database calls
-        self.assertEquals([
-            call({'_id': ObjectId(self._id)}, {'$set': {self._lock_id: True}}),
-            call({'_id': ObjectId(self._id)}, {'$set': {self._lock_id: True}})
-        ], self._connection[self._collection].find_one_and_update.call_args_list)
+        calls = self._connection[self._collection].find_one_and_update.call_args_list
+        self.assertEquals(2, len(calls))
+        self._check_acquire_call(calls[0])
+        self._check_acquire_call(calls[1])
+
+        database.random.uniform.assert_called_once_with(0, 0.05)
+        database.time.sleep.assert_called_once_with(0.05)
+
+        self.assertEquals(self._get_owner(), lock.owner)
+        self.assertEquals(4, lock.token)
+
+        metrics = database.get_lock_metrics()[self._collection + '.' + self._lock_id]
+        self.assertEquals(1, metrics['acquired'])
+        self.assertEquals(1, metrics['contended'])
+
+    def test_lock_document_locked(self):
+        self._connection[self._collection].find_one_and_update.return_value = None
+        self._connection[self._collection].update_one.return_value = MagicMock(modified_count=0)
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        self.assertTrue(lock.lock_document())
+        self.assertEquals(None, lock.owner)
+        self.assertFalse(database.time.sleep.called)
+        self.assertEquals(0, database.get_lock_metrics()[self._collection + '.' + self._lock_id]['legacy'])
+
+    def test_lock_document_legacy(self):
+        self._connection[self._collection].find_one_and_update.return_value = None
+        self._connection[self._collection].update_one.return_value = MagicMock(modified_count=1)
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        self.assertTrue(lock.lock_document())
+
+        # The boolean lock is given a lease instead of being taken over
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {'_id': ObjectId(self._id), self._lock_id: True}, {
+                '$set': {
+                    self._lock_id: {
+                        'owner': database.LEGACY_OWNER,
+                        'acquired': self._now,
+                        'expires': self._now + timedelta(seconds=300)
+                    }
+                }
+            })
+        self.assertEquals(1, database.get_lock_metrics()[self._collection + '.' + self._lock_id]['legacy'])
+
+    def test_wait_document_timeout(self):
+        self._connection[self._collection].find_one_and_update.return_value = None
+        database.time.time.side_effect = [10.0, 11.0, 12.5]
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+
+        error = None
+        try:
+            lock.wait_document(timeout=2)
+        except database.LockTimeoutError as e:
+            error = e
+
+        self.assertEquals('Timeout waiting for document ' + self._id, unicode(error))
+        self.assertEquals(2, self._connection[self._collection].find_one_and_update.call_count)
+
+        metrics = database.get_lock_metrics()[self._collection + '.' + self._lock_id]
+        self.assertEquals(1, metrics['timeouts'])
+
+    def test_create_lock_document(self):
+        lock = database.DistributedLock(self._collection, 'reference', '_lock_test', create=True)
+        self.assertTrue(lock.acquire(blocking=False))
+
+        call_args = self._connection[self._collection].find_one_and_update.call_args
+        self.assertEquals('reference', call_args[0][0]['_id'])
+        self.assertTrue(call_args[1]['upsert'])
+
+    def test_create_lock_document_locked(self):
+        self._connection[self._collection].find_one_and_update.side_effect = database.DuplicateKeyError('duplicated')
+
+        lock = database.DistributedLock(self._collection, 'reference', '_lock_test', create=True)
+        self.assertFalse(lock.acquire(blocking=False))
 
     def test_unlock_document(self):
+        self._connection[self._collection].update_one.return_value = MagicMock(matched_count=1)
+
         lock = database.DocumentLock(self._collection, self._id, 'test')
+        lock.lock_document()
         lock.unlock_document()
 
         # Check database calls
-        self._connection[self._collection].find_one_and_update.assert_called_once_with({'_id': ObjectId(self._id)}, {'$set': {self._lock_id: False}})
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {'_id': ObjectId(self._id), self._lock_id + '.owner': self._get_owner(), self._lock_id + '_fence': 3},
+            {'$set': {self._lock_id: False}})
+
+        self.assertEquals(None, lock.owner)
+        self.assertEquals(0, database.get_lock_metrics()[self._collection + '.' + self._lock_id]['lost'])
+
+    def test_unlock_document_not_acquired(self):
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        lock.unlock_document()
+
+        self.assertFalse(self._connection[self._collection].update_one.called)
+
+    def test_unlock_document_lost(self):
+        self._connection[self._collection].update_one.return_value = MagicMock(matched_count=0)
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        lock.lock_document()
+        lock.unlock_document()
+
+        metrics = database.get_lock_metrics()[self._collection + '.' + self._lock_id]
+        self.assertEquals(1, metrics['lost'])
+        self.assertEquals(0, metrics['deleted'])
+
+    def test_unlock_document_deleted(self):
+        self._connection[self._collection].update_one.return_value = MagicMock(matched_count=0)
+        self._connection[self._collection].find_one.return_value = None
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        lock.lock_document()
+        lock.unlock_document()
+
+        self._connection[self._collection].find_one.assert_called_once_with({'_id': ObjectId(self._id)}, {'_id': True})
+
+        metrics = database.get_lock_metrics()[self._collection + '.' + self._lock_id]
+        self.assertEquals(0, metrics['lost'])
+        self.assertEquals(1, metrics['deleted'])
+
+    @parameterized.expand([
+        ('held', 1, True),
+        ('lost', 0, False)
+    ])
+    def test_update_locked_document(self, name, matched, expected):
+        self._connection[self._collection].update_one.return_value = MagicMock(matched_count=matched)
+
+        lock = database.DistributedLock(self._collection, self._id, self._lock_id)
+        lock.acquire(blocking=False)
+
+        self.assertEquals(expected, lock.update({'$set': {'offset': 10}}))
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {'_id': ObjectId(self._id), self._lock_id + '.owner': self._get_owner(), self._lock_id + '_fence': 3},
+            {'$set': {'offset': 10}})
+
+        self.assertEquals(1 - matched, database.get_lock_metrics()[self._collection + '.' + self._lock_id]['lost'])
+
+    def test_renew_lock(self):
+        self._connection[self._collection].update_one.return_value = MagicMock(matched_count=1)
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        lock.lock_document()
+
+        self.assertTrue(lock.renew(60))
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {'_id': ObjectId(self._id), self._lock_id + '.owner': self._get_owner(), self._lock_id + '_fence': 3},
+            {'$set': {self._lock_id + '.expires': self._now + timedelta(seconds=60)}})
+
+    def test_lock_context_manager(self):
+        self._connection[self._collection].update_one.return_value = MagicMock(matched_count=1)
+
+        with database.DistributedLock(self._collection, self._id, self._lock_id) as lock:
+            self.assertEquals(3, lock.token)
+
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {'_id': ObjectId(self._id), self._lock_id + '.owner': self._get_owner(), self._lock_id + '_fence': 3},
+            {'$set': {self._lock_id: False}})
+
+
+class DeadlineSchedulerTestCase(TestCase):
+    tags = ('scheduler',)
+
+    def setUp(self):
+        self._now = datetime(2017, 10, 30, 10, 0, 0)
+        self._collection = MagicMock()
+        self._connection = MagicMock()
+        self._connection.__getitem__.return_value = self._collection
+
+        scheduler.get_database_connection = MagicMock(return_value=self._connection)
+        scheduler.datetime = MagicMock()
+        scheduler.datetime.utcnow.return_value = self._now
+        scheduler.uuid4 = MagicMock()
+        scheduler.uuid4().hex = 'uuid'
+        scheduler.socket = MagicMock()
+        scheduler.socket.gethostname.return_value = 'host'
+
+        self._handler = MagicMock()
+        self._scheduler = scheduler.DeadlineScheduler(handlers={
+            'payment_timeout': self._handler
+        })
+
+    def tearDown(self):
+        reload(scheduler)
+
+    def test_schedule_deadline(self):
+        self._scheduler.schedule('payment_timeout', 'order_id', 300, {'concept': 'initial'})
+
+        self._connection.__getitem__.assert_called_once_with('wstore_deadline')
+        self.assertEquals([
+            call([('state', 1), ('due', 1)]),
+            call([('kind', 1), ('ref', 1)], unique=True)
+        ], self._collection.create_index.call_args_list)
+
+        self._collection.update_one.assert_called_once_with({
+            'kind': 'payment_timeout',
+            'ref': 'order_id'
+        }, {
+            '$set': {
+                'due': self._now + timedelta(seconds=300),
+                'data': {'concept': 'initial'},
+                'state': 'pending',
+                'owner': None,
+                'lease_expires': None
+            },
+            '$setOnInsert': {
+                'attempts': 0
+            }
+        }, upsert=True)
+
+        # Indexes are only created once
+        self._scheduler.cancel('payment_timeout', 'order_id')
+        self.assertEquals(2, self._collection.create_index.call_count)
+        self._collection.delete_one.assert_called_once_with({
+            'kind': 'payment_timeout',
+            'ref': 'order_id'
+        })
+
+    def test_schedule_deadline_keep_due(self):
+        self._scheduler.schedule('payment_timeout', 'order_id', 0, keep_due=True)
+
+        # The due date is only set when the deadline is created
+        self._collection.update_one.assert_called_once_with({
+            'kind': 'payment_timeout',
+            'ref': 'order_id'
+        }, {
+            '$set': {
+                'data': {},
+                'state': 'pending',
+                'owner': None,
+                'lease_expires': None
+            },
+            '$setOnInsert': {
+                'attempts': 0,
+                'due': self._now
+            }
+        }, upsert=True)
+
+    def test_process_due(self):
+        owner = 'host:{}:uuid'.format(os.getpid())
+        deadline = {
+            '_id': 'deadline_id',
+            'kind': 'payment_timeout',
+            'ref': 'order_id',
+            'data': {'concept': 'initial'},
+            'owner': owner
+        }
+        self._collection.find_one_and_update.side_effect = [deadline, None]
+
+        processed = self._scheduler.process_due(batch_size=10)
+
+        self.assertEquals(1, processed)
+        self.assertEquals(2, self._collection.find_one_and_update.call_count)
+        self._collection.find_one_and_update.assert_called_with({
+            '$or': [
+                {'state': 'pending', 'due': {'$lte': self._now}},
+                {'state': 'running', 'lease_expires': {'$lt': self._now}}
+            ]
+        }, {
+            '$set': {
+                'state': 'running',
+                'owner': owner,
+                'lease_expires': self._now + timedelta(seconds=300)
+            }
+        }, sort=[('due', 1)], return_document=ReturnDocument.AFTER)
+
+        self._handler.assert_called_once_with('order_id', {'concept': 'initial'})
+        self._collection.delete_one.assert_called_once_with({'_id': 'deadline_id', 'owner': owner})
+
+    def test_process_due_batch_size(self):
+        self._collection.find_one_and_update.return_value = {
+            '_id': 'deadline_id',
+            'kind': 'payment_timeout',
+            'ref': 'order_id',
+            'owner': 'owner'
+        }
+
+        processed = self._scheduler.process_due(batch_size=3)
+
+        self.assertEquals(3, processed)
+        self.assertEquals(3, self._collection.find_one_and_update.call_count)
+        self.assertEquals(3, self._handler.call_count)
+
+    def _test_process_error(self, deadline, expected):
+        self._collection.find_one_and_update.side_effect = [deadline, None]
+        self._handler.side_effect = Exception('Handler error')
+
+        self._scheduler.process_due()
+
+        self.assertEquals(0, self._collection.delete_one.call_count)
+        self._collection.update_one.assert_called_once_with({
+            '_id': 'deadline_id',
+            'owner': 'owner'
+        }, {
+            '$set': expected
+        })
+
+    def test_process_due_retry(self):
+        self._test_process_error({
+            '_id': 'deadline_id',
+            'kind': 'payment_timeout',
+            'ref': 'order_id',
+            'owner': 'owner',
+            'attempts': 1
+        }, {
+            'attempts': 2,
+            'error': 'Handler error',
+            'owner': None,
+            'lease_expires': None,
+            'state': 'pending',
+            'due': self._now + timedelta(seconds=120)
+        })
+
+    def test_process_due_failed(self):
+        self._test_process_error({
+            '_id': 'deadline_id',
+            'kind': 'payment_timeout',
+            'ref': 'order_id',
+            'owner': 'owner',
+            'attempts': 4
+        }, {
+            'attempts': 5,
+            'error': 'Handler error',
+            'owner': None,
+            'lease_expires': None,
+            'state': 'failed'
+        })
+
+    def test_process_unknown_kind(self):
+        self._collection.find_one_and_update.side_effect = [{
+            '_id': 'deadline_id',
+            'kind': 'unknown',
+            'ref': 'ref',
+            'owner': 'owner'
+        }, None]
+
+        self._scheduler.process_due()
+
+        self.assertEquals(0, self._handler.call_count)
+        self.assertEquals(
+            'There is not any handler registered for deadlines of kind unknown',
+            self._collection.update_one.call_args[0][1]['$set']['error'])
+
+    def test_start_scheduler(self):
+        scheduler.threading = MagicMock()
+
+        self._scheduler.start()
+        self._scheduler.start()
+
+        scheduler.threading.Thread.assert_called_once_with(target=self._scheduler._run, name='deadline-scheduler')
+        scheduler.threading.Thread().start.assert_called_once_with()
+
+
+class IndexesTestCase(TestCase):
+
+    tags = ('database', 'indexes')
+
+    def setUp(self):
+        self._collections = {}
+
+        def get_collection(name):
+            if name not in self._collections:
+                collection = MagicMock()
+                collection.name = name
+                collection.index_information.return_value = {
+                    '_id_': {'key': [('_id', 1)]}
+                }
+                self._collections[name] = collection
+            return self._collections[name]
+
+        db = MagicMock()
+        db.__getitem__.side_effect = get_collection
+        indexes.get_database_connection = MagicMock(return_value=db)
+
+        indexes.INDEXES = [
+            (MagicMock(_meta=MagicMock(db_table='wstore_order')), [('order_id', ASCENDING)]),
+            (MagicMock(_meta=MagicMock(db_table='wstore_resource')), [('provider_id', ASCENDING), ('state', ASCENDING)])
+        ]
+
+    def tearDown(self):
+        reload(indexes)
+
+    def test_ensure_indexes(self):
+        # Existing indexes with other options are not created again
+        order_collection = indexes.get_database_connection()['wstore_order']
+        order_collection.index_information.return_value['order_id_1'] = {'key': [('order_id', 1)], 'unique': True}
+
+        created = indexes.ensure_indexes()
+
+        self.assertEquals([('wstore_resource', [('provider_id', ASCENDING), ('state', ASCENDING)])], created)
+        self.assertEquals(0, self._collections['wstore_order'].create_index.call_count)
+        self._collections['wstore_resource'].create_index.assert_called_once_with(
+            [('provider_id', ASCENDING), ('state', ASCENDING)], background=True)
+
+    def test_missing_indexes(self):
+        missing = indexes.get_missing_indexes()
+
+        self.assertEquals([
+            ('wstore_order', [('order_id', ASCENDING)]),
+            ('wstore_resource', [('provider_id', ASCENDING), ('state', ASCENDING)])
+        ], missing)
+        self.assertEquals(0, self._collections['wstore_order'].create_index.call_count)
+
+    def test_explain_lookups(self):
+        indexes.LOOKUPS = [
+            (MagicMock(_meta=MagicMock(db_table='wstore_order')), {'order_id': ''}),
+            (MagicMock(_meta=MagicMock(db_table='wstore_offering')), {'off_id': ''})
+        ]
+
+        order_collection = indexes.get_database_connection()['wstore_order']
+        order_collection.find.return_value.limit.return_value.explain.return_value = {
+            'queryPlanner': {
+                'winningPlan': {
+                    'stage': 'LIMIT',
+                    'inputStage': {
+                        'stage': 'FETCH',
+                        'inputStage': {'stage': 'IXSCAN', 'indexName': 'order_id_1'}
+                    }
+                }
+            }
+        }
+        offering_collection = indexes.get_database_connection()['wstore_offering']
+        offering_collection.find.return_value.limit.return_value.explain.return_value = {
+            'queryPlanner': {
+                'winningPlan': {
+                    'stage': 'LIMIT',
+                    'inputStage': {'stage': 'COLLSCAN'}
+                }
+            }
+        }
+
+        plans = indexes.explain_lookups()
+
+        self.assertEquals([
+            ('wstore_order', {'order_id': ''}, ['LIMIT', 'FETCH', 'IXSCAN order_id_1'], True),
+            ('wstore_offering', {'off_id': ''}, ['LIMIT', 'COLLSCAN'], False)
+        ], plans)
+        order_collection.find.assert_called_once_with({'order_id': ''})
+
+
+class HttpClientTestCase(TestCase):
+
+    tags = ('http-client', )
+
+    def setUp(self):
+        http_client.requests = MagicMock()
+        http_client.HTTPAdapter = MagicMock()
+        http_client.Retry = MagicMock()
+
+        self._session = http_client.requests.Session()
+        self._response = MagicMock(status_code=200)
+        self._session.request.return_value = self._response
+
+        http_client.time = MagicMock()
+        http_client.time.time.side_effect = [10.0, 10.5, 20.0, 22.0]
+
+    def tearDown(self):
+        reload(http_client)
+
+    @override_settings(HTTP_POOL_CONNECTIONS=5, HTTP_POOL_MAXSIZE=15, HTTP_MAX_RETRIES=2, HTTP_RETRY_BACKOFF=1)
+    def test_shared_session(self):
+        session = http_client.get_session()
+
+        self.assertEquals(self._session, session)
+        self.assertEquals(session, http_client.get_session())
+
+        http_client.Retry.assert_called_once_with(
+            total=2, backoff_factor=1, status_forcelist=(502, 503, 504),
+            allowed_methods=http_client.RETRY_METHODS, raise_on_status=False)
+
+        http_client.HTTPAdapter.assert_called_once_with(
+            pool_connections=5, pool_maxsize=15, max_retries=http_client.Retry())
+
+        self.assertEquals([
+            call('http://', http_client.HTTPAdapter()),
+            call('https://', http_client.HTTPAdapter())
+        ], session.mount.call_args_list)
+
+        http_client.close_session()
+        session.close.assert_called_once_with()
+        self.assertTrue(http_client._session is None)
+
+    def test_retry_old_urllib3(self):
+        retry = MagicMock()
+        http_client.Retry.side_effect = [TypeError('unexpected keyword argument'), retry]
+
+        http_client.get_session()
+
+        self.assertEquals([
+            call(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                 allowed_methods=http_client.RETRY_METHODS, raise_on_status=False),
+            call(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                 method_whitelist=http_client.RETRY_METHODS, raise_on_status=False)
+        ], http_client.Retry.call_args_list)
+        http_client.HTTPAdapter.assert_called_once_with(pool_connections=10, pool_maxsize=20, max_retries=retry)
+
+    def test_session_fork(self):
+        parent_session = MagicMock()
+        child_session = MagicMock()
+        http_client.requests.Session.side_effect = [parent_session, child_session]
+
+        http_client.os = MagicMock()
+        http_client.os.getpid.return_value = 100
+
+        self.assertEquals(parent_session, http_client.get_session())
+
+        # The session is created again in the forked process
+        http_client.os.getpid.return_value = 101
+        self.assertEquals(child_session, http_client.get_session())
+        self.assertEquals(child_session, http_client.get_session())
+
+        # The connections of the parent are not closed by the child
+        self.assertEquals(0, parent_session.close.call_count)
+
+    @override_settings(HTTP_CONNECT_TIMEOUT=2, HTTP_READ_TIMEOUT=10)
+    def test_request(self):
+        response = http_client.post('http://example.com/api/usage/', json={'status': 'Rated'}, headers={'Host': 'store'})
+
+        self.assertEquals(self._response, response)
+        self._session.request.assert_called_once_with(
+            'POST', 'http://example.com/api/usage/', data=None, json={'status': 'Rated'},
+            headers={'Host': 'store'}, timeout=(2, 10))
+
+    def test_request_timeout(self):
+        http_client.get('http://example.com/api/usage/', timeout=60)
+        self._session.request.assert_called_once_with('GET', 'http://example.com/api/usage/', timeout=60)
+
+    def test_metrics(self):
+        self._session.request.side_effect = [self._response, Exception('Connection error')]
+
+        http_client.get('http://example.com/DSProductCatalog/api/v2/productOffering/12?fields=id')
+
+        error = None
+        try:
+            http_client.patch('http://example.com/DSUsageManagement/api/v2/usage/58a4a6b3d5c6e1a2b3c4d5e6', json={})
+        except Exception as e:
+            error = e
+
+        self.assertEquals('Connection error', unicode(error))
+        self.assertEquals({
+            'GET example.com/DSProductCatalog/api/v2/productOffering/{id}': {
+                'count': 1,
+                'errors': 0,
+                'avg_time': 0.5,
+                'max_time': 0.5
+            },
+            'PATCH example.com/DSUsageManagement/api/v2/usage/{id}': {
+                'count': 1,
+                'errors': 1,
+                'avg_time': 2.0,
+                'max_time': 2.0
+            }
+        }, http_client.get_metrics())
+
+        http_client.reset_metrics()
+        self.assertEquals({}, http_client.get_metrics())
 
 
 class URLUtilsTestCase(TestCase):
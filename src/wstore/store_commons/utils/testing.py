@@ -64,6 +64,48 @@ def build_response_mock(request, code, msg):
     return response
 
 
+class _DeferredResult(object):
+
+    def __init__(self, func, args, kwargs):
+        self._task = (func, args, kwargs)
+        self._value = None
+        self._error = None
+
+    def get(self, timeout=None):
+        if self._task is not None:
+            func, args, kwargs = self._task
+            self._task = None
+
+            try:
+                self._value = func(*args, **kwargs)
+            except Exception as e:
+                self._error = e
+
+        if self._error is not None:
+            raise self._error
+
+        return self._value
+
+
+class ThreadPoolMock(object):
+    """
+    Synchronous mock for ThreadPool, tasks are executed when their result is requested
+    so calls are made in the same order as in a sequential execution
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes
+
+    def apply_async(self, func, args=(), kwds={}):
+        return _DeferredResult(func, args, kwds)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
 class HTTPResponseMock():
 
     data = None
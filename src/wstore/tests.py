@@ -69,46 +69,19 @@ class ServeMediaTestCase(TestCase):
         order_inst.owner_organization = self._org
         views.Order.objects.get.return_value = order_inst
 
-        # Mock offering
-        views.Offering = MagicMock()
-        self._offering_inst = MagicMock()
-        self._offering_inst.asset = self._asset_inst
-        views.Offering.objects.get.side_effect = [MagicMock(), self._offering_inst]
+        # Mock entitlements
+        views.has_asset_access = MagicMock(return_value=True)
+
+    def tearDown(self):
+        reload(views)
 
     def _validate_res_call(self):
         views.Resource.objects.filter.assert_called_once_with(resource_path=self._resource_path)
         self.assertEquals(0, views.Order.objects.get.call_count)
 
-    def _validate_off_call(self):
-        self._validate_res_call()
-        self.assertEquals([
-            call(pk='offpk1'),
-            call(pk='offpk2')
-        ], views.Offering.objects.get.call_args_list)
-
-    def _validate_bundle_call(self):
+    def _validate_acquired_call(self):
         self._validate_res_call()
-        self.assertEquals([
-            call(pk='offpk1'),
-            call(pk='offpk2'),
-            call(pk='offpk3'),
-            call(pk='offpk3'),
-            call(pk='offpk4'),
-            call(pk='offpk4')
-        ], views.Offering.objects.get.call_args_list)
-
-    def _validate_product_bundle_call(self):
-        views.Resource.objects.filter.assert_called_once_with(resource_path=self._resource_path)
-        self.assertEquals([
-            call(pk='prodpk1'),
-            call(pk='prodpk2')
-        ], views.Resource.objects.get.call_args_list)
-        self.assertEquals(0, views.Order.objects.get.call_count)
-
-        self.assertEquals([
-            call(pk='offpk1'),
-            call(pk='offpk2')
-        ], views.Offering.objects.get.call_args_list)
+        views.has_asset_access.assert_called_once_with(self._user.userprofile.current_organization, self._asset_inst)
 
     def _validate_upgrading_call(self):
         self.assertEquals([
@@ -159,8 +132,7 @@ class ServeMediaTestCase(TestCase):
 
     def _unauthorized(self):
         self._acquired()
-        views.Offering.objects.get.side_effect = [MagicMock(is_digital=False),
-                                                  MagicMock(is_digital=True, asset=MagicMock())]
+        views.has_asset_access.return_value = False
 
     def _not_loged(self):
         self._user.is_anonymous.return_value = True
@@ -170,23 +142,6 @@ class ServeMediaTestCase(TestCase):
 
     def _acquired(self):
         self._user.userprofile.current_organization = MagicMock()
-        self._user.userprofile.current_organization.acquired_offerings = ['offpk1', 'offpk2']
-
-    def _bundle_acquired(self):
-        self._acquired()
-        self._offering_inst = MagicMock(asset=None, bundled_offerings=['offpk3', 'offpk4'])
-
-        views.Offering.objects.get.side_effect = [MagicMock(), self._offering_inst,
-                                                  MagicMock(is_digital=True, asset=MagicMock()),
-                                                  MagicMock(is_digital=True, asset=MagicMock()),
-                                                  MagicMock(is_digital=True, asset=self._asset_inst),
-                                                  MagicMock(is_digital=True, asset=self._asset_inst)]
-
-    def _product_bundle_acquired(self):
-        self._acquired()
-        self._offering_inst.asset = MagicMock(bundled_assets=['prodpk1', 'prodpk2'])
-
-        views.Resource.objects.get.side_effect = [self._asset_inst, MagicMock(), self._asset_inst]
 
     def _upgrading(self):
         self._asset_inst.old_versions = [MagicMock(resource_path=self._resource_path)]
@@ -194,9 +149,7 @@ class ServeMediaTestCase(TestCase):
 
     @parameterized.expand([
         ('asset', 'assets/test_user', 'widget.wgt', _validate_res_call, _validate_serve, _expected_file),
-        ('asset_acquired', 'assets/test_user', 'widget.wgt', _validate_off_call, _validate_serve, _expected_file, _acquired),
-        ('asset_in_bundle', 'assets/test_user', 'widget.wgt', _validate_bundle_call, _validate_serve, _expected_file, _bundle_acquired),
-        ('asset_in_product_bundle', 'assets/test_user', 'widget.wgt', _validate_product_bundle_call, _validate_serve, _expected_file, _product_bundle_acquired),
+        ('asset_acquired', 'assets/test_user', 'widget.wgt', _validate_acquired_call, _validate_serve, _expected_file, _acquired),
         ('public_asset', 'assets/test_user', 'widget.wgt', _validate_res_call, _validate_serve, _expected_file, _public_asset),
         ('upgrading_asset', 'assets/test_user', 'widget.wgt', _validate_upgrading_call, _validate_serve, _expected_file, _upgrading),
         ('invoice', 'bills', '111111111111111111111111_userbill.pdf', _validate_order_call, _validate_xfile, 'bills/111111111111111111111111_userbill.pdf', _usexfiles),
@@ -208,7 +161,7 @@ class ServeMediaTestCase(TestCase):
             'result': 'error',
             'error': 'You must be authenticated to download the specified asset'
         }), _not_loged),
-        ('asset_unauthorized', 'assets/test_user', 'widget.wgt', _validate_res_call, _validate_error, (403, {
+        ('asset_unauthorized', 'assets/test_user', 'widget.wgt', _validate_acquired_call, _validate_error, (403, {
             'result': 'error',
             'error': 'You are not authorized to download the specified asset'
         }), _unauthorized),
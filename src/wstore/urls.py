@@ -34,6 +34,9 @@ urlpatterns = patterns('',
     # API
     url(r'^charging/api/assetManagement/assets/?$', offering_views.AssetCollection(permitted_methods=('GET',))),
     url(r'^charging/api/assetManagement/assets/uploadJob/?$', offering_views.UploadCollection(permitted_methods=('POST',))),
+    url(r'^charging/api/assetManagement/assets/uploadJob/sessions/?$', offering_views.UploadSessionCollection(permitted_methods=('POST',))),
+    url(r'^charging/api/assetManagement/assets/uploadJob/sessions/(?P<session_id>\w+)/?$', offering_views.UploadSessionEntry(permitted_methods=('GET', 'PUT', 'DELETE'))),
+    url(r'^charging/api/assetManagement/assets/uploadJob/sessions/(?P<session_id>\w+)/finalize/?$', offering_views.UploadSessionFinalizeCollection(permitted_methods=('POST',))),
     url(r'^charging/api/assetManagement/assets/validateJob/?$', offering_views.ValidateCollection(permitted_methods=('POST',))),
     url(r'^charging/api/assetManagement/assets/offeringJob/?$', offering_views.ValidateOfferingCollection(permitted_methods=('POST',))),
     url(r'^charging/api/assetManagement/assets/(?P<asset_id>\w+)/?$', offering_views.AssetEntry(permitted_methods=('GET',))),
@@ -51,6 +54,7 @@ urlpatterns = patterns('',
     url(r'^charging/api/orderManagement/products/?$', ordering_views.InventoryCollection(permitted_methods=('POST',))),
     url(r'^charging/api/orderManagement/products/renewJob/?$', ordering_views.RenovationCollection(permitted_methods=('POST',))),
     url(r'^charging/api/orderManagement/accounting/?$', accounting_views.ServiceRecordCollection(permitted_methods=('POST',))),
+    url(r'^charging/api/orderManagement/accounting/batch/?$', accounting_views.ServiceRecordBatchCollection(permitted_methods=('POST',))),
     url(r'^charging/api/orderManagement/accounting/refresh/?$', accounting_views.SDRRefreshCollection(permitted_methods=('POST',))),
     url(r'^charging/api/reportManagement/created/?$', reports_views.ReportReceiver(permitted_methods=('POST',)))
 )